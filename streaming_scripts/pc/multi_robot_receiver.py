@@ -0,0 +1,709 @@
+"""
+multi_robot_receiver.py - Receive RTP video and audio from a fleet of robots on one PC
+
+open_video_stream.sh and open_audio_stream.sh handle one robot on one fixed port.
+This asyncio service listens for many robots at once (each robot streams to its own
+ports, e.g. VIDEO_UDP_PORT=5010 / AUDIO_UDP_PORT=5012 on turtlebot2). For every
+stream it keeps:
+
+* loss, interarrival jitter (RFC 3550), bitrate and reordering statistics
+* a jitter buffer that puts packets back in order before they're used
+* an optional stream-copy recording (H.264 Annex B for video, Ogg Opus for audio)
+* a GStreamer decoder that only runs while someone is watching the stream
+
+Streams that nobody watches or records only pay for the statistics.
+
+Usage:
+    python3 multi_robot_receiver.py --robot turtlebot1:5000:5002 --robot turtlebot2:5010:5012
+
+    # Control it from another terminal (one JSON reply per command)
+    echo "watch turtlebot2 video" | nc -q1 127.0.0.1 5100
+    echo "record turtlebot1 audio on" | nc -q1 127.0.0.1 5100
+    echo "stats" | nc -q1 127.0.0.1 5100
+
+    # How many streams can one core take? (synthetic senders on loopback)
+    python3 multi_robot_receiver.py --load-test
+"""
+
+import argparse
+import asyncio
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+VIDEO_CLOCK_RATE = 90000
+AUDIO_CLOCK_RATE = 48000
+DEFAULT_CONTROL_PORT = 5100
+DEFAULT_JITTER_BUFFER_MS = 50.0
+
+VIDEO_CAPS = "application/x-rtp,media=(string)video,clock-rate=(int)90000,encoding-name=(string)H264,payload=(int)96"
+AUDIO_CAPS = "application/x-rtp,media=(string)audio,clock-rate=(int)48000,encoding-name=(string)OPUS,payload=(int)96"
+VIEWER_PIPELINES = {
+    "video": "rtph264depay ! h264parse ! avdec_h264 ! videoconvert ! autovideosink sync=false",
+    "audio": "rtpopusdepay ! opusdec ! audioconvert ! audioresample ! autoaudiosink",
+}
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default}.", file=sys.stderr)
+        return default
+
+
+class JitterBuffer:
+    def __init__(self, delay: float):
+        """Reorder packets; a gap is waited on for at most `delay` seconds."""
+        self.delay = delay
+        self._heap: List[Tuple[int, float, bytes]] = []
+        self.next_sequence: Optional[int] = None
+        self.late = 0
+        self.skipped = 0
+
+    def reset(self):
+        """Forget the position; the next packet starts a new run."""
+        self._heap = []
+        self.next_sequence = None
+
+    def push(self, sequence: int, packet: bytes, now: float):
+        heapq.heappush(self._heap, (sequence, now, packet))
+
+    def pop_ready(self, now: float) -> List[bytes]:
+        ready = []
+        while self._heap:
+            sequence, arrival, packet = self._heap[0]
+            if self.next_sequence is not None and sequence < self.next_sequence:
+                heapq.heappop(self._heap)
+                self.late += 1
+                continue
+            in_order = sequence == self.next_sequence
+            if not in_order and arrival + self.delay > now:
+                break
+            heapq.heappop(self._heap)
+            if self.next_sequence is not None and not in_order:
+                self.skipped += sequence - self.next_sequence
+            ready.append(packet)
+            self.next_sequence = sequence + 1
+        return ready
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class H264Recorder:
+    """Depacketize RTP H.264 (single NAL, STAP-A, FU-A) into an Annex B file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb")
+        self._fragment: Optional[bytearray] = None
+
+    def write(self, packet: bytes):
+        payload = rtp_payload(packet)
+        if not payload:
+            return
+        nal_type = payload[0] & 0x1F
+        if nal_type == 24:  # STAP-A
+            offset = 1
+            while offset + 2 <= len(payload):
+                size = struct.unpack("!H", payload[offset : offset + 2])[0]
+                self._write_nal(payload[offset + 2 : offset + 2 + size])
+                offset += 2 + size
+        elif nal_type == 28:  # FU-A
+            fu_header = payload[1]
+            if fu_header & 0x80:
+                self._fragment = bytearray([(payload[0] & 0xE0) | (fu_header & 0x1F)])
+            if self._fragment is not None:
+                self._fragment += payload[2:]
+                if fu_header & 0x40:
+                    self._write_nal(bytes(self._fragment))
+                    self._fragment = None
+        else:
+            self._write_nal(payload)
+
+    def _write_nal(self, nal: bytes):
+        self.file.write(b"\x00\x00\x00\x01" + nal)
+
+    def close(self):
+        self.file.close()
+
+
+def _ogg_crc_table() -> List[int]:
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+OGG_CRC_TABLE = _ogg_crc_table()
+
+
+def opus_packet_samples(packet: bytes) -> int:
+    """Samples at 48 kHz in an Opus packet, from its TOC byte (RFC 6716 3.1)."""
+    if not packet:
+        return 0
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame = (480, 960, 1920, 2880)[config & 3]
+    elif config < 16:
+        frame = (480, 960)[config & 1]
+    else:
+        frame = (120, 240, 480, 960)[config & 3]
+    code = toc & 3
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frame * frames
+
+
+class OggOpusRecorder:
+    """Write RTP Opus payloads unchanged into an Ogg Opus file (RFC 7845)."""
+
+    def __init__(self, path: str, channels: int = 1):
+        self.path = path
+        self.file = open(path, "wb")
+        self.serial = random.getrandbits(32)
+        self.page_sequence = 0
+        self.granule = 0
+        self._last: Optional[bytes] = None  # Held back to be the end-of-stream page
+        head = b"OpusHead" + struct.pack("<BBHIhB", 1, channels, 312, 48000, 0, 0)
+        tags = b"OpusTags" + struct.pack("<I", 5) + b"rpiav" + struct.pack("<I", 0)
+        self._page(head, 0, header_type=0x02)
+        self._page(tags, 0)
+
+    def write(self, packet: bytes):
+        payload = rtp_payload(packet)
+        if not payload:
+            return
+        if self._last is not None:
+            self._page(self._last, self.granule)
+        self.granule += opus_packet_samples(payload)
+        self._last = payload
+
+    def _page(self, data: bytes, granule: int, header_type: int = 0):
+        lacing = [255] * (len(data) // 255) + [len(data) % 255] if data else []
+        header = struct.pack(
+            "<4sBBqIIIB",
+            b"OggS",
+            0,
+            header_type,
+            granule,
+            self.serial,
+            self.page_sequence,
+            0,
+            len(lacing),
+        ) + bytes(lacing)
+        page = bytearray(header + data)
+        crc = 0
+        for byte in page:
+            crc = ((crc << 8) & 0xFFFFFFFF) ^ OGG_CRC_TABLE[(crc >> 24) ^ byte]
+        page[22:26] = struct.pack("<I", crc)
+        self.file.write(page)
+        self.page_sequence += 1
+
+    def close(self):
+        # RFC 7845: the last page carries the end-of-stream flag
+        self._page(self._last or b"", self.granule, header_type=0x04)
+        self.file.close()
+
+
+def rtp_payload(packet: bytes) -> bytes:
+    """RTP payload with CSRCs, header extension and padding removed."""
+    if len(packet) < 12:
+        return b""
+    first = packet[0]
+    offset = 12 + 4 * (first & 0x0F)
+    if first & 0x10 and len(packet) >= offset + 4:
+        offset += 4 + 4 * struct.unpack("!H", packet[offset + 2 : offset + 4])[0]
+    end = len(packet)
+    if first & 0x20:
+        end -= packet[-1]
+    return packet[offset:end]
+
+
+class RtpStream(asyncio.DatagramProtocol):
+    def __init__(
+        self,
+        robot: str,
+        kind: str,
+        port: int,
+        clock_rate: int,
+        jitter_buffer_ms: float,
+        record_dir: str,
+    ):
+        self.robot = robot
+        self.kind = kind
+        self.port = port
+        self.clock_rate = clock_rate
+        self.record_dir = record_dir
+        self.jitter_buffer = JitterBuffer(jitter_buffer_ms / 1000)
+        self.recorder = None
+        self.viewer: Optional[subprocess.Popen] = None
+        self.viewer_sock: Optional[socket.socket] = None
+        self._reset()
+
+    def _reset(self, ssrc: Optional[int] = None):
+        self.ssrc = ssrc
+        self.received = 0
+        self.bytes = 0
+        self.base_sequence: Optional[int] = None
+        self.highest: Optional[int] = None
+        self.jitter = 0.0
+        self.duplicates = 0
+        self.reordered = 0
+        self._last_transit: Optional[float] = None
+        self._window_bytes = 0
+        self._window_start = time.monotonic()
+        self.bitrate_kbps = 0.0
+        self.last_packet: Optional[float] = None
+
+    @property
+    def active(self) -> bool:
+        """Packets only need buffering when something consumes them."""
+        return self.recorder is not None or self.viewer_sock is not None
+
+    def datagram_received(self, packet: bytes, addr):
+        if len(packet) < 12 or packet[0] >> 6 != 2:
+            return
+        now = time.monotonic()
+        sequence, timestamp, ssrc = struct.unpack("!HII", packet[2:12])
+        if ssrc != self.ssrc:
+            self._reset(ssrc)  # Robot restarted its stream
+            self.jitter_buffer = JitterBuffer(self.jitter_buffer.delay)
+
+        if self.highest is None:
+            extended = sequence
+            self.base_sequence = sequence
+            self.highest = sequence
+        else:
+            extended = (self.highest & ~0xFFFF) | sequence
+            if extended - self.highest > 0x8000:
+                extended -= 0x10000
+            elif self.highest - extended > 0x8000:
+                extended += 0x10000
+            if extended > self.highest:
+                self.highest = extended
+            else:
+                self.reordered += 1
+
+        # RFC 3550 interarrival jitter, in timestamp units
+        transit = now * self.clock_rate - timestamp
+        if self._last_transit is not None:
+            delta = abs(transit - self._last_transit)
+            if delta < self.clock_rate:  # Ignore timestamp jumps on stream restarts
+                self.jitter += (delta - self.jitter) / 16
+        self._last_transit = transit
+
+        self.received += 1
+        self.bytes += len(packet)
+        self._window_bytes += len(packet)
+        self.last_packet = now
+        if now - self._window_start >= 1.0:
+            self.bitrate_kbps = (
+                self._window_bytes * 8 / (now - self._window_start) / 1000
+            )
+            self._window_bytes = 0
+            self._window_start = now
+
+        if self.active:
+            self.jitter_buffer.push(extended, packet, now)
+            self.release(now)
+
+    def release(self, now: float):
+        for packet in self.jitter_buffer.pop_ready(now):
+            if self.recorder:
+                self.recorder.write(packet)
+            if self.viewer_sock:
+                try:
+                    self.viewer_sock.send(packet)
+                except ConnectionRefusedError:
+                    pass  # Decoder still starting
+
+    def _attach(self):
+        """A consumer is being added; if none was, the buffer's position is stale."""
+        if not self.active:
+            self.jitter_buffer.reset()
+
+    def watch(self) -> str:
+        if self.viewer:
+            return "already watching"
+        self._attach()
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(("127.0.0.1", 0))
+        viewer_port = probe.getsockname()[1]
+        probe.close()
+        caps = VIDEO_CAPS if self.kind == "video" else AUDIO_CAPS
+        pipeline = f'udpsrc address=127.0.0.1 port={viewer_port} caps="{caps}" ! {VIEWER_PIPELINES[self.kind]}'
+        self.viewer = subprocess.Popen(
+            ["gst-launch-1.0", "-q", *shlex.split(pipeline)],
+            stdout=subprocess.DEVNULL,
+        )
+        self.viewer_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.viewer_sock.connect(("127.0.0.1", viewer_port))
+        return f"decoding on 127.0.0.1:{viewer_port}"
+
+    def unwatch(self) -> str:
+        if not self.viewer:
+            return "not watching"
+        self.viewer.terminate()
+        self.viewer.wait()
+        self.viewer = None
+        self.viewer_sock.close()
+        self.viewer_sock = None
+        return "stopped"
+
+    def record(self, enabled: bool) -> str:
+        if enabled and not self.recorder:
+            self._attach()
+            os.makedirs(self.record_dir, exist_ok=True)
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            if self.kind == "video":
+                path = os.path.join(self.record_dir, f"{self.robot}-{stamp}.h264")
+                self.recorder = H264Recorder(path)
+            else:
+                path = os.path.join(self.record_dir, f"{self.robot}-{stamp}.opus")
+                self.recorder = OggOpusRecorder(path)
+            return f"recording to {path}"
+        if not enabled and self.recorder:
+            self.recorder.close()
+            path, self.recorder = self.recorder.path, None
+            return f"saved {path}"
+        return "unchanged"
+
+    def stats(self) -> dict:
+        expected = (
+            self.highest - self.base_sequence + 1 if self.highest is not None else 0
+        )
+        lost = max(expected - self.received, 0)
+        idle = time.monotonic() - self.last_packet if self.last_packet else None
+        return {
+            "port": self.port,
+            "packets": self.received,
+            "lost": lost,
+            "loss_percent": round(100 * lost / expected, 2) if expected else 0.0,
+            "jitter_ms": round(1000 * self.jitter / self.clock_rate, 2),
+            "bitrate_kbps": round(self.bitrate_kbps, 1),
+            "reordered": self.reordered,
+            "late": self.jitter_buffer.late,
+            "skipped": self.jitter_buffer.skipped,
+            "idle_seconds": round(idle, 1) if idle is not None else None,
+            "watching": self.viewer is not None,
+            "recording": self.recorder.path if self.recorder else None,
+        }
+
+    def close(self):
+        self.unwatch()
+        self.record(False)
+
+
+class FleetReceiver:
+    def __init__(self, jitter_buffer_ms: float, record_dir: str):
+        self.jitter_buffer_ms = jitter_buffer_ms
+        self.record_dir = record_dir
+        self.streams: Dict[Tuple[str, str], RtpStream] = {}
+        self.transports = []
+
+    async def add_stream(self, robot: str, kind: str, port: int) -> RtpStream:
+        clock_rate = VIDEO_CLOCK_RATE if kind == "video" else AUDIO_CLOCK_RATE
+        stream = RtpStream(
+            robot, kind, port, clock_rate, self.jitter_buffer_ms, self.record_dir
+        )
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: stream, local_addr=("0.0.0.0", port)
+        )
+        sock = transport.get_extra_info("socket")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.transports.append(transport)
+        self.streams[(robot, kind)] = stream
+        return stream
+
+    async def release_loop(self):
+        """Flush jitter buffers whose gaps have timed out, even without new packets."""
+        while True:
+            await asyncio.sleep(0.005)
+            now = time.monotonic()
+            for stream in self.streams.values():
+                if stream.active and len(stream.jitter_buffer):
+                    stream.release(now)
+
+    def stats(self) -> dict:
+        fleet: Dict[str, dict] = {}
+        for (robot, kind), stream in self.streams.items():
+            fleet.setdefault(robot, {})[kind] = stream.stats()
+        return fleet
+
+    def command(self, line: str) -> dict:
+        words = line.split()
+        if not words:
+            return {"error": "empty command"}
+        if words[0] == "stats":
+            return self.stats()
+        if words[0] == "list":
+            return {
+                "streams": [f"{robot} {kind}" for robot, kind in self.streams.keys()]
+            }
+        if len(words) < 3 or (words[1], words[2]) not in self.streams:
+            return {"error": "usage: watch|unwatch|record ROBOT video|audio [on|off]"}
+        stream = self.streams[(words[1], words[2])]
+        if words[0] == "watch":
+            return {"result": stream.watch()}
+        if words[0] == "unwatch":
+            return {"result": stream.unwatch()}
+        if words[0] == "record":
+            enabled = len(words) < 4 or words[3] == "on"
+            return {"result": stream.record(enabled)}
+        return {"error": f"unknown command '{words[0]}'"}
+
+    async def handle_control(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = self.command(line.decode(errors="replace"))
+                writer.write((json.dumps(reply) + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def close(self):
+        for stream in self.streams.values():
+            stream.close()
+        for transport in self.transports:
+            transport.close()
+
+
+def parse_robot(spec: str) -> Tuple[str, int, Optional[int]]:
+    parts = spec.split(":")
+    if len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError(
+            f"'{spec}' should be NAME:VIDEO_PORT or NAME:VIDEO_PORT:AUDIO_PORT"
+        )
+    audio_port = int(parts[2]) if len(parts) == 3 and parts[2] else None
+    return parts[0], int(parts[1]), audio_port
+
+
+async def run_service(args):
+    fleet = FleetReceiver(args.jitter_buffer_ms, args.record_dir)
+    for robot, video_port, audio_port in args.robot:
+        await fleet.add_stream(robot, "video", video_port)
+        if audio_port:
+            await fleet.add_stream(robot, "audio", audio_port)
+        print(
+            f"{robot}: video on {video_port}"
+            + (f", audio on {audio_port}" if audio_port else "")
+        )
+    for robot in args.record:
+        for kind in ("video", "audio"):
+            if (robot, kind) in fleet.streams:
+                print(fleet.command(f"record {robot} {kind} on")["result"])
+    for robot in args.watch:
+        print(fleet.command(f"watch {robot} video")["result"])
+
+    server = await asyncio.start_server(
+        fleet.handle_control, "127.0.0.1", args.control_port
+    )
+    print(f"Control commands on 127.0.0.1:{args.control_port}")
+    release_task = asyncio.create_task(fleet.release_loop())
+    try:
+        while True:
+            await asyncio.sleep(args.stats_interval)
+            for robot, kinds in fleet.stats().items():
+                for kind, stats in kinds.items():
+                    print(
+                        f"{robot:>12} {kind}: {stats['bitrate_kbps']:8.1f} kbps  "
+                        f"loss {stats['loss_percent']:5.2f}%  jitter {stats['jitter_ms']:6.2f} ms",
+                        flush=True,
+                    )
+    finally:
+        release_task.cancel()
+        server.close()
+        fleet.close()
+
+
+def synthetic_sender(
+    ports: List[int], packets_per_second: int, duration: float, result
+):
+    """Send fake RTP at a fixed rate to each port (runs in its own process)."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    payload = os.urandom(1188)
+    ssrcs = [random.getrandbits(32) for _ in ports]
+    interval = 1 / packets_per_second
+    start = time.monotonic()
+    sent = 0
+    tick = 0
+    while time.monotonic() - start < duration:
+        for index, port in enumerate(ports):
+            header = struct.pack(
+                "!BBHII",
+                0x80,
+                96,
+                tick & 0xFFFF,
+                tick * 3000 & 0xFFFFFFFF,
+                ssrcs[index],
+            )
+            try:
+                sock.sendto(header + payload, ("127.0.0.1", port))
+                sent += 1
+            except OSError:
+                pass
+        tick += 1
+        delay = start + tick * interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    result.put(sent)
+
+
+async def run_load_step(streams: int, args) -> dict:
+    fleet = FleetReceiver(args.jitter_buffer_ms, args.record_dir)
+    ports = [args.load_test_base_port + i for i in range(streams)]
+    for i, port in enumerate(ports):
+        stream = await fleet.add_stream(f"synthetic{i}", "video", port)
+        if args.load_test_buffered:
+            # Exercise the jitter buffer as if every stream were watched
+            stream.viewer_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            stream.viewer_sock.connect(("127.0.0.1", 9))
+    release_task = asyncio.create_task(fleet.release_loop())
+
+    workers = max(1, min((os.cpu_count() or 2) - 1, streams))
+    result = multiprocessing.Queue()
+    senders = [
+        multiprocessing.Process(
+            target=synthetic_sender,
+            args=(
+                ports[i::workers],
+                args.load_test_pps,
+                args.load_test_seconds,
+                result,
+            ),
+        )
+        for i in range(workers)
+    ]
+    for sender in senders:
+        sender.start()
+    await asyncio.sleep(0.5)  # Let the senders get going before measuring
+    cpu_start, wall_start = time.process_time(), time.monotonic()
+    await asyncio.sleep(args.load_test_seconds - 1.0)
+    cpu = (time.process_time() - cpu_start) / (time.monotonic() - wall_start)
+    for sender in senders:
+        sender.join()
+    sent = sum(result.get() for _ in senders)
+    await asyncio.sleep(0.2)
+    received = sum(s.received for s in fleet.streams.values())
+    release_task.cancel()
+    for stream in fleet.streams.values():
+        if stream.viewer_sock:
+            stream.viewer_sock.close()
+        stream.viewer_sock = None
+    fleet.close()
+    await asyncio.sleep(0.1)  # Let the transports release their ports
+    return {
+        "streams": streams,
+        "packets_per_second": streams * args.load_test_pps,
+        "cpu_percent": round(100 * cpu, 1),
+        "loss_percent": round(100 * max(sent - received, 0) / max(sent, 1), 2),
+    }
+
+
+async def run_load_test(args):
+    print(
+        f"Load test: {args.load_test_pps} packets/s per stream (~{args.load_test_pps * 1200 * 8 // 1000} kbps), "
+        f"{'jitter-buffered' if args.load_test_buffered else 'statistics only'}"
+    )
+    print(f"{'streams':>8} {'packets/s':>10} {'cpu %':>7} {'loss %':>7}")
+    capacity = 0
+    streams = 1
+    while streams <= args.load_test_max_streams:
+        step = await run_load_step(streams, args)
+        print(
+            f"{step['streams']:>8} {step['packets_per_second']:>10} {step['cpu_percent']:>7} {step['loss_percent']:>7}",
+            flush=True,
+        )
+        if step["cpu_percent"] >= 90 or step["loss_percent"] >= 1:
+            break
+        capacity = streams
+        streams *= 2
+    print(
+        f"One core handles at least {capacity} streams at this rate (CPU < 90%, loss < 1%)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Receive RTP video and audio from many robots at once"
+    )
+    parser.add_argument(
+        "--robot",
+        type=parse_robot,
+        action="append",
+        default=[],
+        help="NAME:VIDEO_PORT[:AUDIO_PORT], repeat for each robot",
+    )
+    parser.add_argument(
+        "--watch", action="append", default=[], help="Robot to start watching"
+    )
+    parser.add_argument(
+        "--record", action="append", default=[], help="Robot to start recording"
+    )
+    parser.add_argument("--record-dir", default="recordings")
+    parser.add_argument(
+        "--jitter-buffer-ms",
+        type=float,
+        default=DEFAULT_JITTER_BUFFER_MS,
+        help=f"How long a gap is waited on before skipping it (default: {DEFAULT_JITTER_BUFFER_MS})",
+    )
+    parser.add_argument("--control-port", type=int, default=DEFAULT_CONTROL_PORT)
+    parser.add_argument("--stats-interval", type=float, default=5.0)
+    parser.add_argument(
+        "--load-test",
+        action="store_true",
+        help="Measure how many synthetic streams one core can receive",
+    )
+    parser.add_argument("--load-test-pps", type=int, default=200)
+    parser.add_argument("--load-test-seconds", type=float, default=4.0)
+    parser.add_argument("--load-test-max-streams", type=int, default=256)
+    parser.add_argument("--load-test-base-port", type=int, default=16000)
+    parser.add_argument(
+        "--load-test-buffered",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Run every synthetic stream through the jitter buffer",
+    )
+    args = parser.parse_args()
+
+    if args.load_test:
+        asyncio.run(run_load_test(args))
+        return
+    if not args.robot:
+        default_video = env_int("VIDEO_UDP_PORT", 5000)
+        default_audio = env_int("AUDIO_UDP_PORT", 5002)
+        args.robot = [("robot", default_video, default_audio)]
+    try:
+        asyncio.run(run_service(args))
+    except KeyboardInterrupt:
+        print("\nStopped.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
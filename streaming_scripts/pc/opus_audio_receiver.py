@@ -0,0 +1,373 @@
+"""
+opus_audio_receiver.py - Play the Pi's Opus audio with FEC recovery and send loss reports back
+
+Receives the RTP Opus stream from streaming_scripts/pi/opus_audio_streamer.py and
+plays it out on a fixed delay (--delay-ms) so it has time to repair the stream:
+
+* A lost frame is rebuilt from the in-band FEC copy in the packet after it, if
+  that packet is already here. If not, the Opus decoder conceals the gap.
+* Gaps the sender left on purpose (silence suppression: the timestamp jumps but
+  the sequence number doesn't) are played as silence, not concealed.
+* Once a second an RTCP receiver report (RFC 3550: fraction lost, cumulative loss,
+  jitter) goes back to the sender, on the socket the audio came from. The
+  sender uses these reports to adapt its bitrate and FEC share.
+
+Decoded 48 kHz mono S16LE goes to a WAV file (--out) and/or stdout (--stdout, for
+aplay or ffplay). Needs libopus (`sudo apt install libopus0`).
+
+Usage:
+    python3 opus_audio_receiver.py [--port 5002] --stdout | aplay -q -f S16_LE -r 48000 -c 1
+    python3 opus_audio_receiver.py --out received.wav
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import math
+import os
+import random
+import select
+import socket
+import struct
+import sys
+import time
+import wave
+from typing import Dict, Optional, Tuple
+
+RATE = 48000
+FRAME_SAMPLES = 960  # 20 ms, what the Pi sends
+RTCP_RECEIVER_REPORT = 201
+REPORT_INTERVAL = 1.0
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default}.", file=sys.stderr)
+        return default
+
+
+def load_libopus():
+    name = ctypes.util.find_library("opus") or "libopus.so.0"
+    try:
+        lib = ctypes.CDLL(name)
+    except OSError as e:
+        raise OSError(
+            f"libopus not found ({e}); install it with: sudo apt install libopus0"
+        ) from e
+    lib.opus_decoder_create.restype = ctypes.c_void_p
+    lib.opus_decoder_create.argtypes = [
+        ctypes.c_int32,
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int),
+    ]
+    lib.opus_decode.restype = ctypes.c_int
+    lib.opus_decode.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        ctypes.c_int32,
+        ctypes.POINTER(ctypes.c_int16),
+        ctypes.c_int,
+        ctypes.c_int,
+    ]
+    lib.opus_decoder_destroy.argtypes = [ctypes.c_void_p]
+    if hasattr(lib, "opus_packet_has_lbrr"):  # libopus 1.5 and later
+        lib.opus_packet_has_lbrr.restype = ctypes.c_int
+        lib.opus_packet_has_lbrr.argtypes = [ctypes.c_char_p, ctypes.c_int32]
+    return lib
+
+
+class OpusDecoder:
+    def __init__(self, rate: int = RATE, channels: int = 1):
+        self.lib = load_libopus()
+        error = ctypes.c_int()
+        self.state = self.lib.opus_decoder_create(rate, channels, ctypes.byref(error))
+        if error.value != 0:
+            raise OSError(f"opus_decoder_create failed ({error.value})")
+        self._pcm = (ctypes.c_int16 * (FRAME_SAMPLES * channels * 6))()
+
+    def decode(self, payload: Optional[bytes], fec: bool = False) -> bytes:
+        """One 20 ms frame; payload None conceals, fec=True decodes the FEC copy."""
+        samples = self.lib.opus_decode(
+            self.state,
+            payload,
+            len(payload) if payload else 0,
+            self._pcm,
+            FRAME_SAMPLES,
+            int(fec),
+        )
+        if samples < 0:
+            return bytes(FRAME_SAMPLES * 2)
+        return bytes(memoryview(self._pcm).cast("B")[: samples * 2])
+
+    def has_fec(self, payload: bytes) -> bool:
+        """Whether the packet carries an FEC copy (assumed yes on libopus < 1.5)."""
+        if not hasattr(self.lib, "opus_packet_has_lbrr"):
+            return True
+        return self.lib.opus_packet_has_lbrr(payload, len(payload)) > 0
+
+
+class OpusPlayout:
+    def __init__(self, decoder: OpusDecoder, delay: float):
+        """Play frames in timestamp order, `delay` seconds behind their arrival."""
+        self.decoder = decoder
+        self.delay = delay
+        self.buffer: Dict[int, Tuple[int, bytes]] = (
+            {}
+        )  # timestamp -> (sequence, payload)
+        self.next_ts: Optional[int] = None
+        self.base: Tuple[float, int] = (0.0, 0)  # (play time, timestamp)
+        self.last_played_seq: Optional[int] = None
+        self._last_ts_raw: Optional[int] = None
+        self._ts_ext = 0
+        self.stats = {
+            "frames_played": 0,
+            "fec_recovered": 0,
+            "concealed": 0,
+            "dtx_frames": 0,
+            "late_packets": 0,
+            "resyncs": 0,
+        }
+
+    def _extend_ts(self, timestamp: int) -> int:
+        if self._last_ts_raw is not None:
+            delta = (timestamp - self._last_ts_raw) & 0xFFFFFFFF
+            self._ts_ext += delta - (1 << 32) if delta >= 1 << 31 else delta
+        else:
+            self._ts_ext = timestamp
+        self._last_ts_raw = timestamp
+        return self._ts_ext
+
+    def push(self, sequence: int, timestamp: int, payload: bytes, now: float):
+        timestamp = self._extend_ts(timestamp)
+        ahead = None if self.next_ts is None else timestamp - self.next_ts
+        if ahead is None or ahead > 2 * RATE or ahead < -RATE:
+            # First packet, or the sender restarted: start a new timeline
+            if self.next_ts is not None:
+                self.stats["resyncs"] += 1
+            self.buffer.clear()
+            self.next_ts = timestamp
+            self.base = (now + self.delay, timestamp)
+            self.last_played_seq = None
+        elif ahead < 0:
+            self.stats["late_packets"] += 1
+            return
+        self.buffer[timestamp] = (sequence, payload)
+
+    def due(self) -> Optional[float]:
+        if self.next_ts is None:
+            return None
+        return self.base[0] + (self.next_ts - self.base[1]) / RATE
+
+    def pop_ready(self, now: float) -> bytes:
+        """PCM for every frame whose play time has come."""
+        pcm = b""
+        while self.next_ts is not None and now >= self.due():
+            pcm += self._play(self.next_ts)
+            self.next_ts += FRAME_SAMPLES
+            self.stats["frames_played"] += 1
+        return pcm
+
+    def _play(self, timestamp: int) -> bytes:
+        entry = self.buffer.pop(timestamp, None)
+        if entry:
+            self.last_played_seq = entry[0]
+            return self.decoder.decode(entry[1])
+        later = [ts for ts in self.buffer if ts > timestamp]
+        if not later:
+            self.stats["dtx_frames"] += 1  # Nothing after it yet: silence
+            return bytes(FRAME_SAMPLES * 2)
+        next_ts = min(later)
+        next_seq, next_payload = self.buffer[next_ts]
+        if (
+            self.last_played_seq is not None
+            and next_seq == (self.last_played_seq + 1) & 0xFFFF
+        ):
+            self.stats["dtx_frames"] += 1  # Nothing was sent for this frame
+            return bytes(FRAME_SAMPLES * 2)
+        if next_ts == timestamp + FRAME_SAMPLES and self.decoder.has_fec(next_payload):
+            self.stats["fec_recovered"] += 1
+            return self.decoder.decode(next_payload, fec=True)
+        self.stats["concealed"] += 1
+        return self.decoder.decode(None)
+
+
+class ReceptionReport:
+    def __init__(self):
+        """RFC 3550 receiver statistics for one source."""
+        self.ssrc: Optional[int] = None
+        self.base_seq = 0
+        self.max_seq = 0
+        self.cycles = 0
+        self.received = 0
+        self.expected_prior = 0
+        self.received_prior = 0
+        self.jitter = 0.0
+        self._transit: Optional[float] = None
+
+    def on_packet(self, ssrc: int, sequence: int, timestamp: int, now: float):
+        if ssrc != self.ssrc:
+            self.__init__()
+            self.ssrc = ssrc
+            self.base_seq = self.max_seq = sequence
+        elif 0 < (sequence - self.max_seq) & 0xFFFF < 0x8000:
+            if sequence < self.max_seq:
+                self.cycles += 1 << 16
+            self.max_seq = sequence
+        self.received += 1
+        transit = now * RATE - timestamp
+        if self._transit is not None:
+            self.jitter += (abs(transit - self._transit) - self.jitter) / 16
+        self._transit = transit
+
+    @property
+    def expected(self) -> int:
+        return self.cycles + self.max_seq - self.base_seq + 1
+
+    @property
+    def lost(self) -> int:
+        return self.expected - self.received
+
+    def build(self, own_ssrc: int) -> bytes:
+        expected_interval = self.expected - self.expected_prior
+        lost_interval = expected_interval - (self.received - self.received_prior)
+        self.expected_prior, self.received_prior = self.expected, self.received
+        fraction = 0
+        if expected_interval > 0 and lost_interval > 0:
+            fraction = min(255, (lost_interval << 8) // expected_interval)
+        cumulative = max(-(1 << 23), min((1 << 23) - 1, self.lost)) & 0xFFFFFF
+        return struct.pack(
+            "!BBHIIIIIII",
+            0x81,
+            RTCP_RECEIVER_REPORT,
+            7,
+            own_ssrc,
+            self.ssrc,
+            (fraction << 24) | cumulative,
+            self.cycles + self.max_seq,
+            int(self.jitter),
+            0,  # No sender reports, so no round-trip fields
+            0,
+        )
+
+
+def is_rtcp(packet: bytes) -> bool:
+    """RFC 5761 demultiplexing: RTCP packet types occupy 192-223 in the second byte."""
+    return 192 <= packet[1] <= 223
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Receive the Pi's Opus RTP audio with FEC recovery and loss reports"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=env_int("AUDIO_UDP_PORT", 5002),
+        help="Port the Pi sends audio to (env: AUDIO_UDP_PORT)",
+    )
+    parser.add_argument(
+        "--delay-ms", type=float, default=60.0, help="Playout delay (jitter buffer)"
+    )
+    parser.add_argument("--out", type=str, help="Write the decoded audio to this WAV")
+    parser.add_argument(
+        "--stdout", action="store_true", help="Write raw S16LE 48 kHz mono to stdout"
+    )
+    parser.add_argument(
+        "--feedback-to",
+        type=str,
+        help="HOST:PORT for receiver reports (default: where the audio comes from)",
+    )
+    parser.add_argument(
+        "--stats-interval", type=float, default=5.0, help="Seconds between stats"
+    )
+    args = parser.parse_args()
+
+    try:
+        playout = OpusPlayout(OpusDecoder(), args.delay_ms / 1000)
+    except OSError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    report = ReceptionReport()
+    own_ssrc = random.getrandbits(32)
+    feedback_to = None
+    if args.feedback_to:
+        host, _, port = args.feedback_to.rpartition(":")
+        feedback_to = (host, int(port))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("0.0.0.0", args.port))
+    wav = None
+    if args.out:
+        wav = wave.open(args.out, "wb")
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(RATE)
+    log = sys.stderr if args.stdout else sys.stdout
+    print(f"Receiving Opus audio on {args.port}", file=log)
+
+    sender_address = None
+    bytes_received = 0
+    level_sum, level_count = 0.0, 0
+    started = time.monotonic()
+    next_report = started + REPORT_INTERVAL
+    next_stats = started + args.stats_interval
+
+    def stats() -> dict:
+        elapsed = time.monotonic() - started
+        level = 10 * math.log10(level_sum / level_count) if level_sum else -99.0
+        return {
+            **playout.stats,
+            "packets": report.received,
+            "lost": report.lost if report.ssrc is not None else 0,
+            "jitter_ms": round(report.jitter * 1000 / RATE, 1),
+            "kbps": round(bytes_received * 8 / 1000 / elapsed, 1) if elapsed else 0.0,
+            "level_dbfs": round(level, 1),
+        }
+
+    try:
+        while True:
+            now = time.monotonic()
+            due = playout.due()
+            timeout = 0.02 if due is None else max(0.0, min(0.02, due - now))
+            readable, _, _ = select.select([sock], [], [], timeout)
+            now = time.monotonic()
+            if readable:
+                packet, address = sock.recvfrom(2048)
+                if len(packet) > 12 and packet[0] >> 6 == 2 and not is_rtcp(packet):
+                    sequence, timestamp, ssrc = struct.unpack("!HII", packet[2:12])
+                    sender_address = address
+                    bytes_received += len(packet)
+                    report.on_packet(ssrc, sequence, timestamp, now)
+                    playout.push(sequence, timestamp, packet[12:], now)
+            pcm = playout.pop_ready(now)
+            if pcm:
+                samples = memoryview(pcm).cast("h")
+                level_sum += sum(s * s for s in samples) / len(samples) / 32768**2
+                level_count += 1
+                if wav:
+                    wav.writeframes(pcm)
+                if args.stdout:
+                    sys.stdout.buffer.write(pcm)
+                    sys.stdout.buffer.flush()
+            if now >= next_report:
+                next_report += REPORT_INTERVAL
+                destination = feedback_to or sender_address
+                if destination and report.ssrc is not None:
+                    sock.sendto(report.build(own_ssrc), destination)
+            if now >= next_stats:
+                next_stats += args.stats_interval
+                print(f"Opus receiver stats: {stats()}", file=log, flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if wav:
+            wav.close()
+        print(f"Opus receiver stats: {stats()}", file=log, flush=True)
+
+
+if __name__ == "__main__":
+    main()
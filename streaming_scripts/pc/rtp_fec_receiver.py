@@ -0,0 +1,280 @@
+"""
+rtp_fec_receiver.py - Repair the Pi's FEC-protected RTP video and hand it to GStreamer
+
+Receives the H.264 RTP stream and its XOR parity packets (sent by the Pi with --fec,
+see streaming_scripts/pi/rtp_fec.py), rebuilds lost packets where a parity group is
+missing only one packet, puts the stream back in sequence order and forwards it to
+a local port for open_video_stream.sh. Packets that can't be recovered within
+--max-delay-ms are skipped so a loss never stalls the picture.
+
+Usage:
+    python3 rtp_fec_receiver.py [--port 5000] [--fec-port 5001] [--forward-port 5010]
+    VIDEO_UDP_PORT=5010 ./open_video_stream.sh
+"""
+
+import argparse
+import os
+import select
+import socket
+import struct
+import sys
+import time
+from typing import Dict, List, Optional, Set
+
+MAX_MASK_OFFSET = 47
+HISTORY_PACKETS = 1024  # Forwarded packets kept to help recover their group
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default}.", file=sys.stderr)
+        return default
+
+
+def xor_bytes(a: bytes, b: bytes) -> bytes:
+    """XOR two byte strings, padding the shorter one with zeros."""
+    if len(a) < len(b):
+        a, b = b, a
+    result = int.from_bytes(a, "big") ^ int.from_bytes(b.ljust(len(a), b"\0"), "big")
+    return result.to_bytes(len(a), "big")
+
+
+class FecPacket:
+    def __init__(self, packet: bytes, sn_base_ext: int):
+        """Parse an RFC 5109 FEC packet (level 0 only)."""
+        self.ssrc = struct.unpack("!I", packet[8:12])[0]
+        first, second, _, self.ts_xor, self.length_xor = struct.unpack(
+            "!BBHIH", packet[12:22]
+        )
+        self.bits_xor = ((first & 0x3F) << 8) | second
+        long_mask = bool(first & 0x40)
+        protection_length = struct.unpack("!H", packet[22:24])[0]
+        mask_bytes = 6 if long_mask else 2
+        mask = int.from_bytes(packet[24 : 24 + mask_bytes], "big")
+        mask_bits = mask_bytes * 8
+        self.sequences = [
+            sn_base_ext + offset
+            for offset in range(mask_bits)
+            if mask & (1 << (mask_bits - 1 - offset))
+        ]
+        start = 24 + mask_bytes
+        self.payload_xor = packet[start : start + protection_length]
+
+
+class FecReceiver:
+    def __init__(self, forward_sock: socket.socket, max_delay: float):
+        self.forward_sock = forward_sock
+        self.max_delay = max_delay
+        # Recent packets by extended sequence, forwarded or not; recovery needs both
+        self.media: Dict[int, bytes] = {}
+        self.pending_fec: List[FecPacket] = []
+        # Rebuilt packets whose original may still turn up, only reordered or late
+        self.rebuilt: Set[int] = set()
+        self.highest: Optional[int] = None
+        self.next_expected: Optional[int] = None
+        self.gap_since: Optional[float] = None
+        self.stats = {
+            "media_received": 0,
+            "fec_received": 0,
+            "recovered": 0,
+            "unrecovered": 0,
+            "duplicates": 0,
+            "forwarded": 0,
+        }
+
+    def _extend(self, sequence: int) -> int:
+        """Unwrap a 16-bit sequence number relative to the highest seen."""
+        if self.highest is None:
+            return sequence
+        candidate = (self.highest & ~0xFFFF) | sequence
+        if candidate - self.highest > 0x8000:
+            candidate -= 0x10000
+        elif self.highest - candidate > 0x8000:
+            candidate += 0x10000
+        return candidate
+
+    def on_media(self, packet: bytes):
+        sequence = self._extend(struct.unpack("!H", packet[2:4])[0])
+        if sequence in self.rebuilt:
+            # Not lost after all: the rebuilt copy stands, but it wasn't a recovery
+            self.rebuilt.discard(sequence)
+            self.stats["recovered"] -= 1
+            self.stats["media_received"] += 1
+            return
+        if sequence in self.media or (
+            self.next_expected is not None and sequence < self.next_expected
+        ):
+            self.stats["duplicates"] += 1
+            return
+        self.stats["media_received"] += 1
+        self._store(sequence, packet)
+        self._try_pending()
+        self.flush()
+
+    def on_fec(self, packet: bytes):
+        self.stats["fec_received"] += 1
+        if self.highest is None:
+            return
+        fec = FecPacket(packet, self._extend(struct.unpack("!H", packet[14:16])[0]))
+        if not self._try_recover(fec):
+            self.pending_fec.append(fec)
+        self.flush()
+
+    def _store(self, sequence: int, packet: bytes):
+        self.media[sequence] = packet
+        if self.highest is None or sequence > self.highest:
+            self.highest = sequence
+        if self.next_expected is None:
+            self.next_expected = sequence
+
+    def _try_pending(self):
+        self.pending_fec = [fec for fec in self.pending_fec if not self._resolved(fec)]
+
+    def _resolved(self, fec: FecPacket) -> bool:
+        if self._try_recover(fec):
+            return True
+        # Give up on groups that have already been skipped past
+        return fec.sequences[-1] < (self.next_expected or 0)
+
+    def _try_recover(self, fec: FecPacket) -> bool:
+        """Rebuild the one missing packet of a group; True when nothing is left to do."""
+        missing = [s for s in fec.sequences if s not in self.media]
+        if not missing:
+            return True
+        if len(missing) > 1 or missing[0] < (self.next_expected or 0):
+            return False
+        bits, ts, length, payload = (
+            fec.bits_xor,
+            fec.ts_xor,
+            fec.length_xor,
+            fec.payload_xor,
+        )
+        for sequence in fec.sequences:
+            if sequence == missing[0]:
+                continue
+            packet = self.media[sequence]
+            first, second, _, timestamp = struct.unpack("!BBHI", packet[:8])
+            bits ^= ((first & 0x3F) << 8) | second
+            ts ^= timestamp
+            length ^= len(packet) - 12
+            payload = xor_bytes(payload, packet[12:])
+        header = struct.pack(
+            "!BBHII",
+            0x80 | (bits >> 8),
+            bits & 0xFF,
+            missing[0] & 0xFFFF,
+            ts,
+            fec.ssrc,
+        )
+        self._store(missing[0], header + payload[:length])
+        self.rebuilt.add(missing[0])
+        self.stats["recovered"] += 1
+        return True
+
+    def flush(self):
+        """Forward everything that is in order; skip gaps older than max_delay."""
+        if self.next_expected is None:
+            return
+        while True:
+            packet = self.media.get(self.next_expected)
+            if packet is not None:
+                try:
+                    self.forward_sock.send(packet)
+                    self.stats["forwarded"] += 1
+                except ConnectionRefusedError:
+                    pass  # GStreamer isn't listening yet
+                self.next_expected += 1
+                self.gap_since = None
+                continue
+            waiting = [s for s in self.media if s > self.next_expected]
+            if not waiting:
+                self._prune()
+                return
+            now = time.monotonic()
+            if self.gap_since is None:
+                self.gap_since = now
+            if now - self.gap_since < self.max_delay:
+                return
+            next_available = min(waiting)
+            self.stats["unrecovered"] += next_available - self.next_expected
+            self.next_expected = next_available
+            self.gap_since = None
+            self._try_pending()
+
+    def _prune(self):
+        oldest = self.next_expected - HISTORY_PACKETS
+        if self.media and min(self.media) < oldest:
+            self.media = {s: p for s, p in self.media.items() if s >= oldest}
+            self.rebuilt = {s for s in self.rebuilt if s >= oldest}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recover lost RTP packets with the Pi's XOR FEC and forward to GStreamer"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=env_int("VIDEO_UDP_PORT", 5000),
+        help="Port the Pi sends video to (env: VIDEO_UDP_PORT)",
+    )
+    parser.add_argument(
+        "--fec-port", type=int, default=None, help="Parity port (default: port + 1)"
+    )
+    parser.add_argument(
+        "--forward-port",
+        type=int,
+        default=5010,
+        help="Local port for open_video_stream.sh (default: 5010)",
+    )
+    parser.add_argument(
+        "--max-delay-ms",
+        type=float,
+        default=100.0,
+        help="How long to wait for a missing packet before skipping it",
+    )
+    parser.add_argument(
+        "--stats-interval", type=float, default=5.0, help="Seconds between stats"
+    )
+    args = parser.parse_args()
+
+    media_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    media_sock.bind(("0.0.0.0", args.port))
+    fec_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    fec_sock.bind(("0.0.0.0", args.fec_port or args.port + 1))
+    forward_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    forward_sock.connect(("127.0.0.1", args.forward_port))
+
+    receiver = FecReceiver(forward_sock, args.max_delay_ms / 1000)
+    print(
+        f"Receiving on {args.port} (FEC {args.fec_port or args.port + 1}), forwarding to 127.0.0.1:{args.forward_port}"
+    )
+    next_stats = time.monotonic() + args.stats_interval
+    try:
+        while True:
+            readable, _, _ = select.select([media_sock, fec_sock], [], [], 0.01)
+            for sock in readable:
+                packet = sock.recv(65536)
+                if len(packet) < 12:
+                    continue
+                if sock is media_sock:
+                    receiver.on_media(packet)
+                else:
+                    receiver.on_fec(packet)
+            receiver.flush()
+            if time.monotonic() >= next_stats:
+                print(f"FEC stats: {receiver.stats}", flush=True)
+                next_stats += args.stats_interval
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"FEC stats: {receiver.stats}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,591 @@
+"""
+audio_analyzer.py - Microphone levels and simple sound events, on the robot
+
+The audio path used to be a blind pipe from the microphone to the encoders:
+nothing on the robot knew whether the mic was dead, clipping, or hearing
+anything. With --audio-analysis (or AUDIO_ANALYSIS=true), a streaming script
+also analyses the PCM it captures:
+
+* Levels: RMS and peak of every 20 ms block, in dBFS.
+* Clipping: a block with CLIP_SAMPLES or more samples at full scale.
+* Silence: the level stays below --silence-dbfs for --silence-seconds. A
+  silence of exact zeros (a muted or unplugged device) is flagged as such.
+* Sound events: the energy of each band of --audio-bands (env: AUDIO_BANDS;
+  name:low-high in Hz) is followed by its own noise floor. The floor falls
+  fast and rises slowly, like the Opus streamer's voice-activity detector.
+  An event starts when a band stays --audio-event-margin-db above its floor
+  for EVENT_MIN_BLOCKS blocks, and ends after EVENT_HANGOVER_BLOCKS blocks
+  below it. The default bands roughly separate motor rumble, voices, beeps
+  and alarms, and hiss.
+
+The analyser is one more sink of the shared AudioCapture, so it sees the
+same re-timed blocks as the encoders. A block's time is its position in the
+stream, which is the video's time too. It runs in its own thread and reads
+BATCH_BLOCKS blocks at a time. Each batch is analysed with a few vectorised
+NumPy operations, including one windowed FFT of every block. Only the
+per-band event state is stepped block by block. If the thread falls behind,
+the capture drops blocks for it (see AudioCapture.add_sink) and the encoders
+are not held up.
+
+Results go out with the video detections: snapshot() is added to the frame
+bus metadata and to the web viewer's detection messages, under "audio". The
+stats file shows the counters and the recent events under "audio_analysis".
+
+Usage (from a streaming script):
+    analyzer = analyzer_from_args(args, audio_capture)  # None without --audio-analysis
+    ...
+    metadata = {"detections": records}
+    if analyzer:
+        metadata["audio"] = analyzer.snapshot()
+    ...
+    audio_capture.stop()
+    if analyzer:
+        analyzer.close()
+
+    # Events and levels of a recording (or of a generated test scene, checked
+    # against the events it contains), and the CPU used per block
+    python3 audio_analyzer.py analyze [--wav recording.wav]
+    python3 audio_analyzer.py benchmark   # microseconds per block by batch size
+"""
+
+import argparse
+import collections
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+import wave
+from typing import Deque, List, Optional, Tuple
+
+from audio_capture import AudioCapture
+from startup_timing import lazy_import
+
+np = lazy_import("numpy")
+
+DEFAULT_BANDS = "rumble:30-150,voice:250-3000,alarm:3000-8000,hiss:8000-16000"
+DEFAULT_EVENT_MARGIN_DB = 12.0
+DEFAULT_SILENCE_DBFS = -60.0
+DEFAULT_SILENCE_SECONDS = 5.0
+BATCH_BLOCKS = 5  # 100 ms of 20 ms blocks per analysis
+EVENT_MIN_BLOCKS = 2
+EVENT_HANGOVER_BLOCKS = 10
+FLOOR_RISE_DB = 0.05  # Per block, ~2.5 dB/s: follows a rising background
+CLIP_LEVEL = 32700  # Of 32767
+CLIP_SAMPLES = 3
+MIN_DBFS = -120.0  # Reported for digital silence
+RECENT_EVENTS = 20
+
+
+def dbfs(mean_square):
+    """Mean square of samples in [-1, 1] as dBFS (a full-scale sine is -3 dBFS)."""
+    return 10 * np.log10(np.maximum(mean_square, 10 ** (MIN_DBFS / 10)))
+
+
+def parse_bands(text: str, rate: int) -> List[Tuple[str, float, float]]:
+    """name:low-high,... in Hz; bands above the Nyquist frequency are cut to it."""
+    bands = []
+    for item in text.split(","):
+        name, _, span = item.strip().partition(":")
+        low, _, high = span.partition("-")
+        try:
+            low_hz, high_hz = float(low), min(float(high), rate / 2)
+        except ValueError:
+            raise ValueError(f"audio band '{item}' is not name:low-high") from None
+        if not name or low_hz >= high_hz:
+            raise ValueError(
+                f"audio band '{item}' is empty at {rate} Hz (name:low-high, Hz)"
+            )
+        bands.append((name, low_hz, high_hz))
+    return bands
+
+
+class EventTracker:
+    def __init__(
+        self, kind: str, min_blocks: int, hangover_blocks: int, block_seconds: float
+    ):
+        """A condition held for min_blocks starts an event; hangover_blocks without it end it."""
+        self.kind = kind
+        self.min_blocks = min_blocks
+        self.hangover_blocks = hangover_blocks
+        self.block_seconds = block_seconds
+        self.active = False
+        self.count = 0
+        self._run = 0
+        self._quiet = 0
+        self._start = 0.0
+        self._end = 0.0
+        self._wall = 0.0
+        self._peak = MIN_DBFS
+
+    def update(self, condition: bool, t: float, value: float) -> Optional[dict]:
+        """Step one block at stream time t; returns the event that just ended, if any."""
+        if condition:
+            if not self._run and not self.active:
+                self._start, self._wall, self._peak = t, time.time(), value
+            self._run += 1
+            self._quiet = 0
+            self._end = t + self.block_seconds
+            self._peak = max(self._peak, value)
+            if not self.active and self._run >= self.min_blocks:
+                self.active = True
+                self.count += 1
+            return None
+        self._run = 0
+        if not self.active:
+            return None
+        self._quiet += 1
+        if self._quiet < self.hangover_blocks:
+            return None
+        self.active = False
+        return self.finish(self._end)
+
+    def finish(self, end: float) -> dict:
+        """The current event as a record, ending at stream time end."""
+        return {
+            "type": self.kind,
+            "start": round(self._start, 3),
+            "end": round(end, 3),
+            "wall": round(self._wall, 3),
+            "peak": round(self._peak, 1),
+        }
+
+
+class AudioAnalyzer:
+    def __init__(
+        self,
+        rate: int,
+        channels: int = 1,
+        block_frames: Optional[int] = None,
+        bands: str = DEFAULT_BANDS,
+        margin_db: float = DEFAULT_EVENT_MARGIN_DB,
+        silence_dbfs: float = DEFAULT_SILENCE_DBFS,
+        silence_seconds: float = DEFAULT_SILENCE_SECONDS,
+    ):
+        """Analysis of S16LE blocks of block_frames samples (default 20 ms)."""
+        self.rate = rate
+        self.channels = channels
+        self.block_frames = block_frames or rate // 50
+        self.block_bytes = self.block_frames * channels * 2
+        self.block_seconds = self.block_frames / rate
+        self.margin_db = margin_db
+        self.silence_dbfs = silence_dbfs
+        self.bands = parse_bands(bands, rate)
+        self.band_names = [name for name, _, _ in self.bands]
+
+        # Hann window, and a bins x bands matrix summing the power of each band.
+        # One-sided power scaled so a band's sum is its share of the mean square.
+        self.window = np.hanning(self.block_frames).astype(np.float32)
+        freqs = np.fft.rfftfreq(self.block_frames, 1 / rate)
+        self.band_matrix = np.zeros((freqs.size, len(self.bands)), np.float32)
+        for index, (_, low, high) in enumerate(self.bands):
+            self.band_matrix[(freqs >= low) & (freqs < high), index] = 1.0
+        self.power_scale = 2.0 / (self.block_frames * float(np.sum(self.window**2)))
+
+        self.band_events = [
+            EventTracker(
+                name, EVENT_MIN_BLOCKS, EVENT_HANGOVER_BLOCKS, self.block_seconds
+            )
+            for name in self.band_names
+        ]
+        self.clipping = EventTracker(
+            "clipping", 1, EVENT_HANGOVER_BLOCKS, self.block_seconds
+        )
+        self.silence = EventTracker(
+            "silence",
+            max(1, round(silence_seconds / self.block_seconds)),
+            1,
+            self.block_seconds,
+        )
+        self.floors: Optional["np.ndarray"] = None
+        self.recent: Deque[dict] = collections.deque(maxlen=RECENT_EVENTS)
+        self._snapshot: dict = {}
+
+        self.blocks = 0
+        self.batches = 0
+        self.clipped_blocks = 0
+        self.silent_blocks = 0
+        self.analysis_seconds = 0.0
+        self._level_sum = 0.0
+        self._level_count = 0
+        self.level_db = MIN_DBFS
+        self.peak_db = MIN_DBFS
+        self._lock = threading.Lock()  # Stats and recent events vs the analysis thread
+        self._pipe = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def trackers(self) -> List[EventTracker]:
+        return [*self.band_events, self.clipping, self.silence]
+
+    def start(self, audio: AudioCapture):
+        """Analyse the capture's blocks in a thread, as one more of its sinks."""
+        self._pipe = open(audio.add_sink("analysis"), "rb", buffering=0)
+        self._thread = threading.Thread(
+            target=self._run, name="audio-analysis", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        batch_bytes = BATCH_BLOCKS * self.block_bytes
+        while True:
+            data = b""
+            while len(data) < batch_bytes:
+                chunk = self._pipe.read(batch_bytes - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            usable = len(data) - len(data) % self.block_bytes
+            if usable:
+                self.analyze(data[:usable])
+            if len(data) < batch_bytes:
+                return  # The capture stopped and closed the pipe
+
+    def analyze(self, pcm: bytes) -> List[dict]:
+        """Analyse whole blocks of S16LE PCM; returns the events that ended in them."""
+        started = time.perf_counter()
+        count = len(pcm) // self.block_bytes
+        samples = np.frombuffer(
+            pcm, np.int16, count * self.block_frames * self.channels
+        )
+        blocks = samples.reshape(count, self.block_frames * self.channels)
+        peaks = np.maximum(
+            blocks.max(axis=1).astype(np.int32), -blocks.min(axis=1).astype(np.int32)
+        )
+        clipped = np.count_nonzero(
+            (blocks >= CLIP_LEVEL) | (blocks <= -CLIP_LEVEL), axis=1
+        )
+        if self.channels > 1:
+            mono = blocks.reshape(count, self.block_frames, self.channels).mean(
+                axis=2, dtype=np.float32
+            )
+        else:
+            mono = blocks.astype(np.float32)
+        mono *= 1 / 32768
+        levels = dbfs(np.einsum("ij,ij->i", mono, mono) / self.block_frames)
+        peak_levels = dbfs((peaks / 32768.0) ** 2)
+        spectra = np.fft.rfft(mono * self.window, axis=1)
+        power = spectra.real**2 + spectra.imag**2
+        band_levels = dbfs((power @ self.band_matrix) * self.power_scale)
+        if self.floors is None:
+            self.floors = np.maximum(band_levels[0], self.silence_dbfs)
+
+        ended = []
+        for index in range(count):
+            t = (self.blocks + index) * self.block_seconds
+            loud = band_levels[index] > self.floors + self.margin_db
+            for tracker, condition, value in zip(
+                self.band_events, loud, band_levels[index]
+            ):
+                ended.append(tracker.update(bool(condition), t, float(value)))
+            ended.append(
+                self.clipping.update(
+                    clipped[index] >= CLIP_SAMPLES, t, float(peak_levels[index])
+                )
+            )
+            ended.append(
+                self.silence.update(
+                    levels[index] < self.silence_dbfs, t, float(peak_levels[index])
+                )
+            )
+            # Floors fall at once and rise slowly; never below the silence level,
+            # so a band does not "start" every time the room goes quiet and back
+            self.floors = np.maximum(
+                np.minimum(band_levels[index], self.floors + FLOOR_RISE_DB),
+                self.silence_dbfs,
+            )
+        ended = [event for event in ended if event]
+        for event in ended:
+            if event["type"] == "silence":
+                event["digital_zero"] = event["peak"] <= MIN_DBFS
+
+        with self._lock:
+            self.blocks += count
+            self.batches += 1
+            self.clipped_blocks += int(np.count_nonzero(clipped >= CLIP_SAMPLES))
+            self.silent_blocks += int(np.count_nonzero(levels < self.silence_dbfs))
+            self._level_sum += float(np.sum(10 ** (levels / 10)))
+            self._level_count += count
+            self.peak_db = max(self.peak_db, float(peak_levels.max()))
+            self.recent.extend(ended)
+            self.analysis_seconds += time.perf_counter() - started
+        # Replaced whole, so readers in other threads never see it half-built
+        self._snapshot = {
+            "t": round(self.blocks * self.block_seconds, 3),
+            "level_dbfs": round(float(levels[-1]), 1),
+            "peak_dbfs": round(float(peak_levels.max()), 1),
+            "clipping": self.clipping.active,
+            "silent": self.silence.active,
+            "events": [tracker.kind for tracker in self.band_events if tracker.active],
+            "bands": {
+                name: round(float(level), 1)
+                for name, level in zip(self.band_names, band_levels[-1])
+            },
+        }
+        return ended
+
+    def snapshot(self) -> dict:
+        """Capture path: the latest levels and active events; just a reference."""
+        return self._snapshot
+
+    def flush(self) -> List[dict]:
+        """End the events still active, at the end of the analysed audio."""
+        end = self.blocks * self.block_seconds
+        ended = [tracker.finish(end) for tracker in self.trackers if tracker.active]
+        for tracker in self.trackers:
+            tracker.active = False
+        with self._lock:
+            self.recent.extend(ended)
+        return ended
+
+    def close(self):
+        """Call after the capture stopped (which ends the analysis thread)."""
+        if self._thread:
+            self._thread.join(timeout=2)
+        if self._pipe:
+            self._pipe.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            if self._level_count:
+                self.level_db = 10 * math.log10(
+                    max(self._level_sum / self._level_count, 10 ** (MIN_DBFS / 10))
+                )
+            level, peak = self.level_db, self.peak_db
+            self._level_sum, self._level_count = 0.0, 0
+            self.peak_db = MIN_DBFS
+            recent = list(self.recent)[-5:]
+            analysed_seconds = self.blocks * self.block_seconds
+            return {
+                "blocks": self.blocks,
+                "level_dbfs": round(level, 1),
+                "peak_dbfs": round(peak, 1),
+                "clipped_blocks": self.clipped_blocks,
+                "silent_seconds": round(self.silent_blocks * self.block_seconds, 1),
+                "events": {tracker.kind: tracker.count for tracker in self.trackers},
+                "active": [tracker.kind for tracker in self.trackers if tracker.active],
+                "recent_events": recent,
+                "us_per_block": (
+                    round(1e6 * self.analysis_seconds / self.blocks, 1)
+                    if self.blocks
+                    else None
+                ),
+                "cpu_percent": (
+                    round(100 * self.analysis_seconds / analysed_seconds, 2)
+                    if analysed_seconds
+                    else None
+                ),
+            }
+
+
+def add_audio_analysis_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by the scripts that capture audio."""
+    parser.add_argument(
+        "--audio-analysis",
+        action=argparse.BooleanOptionalAction,
+        default=os.environ.get("AUDIO_ANALYSIS", "false").lower() == "true",
+        help="Measure microphone levels and detect sound events (env: AUDIO_ANALYSIS=true)",
+    )
+    parser.add_argument(
+        "--audio-bands",
+        default=os.environ.get("AUDIO_BANDS", DEFAULT_BANDS),
+        help=f"Sound event bands, name:low-high in Hz (env: AUDIO_BANDS, default: {DEFAULT_BANDS})",
+    )
+    parser.add_argument(
+        "--audio-event-margin-db",
+        type=float,
+        default=DEFAULT_EVENT_MARGIN_DB,
+        help=f"A band this far above its noise floor is an event (default: {DEFAULT_EVENT_MARGIN_DB:g})",
+    )
+    parser.add_argument(
+        "--silence-dbfs",
+        type=float,
+        default=DEFAULT_SILENCE_DBFS,
+        help=f"Level below which audio counts as silent (default: {DEFAULT_SILENCE_DBFS:g})",
+    )
+    parser.add_argument(
+        "--silence-seconds",
+        type=float,
+        default=DEFAULT_SILENCE_SECONDS,
+        help=f"Silence this long is reported (default: {DEFAULT_SILENCE_SECONDS:g})",
+    )
+
+
+def analyzer_for(args: argparse.Namespace, rate: int, channels: int) -> AudioAnalyzer:
+    try:
+        return AudioAnalyzer(
+            rate,
+            channels,
+            bands=args.audio_bands,
+            margin_db=args.audio_event_margin_db,
+            silence_dbfs=args.silence_dbfs,
+            silence_seconds=args.silence_seconds,
+        )
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+def analyzer_from_args(
+    args: argparse.Namespace, audio: Optional[AudioCapture]
+) -> Optional[AudioAnalyzer]:
+    """A started AudioAnalyzer on the capture for --audio-analysis, otherwise None."""
+    if not args.audio_analysis:
+        return None
+    if audio is None:
+        print(
+            "Warning: --audio-analysis needs --audio-device; not analysing audio.",
+            file=sys.stderr,
+        )
+        return None
+    analyzer = analyzer_for(args, audio.rate, audio.channels)
+    analyzer.start(audio)
+    print(f"Analysing audio: bands {', '.join(analyzer.band_names)}")
+    return analyzer
+
+
+# Generated test scene: (start, end, kind), with the events analyze expects from it
+TEST_SCENE = [
+    (2.0, 3.0, "voice"),
+    (3.5, 4.0, "rumble"),
+    (4.5, 5.0, "alarm"),
+    (5.5, 6.0, "clipping"),
+    (6.5, 13.0, "silence"),
+]
+TEST_SCENE_SECONDS = 14.0
+
+
+def write_test_scene(path: str, rate: int = 48000):
+    """Background noise with a voice, a motor, a beeping alarm, a clipped shout and a dead mic."""
+    rng = np.random.default_rng(0)
+    t = np.arange(int(TEST_SCENE_SECONDS * rate)) / rate
+    signal_ = rng.normal(0, 0.002, t.size)
+    for start, end, kind in TEST_SCENE:
+        part = (t >= start) & (t < end)
+        tp = t[part] - start
+        if kind == "voice":
+            pitch = 200 + 30 * np.sin(2 * np.pi * 0.7 * tp)
+            phase = 2 * np.pi * np.cumsum(pitch) / rate
+            voiced = sum(np.sin(k * phase) / k for k in range(2, 12))
+            signal_[part] += (
+                0.2 * voiced * np.clip(np.sin(2 * np.pi * 3.5 * tp), 0.3, None)
+            )
+        elif kind == "rumble":
+            signal_[part] += 0.2 * np.sin(2 * np.pi * 60 * tp) + 0.1 * np.sin(
+                2 * np.pi * 90 * tp
+            )
+        elif kind == "alarm":
+            beeping = (tp % 0.2) < 0.1
+            signal_[part] += 0.2 * np.sin(2 * np.pi * 3200 * tp) * beeping
+        elif kind == "clipping":
+            signal_[part] += 3.0 * np.sin(2 * np.pi * 440 * tp)
+        elif kind == "silence":
+            signal_[part] = 0.0
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes((np.clip(signal_, -1, 1) * 32767).astype(np.int16).tobytes())
+
+
+def analyze_wav(
+    path: str, args: argparse.Namespace, batch_blocks: int = BATCH_BLOCKS
+) -> Tuple[AudioAnalyzer, List[dict]]:
+    """Run a WAV file through an analyser, as fast as it goes; returns it and its events."""
+    with wave.open(path, "rb") as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"WAV file '{path}' must be 16-bit PCM")
+        analyzer = analyzer_for(args, wav.getframerate(), wav.getnchannels())
+        events = []
+        while True:
+            data = wav.readframes(batch_blocks * analyzer.block_frames)
+            usable = len(data) - len(data) % analyzer.block_bytes
+            if not usable:
+                break
+            events += analyzer.analyze(data[:usable])
+    return analyzer, events + analyzer.flush()
+
+
+def analyze(args):
+    """Events and levels of a WAV file; without --wav, of the generated test scene."""
+    workdir = None
+    path = args.wav
+    if not path:
+        workdir = tempfile.mkdtemp(prefix="audio_analysis_")
+        path = os.path.join(workdir, "scene.wav")
+        write_test_scene(path)
+    try:
+        analyzer, events = analyze_wav(path, args)
+    except (OSError, ValueError, wave.Error) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    for event in events:
+        extra = " (digital zero)" if event.get("digital_zero") else ""
+        print(
+            f"{event['start']:7.2f}-{event['end']:7.2f} s  {event['type']:<9} "
+            f"peak {event['peak']:6.1f} dBFS{extra}"
+        )
+    print(f"Stats: {analyzer.stats()}")
+    if not workdir:
+        return 0
+    os.remove(path)
+    os.rmdir(workdir)
+    missing = [
+        (start, kind)
+        for start, _, kind in TEST_SCENE
+        if not any(
+            event["type"] == kind and abs(event["start"] - start) < 0.2
+            for event in events
+        )
+    ]
+    for start, kind in missing:
+        print(f"MISSING: {kind} at {start:g} s", file=sys.stderr)
+    print("Test scene: " + ("FAILED" if missing else "all events found"))
+    return 1 if missing else 0
+
+
+def benchmark(args):
+    """Microseconds of analysis per 20 ms block, by blocks per batch."""
+    workdir = tempfile.mkdtemp(prefix="audio_analysis_")
+    path = os.path.join(workdir, "scene.wav")
+    write_test_scene(path)
+    try:
+        for batch_blocks in (1, BATCH_BLOCKS, 25):
+            best = None
+            for _ in range(args.repeat):
+                analyzer, _ = analyze_wav(path, args, batch_blocks)
+                us = analyzer.stats()["us_per_block"]
+                best = us if best is None else min(best, us)
+            print(
+                f"{batch_blocks:3} blocks per batch: {best:6.1f} us per 20 ms block "
+                f"({best / 200:.2f}% of a core)"
+            )
+    finally:
+        os.remove(path)
+        os.rmdir(workdir)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Microphone levels and sound events from PCM or a WAV file"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    analyze_parser = subparsers.add_parser(
+        "analyze", help="Events and levels of a WAV file, or of a test scene"
+    )
+    analyze_parser.add_argument(
+        "--wav", help="16-bit WAV (default: generated scene, checked)"
+    )
+    add_audio_analysis_arguments(analyze_parser)
+    bench = subparsers.add_parser("benchmark", help="CPU per block by batch size")
+    bench.add_argument("--repeat", type=int, default=3)
+    add_audio_analysis_arguments(bench)
+    args = parser.parse_args()
+    commands = {"analyze": analyze, "benchmark": benchmark}
+    return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
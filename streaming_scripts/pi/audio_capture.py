@@ -0,0 +1,254 @@
+"""
+audio_capture.py - One microphone capture shared by every ffmpeg sink of a streaming process
+
+The microphone is opened once (through `arecord`, or a WAV file standing in for it)
+and each 20 ms block of S16LE PCM is fanned out to one pipe per ffmpeg process.
+Each ffmpeg encodes it once for its own container: AAC for RTMP, Opus for RTP.
+
+Audio is re-timed against time.monotonic(), the same clock that paces the video
+frames written by the capture loop. If the microphone stalls, silence is inserted.
+If it runs ahead of the clock, blocks are dropped. Either way the audio timeline
+stays in step with the video timeline inside ffmpeg.
+
+Usage (from a streaming script):
+    audio = AudioCapture(args.audio_device)
+    audio_fd = audio.add_sink("youtube")
+    ffmpeg = subprocess.Popen(
+        [..., *audio.ffmpeg_input_args(audio_fd), ...], pass_fds=(audio_fd,), ...
+    )
+    os.close(audio_fd)
+    audio.start()
+    audio.start_clock()  # right before the first video frame is written
+
+Testing without a microphone:
+    --audio-device some_recording.wav     # file-backed stand-in, played in real time
+    --audio-device hw:Loopback,1          # snd-aloop loopback device
+"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+import wave
+from typing import List, Optional
+
+DEFAULT_AUDIO_RATE = 48000
+DEFAULT_AUDIO_CHANNELS = 1
+DEFAULT_BLOCK_MS = 20
+# Blocks of drift tolerated before silence is inserted or audio is dropped
+DRIFT_TOLERANCE_BLOCKS = 5
+
+
+class AudioSink:
+    """Write end of the pipe feeding one ffmpeg audio input."""
+
+    def __init__(self, name: str, write_fd: int):
+        self.name = name
+        self.write_fd = write_fd
+        self.blocks_written = 0
+        self.blocks_dropped = 0
+        self.closed = False
+
+
+class AudioCapture:
+    def __init__(
+        self,
+        device: str,
+        rate: int = DEFAULT_AUDIO_RATE,
+        channels: int = DEFAULT_AUDIO_CHANNELS,
+        block_ms: int = DEFAULT_BLOCK_MS,
+    ):
+        """Describe the capture; nothing is opened until start()."""
+        self.device = device
+        self.is_file = device.lower().endswith(".wav")
+        if self.is_file:
+            with wave.open(device, "rb") as wav:
+                if wav.getsampwidth() != 2:
+                    raise ValueError(f"WAV file '{device}' must be 16-bit PCM")
+                rate = wav.getframerate()
+                channels = wav.getnchannels()
+        self.rate = rate
+        self.channels = channels
+        self.block_frames = rate * block_ms // 1000
+        self.block_bytes = self.block_frames * channels * 2
+        self.block_seconds = self.block_frames / rate
+
+        self.sinks: List[AudioSink] = []
+        self._sinks_lock = threading.Lock()  # Sinks are replaced on encoder restarts
+        self.samples_written = 0
+        self.silence_blocks_inserted = 0
+        self.blocks_dropped_ahead = 0
+
+        self._epoch: Optional[float] = None
+        self._proc: Optional[subprocess.Popen] = None
+        self._wav: Optional[wave.Wave_read] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def add_sink(self, name: str) -> int:
+        """Create a pipe for one ffmpeg process and return its read end.
+
+        The caller passes the fd to ffmpeg (pass_fds) and closes it afterwards.
+        Writes are non-blocking so a stalled encoder loses audio instead of
+        stalling the capture for every other sink; blocks are smaller than
+        PIPE_BUF, so a write is either complete or not done at all.
+        Adding a name again (an encoder restart) closes and replaces that sink.
+        """
+        read_fd, write_fd = os.pipe()
+        if self.block_bytes <= os.fpathconf(write_fd, "PC_PIPE_BUF"):
+            os.set_blocking(write_fd, False)
+        with self._sinks_lock:
+            for sink in self.sinks:
+                if sink.name == name and not sink.closed:
+                    os.close(sink.write_fd)
+                    sink.closed = True
+            self.sinks = [sink for sink in self.sinks if sink.name != name]
+            self.sinks.append(AudioSink(name, write_fd))
+        return read_fd
+
+    def ffmpeg_input_args(self, fd: int) -> List[str]:
+        """ffmpeg arguments that read this capture's PCM from the given fd."""
+        return [
+            "-thread_queue_size",
+            "1024",
+            "-f",
+            "s16le",
+            "-ar",
+            str(self.rate),
+            "-ac",
+            str(self.channels),
+            "-i",
+            f"pipe:{fd}",
+        ]
+
+    def start(self):
+        """Open the microphone (or WAV file) and start the capture thread."""
+        if self.is_file:
+            self._wav = wave.open(self.device, "rb")
+        else:
+            arecord_cmd = [
+                "arecord",
+                "-q",
+                "-D",
+                self.device,
+                "-f",
+                "S16_LE",
+                "-r",
+                str(self.rate),
+                "-c",
+                str(self.channels),
+                "-t",
+                "raw",
+            ]
+            self._proc = subprocess.Popen(arecord_cmd, stdout=subprocess.PIPE)
+        self._thread = threading.Thread(
+            target=self._run, name="audio-capture", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def source_pid(self) -> Optional[int]:
+        """pid of the arecord process, for CPU pinning; None for a WAV file."""
+        return self._proc.pid if self._proc else None
+
+    def start_clock(self, epoch: Optional[float] = None):
+        """Anchor audio time zero to the first video frame (time.monotonic())."""
+        self._epoch = time.monotonic() if epoch is None else epoch
+
+    def stop(self):
+        self._stop.set()
+        if self._proc:
+            self._proc.terminate()
+            self._proc.wait()
+        if self._thread:
+            self._thread.join(timeout=2)
+        with self._sinks_lock:
+            for sink in self.sinks:
+                if not sink.closed:
+                    os.close(sink.write_fd)
+                    sink.closed = True
+        if self._wav:
+            self._wav.close()
+
+    def stats(self) -> dict:
+        return {
+            "device": self.device,
+            "seconds_written": self.samples_written / self.rate,
+            "silence_blocks_inserted": self.silence_blocks_inserted,
+            "blocks_dropped_ahead": self.blocks_dropped_ahead,
+            "sinks": {
+                sink.name: {
+                    "blocks_written": sink.blocks_written,
+                    "blocks_dropped": sink.blocks_dropped,
+                }
+                for sink in self.sinks
+            },
+        }
+
+    def _read_block(self) -> Optional[bytes]:
+        """Read one block from the source; None when the source has ended."""
+        if self._wav:
+            data = self._wav.readframes(self.block_frames)
+            if len(data) < self.block_bytes:
+                self._wav.rewind()  # Loop the stand-in recording
+                data += self._wav.readframes(
+                    self.block_frames - len(data) // (self.channels * 2)
+                )
+            return data
+        data = self._proc.stdout.read(self.block_bytes)
+        if len(data) < self.block_bytes:
+            return None
+        return data
+
+    def _run(self):
+        silence = bytes(self.block_bytes)
+        source_ended = False
+        next_wav_block = time.monotonic()
+        while not self._stop.is_set():
+            if source_ended:
+                data = silence
+                time.sleep(self.block_seconds)
+            else:
+                if self._wav:
+                    # Pace the file like a real device would
+                    delay = next_wav_block - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_wav_block += self.block_seconds
+                data = self._read_block()
+                if data is None:
+                    print(
+                        f"Warning: audio device '{self.device}' stopped delivering; sending silence.",
+                        file=sys.stderr,
+                    )
+                    source_ended = True
+                    continue
+
+            if self._epoch is None:
+                continue  # Drain the device until the video clock starts
+
+            expected = int((time.monotonic() - self._epoch) * self.rate)
+            tolerance = DRIFT_TOLERANCE_BLOCKS * self.block_frames
+            while expected - (self.samples_written + self.block_frames) > tolerance:
+                self._write(silence)
+                self.silence_blocks_inserted += 1
+            if self.samples_written - expected > tolerance:
+                self.blocks_dropped_ahead += 1
+                continue
+            self._write(data)
+
+    def _write(self, data: bytes):
+        self.samples_written += self.block_frames
+        with self._sinks_lock:
+            for sink in self.sinks:
+                if sink.closed:
+                    continue
+                try:
+                    os.write(sink.write_fd, data)
+                    sink.blocks_written += 1
+                except BlockingIOError:
+                    sink.blocks_dropped += 1
+                except (BrokenPipeError, OSError):
+                    os.close(sink.write_fd)
+                    sink.closed = True
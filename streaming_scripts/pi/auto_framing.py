@@ -0,0 +1,541 @@
+"""
+auto_framing.py - Stream only the part of the view around the detections
+
+The IMX500 scripts stream the whole field of view. When the only thing of
+interest is one object in a corner, most of the bitrate and encoder time goes
+to the rest of the frame. With --auto-framing, AutoFramer moves a crop window
+to follow the detections, and the encoders get a smaller frame that is
+centred on them, at --framing-size and at a bitrate scaled down with the pixel
+count.
+
+* The target window is the union of the detections (of --framing-classes, if
+  set), padded by FRAMING_PADDING of their size. It is widened to the output
+  aspect ratio, and it is never smaller than the field of view divided by
+  --framing-max-zoom. If nothing has been detected for --framing-hold seconds,
+  the target becomes the whole view.
+* Hysteresis: a new target that differs from the current one by less than
+  FRAMING_DEADBAND of the window size is ignored, so noisy boxes do not move
+  the view. The window eases towards its target with a time constant of
+  --framing-smoothing seconds.
+* Rate limiting: a new crop is applied at most FRAMING_RATE times a second,
+  and only when it has moved by at least MIN_STEP of the field of view.
+
+There are two ways to apply the crop:
+
+* isp: the camera's ScalerCrop control. The ISP crops and scales before the
+  frame exists, so capture, drawing and encoding all work at the output size.
+  The IMX500 keeps inferring on the whole sensor, so objects outside the crop
+  still move the window. convert_inference_coords() maps boxes through the
+  ScalerCrop in each frame's own metadata, so boxes stay aligned while a new
+  crop takes effect a few frames later. Objects outside the crop are clamped
+  to its edge by that mapping; remap() drops them.
+* array: the camera captures the whole view and crop_frame() cuts the window
+  out of each frame and resizes it (a plain copy when the window is the output
+  size). The crop applies to the same frame it was computed on. remap() moves
+  the boxes from the camera frame into the cropped one. Use this where the
+  ScalerCrop cannot be changed per frame. The frame bus and snapshots still get
+  the whole view.
+
+Usage (from a streaming script):
+    framer = framer_from_args(args, labels)  # None without --auto-framing
+    framer.set_field(picam2.camera_properties["ScalerCropMaximum"])  # isp mode
+    crop = framer.update(detections)
+    if crop and framer.mode == "isp":
+        picam2.set_controls({"ScalerCrop": crop})
+    frame = framer.crop_frame(frame)  # array mode; isp frames pass through
+    draw(frame, framer.remap(detections))
+
+    # Crop changes, window jitter and subject coverage: a naive follower vs AutoFramer
+    python3 auto_framing.py simulate --seconds 30
+"""
+
+import argparse
+import copy
+import math
+import os
+import random
+import sys
+import time
+from typing import List, Optional, Sequence, Tuple
+
+from startup_timing import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+
+FRAMING_MODES = ["off", "isp", "array"]
+FRAMING_PADDING = 0.3  # Margin around the detections, as a fraction of their size
+FRAMING_DEADBAND = 0.15  # Targets closer than this (fraction of the window) are ignored
+FRAMING_RATE = 10.0  # Crop changes per second at most
+MIN_STEP = 0.005  # Smallest crop move applied, as a fraction of the field of view
+BITRATE_EXPONENT = 0.75  # Bitrate grows more slowly than the pixel count
+DEFAULT_MAX_ZOOM = 3.0
+DEFAULT_SMOOTHING = 0.5  # Seconds
+DEFAULT_HOLD = 2.0  # Seconds
+
+Rect = Tuple[float, float, float, float]  # x, y, width, height
+
+
+def parse_size(text: str) -> Tuple[int, int]:
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def framed_bitrate(bitrate: int, full: Tuple[int, int], output: Tuple[int, int]) -> int:
+    """Bitrate for the framed stream: scaled by pixel count, less than linearly."""
+    ratio = (output[0] * output[1]) / (full[0] * full[1])
+    return max(1, round(bitrate * min(1.0, ratio) ** BITRATE_EXPONENT))
+
+
+def union(boxes: Sequence[Rect]) -> Rect:
+    x0 = min(box[0] for box in boxes)
+    y0 = min(box[1] for box in boxes)
+    x1 = max(box[0] + box[2] for box in boxes)
+    y1 = max(box[1] + box[3] for box in boxes)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+class AutoFramer:
+    def __init__(
+        self,
+        mode: str,
+        output_size: Tuple[int, int],
+        camera_size: Tuple[int, int],
+        bitrate: int,
+        max_zoom: float = DEFAULT_MAX_ZOOM,
+        smoothing: float = DEFAULT_SMOOTHING,
+        hold: float = DEFAULT_HOLD,
+        categories: Optional[set] = None,
+        rate: float = FRAMING_RATE,
+        deadband: float = FRAMING_DEADBAND,
+    ):
+        """camera_size is what the camera delivers: the output size in isp mode."""
+        self.mode = mode
+        self.output_size = output_size
+        self.camera_size = camera_size
+        self.bitrate = bitrate
+        self.max_zoom = max_zoom
+        self.smoothing = smoothing
+        self.hold = hold
+        self.categories = categories
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.deadband = deadband
+        self._output = None
+        self.field: Rect = (0, 0, *camera_size)
+        self.window: Rect = self.field
+        self.target: Rect = self.field
+        self.crop: Tuple[int, int, int, int] = (0, 0, *camera_size)
+        self._last_update: Optional[float] = None
+        self._last_applied = 0.0
+        self._last_seen: Optional[float] = None
+        self.updates = 0
+        self.applied = 0
+        self.target_changes = 0
+        self.ignored_targets = 0
+        self.rate_limited = 0
+        self.dropped_boxes = 0
+        self._zoom_sum = 0.0
+        if mode == "array":
+            self.set_field((0, 0, *camera_size))
+
+    def set_field(self, field: Sequence[int]):
+        """The whole view in crop coordinates: ScalerCropMaximum, or the camera frame."""
+        self.field = tuple(float(v) for v in field)
+        self.window = self.target = self.full_window()
+        self.crop = self._rounded(self.window)
+
+    def full_window(self) -> Rect:
+        """The largest window of the output aspect ratio, centred in the field."""
+        fx, fy, fw, fh = self.field
+        aspect = self.output_size[0] / self.output_size[1]
+        width = min(fw, fh * aspect)
+        height = width / aspect
+        return fx + (fw - width) / 2, fy + (fh - height) / 2, width, height
+
+    def subject_boxes(self, detections) -> List[Rect]:
+        """Detections in field coordinates, filtered by category."""
+        boxes = []
+        fx, fy, fw, fh = self.field
+        for detection in detections or []:
+            if (
+                self.categories is not None
+                and int(detection.category) not in self.categories
+            ):
+                continue
+            if self.mode == "isp":
+                # Normalized to the whole sensor, whatever the current crop
+                coords = np.ravel(np.asarray(detection.coords, dtype=float))
+                y0, x0, y1, x1 = (float(v) for v in coords[:4])
+                boxes.append(
+                    (fx + x0 * fw, fy + y0 * fh, (x1 - x0) * fw, (y1 - y0) * fh)
+                )
+            else:
+                boxes.append(tuple(float(v) for v in detection.box))
+        return [box for box in boxes if box[2] > 0 and box[3] > 0]
+
+    def window_for(self, boxes: Sequence[Rect]) -> Rect:
+        """The padded window of the output aspect ratio around boxes, inside the field."""
+        x, y, w, h = union(boxes)
+        cx, cy = x + w / 2, y + h / 2
+        w, h = w * (1 + 2 * FRAMING_PADDING), h * (1 + 2 * FRAMING_PADDING)
+        full = self.full_window()
+        aspect = full[2] / full[3]
+        width = max(w, h * aspect, full[2] / self.max_zoom)
+        width = min(width, full[2])
+        height = width / aspect
+        fx, fy, fw, fh = self.field
+        x = min(max(cx - width / 2, fx), fx + fw - width)
+        y = min(max(cy - height / 2, fy), fy + fh - height)
+        return x, y, width, height
+
+    def _differs(self, a: Rect, b: Rect, fraction: float) -> bool:
+        """a and b differ by more than fraction of a's size, in position or size."""
+        return (
+            abs((a[0] + a[2] / 2) - (b[0] + b[2] / 2)) > fraction * a[2]
+            or abs((a[1] + a[3] / 2) - (b[1] + b[3] / 2)) > fraction * a[3]
+            or abs(a[2] - b[2]) > fraction * a[2]
+        )
+
+    def _rounded(self, window: Rect) -> Tuple[int, int, int, int]:
+        x, y, w, h = (round(v) for v in window)
+        return x, y, w, h
+
+    def update(
+        self, detections, now: Optional[float] = None
+    ) -> Optional[Tuple[int, int, int, int]]:
+        """Move the window towards the detections; the new crop when one is due, else None."""
+        now = time.monotonic() if now is None else now
+        self.updates += 1
+        boxes = self.subject_boxes(detections)
+        if boxes:
+            self._last_seen = now
+            target = self.window_for(boxes)
+        elif self._last_seen is None or now - self._last_seen > self.hold:
+            target = self.full_window()
+        else:
+            target = self.target  # Keep framing the last place the subject was seen
+        if target != self.target:
+            if self._differs(self.target, target, self.deadband):
+                self.target = target
+                self.target_changes += 1
+            else:
+                self.ignored_targets += 1
+
+        dt = 0.0 if self._last_update is None else now - self._last_update
+        self._last_update = now
+        alpha = 1.0 - math.exp(-dt / self.smoothing) if self.smoothing > 0 else 1.0
+        self.window = tuple(
+            w + alpha * (t - w) for w, t in zip(self.window, self.target)
+        )
+        self._zoom_sum += self.full_window()[2] / self.window[2]
+
+        crop = self._rounded(self.window)
+        if not self._differs_by_step(crop):
+            return None
+        if now - self._last_applied < self.interval:
+            self.rate_limited += 1
+            return None
+        self._last_applied = now
+        self.crop = crop
+        self.applied += 1
+        return crop
+
+    def _differs_by_step(self, crop: Tuple[int, int, int, int]) -> bool:
+        step = MIN_STEP * self.field[2]
+        return any(abs(a - b) >= step for a, b in zip(crop, self.crop))
+
+    def crop_frame(self, frame: "np.ndarray") -> "np.ndarray":
+        """The current crop of a camera frame at the output size (array mode; isp passes through)."""
+        if self.mode != "array":
+            return frame
+        if self._output is None:
+            width, height = self.output_size
+            self._output = np.empty((height, width, frame.shape[2]), frame.dtype)
+        x, y, w, h = self.crop
+        region = frame[y : y + h, x : x + w]
+        if (w, h) == self.output_size:
+            np.copyto(self._output, region)
+        else:
+            shrink = w > self.output_size[0]
+            cv2.resize(
+                region,
+                self.output_size,
+                dst=self._output,
+                interpolation=cv2.INTER_AREA if shrink else cv2.INTER_LINEAR,
+            )
+        return self._output
+
+    def remap(self, detections):
+        """Detections with boxes in the framed output; those outside the crop are dropped."""
+        if detections is None:
+            return None
+        remapped = []
+        x, y, w, h = self.crop
+        sx, sy = self.output_size[0] / w, self.output_size[1] / h
+        for detection in detections:
+            bx, by, bw, bh = detection.box
+            if self.mode == "array":
+                # Camera frame to the crop, clipped to it
+                x0, y0 = max(bx, x), max(by, y)
+                x1, y1 = min(bx + bw, x + w), min(by + bh, y + h)
+                bx, by = round((x0 - x) * sx), round((y0 - y) * sy)
+                bw, bh = round((x1 - x0) * sx), round((y1 - y0) * sy)
+            if bw <= 1 or bh <= 1:
+                # isp: clamped to the crop edge by convert_inference_coords
+                self.dropped_boxes += 1
+                continue
+            moved = copy.copy(detection)
+            moved.box = (bx, by, bw, bh)
+            remapped.append(moved)
+        return remapped
+
+    @property
+    def zoom(self) -> float:
+        return self.full_window()[2] / self.window[2]
+
+    def describe(self) -> str:
+        width, height = self.output_size
+        source = (
+            "ScalerCrop"
+            if self.mode == "isp"
+            else f"crop of {self.camera_size[0]}x{self.camera_size[1]} frames"
+        )
+        return f"{width}x{height} via {source}, up to {self.max_zoom:g}x zoom"
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "output": f"{self.output_size[0]}x{self.output_size[1]}",
+            "bitrate": self.bitrate,
+            "crop": list(self.crop),
+            "zoom": round(self.zoom, 2),
+            "mean_zoom": (
+                round(self._zoom_sum / self.updates, 2) if self.updates else None
+            ),
+            "updates": self.updates,
+            "crops_applied": self.applied,
+            "target_changes": self.target_changes,
+            "ignored_targets": self.ignored_targets,
+            "rate_limited": self.rate_limited,
+            "dropped_boxes": self.dropped_boxes,
+        }
+
+
+def add_framing_arguments(
+    parser: argparse.ArgumentParser, modes: Sequence[str] = FRAMING_MODES
+):
+    """Command-line options shared by the IMX500 scripts that can frame their subject."""
+    parser.add_argument(
+        "--auto-framing",
+        choices=list(modes),
+        default=os.environ.get("AUTO_FRAMING", "off"),
+        help="Crop the stream to the detections: isp (camera ScalerCrop) or array "
+        "(crop each captured frame) (env: AUTO_FRAMING, default: off)",
+    )
+    parser.add_argument(
+        "--framing-size",
+        type=parse_size,
+        default=os.environ.get("FRAMING_SIZE"),
+        help="Framed stream size WxH (env: FRAMING_SIZE, default: half the stream size)",
+    )
+    parser.add_argument(
+        "--framing-max-zoom",
+        type=float,
+        default=DEFAULT_MAX_ZOOM,
+        help=f"Smallest crop is the view divided by this (default: {DEFAULT_MAX_ZOOM:g})",
+    )
+    parser.add_argument(
+        "--framing-classes",
+        type=str,
+        help="Comma-separated labels to frame, e.g. person,dog (default: every detection)",
+    )
+    parser.add_argument(
+        "--framing-smoothing",
+        type=float,
+        default=DEFAULT_SMOOTHING,
+        help=f"Seconds for the crop to ease towards the detections (default: {DEFAULT_SMOOTHING:g})",
+    )
+    parser.add_argument(
+        "--framing-hold",
+        type=float,
+        default=DEFAULT_HOLD,
+        help=f"Seconds without detections before zooming back out (default: {DEFAULT_HOLD:g})",
+    )
+
+
+def framer_from_args(
+    args: argparse.Namespace, labels: List[str]
+) -> Optional[AutoFramer]:
+    """An AutoFramer for --auto-framing, sized from args' stream size and bitrate; else None."""
+    if args.auto_framing == "off":
+        return None
+    full = (args.width, args.height)
+    size = args.framing_size
+    if isinstance(size, str):
+        size = parse_size(size)
+    if size is None:
+        size = (args.width // 4 * 2, args.height // 4 * 2)
+    size = (min(size[0], full[0]) // 2 * 2, min(size[1], full[1]) // 2 * 2)
+    categories = None
+    if args.framing_classes:
+        names = {
+            name.strip() for name in args.framing_classes.split(",") if name.strip()
+        }
+        categories = {index for index, label in enumerate(labels) if label in names}
+        unknown = names - set(labels)
+        if unknown:
+            print(
+                f"Warning: no such labels to frame: {', '.join(sorted(unknown))}",
+                file=sys.stderr,
+            )
+    return AutoFramer(
+        args.auto_framing,
+        size,
+        full if args.auto_framing == "array" else size,
+        framed_bitrate(args.bitrate, full, size),
+        max_zoom=args.framing_max_zoom,
+        smoothing=args.framing_smoothing,
+        hold=args.framing_hold,
+        categories=categories,
+    )
+
+
+class SimulatedDetection:
+    def __init__(self, box: Rect, field: Tuple[int, int]):
+        self.category = 0
+        self.conf = 0.8
+        self.box = tuple(round(v) for v in box)
+        x, y, w, h = box
+        self.coords = (
+            y / field[1],
+            x / field[0],
+            (y + h) / field[1],
+            (x + w) / field[0],
+        )
+
+
+def subject_path(t: float, width: int, height: int) -> Rect:
+    """A person-sized box that wanders, dashes across the view and leaves it for a while."""
+    w, h = width * 0.08, height * 0.3
+    phase = t % 20.0
+    if phase < 8:
+        x = width * (0.1 + 0.02 * math.sin(t))  # Lingers in a corner
+        y = height * 0.6
+    elif phase < 11:
+        x = width * (0.1 + 0.75 * (phase - 8) / 3)  # Walks across
+        y = height * (0.6 - 0.3 * (phase - 8) / 3)
+    elif phase < 16:
+        x, y = width * 0.85, height * 0.3
+    else:
+        return None  # Out of view
+    return x, y, w, h
+
+
+def simulate_framer(args, framer: AutoFramer, width: int, height: int) -> dict:
+    rng = random.Random(0)
+    frames = int(args.seconds * args.fps)
+    moves: List[float] = []
+    covered = 0
+    visible = 0
+    previous = framer.crop
+    changes = 0
+    for index in range(frames):
+        now = index / args.fps
+        box = subject_path(now, width, height)
+        detections = []
+        if box is not None and rng.random() > args.missed:
+            jitter = [rng.gauss(0, args.jitter * size) for size in (box[2], box[3])]
+            noisy = (box[0] + jitter[0], box[1] + jitter[1], box[2], box[3])
+            detections = [SimulatedDetection(noisy, (width, height))]
+        crop = framer.update(detections, now)
+        if crop is not None:
+            changes += 1
+            moves.append(max(abs(a - b) for a, b in zip(crop, previous)))
+            previous = crop
+        if box is not None:
+            visible += 1
+            x, y, w, h = framer.crop
+            if (
+                box[0] >= x
+                and box[1] >= y
+                and box[0] + box[2] <= x + w
+                and box[1] + box[3] <= y + h
+            ):
+                covered += 1
+    return {
+        "crop_changes_per_s": round(changes / args.seconds, 1),
+        "mean_move_px": round(sum(moves) / len(moves), 1) if moves else 0.0,
+        "subject_in_crop": round(covered / visible, 3) if visible else None,
+        "mean_zoom": framer.stats()["mean_zoom"],
+    }
+
+
+def crop_cost_ms(
+    width: int, height: int, output: Tuple[int, int], repeats: int = 200
+) -> float:
+    framer = AutoFramer("array", output, (width, height), 0)
+    frame = np.random.default_rng(0).integers(0, 255, (height, width, 3), np.uint8)
+    framer.crop = framer._rounded(
+        framer.window_for([(width * 0.4, height * 0.4, 100, 200)])
+    )
+    started = time.perf_counter()
+    for _ in range(repeats):
+        framer.crop_frame(frame)
+    return 1000 * (time.perf_counter() - started) / repeats
+
+
+def simulate(args):
+    """A naive crop that follows every detection vs AutoFramer, on a wandering subject."""
+    width, height = args.width, args.height
+    output = (width // 4 * 2, height // 4 * 2)
+    print(
+        f"{width}x{height} at {args.fps:g} fps for {args.seconds:g} s, output "
+        f"{output[0]}x{output[1]}, box jitter {100 * args.jitter:g}%, "
+        f"{100 * args.missed:g}% of frames missed"
+    )
+    naive = AutoFramer(
+        "array", output, (width, height), 0, smoothing=0, hold=0, rate=0, deadband=0
+    )
+    framer = AutoFramer("array", output, (width, height), 0)
+    for name, candidate in [("naive", naive), ("framer", framer)]:
+        print(f"  {name:<7} {simulate_framer(args, candidate, width, height)}")
+    print(
+        f"  array crop and resize: {crop_cost_ms(width, height, output):.2f} ms per frame"
+    )
+    print(
+        f"  bitrate at {output[0]}x{output[1]}: "
+        f"{framed_bitrate(args.bitrate, (width, height), output)} kbps (from {args.bitrate})"
+    )
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crop the stream to the detections")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sim = subparsers.add_parser(
+        "simulate", help="Naive crop vs AutoFramer on a simulated subject"
+    )
+    sim.add_argument("--width", type=int, default=1280)
+    sim.add_argument("--height", type=int, default=720)
+    sim.add_argument("--fps", type=float, default=30.0)
+    sim.add_argument("--seconds", type=float, default=40.0)
+    sim.add_argument("--bitrate", type=int, default=2500, help="kbps")
+    sim.add_argument(
+        "--jitter",
+        type=float,
+        default=0.05,
+        help="Box noise, fraction of its size (default: 0.05)",
+    )
+    sim.add_argument(
+        "--missed",
+        type=float,
+        default=0.1,
+        help="Fraction of frames without a detection (default: 0.1)",
+    )
+    args = parser.parse_args()
+    commands = {"simulate": simulate}
+    return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,723 @@
+"""
+camera_rig.py - Several cameras streamed from one process
+
+A Pi 5 has two CSI ports, and some robots carry an AI Camera next to a Camera
+Module v2 or a webcam. One streaming script per camera means one Python
+interpreter per camera (about 75 MB each, see memory_budget.py), one ffmpeg per
+camera, and one copy of the CPU detector's network per camera.
+stream_multi_camera_to_pc.py drives all of them from one process, using the
+pieces in this module:
+
+* CameraPipeline: one per camera, with its own capture thread. The thread reads
+  a frame, offers it to the camera's detector, draws the detections and passes
+  the frame to the encoder. A slow or stalled camera never holds up the others.
+* Detectors are optional, per camera. The AI Camera (source imx500) parses its
+  on-sensor network's output for each frame (Imx500Source). detect=cpu runs the
+  CPU detector (cpu_detector.py). Every detect=cpu camera shares one copy of the
+  network (SharedBackend). Inferences take turns, and each camera's adaptive
+  rate backs off as the shared network gets busier.
+* SharedEncoder: one ffmpeg process for every camera.
+  - --layout streams gives each camera its own pipe, encode and RTP port:
+    --remote-port, +10, +20 and so on, the spacing multi_robot_receiver.py uses.
+  - --layout mosaic tiles the cameras into one frame (Mosaic), for one encode and
+    one RTP stream, the cheapest on CPU. Cameras capture at their tile size, so
+    the ISP does the scaling.
+* stats() is kept per camera and published together as "cameras" in the stats
+  file. It covers capture fps, frames written, time blocked on the encoder and
+  the detector.
+
+Cameras are given as --camera SOURCE[,key=value...], repeated. SOURCE is anything
+frame_sources.py opens (libcamera, picamera2:N, synthetic:SEED, /dev/videoN, a
+file), or imx500 for the AI Camera. The keys are name, size (WxH), fps, detect
+(cpu or none; an imx500 camera detects unless it has detect=none), bitrate
+(kbps) and port.
+
+Usage (from a streaming script):
+    specs = [parse_camera_spec(text, index, args) for index, text in enumerate(args.camera)]
+    encoder = SharedEncoder(specs, args.layout, args)
+    pipelines = [CameraPipeline(spec, source, detector, labels, encoder.sink(index)) ...]
+    stream_stats.add_source("cameras", lambda: {p.spec.name: p.stats() for p in pipelines})
+
+    # Three synthetic cameras with CPU detection, all at once through the
+    # multi-camera script; fails unless each one streams at its frame rate and
+    # detects its objects
+    python3 camera_rig.py check --cameras 3 --layout streams
+"""
+
+import argparse
+import json
+import math
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from cpu_detector import CpuDetector, Detection, detector_from_args
+from crop_harvester import CropHarvester
+from detection_sync import timeline_from_args
+from encoder_tuner import EncoderProfile
+from ffmpeg_progress import FfmpegProgress
+from frame_sources import FrameSource, Picamera2Source, open_frame_source
+from nanodet_postprocess import nanodet_postprocessor
+from startup_timing import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+
+LAYOUTS = ["streams", "mosaic"]
+PORT_STEP = 10  # Video ports of successive cameras, as in the fleet receiver
+CAMERA_KEYS = ["name", "size", "fps", "detect", "bitrate", "port"]
+MULTI_CAMERA_SCRIPT = "stream_multi_camera_to_pc.py"
+
+
+class CameraSpec:
+    def __init__(
+        self,
+        name: str,
+        source: str,
+        width: int,
+        height: int,
+        fps: float,
+        detect: str,
+        bitrate: int,
+        port: int,
+    ):
+        self.name = name
+        self.source = source
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.detect = detect
+        self.bitrate = bitrate
+        self.port = port
+
+    def __repr__(self):
+        return (
+            f"{self.name}: {self.source} {self.width}x{self.height}@{self.fps:g}, "
+            f"detect={self.detect}"
+        )
+
+
+def mosaic_grid(count: int) -> Tuple[int, int]:
+    """Columns and rows of the most square grid with room for count tiles."""
+    columns = math.ceil(math.sqrt(count))
+    return columns, math.ceil(count / columns)
+
+
+def mosaic_tile_size(width: int, height: int, count: int) -> Tuple[int, int]:
+    columns, rows = mosaic_grid(count)
+    # Even sizes, for the encoder's 4:2:0 chroma
+    return width // columns // 2 * 2, height // rows // 2 * 2
+
+
+def parse_camera_spec(text: str, index: int, args: argparse.Namespace) -> CameraSpec:
+    """SOURCE[,key=value...] to a CameraSpec; the script's options fill the gaps."""
+    source, *options = [part.strip() for part in text.split(",")]
+    if not source:
+        raise ValueError(f"camera '{text}' has no source")
+    values: Dict[str, str] = {}
+    for option in options:
+        key, _, value = option.partition("=")
+        if key not in CAMERA_KEYS or not value:
+            raise ValueError(
+                f"camera '{text}': '{option}' is not one of "
+                + ", ".join(f"{key}=..." for key in CAMERA_KEYS)
+            )
+        values[key] = value
+    if args.layout == "mosaic":
+        width, height = mosaic_tile_size(args.width, args.height, len(args.camera))
+    else:
+        width, height = args.width, args.height
+    if "size" in values:
+        try:
+            width, height = (int(part) for part in values["size"].lower().split("x"))
+        except ValueError:
+            raise ValueError(f"camera '{text}': size should be WxH")
+    default_detect = "imx500" if source == "imx500" else "none"
+    detect = values.get("detect", default_detect)
+    allowed = ["imx500", "none"] if source == "imx500" else ["cpu", "none"]
+    if detect not in allowed:
+        raise ValueError(f"camera '{text}': detect should be one of {allowed}")
+    try:
+        return CameraSpec(
+            values.get("name", f"cam{index}"),
+            source,
+            width,
+            height,
+            float(values.get("fps", args.fps)),
+            detect,
+            int(values.get("bitrate", args.bitrate)),
+            int(values.get("port", args.remote_port + PORT_STEP * index)),
+        )
+    except ValueError as e:
+        raise ValueError(f"camera '{text}': {e}")
+
+
+class Imx500Source(Picamera2Source):
+    def __init__(self, args: argparse.Namespace, spec: CameraSpec, labels: List[str]):
+        """The AI Camera: frames, and the on-sensor network's detections for each one."""
+        from picamera2.devices import IMX500
+        from picamera2.devices.imx500 import NetworkIntrinsics
+
+        self.args = args
+        self.imx500 = IMX500(args.model)  # Before Picamera2, as the IMX500 scripts do
+        intrinsics = self.imx500.network_intrinsics
+        if not intrinsics:
+            intrinsics = NetworkIntrinsics()
+            intrinsics.task = "object detection"
+        elif intrinsics.task != "object detection":
+            raise ValueError("the imx500 camera's network is not for object detection")
+        if intrinsics.labels is None:
+            intrinsics.labels = labels
+        intrinsics.update_with_defaults()
+        self.intrinsics = intrinsics
+        self.labels = intrinsics.labels
+        if intrinsics.ignore_dash_labels:
+            self.labels = [label for label in self.labels if label and label != "-"]
+        self.parse_enabled = spec.detect == "imx500"
+        self.timeline = timeline_from_args(args)
+        self.detections: Optional[List[Detection]] = None
+        self.imx500.show_network_fw_progress_bar()
+        super().__init__(self.imx500.camera_num, spec.width, spec.height, spec.fps)
+        if intrinsics.preserve_aspect_ratio:
+            self.imx500.set_auto_aspect_ratio()
+
+    def parse_detections(self, metadata: dict) -> Optional[List[Detection]]:
+        """Detections from this frame's output tensor; None if it carries none."""
+        np_outputs = self.imx500.get_outputs(metadata, add_batch=True)
+        if np_outputs is None:
+            return None
+        args, intrinsics = self.args, self.intrinsics
+        input_w, input_h = self.imx500.get_input_size()
+        if intrinsics.postprocess == "nanodet" and args.nanodet_engine == "picamera2":
+            from picamera2.devices.imx500 import postprocess_nanodet_detection
+            from picamera2.devices.imx500.postprocess import scale_boxes
+
+            boxes, scores, classes = postprocess_nanodet_detection(
+                outputs=np_outputs[0],
+                conf=args.threshold,
+                iou_thres=args.iou,
+                max_out_dets=args.max_detections,
+            )[0]
+            boxes = scale_boxes(boxes, 1, 1, input_h, input_w, False, False)
+        elif intrinsics.postprocess == "nanodet":
+            boxes, scores, classes = nanodet_postprocessor(input_w)(
+                np_outputs[0],
+                conf=args.threshold,
+                iou_thres=args.iou,
+                max_out_dets=args.max_detections,
+            )
+        else:
+            boxes, scores, classes = (
+                np_outputs[0][0],
+                np_outputs[1][0],
+                np_outputs[2][0],
+            )
+            if intrinsics.bbox_normalization:
+                boxes = boxes / input_h
+            if intrinsics.bbox_order == "xy":
+                boxes = boxes[:, [1, 0, 3, 2]]
+            boxes = zip(*np.array_split(boxes, 4, axis=1))
+        return [
+            Detection(
+                self.imx500.convert_inference_coords(box, metadata, self.camera),
+                int(category),
+                float(score),
+            )
+            for box, score, category in zip(boxes, scores, classes)
+            if score > args.threshold
+        ]
+
+    def read(self):
+        item = super().read()
+        if self.parse_enabled and self.metadata:
+            timestamp = self.metadata.get("SensorTimestamp", 0)
+            parsed = self.parse_detections(self.metadata)
+            if parsed is not None:
+                self.timeline.publish(timestamp, parsed)
+            # This frame's detections, or recent ones if it carried no output tensor
+            self.detections = self.timeline.for_frame(timestamp)
+        return item
+
+
+def open_camera(
+    spec: CameraSpec, args: argparse.Namespace, labels: List[str]
+) -> FrameSource:
+    if spec.source == "imx500":
+        return Imx500Source(args, spec, labels)
+    return open_frame_source(spec.source, spec.width, spec.height, spec.fps)
+
+
+class SharedBackend:
+    """One copy of the CPU detector's network for every camera; inferences take turns."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.input_size = backend.input_size
+        self._lock = threading.Lock()
+
+    def infer(self, *args):
+        # The wait for the lock counts as latency, so each camera's rate backs off
+        with self._lock:
+            return self.backend.infer(*args)
+
+
+def shared_detectors(
+    args: argparse.Namespace, specs: List[CameraSpec]
+) -> Dict[str, CpuDetector]:
+    """A CpuDetector per detect=cpu camera, all on one loaded network."""
+    wanted = [spec for spec in specs if spec.detect == "cpu"]
+    if not wanted:
+        return {}
+    backend = SharedBackend(detector_from_args(args).backend)
+    return {
+        spec.name: CpuDetector(
+            backend,
+            spec.fps,
+            threshold=args.threshold,
+            iou=args.iou,
+            max_detections=args.max_detections,
+            cpu_share=args.detector_cpu_share,
+            adaptive=args.adaptive_rate,
+        )
+        for spec in wanted
+    }
+
+
+def draw_detections(array: "np.ndarray", detections, labels: List[str]):
+    for detection in detections or []:
+        x, y, w, h = detection.box
+        category = int(detection.category)
+        name = labels[category] if category < len(labels) else str(category)
+        label_text = f"{name} ({detection.conf:.2f})"
+        (text_width, text_height), baseline = cv2.getTextSize(
+            label_text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1
+        )
+        text_x, text_y = x + 5, y + 15
+        cv2.rectangle(
+            array,
+            (text_x, text_y - text_height - baseline // 2),
+            (text_x + text_width, text_y + baseline // 2),
+            (255, 255, 255),
+            cv2.FILLED,
+        )
+        cv2.putText(
+            array,
+            label_text,
+            (text_x, text_y),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.5,
+            (0, 0, 255),
+            1,
+        )
+        cv2.rectangle(array, (x, y), (x + w, y + h), (0, 255, 0), thickness=2)
+    return array
+
+
+class CameraPipeline:
+    def __init__(
+        self,
+        spec: CameraSpec,
+        source: FrameSource,
+        detector: Optional[CpuDetector],
+        labels: List[str],
+        sink: Callable[["np.ndarray"], None],
+        harvester: Optional[CropHarvester] = None,
+    ):
+        """Capture, detect, draw and hand to sink, in this camera's own thread."""
+        self.spec = spec
+        self.source = source
+        self.detector = detector
+        self.labels = labels
+        self.sink = sink
+        self.harvester = harvester  # Shared by every camera, rate-limited per camera
+        self.frames_written = 0
+        self.write_seconds = 0.0
+        self.error: Optional[str] = None
+        self.ended = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.detector:
+            self.detector.start()
+        self._thread = threading.Thread(
+            target=self._run, name=f"camera-{self.spec.name}", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            item = self.source.read()
+            if item is None:
+                print(f"Camera {self.spec.name}: source ended.")
+                self.ended = True
+                return
+            frame, _ = item
+            if self.detector:
+                self.detector.submit(frame)
+                detections = self.detector.latest()
+            else:
+                detections = getattr(self.source, "detections", None)
+            if self.harvester:
+                # Before drawing: the crops must not carry the overlays
+                self.harvester.offer(frame, detections, source=self.spec.name)
+            draw_detections(frame, detections, self.labels)
+            started = time.perf_counter()
+            try:
+                self.sink(frame)
+            except (OSError, ValueError) as e:
+                self.error = str(e)
+                print(
+                    f"Error writing camera {self.spec.name} to ffmpeg: {e}",
+                    file=sys.stderr,
+                )
+                return
+            self.write_seconds += time.perf_counter() - started
+            self.frames_written += 1
+
+    def stop(self, timeout: float = 2.0):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def close(self):
+        if self.detector:
+            self.detector.close()
+        self.source.close()
+
+    def stats(self) -> dict:
+        stats = {
+            "source": self.source.stats(),
+            "frames_written": self.frames_written,
+            "write_ms": (
+                round(1000 * self.write_seconds / self.frames_written, 2)
+                if self.frames_written
+                else None
+            ),
+            "ended": self.ended,
+            "error": self.error,
+        }
+        if self.detector:
+            stats["detector"] = self.detector.stats()
+        elif self.spec.detect == "imx500":
+            stats["detection_sync"] = self.source.timeline.stats()
+        return stats
+
+
+class Mosaic:
+    def __init__(self, width: int, height: int, count: int, fps: float):
+        """Cameras tiled into one width x height frame, written out at fps."""
+        self.columns, self.rows = mosaic_grid(count)
+        self.tile_width, self.tile_height = mosaic_tile_size(width, height, count)
+        self.fps = fps
+        self.canvas = np.zeros((height, width, 3), np.uint8)
+        self.output = np.empty_like(self.canvas)
+        self.frames = 0
+        self.late = 0
+        self.resized = 0
+        self._lock = threading.Lock()
+
+    def tile(self, index: int) -> "np.ndarray":
+        column, row = index % self.columns, index // self.columns
+        x, y = column * self.tile_width, row * self.tile_height
+        return self.canvas[y : y + self.tile_height, x : x + self.tile_width]
+
+    def sink(self, index: int) -> Callable[["np.ndarray"], None]:
+        tile = self.tile(index)
+        size = (self.tile_width, self.tile_height)
+
+        def put(frame: "np.ndarray"):
+            if frame.shape[:2] != tile.shape[:2]:
+                # Only cameras given their own size= land here
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                self.resized += 1
+            with self._lock:
+                np.copyto(tile, frame)
+
+        return put
+
+    def run(self, output, stop: threading.Event):
+        """Write the newest tiles at a steady rate, whatever each camera delivers."""
+        period = 1.0 / self.fps
+        next_frame = time.monotonic()
+        while not stop.is_set():
+            with self._lock:
+                np.copyto(self.output, self.canvas)  # Cameras keep drawing meanwhile
+            output.write(self.output)
+            self.frames += 1
+            next_frame += period
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                stop.wait(delay)
+            elif delay < -1.0:
+                next_frame = time.monotonic()  # Far behind: don't burst
+                self.late += 1
+
+    def stats(self) -> dict:
+        return {
+            "grid": f"{self.columns}x{self.rows}",
+            "tile": f"{self.tile_width}x{self.tile_height}",
+            "frames": self.frames,
+            "late": self.late,
+            "resized_frames": self.resized,
+        }
+
+
+class SharedEncoder:
+    def __init__(
+        self,
+        specs: List[CameraSpec],
+        layout: str,
+        args: argparse.Namespace,
+        profile: EncoderProfile,
+    ):
+        """One ffmpeg for every camera: an encode each (streams) or one mosaic encode."""
+        self.specs = specs
+        self.layout = layout
+        self.remote_ip = args.remote_ip
+        self.progress = FfmpegProgress("cameras")
+        self.mosaic: Optional[Mosaic] = None
+        self._stop = threading.Event()
+        self._writers = []
+        command = ["ffmpeg", *self.progress.ffmpeg_args(), "-loglevel", "warning"]
+        if layout == "mosaic":
+            self.mosaic = Mosaic(args.width, args.height, len(specs), args.fps)
+            self.port = args.remote_port
+            command += self._input(args.width, args.height, args.fps, "-")
+            command += self._output(args.fps, args.bitrate, args.remote_port, profile)
+            self.process = self._popen(
+                command, stdin=subprocess.PIPE, pass_fds=self.progress.pass_fds
+            )
+            self._writers = [self.process.stdin]
+            threading.Thread(
+                target=self._run_mosaic, name="mosaic", daemon=True
+            ).start()
+        else:
+            pipes = [os.pipe() for _ in specs]
+            for spec, (read_fd, _) in zip(specs, pipes):
+                command += self._input(
+                    spec.width, spec.height, spec.fps, f"pipe:{read_fd}"
+                )
+            for index, spec in enumerate(specs):
+                command += ["-map", f"{index}:v"]
+                command += self._output(spec.fps, spec.bitrate, spec.port, profile)
+            try:
+                self.process = self._popen(
+                    command,
+                    pass_fds=(*self.progress.pass_fds, *(read for read, _ in pipes)),
+                )
+            except OSError:
+                for fd in (fd for pipe in pipes for fd in pipe):
+                    os.close(fd)
+                raise
+            for read_fd, write_fd in pipes:
+                os.close(read_fd)
+                self._writers.append(os.fdopen(write_fd, "wb"))
+        self.progress.start()
+
+    def _popen(self, command: List[str], **kwargs) -> subprocess.Popen:
+        """Start ffmpeg; OSError (e.g. not installed) once the progress pipe is closed."""
+        try:
+            return subprocess.Popen(command, **kwargs)
+        except OSError:
+            self.progress.close()
+            raise
+
+    @staticmethod
+    def _input(width: int, height: int, fps: float, path: str) -> List[str]:
+        return [
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "bgr24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            f"{fps:g}",
+            # Room for a few frames per input, so one camera's pipe never holds up the rest
+            "-thread_queue_size",
+            "16",
+            "-i",
+            path,
+        ]
+
+    def _output(
+        self, fps: float, bitrate: int, port: int, profile: EncoderProfile
+    ) -> List[str]:
+        return [
+            "-c:v",
+            "libx264",
+            *profile.ffmpeg_args(fps, bitrate),
+            "-pix_fmt",
+            "yuv420p",
+            "-f",
+            "rtp",
+            f"rtp://{self.remote_ip}:{port}",
+        ]
+
+    def _run_mosaic(self):
+        try:
+            self.mosaic.run(self.process.stdin, self._stop)
+        except (OSError, ValueError) as e:
+            if not self._stop.is_set():
+                print(f"Error writing the mosaic to ffmpeg: {e}", file=sys.stderr)
+
+    def sink(self, index: int) -> Callable[["np.ndarray"], None]:
+        if self.mosaic:
+            return self.mosaic.sink(index)
+        return self._writers[index].write  # No tobytes() copy
+
+    @property
+    def running(self) -> bool:
+        return self.process.poll() is None
+
+    def describe(self) -> str:
+        if self.mosaic:
+            return (
+                f"one mosaic ({self.mosaic.columns}x{self.mosaic.rows} tiles of "
+                f"{self.mosaic.tile_width}x{self.mosaic.tile_height}) to "
+                f"{self.remote_ip}:{self.port}"
+            )
+        return ", ".join(
+            f"{spec.name} to {self.remote_ip}:{spec.port}" for spec in self.specs
+        )
+
+    def close(self):
+        self._stop.set()
+        for writer in self._writers:
+            try:
+                writer.close()
+            except OSError:
+                pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.terminate()
+            self.process.wait()
+        self.progress.close()
+
+    def stats(self) -> dict:
+        stats = {"layout": self.layout, "encoder": self.progress.stats()}
+        if self.mosaic:
+            stats["mosaic"] = self.mosaic.stats()
+        return stats
+
+
+def check(args) -> int:
+    """Run the multi-camera script on synthetic cameras; fail if any camera falls short."""
+    script = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), MULTI_CAMERA_SCRIPT
+    )
+    stats_path = os.path.join(tempfile.mkdtemp(prefix="camera-rig-"), "stats.json")
+    command = [
+        sys.executable,
+        script,
+        "--layout",
+        args.layout,
+        "--width",
+        str(args.width),
+        "--height",
+        str(args.height),
+        "--fps",
+        str(args.fps),
+        "--remote-ip",
+        "127.0.0.1",
+        "--stats-file",
+        stats_path,
+        "--stats-interval",
+        "1",
+    ]
+    for index in range(args.cameras):
+        # Different seeds, so every camera sees its own scene
+        command += ["--camera", f"synthetic:{index + 1},name=cam{index},detect=cpu"]
+    command += ["--synthetic-cost-ms", str(args.synthetic_cost_ms)]
+    print(
+        f"Running {args.cameras} synthetic cameras ({args.layout}) for {args.duration:g} s"
+    )
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        process.wait(timeout=args.duration)
+    except subprocess.TimeoutExpired:
+        process.send_signal(signal.SIGINT)  # The script's own cleanup path
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    try:
+        with open(stats_path) as f:
+            stats = json.load(f)
+    except (OSError, ValueError):
+        print(
+            f"Error: no stats from the script (status {process.returncode}).",
+            file=sys.stderr,
+        )
+        return 1
+    cameras = stats.get("cameras", {})
+    failures = []
+    print(
+        f"  {'camera':<8} {'fps':>6} {'written':>8} {'write ms':>9} {'inferences':>11}"
+    )
+    for index in range(args.cameras):
+        name = f"cam{index}"
+        camera = cameras.get(name)
+        if not camera:
+            failures.append(f"{name} missing")
+            continue
+        fps = camera["source"]["fps"]
+        inferences = camera.get("detector", {}).get("inferences", 0)
+        print(
+            f"  {name:<8} {fps:6.1f} {camera['frames_written']:8d} "
+            f"{camera['write_ms'] or 0:9.2f} {inferences:11d}"
+        )
+        if fps < 0.9 * args.fps:
+            failures.append(f"{name} at {fps:.1f} fps")
+        if camera["error"] or not camera["frames_written"]:
+            failures.append(f"{name} wrote nothing ({camera['error']})")
+        if not inferences:
+            failures.append(f"{name} never ran its detector")
+    encoder = stats.get("encoder", {}).get("encoder", {})
+    print(f"  encoder: {encoder.get('frames')} frames, speed {encoder.get('speed')}")
+    if not encoder.get("frames"):
+        failures.append("the encoder reported no frames")
+    if failures:
+        print("FAIL: " + "; ".join(failures))
+        return 1
+    print(f"OK: {args.cameras} cameras streamed together")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Several cameras in one process")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    check_parser = subparsers.add_parser(
+        "check", help="Stream several synthetic cameras at once and check each one"
+    )
+    check_parser.add_argument("--cameras", type=int, default=3)
+    check_parser.add_argument("--layout", choices=LAYOUTS, default="streams")
+    check_parser.add_argument("--width", type=int, default=640)
+    check_parser.add_argument("--height", type=int, default=360)
+    check_parser.add_argument("--fps", type=int, default=15)
+    check_parser.add_argument("--duration", type=float, default=15.0, help="Seconds")
+    check_parser.add_argument(
+        "--synthetic-cost-ms",
+        type=float,
+        default=20.0,
+        help="CPU time per inference of the shared synthetic detector",
+    )
+    args = parser.parse_args()
+    commands = {"check": check}
+    return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
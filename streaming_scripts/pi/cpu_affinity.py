@@ -0,0 +1,495 @@
+"""
+cpu_affinity.py - Pin each streaming pipeline role to its own cores with its own priority
+
+On a 4-core Pi, the camera capture loop, the libx264 threads of every ffmpeg encoder
+and ROS all compete for the same cores. The capture loop is the part that must not
+wait: a late capture_request() shows up as jitter in every stream. A CPU layout gives
+each role a CPU set, a nice value, an optional scheduling policy and (for encoders)
+an x264 thread count:
+
+    capture      the main Python thread (capture, detection parsing, overlays)
+    audio        the audio capture thread and its arecord process
+    encoder-yt   the YouTube ffmpeg process and all of its threads
+    encoder-pc   the PC ffmpeg process and all of its threads
+    sink         RTP packetizing / FEC / pacing threads
+    detector     the CPU object detector's worker thread (threads= sets OpenCV's count)
+
+A layout is one of the named layouts below, or a spec string of `role@cpus:key=value`
+entries separated by spaces, e.g.
+
+    "capture@0 audio@0 encoder-yt@1-2:threads=2:nice=5 encoder-pc@3:threads=1:nice=5"
+
+Keys: threads (x264 -threads), nice (-20..19; below 0 needs root), sched
+(other, batch, idle, fifo/PRIORITY, rr/PRIORITY; fifo and rr need root or an
+rtprio limit). Policies are applied per thread (Linux tids), so the capture thread
+can be pinned without pinning the audio thread next to it. Child processes get the
+policy on every thread they have, and threads they create later inherit it.
+
+Usage (from a streaming script):
+    layout = layout_from_args(args)
+    cmd = [..., "-c:v", "libx264", *layout.x264_args("encoder-pc"), ...]
+    process = subprocess.Popen(cmd, ...)
+    layout.apply_to_process("encoder-pc", process.pid)
+    layout.apply_to_current_thread("capture")
+
+    # Compare capture jitter and throughput across layouts
+    python3 cpu_affinity.py benchmark --layouts none,isolated,ros --background 1
+
+    # Run any command (e.g. a gst-launch pipeline) under a role's policy
+    python3 cpu_affinity.py run --cpu-layout ros encoder-pc -- gst-launch-1.0 ...
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+ROLES = ["capture", "audio", "encoder-yt", "encoder-pc", "sink", "detector"]
+# Python thread names (threading.Thread(name=...)) that belong to each role
+ROLE_THREAD_NAMES = {
+    "audio": ["audio-capture"],
+    "sink": ["pc-rtp-fec", "pc-web-viewer", "rtp-pacer"],
+    "detector": ["cpu-detector"],
+}
+
+LAYOUTS = {
+    # Leave everything to the kernel scheduler
+    "none": "",
+    # Capture and audio own core 0; each encoder gets the rest, at lower priority
+    "isolated": (
+        "capture@0 audio@0 sink@0 encoder-yt@1-2:threads=2:nice=5"
+        " encoder-pc@3:threads=1:nice=5 detector@1-2:threads=2:nice=10"
+    ),
+    # Core 0 is left to ROS on the turtlebot
+    "ros": (
+        "capture@1 audio@1 sink@1 encoder-yt@2:threads=1:nice=5"
+        " encoder-pc@3:threads=1:nice=5 detector@2:threads=1:nice=10"
+    ),
+    # Like isolated, with real-time capture and audio threads (needs root or rtprio)
+    "realtime": (
+        "capture@0:sched=fifo/10 audio@0:sched=fifo/20 sink@0"
+        " encoder-yt@1-2:threads=2 encoder-pc@3:threads=1 detector@1-2:threads=2:nice=10"
+    ),
+}
+
+SCHED_POLICIES = {
+    "other": os.SCHED_OTHER,
+    "batch": os.SCHED_BATCH,
+    "idle": os.SCHED_IDLE,
+    "fifo": os.SCHED_FIFO,
+    "rr": os.SCHED_RR,
+}
+
+
+def parse_cpus(text: str) -> Set[int]:
+    """'0', '1-2', '0,3' or '*' (any CPU) to a CPU set."""
+    if text in ("", "*"):
+        return set()
+    cpus: Set[int] = set()
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+class RolePolicy:
+    def __init__(
+        self,
+        cpus: Optional[Set[int]] = None,
+        nice: Optional[int] = None,
+        sched: Optional[str] = None,
+        priority: int = 0,
+        threads: Optional[int] = None,
+    ):
+        self.cpus = cpus or set()
+        self.nice = nice
+        self.sched = sched
+        self.priority = priority
+        self.threads = threads
+
+    def __repr__(self):
+        parts = [",".join(str(c) for c in sorted(self.cpus)) or "*"]
+        if self.threads:
+            parts.append(f"threads={self.threads}")
+        if self.nice is not None:
+            parts.append(f"nice={self.nice}")
+        if self.sched:
+            parts.append(f"sched={self.sched}/{self.priority}")
+        return ":".join(parts)
+
+
+def parse_layout(spec: str) -> Dict[str, RolePolicy]:
+    """A named layout or a 'role@cpus:key=value ...' spec to per-role policies."""
+    spec = LAYOUTS.get(spec, spec)
+    policies: Dict[str, RolePolicy] = {}
+    for entry in spec.replace(";", " ").split():
+        role, _, rest = entry.partition("@")
+        if role not in ROLES:
+            raise ValueError(f"Unknown role '{role}' (roles: {', '.join(ROLES)})")
+        cpu_text, *options = rest.split(":")
+        policy = RolePolicy(parse_cpus(cpu_text))
+        for option in options:
+            key, _, value = option.partition("=")
+            if key == "threads":
+                policy.threads = int(value)
+            elif key == "nice":
+                policy.nice = int(value)
+            elif key == "sched":
+                name, _, priority = value.partition("/")
+                if name not in SCHED_POLICIES:
+                    raise ValueError(f"Unknown scheduling policy '{name}'")
+                policy.sched = name
+                policy.priority = int(priority or 0)
+            else:
+                raise ValueError(f"Unknown layout option '{key}' for {role}")
+        policies[role] = policy
+    return policies
+
+
+class CpuLayout:
+    def __init__(self, spec: str = "none"):
+        self.spec = spec
+        self.policies = parse_layout(spec)
+        self.available = os.sched_getaffinity(0)
+        self.applied: Dict[str, List[int]] = {}
+        self._warned: Set[str] = set()
+
+    def threads(self, role: str) -> Optional[int]:
+        policy = self.policies.get(role)
+        return policy.threads if policy else None
+
+    def x264_args(self, role: str) -> List[str]:
+        """ffmpeg output options limiting libx264 to the role's thread count."""
+        policy = self.policies.get(role)
+        if policy is None or not policy.threads:
+            return []
+        return ["-threads", str(policy.threads)]
+
+    def apply_to_thread(self, role: str, tid: int):
+        """Apply the role's policy to one Linux thread (or single-threaded process)."""
+        policy = self.policies.get(role)
+        if policy is None:
+            return
+        try:
+            if policy.cpus:
+                cpus = policy.cpus & self.available
+                if not cpus:
+                    self._warn(role, f"none of CPUs {sorted(policy.cpus)} available")
+                else:
+                    os.sched_setaffinity(tid, cpus)
+            if policy.sched:
+                os.sched_setscheduler(
+                    tid,
+                    SCHED_POLICIES[policy.sched],
+                    os.sched_param(policy.priority),
+                )
+            if policy.nice is not None:
+                # With PRIO_PROCESS and a tid, Linux sets the nice of that thread only
+                os.setpriority(os.PRIO_PROCESS, tid, policy.nice)
+        except PermissionError as e:
+            self._warn(role, f"{e.strerror}; run with sudo or relax the layout")
+        except ProcessLookupError:
+            return  # The thread already exited
+        self.applied.setdefault(role, []).append(tid)
+
+    def apply_to_current_thread(self, role: str):
+        self.apply_to_thread(role, threading.get_native_id())
+
+    def apply_to_process(self, role: str, pid: int):
+        """Apply to every thread of a child; threads it creates later inherit the policy."""
+        try:
+            tids = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+        except FileNotFoundError:
+            tids = [pid]
+        for tid in tids:
+            self.apply_to_thread(role, tid)
+
+    def apply_to_named_threads(self):
+        """Apply to the running Python threads named in ROLE_THREAD_NAMES."""
+        for thread in threading.enumerate():
+            for role, names in ROLE_THREAD_NAMES.items():
+                if thread.name in names and thread.native_id is not None:
+                    self.apply_to_thread(role, thread.native_id)
+
+    def describe(self) -> str:
+        if not self.policies:
+            return "no CPU pinning"
+        return " ".join(f"{role}@{policy}" for role, policy in self.policies.items())
+
+    def stats(self) -> dict:
+        return {
+            "layout": self.spec,
+            "policies": {role: repr(p) for role, p in self.policies.items()},
+            "applied_tids": self.applied,
+        }
+
+    def _warn(self, role: str, message: str):
+        if role in self._warned:
+            return
+        self._warned.add(role)
+        print(f"Warning: CPU layout for {role}: {message}", file=sys.stderr)
+
+
+def add_affinity_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by every script with capture and encoder roles."""
+    parser.add_argument(
+        "--cpu-layout",
+        type=str,
+        default=os.environ.get("CPU_LAYOUT", "none"),
+        help=f"CPU pinning and priority per role: {', '.join(LAYOUTS)} or a 'role@cpus:key=value ...' spec (env: CPU_LAYOUT)",
+    )
+
+
+def layout_from_args(args) -> CpuLayout:
+    try:
+        return CpuLayout(args.cpu_layout)
+    except ValueError as e:
+        print(f"Error: invalid --cpu-layout: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+# Stand-in encoder for machines without ffmpeg: JPEG-encodes every frame
+JPEG_ENCODER_SOURCE = """
+import sys, cv2, numpy as np
+w, h = int(sys.argv[1]), int(sys.argv[2])
+size = w * h * 3
+stdin = sys.stdin.buffer
+while True:
+    data = stdin.read(size)
+    if len(data) < size:
+        break
+    cv2.imencode(".jpg", np.frombuffer(data, np.uint8).reshape(h, w, 3))
+"""
+
+
+def check_benchmark_encoder(args):
+    """Fall back to the JPEG stand-in where ffmpeg is not installed."""
+    if args.encoder == "ffmpeg" and not shutil.which("ffmpeg"):
+        print("ffmpeg not found; using the JPEG stand-in encoder", file=sys.stderr)
+        args.encoder = "jpeg"
+
+
+def start_benchmark_encoder(args, layout: CpuLayout, role: str) -> subprocess.Popen:
+    if args.encoder == "jpeg":
+        cmd = [
+            sys.executable,
+            "-c",
+            JPEG_ENCODER_SOURCE,
+            str(args.width),
+            str(args.height),
+        ]
+    else:
+        cmd = [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "bgr24",
+            "-s",
+            f"{args.width}x{args.height}",
+            "-r",
+            str(args.fps),
+            "-i",
+            "-",
+            "-c:v",
+            "libx264",
+            *layout.x264_args(role),
+            "-preset",
+            "veryfast",
+            "-tune",
+            "zerolatency",
+            "-pix_fmt",
+            "yuv420p",
+            "-f",
+            "null",
+            "-",
+        ]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    layout.apply_to_process(role, process.pid)
+    return process
+
+
+def benchmark_run(args):
+    """One layout in this process: paced synthetic capture into two encoders."""
+    import cv2
+    import numpy as np
+
+    check_benchmark_encoder(args)
+    layout = CpuLayout(args.layout)
+    background = [
+        subprocess.Popen([sys.executable, "-c", "while True: pass"])
+        for _ in range(args.background)
+    ]
+    encoders = [
+        start_benchmark_encoder(args, layout, role)
+        for role in ("encoder-yt", "encoder-pc")
+    ]
+    layout.apply_to_current_thread("capture")
+
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 255, (args.height, args.width, 3), dtype=np.uint8)
+    period = 1.0 / args.fps
+    lateness: List[float] = []
+    frames = 0
+    start = time.monotonic()
+    deadline = start
+    try:
+        while time.monotonic() - start < args.seconds:
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            # A camera frame that arrives late is delivered late, not skipped
+            lateness.append(max(0.0, time.monotonic() - deadline))
+            frame = base.copy()
+            x = (frames * 7) % (args.width - 200)
+            cv2.rectangle(frame, (x, 100), (x + 200, 300), (0, 255, 0), 2)
+            cv2.putText(
+                frame,
+                "person (0.87)",
+                (x + 5, 115),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.5,
+                (0, 0, 255),
+                1,
+            )
+            data = frame.tobytes()
+            for encoder in encoders:
+                encoder.stdin.write(data)
+            frames += 1
+            if deadline < time.monotonic() - period:
+                deadline = time.monotonic()  # Don't try to catch up a backlog
+    finally:
+        elapsed = time.monotonic() - start
+        for encoder in encoders:
+            encoder.stdin.close()
+            encoder.wait()
+        for process in background:
+            process.kill()
+            process.wait()
+
+    lateness_ms = np.array(lateness) * 1000
+    print(
+        json.dumps(
+            {
+                "layout": args.layout,
+                "fps": frames / elapsed,
+                "late_p50_ms": float(np.percentile(lateness_ms, 50)),
+                "late_p99_ms": float(np.percentile(lateness_ms, 99)),
+                "late_max_ms": float(lateness_ms.max()),
+                "late_frames": int((lateness_ms > period * 1000 / 2).sum()),
+            }
+        )
+    )
+
+
+def benchmark(args):
+    """Run each layout in a fresh process so one layout's policies can't leak into the next."""
+    check_benchmark_encoder(args)
+    results = []
+    for layout in args.layouts.split(","):
+        parse_layout(layout)  # Fail early on a typo
+        cmd = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "benchmark-run",
+            "--layout",
+            layout,
+            "--seconds",
+            str(args.seconds),
+            "--fps",
+            str(args.fps),
+            "--width",
+            str(args.width),
+            "--height",
+            str(args.height),
+            "--encoder",
+            args.encoder,
+            "--background",
+            str(args.background),
+        ]
+        print(f"Running layout '{layout}' for {args.seconds:.0f}s...", flush=True)
+        output = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, check=True)
+        results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    print(
+        f"\n{'layout':<12} {'fps':>6} {'late p50':>9} {'late p99':>9} {'late max':>9} {'late frames':>12}"
+    )
+    for r in results:
+        print(
+            f"{r['layout']:<12} {r['fps']:6.1f} {r['late_p50_ms']:7.2f}ms {r['late_p99_ms']:7.2f}ms"
+            f" {r['late_max_ms']:7.2f}ms {r['late_frames']:12d}"
+        )
+
+
+def run(args):
+    """Apply a role's policy to this process and exec the command."""
+    layout = layout_from_args(args)
+    layout.apply_to_thread(args.role, os.getpid())
+    os.execvp(args.command[0], args.command)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU layouts for the streaming roles")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    def add_benchmark_options(sub):
+        sub.add_argument("--seconds", type=float, default=20.0)
+        sub.add_argument("--fps", type=int, default=30)
+        sub.add_argument("--width", type=int, default=1280)
+        sub.add_argument("--height", type=int, default=720)
+        sub.add_argument(
+            "--encoder",
+            choices=["ffmpeg", "jpeg"],
+            default="ffmpeg",
+            help="libx264 through ffmpeg, or a JPEG stand-in where ffmpeg is missing",
+        )
+        sub.add_argument(
+            "--background",
+            type=int,
+            default=0,
+            help="Unpinned busy processes competing like ROS nodes",
+        )
+
+    bench_parser = subparsers.add_parser(
+        "benchmark", help="Compare capture jitter and throughput across layouts"
+    )
+    bench_parser.add_argument("--layouts", default="none,isolated,ros")
+    add_benchmark_options(bench_parser)
+
+    run_parser = subparsers.add_parser("benchmark-run", help=argparse.SUPPRESS)
+    run_parser.add_argument("--layout", default="none")
+    add_benchmark_options(run_parser)
+
+    exec_parser = subparsers.add_parser(
+        "run", help="Run a command under one role's policy"
+    )
+    add_affinity_arguments(exec_parser)
+    exec_parser.add_argument("role", choices=ROLES)
+    exec_parser.add_argument("command", nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    if args.subcommand == "benchmark":
+        benchmark(args)
+    elif args.subcommand == "benchmark-run":
+        benchmark_run(args)
+    else:
+        if args.command and args.command[0] == "--":
+            args.command = args.command[1:]
+        if not args.command:
+            parser.error("run needs a command after the role")
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
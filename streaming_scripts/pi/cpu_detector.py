@@ -0,0 +1,581 @@
+"""
+cpu_detector.py - Object detection on the CPU for cameras without an IMX500
+
+The AI Camera runs its network on the sensor. The Camera Module v2 (and any webcam
+or recording) has no such chip, so this module runs a small network with OpenCV DNN
+instead. Inference runs in a worker thread on a low-resolution copy of the frame.
+OpenCV releases the GIL while the network runs, so the capture loop keeps going.
+
+The detections have the same fields the IMX500 scripts draw (box as x, y, w, h in
+frame pixels, category, conf), so draw_detections_on_array and the frame bus
+records work unchanged.
+
+The inference rate adapts so streaming fps is never starved:
+
+* A new inference starts only when the worker is idle and the minimum interval has
+  passed. Frames that arrive in between are streamed with the latest detections.
+* The minimum interval never drops below latency / cpu_share, so the network is
+  busy at most that share of the time.
+* The capture loop reports every frame. When its fps over a one-second window
+  falls below 95% of the target, or the encoder reports it is falling behind
+  (add_pressure_source), the interval grows by half. When the target is met,
+  the interval shrinks by 10% per window.
+
+Models (--detector-model):
+    *.pb + --detector-config *.pbtxt, *.caffemodel + *.prototxt
+                    SSD-style networks with a DetectionOutput layer (MobileNet-SSD)
+    *.onnx          nanodet-plus ONNX exports (decoded with nanodet_postprocess.py)
+
+SSD models number their classes from 1, with 0 for background. --label-offset
+(default 1 for SSD, 0 otherwise) is subtracted so the categories index a labels
+file without a background line:
+    TF ssd_mobilenet_v2_coco    assets/coco_labels.txt (0 = person), default offset
+    Caffe MobileNet-SSD (VOC)   the 20 VOC classes, aeroplane first, default offset;
+                                or a list that starts with background and --label-offset 0
+    nanodet-plus (COCO 80)      an 80-class COCO list, person first (no '-' gaps)
+    synthetic       finds the shapes drawn by frame_sources.SyntheticSource; with
+                    --synthetic-cost-ms it also burns that much CPU like a network
+
+Usage (from a streaming script):
+    detector = detector_from_args(args)
+    detector.start()
+    while streaming:
+        frame, _ = source.read()
+        detector.submit(frame)
+        draw_detections_on_array(frame, detector.latest())
+
+    # Capture fps and inference rate without a detector, inferring every frame,
+    # and with the adaptive rate
+    python3 cpu_detector.py benchmark --source synthetic --synthetic-cost-ms 80 --background 2
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from frame_sources import SYNTHETIC_OBJECTS, add_source_arguments, open_frame_source
+from nanodet_postprocess import nanodet_postprocessor
+from startup_timing import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+
+DEFAULT_CPU_SHARE = 0.5
+MAX_INTERVAL = 5.0  # Never infer less often than this
+RATE_WINDOW = 1.0  # Seconds of capture fps behind each rate decision
+NANODET_MEAN = (103.53, 116.28, 123.675)  # BGR, as in the nanodet training config
+NANODET_STD = (57.375, 57.12, 58.395)
+
+# (x0, y0, x1, y1) normalized, category, score
+RawDetection = Tuple[Tuple[float, float, float, float], int, float]
+
+
+def env_int(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default}.", file=sys.stderr)
+        return default
+
+
+class Detection:
+    def __init__(self, box: Tuple[int, int, int, int], category: int, conf: float):
+        """box is (x, y, w, h) in frame pixels, like the IMX500 scripts' Detection."""
+        self.box = box
+        self.category = category
+        self.conf = conf
+
+    def __repr__(self):
+        return f"Detection({self.box}, {self.category}, {self.conf:.2f})"
+
+
+class DnnBackend:
+    def __init__(
+        self,
+        model: str,
+        config: Optional[str] = None,
+        kind: Optional[str] = None,
+        input_size: Optional[int] = None,
+        label_offset: Optional[int] = None,
+    ):
+        """An OpenCV DNN network; kind is 'ssd' or 'nanodet' (default: by extension).
+
+        label_offset is subtracted from the network's class ids (default: 1 for
+        ssd, whose label 0 is background; 0 for nanodet).
+        """
+        self.kind = kind or ("nanodet" if model.endswith(".onnx") else "ssd")
+        if label_offset is None:
+            label_offset = 1 if self.kind == "ssd" else 0
+        self.label_offset = label_offset
+        self.size = input_size or (416 if self.kind == "nanodet" else 300)
+        self.input_size = (self.size, self.size)
+        self.net = cv2.dnn.readNet(model, config or "")
+
+    def infer(
+        self, image: "np.ndarray", threshold: float, iou: float, max_detections: int
+    ) -> List[RawDetection]:
+        if self.kind == "nanodet":
+            blob = cv2.dnn.blobFromImage(image, 1.0, self.input_size, NANODET_MEAN)
+            blob /= np.float32(NANODET_STD).reshape(1, 3, 1, 1)
+            self.net.setInput(blob)
+            boxes, scores, classes = nanodet_postprocessor(self.size)(
+                self.net.forward(),
+                conf=threshold,
+                iou_thres=iou,
+                max_out_dets=max_detections,
+                activated=True,
+            )
+            return [
+                ((x0, y0, x1, y1), int(category) - self.label_offset, float(score))
+                for (y0, x0, y1, x1), score, category in zip(boxes, scores, classes)
+                if int(category) >= self.label_offset
+            ]
+
+        # MobileNet-SSD style: [1, 1, N, 7] rows of (image, label, score, x0, y0, x1, y1)
+        blob = cv2.dnn.blobFromImage(
+            image, 1 / 127.5, self.input_size, (127.5, 127.5, 127.5), swapRB=True
+        )
+        self.net.setInput(blob)
+        rows = self.net.forward().reshape(-1, 7)
+        # Background (below the offset) is never a detection
+        rows = rows[(rows[:, 2] > threshold) & (rows[:, 1] >= self.label_offset)]
+        return [
+            (
+                tuple(np.clip(row[3:7], 0.0, 1.0)),
+                int(row[1]) - self.label_offset,
+                float(row[2]),
+            )
+            for row in rows[:max_detections]
+        ]
+
+
+class SyntheticBackend:
+    def __init__(self, cost_ms: float = 0.0, input_size: int = 320):
+        """Colour-blob 'network' for SyntheticSource frames, costing about cost_ms."""
+        self.input_size = (input_size, input_size)
+        self.colours = np.array([colour for _, colour, _ in SYNTHETIC_OBJECTS], float)
+        self.categories = [category for category, _, _ in SYNTHETIC_OBJECTS]
+        self.burn_rounds = 0
+        if cost_ms > 0:
+            self.burn_rounds = self._calibrate(cost_ms / 1000.0)
+
+    def _burn(self, image: "np.ndarray", rounds: int):
+        # Real work in OpenCV (which releases the GIL), like a network forward pass
+        work = image.astype(np.float32)
+        for _ in range(rounds):
+            work = cv2.GaussianBlur(work, (9, 9), 0)
+
+    def _calibrate(self, seconds: float) -> int:
+        image = np.zeros((*self.input_size, 3), np.uint8)
+        start = time.perf_counter()
+        self._burn(image, 10)
+        per_round = (time.perf_counter() - start) / 10
+        return max(1, int(seconds / per_round))
+
+    def infer(
+        self, image: "np.ndarray", threshold: float, iou: float, max_detections: int
+    ) -> List[RawDetection]:
+        self._burn(image, self.burn_rounds)
+        height, width = image.shape[:2]
+        saturation = image.max(axis=2).astype(np.int16) - image.min(axis=2)
+        mask = (saturation > 80).astype(np.uint8)
+        count, _, boxes, _ = cv2.connectedComponentsWithStats(mask)
+        detections: List[RawDetection] = []
+        for label in range(1, count):
+            x, y, w, h, area = boxes[label]
+            if area < 30:
+                continue
+            region = image[y : y + h, x : x + w][mask[y : y + h, x : x + w] > 0]
+            colour = region.mean(axis=0)
+            nearest = int(np.argmin(np.abs(self.colours - colour).sum(axis=1)))
+            score = min(1.0, area / float(w * h) + 0.2)
+            if score > threshold:
+                box = (x / width, y / height, (x + w) / width, (y + h) / height)
+                detections.append((box, self.categories[nearest], score))
+        detections.sort(key=lambda d: -d[2])
+        return detections[:max_detections]
+
+
+class AdaptiveRate:
+    def __init__(
+        self,
+        target_fps: float,
+        cpu_share: float = DEFAULT_CPU_SHARE,
+        adaptive: bool = True,
+    ):
+        """Minimum seconds between inference starts, driven by latency and capture fps."""
+        self.target_fps = target_fps
+        self.cpu_share = cpu_share
+        self.adaptive = adaptive
+        self.latency = 0.0
+        self.interval = 0.0
+        self.capture_fps = 0.0
+        self._window_start: Optional[float] = None
+        self._window_frames = 0
+        self._pressure_sources: List[Callable[[], Optional[str]]] = []
+
+    def add_pressure_source(self, pressure: Callable[[], Optional[str]]):
+        """Back off while this returns a reason, e.g. FfmpegProgress.pressure."""
+        self._pressure_sources.append(pressure)
+
+    @property
+    def floor(self) -> float:
+        return self.latency / self.cpu_share if self.adaptive else 0.0
+
+    def on_inference(self, seconds: float):
+        self.latency = (
+            seconds if not self.latency else 0.8 * self.latency + 0.2 * seconds
+        )
+        self.interval = max(self.interval, self.floor)
+
+    def on_frame(self, now: float):
+        if self._window_start is None:
+            self._window_start = now
+        self._window_frames += 1
+        elapsed = now - self._window_start
+        if elapsed < RATE_WINDOW:
+            return
+        self.capture_fps = (self._window_frames - 1) / elapsed
+        self._window_start, self._window_frames = now, 1
+        if not self.adaptive:
+            return
+        pressure = any(source() for source in self._pressure_sources)
+        if pressure or self.capture_fps < 0.95 * self.target_fps:
+            self.interval = min(
+                MAX_INTERVAL, max(self.interval, self.floor, 0.05) * 1.5
+            )
+        else:
+            self.interval = max(self.floor, self.interval * 0.9)
+
+
+class CpuDetector:
+    def __init__(
+        self,
+        backend,
+        target_fps: float,
+        threshold: float = 0.55,
+        iou: float = 0.65,
+        max_detections: int = 10,
+        cpu_share: float = DEFAULT_CPU_SHARE,
+        adaptive: bool = True,
+    ):
+        self.backend = backend
+        self.threshold = threshold
+        self.iou = iou
+        self.max_detections = max_detections
+        self.rate = AdaptiveRate(target_fps, cpu_share, adaptive)
+        self.detections: List[Detection] = []
+        self.detections_time = 0.0  # monotonic time of the frame they came from
+        self.inferences = 0
+        self.skipped = 0
+        self._pending: Optional[Tuple[np.ndarray, Tuple[int, int], float]] = None
+        self._busy = False
+        self._next_start = 0.0
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="cpu-detector", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, frame: "np.ndarray", now: Optional[float] = None) -> bool:
+        """Offer a frame from the capture loop; True if it was taken for inference."""
+        now = time.monotonic() if now is None else now
+        self.rate.on_frame(now)
+        with self._condition:
+            if self._busy or now < self._next_start:
+                self.skipped += 1
+                return False
+            self._busy = True
+            self._next_start = now + self.rate.interval
+        # The small copy is made here, so the caller may draw on frame right away
+        small = cv2.resize(frame, self.backend.input_size, interpolation=cv2.INTER_AREA)
+        with self._condition:
+            self._pending = (small, (frame.shape[1], frame.shape[0]), now)
+            self._condition.notify()
+        return True
+
+    def latest(self) -> List[Detection]:
+        return self.detections
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and self._running:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                small, (width, height), frame_time = self._pending
+                self._pending = None
+            start = time.perf_counter()
+            try:
+                raw = self.backend.infer(
+                    small, self.threshold, self.iou, self.max_detections
+                )
+            except cv2.error as e:
+                print(f"Warning: detector inference failed: {e}", file=sys.stderr)
+                raw = []
+            self.rate.on_inference(time.perf_counter() - start)
+            self.detections = [
+                Detection(
+                    (
+                        int(x0 * width),
+                        int(y0 * height),
+                        int((x1 - x0) * width),
+                        int((y1 - y0) * height),
+                    ),
+                    category,
+                    score,
+                )
+                for (x0, y0, x1, y1), category, score in raw
+            ]
+            self.detections_time = frame_time
+            self.inferences += 1
+            with self._condition:
+                self._busy = False
+
+    def close(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def stats(self) -> dict:
+        return {
+            "inferences": self.inferences,
+            "skipped_frames": self.skipped,
+            "latency_ms": round(self.rate.latency * 1000, 1),
+            "min_interval_ms": round(self.rate.interval * 1000, 1),
+            "capture_fps": round(self.rate.capture_fps, 2),
+            "detections": len(self.detections),
+        }
+
+
+def add_detector_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by every script that runs the CPU detector."""
+    parser.add_argument(
+        "--detector-model",
+        type=str,
+        default=os.environ.get("CPU_DETECTOR_MODEL", "synthetic"),
+        help="OpenCV DNN model (.pb, .caffemodel, .onnx) or 'synthetic' (env: CPU_DETECTOR_MODEL)",
+    )
+    parser.add_argument(
+        "--detector-config",
+        type=str,
+        default=os.environ.get("CPU_DETECTOR_CONFIG"),
+        help="Network config for the model (.pbtxt, .prototxt) (env: CPU_DETECTOR_CONFIG)",
+    )
+    parser.add_argument(
+        "--detector-kind",
+        choices=["ssd", "nanodet"],
+        default=None,
+        help="Output format of the model (default: nanodet for .onnx, ssd otherwise)",
+    )
+    parser.add_argument(
+        "--detector-input-size",
+        type=int,
+        default=None,
+        help="Network input size in pixels (default: 300 for ssd, 416 for nanodet)",
+    )
+    parser.add_argument(
+        "--label-offset",
+        type=int,
+        default=env_int("CPU_DETECTOR_LABEL_OFFSET", None),
+        help="Subtracted from the network's class ids before looking up --labels "
+        "(env: CPU_DETECTOR_LABEL_OFFSET; default: 1 for ssd, whose 0 is background, 0 for nanodet)",
+    )
+    parser.add_argument(
+        "--detector-cpu-share",
+        type=float,
+        default=DEFAULT_CPU_SHARE,
+        help=f"Largest share of the time the network may be running (default: {DEFAULT_CPU_SHARE})",
+    )
+    parser.add_argument(
+        "--detector-threads",
+        type=int,
+        default=None,
+        help="OpenCV threads for inference (default: the CPU layout's detector threads, else 1)",
+    )
+    parser.add_argument(
+        "--adaptive-rate",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Lower the inference rate whenever capture fps falls behind",
+    )
+    parser.add_argument(
+        "--synthetic-cost-ms",
+        type=float,
+        default=0.0,
+        help="CPU time the synthetic detector burns per inference, to stand in for a network",
+    )
+
+
+def detector_from_args(args, threads: Optional[int] = None) -> CpuDetector:
+    """Build the detector; threads is the CPU layout's default for the detector role."""
+    cv2.setNumThreads(args.detector_threads or threads or 1)
+    if args.detector_model == "synthetic":
+        backend = SyntheticBackend(args.synthetic_cost_ms)
+    else:
+        try:
+            backend = DnnBackend(
+                args.detector_model,
+                args.detector_config,
+                args.detector_kind,
+                args.detector_input_size,
+                args.label_offset,
+            )
+        except cv2.error as e:
+            print(f"Error: cannot load detector model: {e}", file=sys.stderr)
+            sys.exit(1)
+    return CpuDetector(
+        backend,
+        args.fps,
+        threshold=args.threshold,
+        iou=args.iou,
+        max_detections=args.max_detections,
+        cpu_share=args.detector_cpu_share,
+        adaptive=args.adaptive_rate,
+    )
+
+
+def run_capture(args, detector: Optional[CpuDetector]) -> dict:
+    """Paced capture with an encoder stand-in on the capture thread, as a script runs."""
+    source = open_frame_source(args.source, args.width, args.height, args.fps)
+    if detector:
+        detector.start()
+    loop_times: List[float] = []
+    ages: List[float] = []
+    late = 0
+    previous = None
+    start = time.monotonic()
+    try:
+        while time.monotonic() - start < args.seconds:
+            item = source.read()
+            if item is None:
+                break
+            frame, _ = item
+            loop_start = time.perf_counter()
+            now = time.monotonic()
+            late += previous is not None and now - previous > 1.5 / args.fps
+            previous = now
+            if detector:
+                detector.submit(frame, now)
+                for detection in detector.latest():
+                    x, y, w, h = detection.box
+                    cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+                if detector.detections_time:
+                    ages.append(now - detector.detections_time)
+            cv2.imencode(".jpg", frame)  # Stands in for writing to the encoder
+            loop_times.append(time.perf_counter() - loop_start)
+    finally:
+        source.close()
+        if detector:
+            detector.close()
+    elapsed = time.monotonic() - start
+    result = {
+        "capture_fps": round(len(loop_times) / elapsed, 2),
+        "late_frames": late,
+        "loop_p95_ms": round(float(np.percentile(loop_times, 95)) * 1000, 1),
+    }
+    if detector:
+        result["inferences_per_s"] = round(detector.inferences / elapsed, 2)
+        result["latency_ms"] = round(detector.rate.latency * 1000, 1)
+        result["detection_age_ms"] = round(float(np.mean(ages or [0])) * 1000, 1)
+    return result
+
+
+def benchmark(args):
+    print(
+        f"{args.source} {args.width}x{args.height} at {args.fps} fps, "
+        f"model {args.detector_model}, {args.seconds:.0f} s per mode"
+    )
+    modes = [("no detector", None)]
+    for name, adaptive in (("every frame", False), ("adaptive", True)):
+        args.adaptive_rate = adaptive
+        modes.append((name, detector_from_args(args)))
+    # Busy processes stand in for the encoder and ROS competing for the CPU
+    background = [
+        subprocess.Popen([sys.executable, "-c", "while True: pass"])
+        for _ in range(args.background)
+    ]
+    try:
+        for name, detector in modes:
+            print(f"{name:>12}: {run_capture(args, detector)}")
+    finally:
+        for process in background:
+            process.kill()
+
+
+def detect(args):
+    """Run a few seconds of detection and save the last annotated frame."""
+    detector = detector_from_args(args)
+    source = open_frame_source(args.source, args.width, args.height, args.fps)
+    detector.start()
+    frame = None
+    start = time.monotonic()
+    try:
+        while time.monotonic() - start < args.seconds:
+            item = source.read()
+            if item is None:
+                break
+            frame, _ = item
+            detector.submit(frame)
+    finally:
+        source.close()
+        detector.close()
+    for detection in detector.latest():
+        print(detection)
+        x, y, w, h = detection.box
+        if frame is not None:
+            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+    print(detector.stats())
+    if args.out and frame is not None:
+        cv2.imwrite(args.out, frame)
+        print(f"Saved {args.out}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU object detection tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (
+        ("benchmark", "Capture fps and inference rate with and without the detector"),
+        ("detect", "Detect on a source and save the last annotated frame"),
+    ):
+        sub = subparsers.add_parser(name, help=help_text)
+        add_source_arguments(sub)
+        add_detector_arguments(sub)
+        sub.add_argument("--width", type=int, default=1280)
+        sub.add_argument("--height", type=int, default=720)
+        sub.add_argument("--fps", type=int, default=30)
+        sub.add_argument("--seconds", type=float, default=10.0)
+        sub.add_argument("--threshold", type=float, default=0.55)
+        sub.add_argument("--iou", type=float, default=0.65)
+        sub.add_argument("--max-detections", type=int, default=10)
+        sub.set_defaults(source="synthetic")
+        if name == "benchmark":
+            sub.add_argument(
+                "--background", type=int, default=0, help="Busy processes to add"
+            )
+        if name == "detect":
+            sub.add_argument("--out", type=str, help="Save the annotated frame here")
+    args = parser.parse_args()
+    if args.command == "benchmark":
+        benchmark(args)
+    else:
+        detect(args)
+
+
+if __name__ == "__main__":
+    main()
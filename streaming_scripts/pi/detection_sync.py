@@ -0,0 +1,336 @@
+"""
+detection_sync.py - Draw detections on the frame they were inferred on
+
+The IMX500 scripts kept the newest parse result in a global and drew it on
+whichever frame came next. In stream_object_detection_video_to_pc.py that is a
+race: picamera2 runs pre_callback for a request before capture_metadata() hands
+the same request's metadata to the main thread. So the overlay on frame N was
+parsed from frame N-1 or older, and nothing said how much older. The
+capture_request scripts parse and draw the same request, but a frame without an
+output tensor silently reused older boxes.
+
+DetectionTimeline keys detections by the sensor timestamp of the frame that
+carried them:
+
+* publish(timestamp, detections) files a parse result under its frame.
+* for_frame(timestamp) returns the detections of that exact frame if they are
+  known. Otherwise it returns the newest earlier result, as long as that is at
+  most --overlay-max-lag older, and None (draw nothing) beyond that.
+* Every lookup is counted as exact, lagged, stale or missing, and the lag is
+  measured in milliseconds and frames. stats() reports the misalignment, and the
+  scripts publish it as the "detection_sync" stats source.
+
+Both calls take a lock, so the camera thread (pre_callback) and the main thread
+may publish and look up concurrently. The timeline holds only the last few
+frames.
+
+With --overlay-sync exact (the default), stream_object_detection_video_to_pc.py
+parses each request's own metadata in pre_callback and draws on that frame.
+--overlay-sync latest keeps parsing in the main thread and draws the newest
+earlier result, with a lag of at least one frame that is measured and bounded.
+
+Usage (from a streaming script):
+    timeline = timeline_from_args(args)
+    detections = parse_detections(metadata)  # None: no output tensor on this frame
+    if detections is not None:
+        timeline.publish(metadata["SensorTimestamp"], detections)
+    draw(frame, timeline.for_frame(metadata["SensorTimestamp"]))
+
+    # Misalignment of the old shared global vs the timeline, on a simulated camera
+    python3 detection_sync.py simulate --fps 30 --parse-ms 8 --no-output 0.1
+"""
+
+import argparse
+import collections
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Deque, Dict, List, Optional
+
+DEFAULT_CAPACITY = 16  # Frames of detections kept (about half a second at 30 fps)
+DEFAULT_MAX_LAG = 0.2  # Seconds; older detections are not drawn
+SYNC_MODES = ["exact", "latest"]
+LAG_SAMPLES = 1000
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class DetectionTimeline:
+    def __init__(
+        self, capacity: int = DEFAULT_CAPACITY, max_lag: float = DEFAULT_MAX_LAG
+    ):
+        self.capacity = capacity
+        self.max_lag_ns = int(max_lag * 1e9)
+        self._lock = threading.Lock()
+        self._entries: Dict[int, list] = {}
+        self._intervals: Deque[int] = collections.deque(maxlen=30)
+        self._last_lookup: Optional[int] = None
+        self._lag_ms: Deque[float] = collections.deque(maxlen=LAG_SAMPLES)
+        self._lag_frames: Deque[int] = collections.deque(maxlen=LAG_SAMPLES)
+        self.published = 0
+        self.exact = 0
+        self.lagged = 0
+        self.stale = 0
+        self.missing = 0
+        self.max_lag_seen_ms = 0.0
+
+    def publish(self, timestamp: int, detections: list):
+        """File the detections parsed from the frame with this sensor timestamp (ns)."""
+        with self._lock:
+            self._entries[timestamp] = detections
+            if len(self._entries) > self.capacity:
+                del self._entries[min(self._entries)]
+            self.published += 1
+
+    def for_frame(self, timestamp: int) -> Optional[list]:
+        """Detections to draw on this frame: its own, or the newest earlier within max lag."""
+        with self._lock:
+            if self._last_lookup is not None and timestamp > self._last_lookup:
+                self._intervals.append(timestamp - self._last_lookup)
+            self._last_lookup = timestamp
+            detections = self._entries.get(timestamp)
+            if detections is not None:
+                self.exact += 1
+                self._record_lag(0)
+                return detections
+            earlier = [key for key in self._entries if key < timestamp]
+            if not earlier:
+                self.missing += 1
+                return None
+            source = max(earlier)
+            lag = timestamp - source
+            if lag > self.max_lag_ns:
+                self.stale += 1
+                return None
+            self.lagged += 1
+            self._record_lag(lag)
+            return self._entries[source]
+
+    def newest(self) -> Optional[list]:
+        """The most recently inferred detections, without counting a lookup."""
+        with self._lock:
+            return self._entries[max(self._entries)] if self._entries else None
+
+    def _record_lag(self, lag_ns: int):
+        intervals = sorted(self._intervals)
+        interval = intervals[len(intervals) // 2] if intervals else 0
+        self._lag_ms.append(lag_ns / 1e6)
+        self._lag_frames.append(round(lag_ns / interval) if interval else 0)
+        self.max_lag_seen_ms = max(self.max_lag_seen_ms, lag_ns / 1e6)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lag_ms = list(self._lag_ms)
+            lag_frames = list(self._lag_frames)
+        lookups = self.exact + self.lagged + self.stale + self.missing
+        return {
+            "published": self.published,
+            "lookups": lookups,
+            "exact": self.exact,
+            "lagged": self.lagged,
+            "stale": self.stale,
+            "missing": self.missing,
+            "exact_ratio": round(self.exact / lookups, 4) if lookups else None,
+            "lag_ms_p50": round(percentile(lag_ms, 0.5), 2) if lag_ms else None,
+            "lag_ms_p99": round(percentile(lag_ms, 0.99), 2) if lag_ms else None,
+            "lag_ms_max": round(self.max_lag_seen_ms, 2),
+            "lag_frames_p50": percentile(lag_frames, 0.5) if lag_frames else None,
+            "lag_frames_max": max(lag_frames) if lag_frames else None,
+            "max_lag_ms": self.max_lag_ns / 1e6,
+        }
+
+    def describe(self) -> str:
+        """One line for the end-of-stream summary."""
+        stats = self.stats()
+        if not stats["lookups"]:
+            return "no frames drawn"
+        return (
+            f"{stats['exact']} of {stats['lookups']} frames drawn with their own "
+            f"detections, {stats['lagged']} with older ones (lag p99 "
+            f"{stats['lag_ms_p99']} ms, max {stats['lag_frames_max']} frames), "
+            f"{stats['stale']} too old to draw, {stats['missing']} before the first"
+        )
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default:g}.", file=sys.stderr)
+        return default
+
+
+def add_sync_arguments(parser: argparse.ArgumentParser, modes: bool = False):
+    """Command-line options shared by the scripts that draw IMX500 detections."""
+    parser.add_argument(
+        "--overlay-max-lag",
+        type=float,
+        default=env_float("OVERLAY_MAX_LAG", DEFAULT_MAX_LAG),
+        help=f"Don't draw detections older than this many seconds (env: OVERLAY_MAX_LAG, default: {DEFAULT_MAX_LAG})",
+    )
+    if modes:
+        parser.add_argument(
+            "--overlay-sync",
+            choices=SYNC_MODES,
+            default=os.environ.get("OVERLAY_SYNC", "exact"),
+            help="exact: parse each frame's detections in the camera callback and draw them on that "
+            "frame; latest: parse in the main thread and draw the newest earlier result (env: OVERLAY_SYNC)",
+        )
+
+
+def timeline_from_args(args: argparse.Namespace) -> DetectionTimeline:
+    return DetectionTimeline(max_lag=args.overlay_max_lag)
+
+
+class SimulatedCamera:
+    """picamera2's request flow: pre_callback first, then metadata to capture_metadata()."""
+
+    def __init__(self, fps: float, no_output: float, seconds: float):
+        self.period = 1.0 / fps
+        self.no_output = no_output
+        self.seconds = seconds
+        self.pre_callback = None
+        self.completed: "queue.Queue" = queue.Queue(maxsize=2)
+        self.rng = random.Random(0)
+        self.callback_times: List[float] = []
+
+    def run(self):
+        started = time.monotonic()
+        index = 0
+        while time.monotonic() - started < self.seconds:
+            delay = started + index * self.period - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            timestamp = time.monotonic_ns()
+            has_output = self.rng.random() >= self.no_output
+            metadata = {"SensorTimestamp": timestamp, "outputs": has_output}
+            callback_started = time.monotonic()
+            self.pre_callback(metadata)
+            self.callback_times.append(time.monotonic() - callback_started)
+            try:
+                self.completed.put_nowait(metadata)
+            except queue.Full:
+                pass  # picamera2 drops completed requests nobody waits for
+            index += 1
+        self.completed.put(None)
+
+    def capture_metadata(self):
+        return self.completed.get()
+
+
+def simulate_mode(args, mode: str) -> dict:
+    """Run one overlay strategy against the simulated camera; measure what is drawn."""
+    camera = SimulatedCamera(args.fps, args.no_output, args.seconds)
+    timeline = DetectionTimeline(max_lag=args.max_lag)
+    shared = {"last_results": None}  # The old global
+
+    def parse(metadata):
+        time.sleep(args.parse_ms / 1000)  # Output tensor to Detection objects
+        if not metadata["outputs"]:
+            return None
+        return {"from": metadata["SensorTimestamp"]}
+
+    drawn_lag_ms: List[float] = []
+    frame_ns = 1e9 / args.fps
+
+    def pre_callback(metadata):
+        timestamp = metadata["SensorTimestamp"]
+        if mode == "global":
+            detections = shared["last_results"]
+        elif mode == "exact":
+            parsed = parse(metadata)
+            if parsed is not None:
+                timeline.publish(timestamp, parsed)
+            detections = timeline.for_frame(timestamp)
+        else:
+            detections = timeline.for_frame(timestamp)
+        if detections is not None:
+            drawn_lag_ms.append((timestamp - detections["from"]) / 1e6)
+
+    camera.pre_callback = pre_callback
+    thread = threading.Thread(target=camera.run, name="camera", daemon=True)
+    thread.start()
+    while True:
+        metadata = camera.capture_metadata()
+        if metadata is None:
+            break
+        if mode == "global":
+            parsed = parse(metadata)
+            if parsed is not None:
+                shared["last_results"] = parsed
+        elif mode == "latest":
+            parsed = parse(metadata)
+            if parsed is not None:
+                timeline.publish(metadata["SensorTimestamp"], parsed)
+    thread.join()
+    frames = len(camera.callback_times)
+    exact = sum(1 for lag in drawn_lag_ms if lag == 0)
+    return {
+        "frames": frames,
+        "drawn": len(drawn_lag_ms),
+        "exact": exact,
+        "lag_ms_p50": round(percentile(drawn_lag_ms, 0.5), 1) if drawn_lag_ms else None,
+        "lag_ms_max": round(max(drawn_lag_ms), 1) if drawn_lag_ms else None,
+        "lag_frames_max": (
+            round(max(drawn_lag_ms) * 1e6 / frame_ns) if drawn_lag_ms else None
+        ),
+        "callback_ms_p99": round(1000 * percentile(camera.callback_times, 0.99), 2),
+        "timeline": timeline.stats() if mode != "global" else None,
+    }
+
+
+def simulate(args):
+    """What the old shared global drew vs the timeline modes, on a simulated camera."""
+    print(
+        f"{args.fps:.0f} fps for {args.seconds:.0f} s, parse takes {args.parse_ms} ms, "
+        f"{100 * args.no_output:.0f}% of frames carry no output tensor"
+    )
+    for mode in ["global", *SYNC_MODES]:
+        result = simulate_mode(args, mode)
+        timeline = result.pop("timeline")
+        print(f"  {mode:<7} {result}")
+        if timeline and args.verbose:
+            print(f"          timeline stats: {timeline}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pair detections with the frames they were inferred on"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sim = subparsers.add_parser(
+        "simulate", help="Misalignment of the old global vs the timeline modes"
+    )
+    sim.add_argument("--fps", type=float, default=30.0)
+    sim.add_argument("--seconds", type=float, default=5.0)
+    sim.add_argument(
+        "--parse-ms",
+        type=float,
+        default=5.0,
+        help="Time to turn an output tensor into detections (default: 5)",
+    )
+    sim.add_argument(
+        "--no-output",
+        type=float,
+        default=0.0,
+        help="Fraction of frames without an output tensor (default: 0)",
+    )
+    sim.add_argument("--max-lag", type=float, default=DEFAULT_MAX_LAG)
+    sim.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    commands = {"simulate": simulate}
+    return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,652 @@
+"""
+encoder_tuner.py - Pick H.264 encoder settings by measuring them on a recorded clip
+
+The raw-pipe scripts encoded with settings nobody had measured on a Pi:
+-preset veryfast, -g fps*2 and a buffer of twice the bitrate. The shell
+pipelines use x264enc with speed-preset=superfast or ultrafast. This tool
+replays a clip through the encoders over a grid of preset, tune, GOP length,
+bitrate, VBV buffer and thread count. For each combination it measures:
+
+* encode speed (frames per second) and CPU time, as the share of a core the
+  encoder needs to keep up in real time (1.0 = one full core)
+* the size of the output, as the bitrate actually produced
+* quality against the clip: SSIM and PSNR (ffmpeg's ssim and psnr filters)
+
+The clip is decoded once, scaled to the target resolution and frame rate, and
+stored as raw BGR frames. Every trial encodes the same frames the way the
+scripts do, from rawvideo bgr24 on the input. Trials run in a process pool
+(--jobs). CPU time is counted per encoder process, so it stays accurate when
+trials overlap. Encode fps does not: when it matters, run with --jobs 1.
+
+The report marks the Pareto front: the settings that no other setting beats on
+CPU, bitrate and quality at once. It then recommends the best-quality setting
+within --cpu-budget cores and --max-kbps. --write-profile saves that setting.
+The raw-pipe scripts load it with --encoder-profile (env: ENCODER_PROFILE).
+For the shell pipelines, the report prints the matching x264enc properties.
+
+Backends: libx264 through ffmpeg (what the Python scripts use) and x264enc
+through gst-launch-1.0 (what the shell pipelines use).
+
+Usage:
+    # The default grid at 1280x720, 30 fps, on 20 s of a recording
+    python3 encoder_tuner.py tune recording.mp4 --write-profile ~/encoder_profile.json
+    python3 stream_object_detection_video_to_YT.py --encoder-profile ~/encoder_profile.json
+
+    # A wider grid, both backends, saving every measurement
+    python3 encoder_tuner.py tune recording.mp4 --backends libx264,x264enc \\
+        --presets ultrafast,superfast,veryfast,faster --gop 1,2,4 \\
+        --bitrates 1500,2500,4000 --threads 0,2 --tunes zerolatency,zerolatency+film \\
+        --output tuning.json
+
+    # Re-rank saved measurements under another budget
+    python3 encoder_tuner.py report tuning.json --cpu-budget 0.6 --max-kbps 3000
+"""
+
+import argparse
+import concurrent.futures
+import fractions
+import itertools
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+DEFAULT_PRESET = "veryfast"
+DEFAULT_TUNE = "zerolatency"
+DEFAULT_GOP_SECONDS = 2.0
+DEFAULT_BUFSIZE_RATIO = 2.0
+DEFAULT_CPU_BUDGET = (
+    1.0  # Cores the encoder may use; the Pi also runs detection and ROS
+)
+BACKENDS = ["libx264", "x264enc"]
+# x264enc splits x264's tunes: these flags go in tune=, the rest in psy-tune=
+X264ENC_TUNE_FLAGS = ["stillimage", "fastdecode", "zerolatency"]
+X264ENC_PSY_TUNES = ["film", "animation", "grain", "psnr", "ssim"]
+METRICS = ["ssim", "psnr"]
+
+
+class EncoderProfile:
+    """libx264 settings for a stream; the defaults are what the scripts always used."""
+
+    FIELDS = ["preset", "tune", "gop_seconds", "bufsize_ratio", "threads"]
+
+    def __init__(
+        self,
+        preset: str = DEFAULT_PRESET,
+        tune: str = DEFAULT_TUNE,
+        gop_seconds: float = DEFAULT_GOP_SECONDS,
+        bufsize_ratio: float = DEFAULT_BUFSIZE_RATIO,
+        threads: int = 0,
+    ):
+        self.preset = preset
+        self.tune = tune
+        self.gop_seconds = gop_seconds
+        self.bufsize_ratio = bufsize_ratio
+        self.threads = threads  # 0: x264 decides
+
+    def gop(self, fps: float) -> int:
+        return max(1, round(fps * self.gop_seconds))
+
+    def ffmpeg_args(
+        self,
+        fps: float,
+        bitrate_kbps: int,
+        threads: Optional[List[str]] = None,
+        preset: Optional[str] = None,
+    ) -> List[str]:
+        """libx264 output options; threads (from a CPU layout) and preset override the profile's."""
+        args = ["-preset", preset or self.preset]
+        if self.tune:
+            args += ["-tune", self.tune]
+        args += [
+            "-b:v",
+            f"{bitrate_kbps}k",
+            "-maxrate",
+            f"{bitrate_kbps}k",
+            "-bufsize",
+            f"{round(self.bufsize_ratio * bitrate_kbps)}k",
+            "-g",
+            str(self.gop(fps)),
+        ]
+        if threads:
+            args += threads
+        elif self.threads:
+            args += ["-threads", str(self.threads)]
+        return args
+
+    def gst_properties(self, fps: float, bitrate_kbps: int) -> List[str]:
+        """The same settings as x264enc properties, for the shell pipelines."""
+        props = [f"speed-preset={self.preset}"]
+        tunes = self.tune.split("+") if self.tune else []
+        flags = [tune for tune in tunes if tune in X264ENC_TUNE_FLAGS]
+        psy = [tune for tune in tunes if tune in X264ENC_PSY_TUNES]
+        if flags:
+            props.append(f"tune={'+'.join(flags)}")
+        if psy:
+            props.append(f"psy-tune={psy[0]}")
+        props += [
+            f"bitrate={bitrate_kbps}",
+            f"key-int-max={self.gop(fps)}",
+            f"vbv-buf-capacity={min(10000, round(1000 * self.bufsize_ratio))}",
+        ]
+        if self.threads:
+            props.append(f"threads={self.threads}")
+        return props
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "EncoderProfile":
+        return cls(**{field: data[field] for field in cls.FIELDS if field in data})
+
+    def __str__(self):
+        threads = self.threads or "auto"
+        return (
+            f"preset {self.preset}, tune {self.tune or 'none'}, GOP {self.gop_seconds:g} s, "
+            f"buffer {self.bufsize_ratio:g}x bitrate, threads {threads}"
+        )
+
+
+def load_profile(path: str) -> EncoderProfile:
+    with open(path) as f:
+        return EncoderProfile.from_dict(json.load(f))
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by the scripts that encode with libx264."""
+    parser.add_argument(
+        "--encoder-profile",
+        default=os.environ.get("ENCODER_PROFILE"),
+        help="JSON profile from encoder_tuner.py tune --write-profile "
+        f"(env: ENCODER_PROFILE, default: preset {DEFAULT_PRESET}, GOP {DEFAULT_GOP_SECONDS:g} s)",
+    )
+
+
+def profile_from_args(args: argparse.Namespace) -> EncoderProfile:
+    if not args.encoder_profile:
+        return EncoderProfile()
+    try:
+        profile = load_profile(args.encoder_profile)
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Error: cannot load encoder profile: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Encoder profile {args.encoder_profile}: {profile}")
+    return profile
+
+
+def prepare_reference(
+    clip: str, path: str, width: int, height: int, fps: float, seconds: float
+) -> int:
+    """Decode the clip once to raw BGR frames at the target size and rate; returns the frame count."""
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-y",
+            "-i",
+            clip,
+            "-t",
+            str(seconds),
+            "-vf",
+            f"scale={width}:{height},fps={fps}",
+            "-pix_fmt",
+            "bgr24",
+            "-f",
+            "rawvideo",
+            path,
+        ],
+        check=True,
+    )
+    return os.path.getsize(path) // (width * height * 3)
+
+
+def encode_command(job: dict, output: str) -> List[str]:
+    """The encoder fed raw BGR frames, as the scripts feed it."""
+    profile = EncoderProfile.from_dict(job["profile"])
+    width, height, fps = job["width"], job["height"], job["fps"]
+    if job["backend"] == "x264enc":
+        rate = fractions.Fraction(fps).limit_denominator(1001)
+        return [
+            "gst-launch-1.0",
+            "-q",
+            "filesrc",
+            f"location={job['reference']}",
+            "!",
+            "rawvideoparse",
+            f"width={width}",
+            f"height={height}",
+            "format=bgr",
+            f"framerate={rate.numerator}/{rate.denominator}",
+            "!",
+            "videoconvert",
+            "!",
+            "video/x-raw,format=I420",
+            "!",
+            "x264enc",
+            *profile.gst_properties(fps, job["bitrate_kbps"]),
+            "!",
+            "video/x-h264,stream-format=byte-stream",
+            "!",
+            "filesink",
+            f"location={output}",
+        ]
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-y",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "bgr24",
+        "-s",
+        f"{width}x{height}",
+        "-framerate",
+        str(fps),
+        "-i",
+        job["reference"],
+        "-c:v",
+        "libx264",
+        *profile.ffmpeg_args(fps, job["bitrate_kbps"]),
+        "-pix_fmt",
+        "yuv420p",
+        "-f",
+        "h264",
+        output,
+    ]
+
+
+def measure_quality(job: dict, encoded: str) -> dict:
+    """SSIM and PSNR of the encoded stream against the reference frames."""
+    result = subprocess.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-nostats",
+            "-framerate",
+            str(job["fps"]),
+            "-i",
+            encoded,
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "bgr24",
+            "-s",
+            f"{job['width']}x{job['height']}",
+            "-framerate",
+            str(job["fps"]),
+            "-i",
+            job["reference"],
+            "-lavfi",
+            "[0:v]split=2[a][b];[1:v]split=2[c][d];[a][c]ssim;[b][d]psnr",
+            "-f",
+            "null",
+            "-",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    ssim = re.search(r"SSIM .*All:([\d.]+)", result.stderr)
+    psnr = re.search(r"PSNR .*average:([\d.]+|inf)", result.stderr)
+    return {
+        "ssim": round(float(ssim.group(1)), 5) if ssim else None,
+        "psnr": round(min(float(psnr.group(1)), 100.0), 2) if psnr else None,
+    }
+
+
+def run_trial(job: dict) -> dict:
+    """Encode the reference with one setting and measure it (runs in a pool worker)."""
+    result = {
+        "backend": job["backend"],
+        **job["profile"],
+        "bitrate_kbps": job["bitrate_kbps"],
+    }
+    encoded = os.path.join(job["workdir"], f"trial-{job['index']}.h264")
+    # Only this worker's children count, and a worker runs one trial at a time
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.monotonic()
+    process = subprocess.run(
+        encode_command(job, encoded),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    elapsed = time.monotonic() - started
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if process.returncode != 0 or not os.path.exists(encoded):
+        lines = process.stderr.strip().splitlines()
+        result["error"] = lines[-1] if lines else f"exit status {process.returncode}"
+        return result
+    duration = job["frames"] / job["fps"]
+    cpu_seconds = (after.ru_utime + after.ru_stime) - (
+        before.ru_utime + before.ru_stime
+    )
+    result.update(
+        {
+            "encode_fps": round(job["frames"] / elapsed, 1),
+            "cpu_cores": round(cpu_seconds / duration, 3),
+            "kbps": round(os.path.getsize(encoded) * 8 / duration / 1000, 1),
+            **measure_quality(job, encoded),
+        }
+    )
+    os.remove(encoded)
+    return result
+
+
+def dominates(a: dict, b: dict, metric: str) -> bool:
+    """a is no worse than b on CPU, bitrate and quality, and better on one."""
+    no_worse = (
+        a["cpu_cores"] <= b["cpu_cores"]
+        and a["kbps"] <= b["kbps"]
+        and a[metric] >= b[metric]
+    )
+    better = (
+        a["cpu_cores"] < b["cpu_cores"]
+        or a["kbps"] < b["kbps"]
+        or a[metric] > b[metric]
+    )
+    return no_worse and better
+
+
+def pareto_front(results: List[dict], metric: str) -> List[dict]:
+    measured = [r for r in results if r.get(metric) is not None]
+    return [
+        r
+        for r in measured
+        if not any(dominates(other, r, metric) for other in measured)
+    ]
+
+
+def recommend(
+    results: List[dict], metric: str, cpu_budget: float, max_kbps: Optional[float]
+) -> Optional[dict]:
+    """Best quality within the budgets; the cheaper setting wins a tie."""
+    fits = [
+        r
+        for r in pareto_front(results, metric)
+        if r["cpu_cores"] <= cpu_budget and (max_kbps is None or r["kbps"] <= max_kbps)
+    ]
+    if not fits:
+        return None
+    return max(fits, key=lambda r: (r[metric], -r["cpu_cores"], -r["kbps"]))
+
+
+def print_report(tuning: dict, metric: str, cpu_budget: float, max_kbps):
+    results = tuning["results"]
+    front = {id(r) for r in pareto_front(results, metric)}
+    print(
+        f"{len(results)} settings on {tuning['frames']} frames at "
+        f"{tuning['width']}x{tuning['height']} {tuning['fps']:g} fps "
+        f"(* = Pareto front on CPU, bitrate and {metric})"
+    )
+    print(
+        "    backend  preset      tune                  gop  buf  thr  target   kbps  cores"
+        "    fps    ssim   psnr"
+    )
+    for r in sorted(
+        results, key=lambda r: (r.get("cpu_cores") or 99, r.get("kbps") or 0)
+    ):
+        settings = (
+            f"{r['backend']:<8} {r['preset']:<11} {r['tune'] or '-':<20} "
+            f"{r['gop_seconds']:>4g} {r['bufsize_ratio']:>4g} {r['threads'] or 'auto':>4} "
+            f"{r['bitrate_kbps']:>6}"
+        )
+        if "error" in r:
+            print(f"    {settings}  failed: {r['error']}")
+            continue
+        ssim = f"{r['ssim']:.4f}" if r["ssim"] is not None else "-"
+        psnr = f"{r['psnr']:.2f}" if r["psnr"] is not None else "-"
+        print(
+            f"  {'*' if id(r) in front else ' '} {settings} {r['kbps']:>6.0f} {r['cpu_cores']:>6.2f}"
+            f" {r['encode_fps']:>6.1f}  {ssim:>6} {psnr:>6}"
+        )
+    if tuning.get("jobs", 1) > 1:
+        print(
+            f"  (fps measured with {tuning['jobs']} trials at a time; CPU is per trial)"
+        )
+    best = recommend(results, metric, cpu_budget, max_kbps)
+    budget = f"{cpu_budget:g} cores" + (f", {max_kbps:g} kbps" if max_kbps else "")
+    if best is None:
+        print(f"No measured setting fits within {budget}.")
+        return None
+    profile = EncoderProfile.from_dict(best)
+    print(f"\nRecommended within {budget}: {profile}, {best['bitrate_kbps']} kbps")
+    print(
+        f"  {best['cpu_cores']:.2f} cores, {best['encode_fps']:.0f} fps, "
+        f"{best['kbps']:.0f} kbps, SSIM {best['ssim']}, PSNR {best['psnr']} dB"
+    )
+    print(
+        "  ffmpeg:  "
+        + " ".join(profile.ffmpeg_args(tuning["fps"], best["bitrate_kbps"]))
+    )
+    print(
+        "  x264enc: "
+        + " ".join(profile.gst_properties(tuning["fps"], best["bitrate_kbps"]))
+    )
+    return best
+
+
+def parse_list(text: str, kind=str) -> list:
+    return [kind(item) for item in text.split(",") if item]
+
+
+def tune_error(tune: str) -> Optional[str]:
+    """Why x264 can't take this tune (on either backend), or None."""
+    names = tune.split("+")
+    unknown = [
+        name for name in names if name not in X264ENC_TUNE_FLAGS + X264ENC_PSY_TUNES
+    ]
+    if unknown:
+        return f"unknown tune {', '.join(unknown)}"
+    if sum(name in X264ENC_PSY_TUNES for name in names) > 1:
+        return f"{tune} combines more than one of {', '.join(X264ENC_PSY_TUNES)}"
+    return None
+
+
+def tune(args):
+    for tune_name in parse_list(args.tunes):
+        error = tune_error(tune_name)
+        if error:
+            print(f"Error: {error}.", file=sys.stderr)
+            return 1
+    backends = parse_list(args.backends)
+    for backend in backends:
+        binary = "gst-launch-1.0" if backend == "x264enc" else "ffmpeg"
+        if backend not in BACKENDS or not shutil.which(binary):
+            print(
+                f"Error: backend {backend} needs {binary} on the PATH.", file=sys.stderr
+            )
+            return 1
+    if not shutil.which("ffmpeg"):
+        print(
+            "Error: ffmpeg is needed to decode the clip and measure quality.",
+            file=sys.stderr,
+        )
+        return 1
+    with tempfile.TemporaryDirectory(prefix="encoder-tuner-") as workdir:
+        reference = os.path.join(workdir, "reference.bgr")
+        print(
+            f"Decoding {args.clip} to {args.width}x{args.height} at {args.fps:g} fps..."
+        )
+        try:
+            frames = prepare_reference(
+                args.clip, reference, args.width, args.height, args.fps, args.seconds
+            )
+        except subprocess.CalledProcessError:
+            print(f"Error: ffmpeg could not decode {args.clip}.", file=sys.stderr)
+            return 1
+        if not frames:
+            print(f"Error: no frames decoded from {args.clip}.", file=sys.stderr)
+            return 1
+        grid = itertools.product(
+            backends,
+            parse_list(args.presets),
+            parse_list(args.tunes),
+            parse_list(args.gop, float),
+            parse_list(args.bufsize_ratios, float),
+            parse_list(args.threads, int),
+            parse_list(args.bitrates, int),
+        )
+        jobs = []
+        for index, (
+            backend,
+            preset,
+            tune_name,
+            gop,
+            ratio,
+            threads,
+            bitrate,
+        ) in enumerate(grid):
+            profile = EncoderProfile(preset, tune_name, gop, ratio, threads)
+            jobs.append(
+                {
+                    "index": index,
+                    "backend": backend,
+                    "profile": profile.to_dict(),
+                    "bitrate_kbps": bitrate,
+                    "reference": reference,
+                    "workdir": workdir,
+                    "width": args.width,
+                    "height": args.height,
+                    "fps": args.fps,
+                    "frames": frames,
+                }
+            )
+        print(
+            f"Running {len(jobs)} trials on {frames} frames, {args.jobs} at a time..."
+        )
+        results = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            for result in pool.map(run_trial, jobs):
+                results.append(result)
+                if args.verbose:
+                    print(f"  {result}")
+    tuning = {
+        "clip": args.clip,
+        "width": args.width,
+        "height": args.height,
+        "fps": args.fps,
+        "frames": frames,
+        "jobs": args.jobs,
+        "results": results,
+    }
+    best = print_report(tuning, args.metric, args.cpu_budget, args.max_kbps)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(tuning, f, indent=2)
+        print(f"Measurements written to {args.output}")
+    if args.write_profile and best:
+        write_profile(args.write_profile, best, tuning)
+    return 0 if best else 1
+
+
+def write_profile(path: str, best: dict, tuning: dict):
+    profile = EncoderProfile.from_dict(best).to_dict()
+    # Unknown keys are ignored on load; these say what the profile was tuned for
+    profile["tuned_for"] = {
+        key: tuning[key] for key in ["clip", "width", "height", "fps"]
+    }
+    profile["tuned_for"].update(
+        {
+            key: best[key]
+            for key in ["bitrate_kbps", "cpu_cores", "kbps", "ssim", "psnr"]
+        }
+    )
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+    print(f"Profile written to {path} (use --encoder-profile {path})")
+
+
+def report(args):
+    with open(args.results) as f:
+        tuning = json.load(f)
+    best = print_report(tuning, args.metric, args.cpu_budget, args.max_kbps)
+    if args.write_profile and best:
+        write_profile(args.write_profile, best, tuning)
+    return 0 if best else 1
+
+
+def add_selection_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--cpu-budget",
+        type=float,
+        default=DEFAULT_CPU_BUDGET,
+        help=f"Cores the encoder may use at the target fps (default: {DEFAULT_CPU_BUDGET:g})",
+    )
+    parser.add_argument(
+        "--max-kbps",
+        type=float,
+        default=None,
+        help="Highest bitrate the uplink carries (default: no limit)",
+    )
+    parser.add_argument("--metric", choices=METRICS, default="ssim")
+    parser.add_argument(
+        "--write-profile", help="Save the recommended setting for --encoder-profile"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure H.264 encoder settings on a recorded clip"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    tune_parser = subparsers.add_parser(
+        "tune", help="Encode a clip over a grid of settings and recommend one"
+    )
+    tune_parser.add_argument("clip", help="Any recording ffmpeg can decode")
+    tune_parser.add_argument("--width", type=int, default=1280)
+    tune_parser.add_argument("--height", type=int, default=720)
+    tune_parser.add_argument("--fps", type=float, default=30.0)
+    tune_parser.add_argument(
+        "--seconds", type=float, default=20.0, help="Length of the clip to use"
+    )
+    tune_parser.add_argument(
+        "--backends", default="libx264", help=f"Comma-separated: {', '.join(BACKENDS)}"
+    )
+    tune_parser.add_argument("--presets", default="ultrafast,superfast,veryfast")
+    tune_parser.add_argument(
+        "--tunes",
+        default=DEFAULT_TUNE,
+        help="Comma-separated; combine tunes with +, at most one of film, animation, "
+        "grain, psnr, ssim (x264enc's psy-tune) each (default: zerolatency)",
+    )
+    tune_parser.add_argument("--gop", default="1,2", help="GOP lengths in seconds")
+    tune_parser.add_argument(
+        "--bufsize-ratios",
+        default="1,2",
+        help="VBV buffer sizes as multiples of the bitrate",
+    )
+    tune_parser.add_argument("--threads", default="0", help="x264 threads (0: auto)")
+    tune_parser.add_argument("--bitrates", default="1500,2500,4000", help="kbps")
+    tune_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=max(1, (os.cpu_count() or 1) // 2),
+        help="Trials run at a time (default: half the cores)",
+    )
+    tune_parser.add_argument("--output", help="Save every measurement as JSON")
+    tune_parser.add_argument("--verbose", action="store_true")
+    add_selection_arguments(tune_parser)
+    report_parser = subparsers.add_parser(
+        "report", help="Re-rank measurements saved with --output"
+    )
+    report_parser.add_argument("results")
+    add_selection_arguments(report_parser)
+    args = parser.parse_args()
+    commands = {"tune": tune, "report": report}
+    return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
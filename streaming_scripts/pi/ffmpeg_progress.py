@@ -0,0 +1,306 @@
+"""
+ffmpeg_progress.py - Live encoder health from ffmpeg's -progress channel
+
+The streaming scripts write raw frames into ffmpeg and used to know nothing more
+about it. They couldn't tell whether x264 kept up, how many frames ffmpeg
+duplicated or dropped, or what bitrate actually went out. ffmpeg can report all
+of that as key=value blocks, once per -stats_period, on a file descriptor of our
+choosing:
+
+    frame=1804  fps=30.00  bitrate=2490.1kbits/s  total_size=18712345
+    out_time_us=60133333  dup_frames=0  drop_frames=2  speed=1.00x  progress=continue
+
+FfmpegProgress gives each spawned ffmpeg its own pipe for this and parses it in a
+daemon thread. The capture loop never reads the pipe, so it can't stall on it;
+it only looks at the parsed numbers. ffmpeg's own speed= is an average since
+start, so a slow encoder shows up late, and startup time pulls it below 1.0x
+forever. The health check uses the speed over the last report instead: output
+media time advanced per second of wall time.
+
+Per encoder (stats()): fps, recent speed, duplicated and dropped frames (total and
+since the previous report), achieved bitrate, and the number of slow episodes.
+When the recent speed stays below --slow-speed for a few reports, pressure()
+returns a reason string. The quality governor and the CPU detector's rate
+controller take it as a signal to back off.
+
+Usage (from a streaming script):
+    progress = FfmpegProgress("youtube")
+    cmd = ["ffmpeg", *progress.ffmpeg_args(), "-f", "rawvideo", ...]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, pass_fds=progress.pass_fds)
+    progress.start()
+    stream_stats.add_source("encoder_youtube", progress.stats)
+    governor.add_pressure_source(progress.pressure)
+
+    # Watch the parser follow a fake encoder that falls behind and recovers
+    python3 ffmpeg_progress.py simulate
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_STATS_PERIOD = 1.0  # Seconds between progress reports
+DEFAULT_SLOW_SPEED = 0.95  # Recent speed below this (x realtime) is falling behind
+DEFAULT_SLOW_REPORTS = 3  # Consecutive slow reports before pressure() fires
+
+
+def parse_number(value: str) -> Optional[float]:
+    """'30.00', '2490.1kbits/s', '1.00x' or 'N/A' to a float (None if unknown)."""
+    value = value.strip()
+    for suffix in ("kbits/s", "x"):
+        if value.endswith(suffix):
+            value = value[: -len(suffix)]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class FfmpegProgress:
+    def __init__(
+        self,
+        name: str,
+        slow_speed: float = DEFAULT_SLOW_SPEED,
+        slow_reports: int = DEFAULT_SLOW_REPORTS,
+        stats_period: float = DEFAULT_STATS_PERIOD,
+    ):
+        self.name = name
+        self.slow_speed = slow_speed
+        self.slow_reports = slow_reports
+        self.stats_period = stats_period
+
+        self.reports = 0
+        self.fps: Optional[float] = None
+        self.speed: Optional[float] = None  # ffmpeg's average since start
+        self.recent_speed: Optional[float] = None  # over the last report
+        self.bitrate_kbps: Optional[float] = None
+        self.recent_kbps: Optional[float] = None
+        self.frames = 0
+        self.dup_frames = 0
+        self.drop_frames = 0
+        self.recent_dup = 0
+        self.recent_drop = 0
+        self.slow = False
+        self.slow_episodes = 0
+        self.ended = False
+
+        self._block: Dict[str, str] = {}
+        self._previous: Optional[Tuple[float, float, float, int, int]] = None
+        self._slow_count = 0
+        self._read_fd: Optional[int] = None
+        self._write_fd: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def ffmpeg_args(self) -> List[str]:
+        """Global ffmpeg options sending progress to our pipe (place them first)."""
+        if self._write_fd is None:
+            self._read_fd, self._write_fd = os.pipe()
+        return [
+            "-nostats",  # The progress pipe replaces the status line on stderr
+            "-progress",
+            f"pipe:{self._write_fd}",
+            "-stats_period",
+            str(self.stats_period),
+        ]
+
+    @property
+    def pass_fds(self) -> Tuple[int, ...]:
+        return () if self._write_fd is None else (self._write_fd,)
+
+    def start(self):
+        """Call after Popen: drop our copy of the write end and start parsing."""
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+        if self._read_fd is None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name=f"ffmpeg-progress-{self.name}", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        with open(self._read_fd, "r", errors="replace") as stream:
+            for line in stream:
+                self.feed(line, time.monotonic())
+        self.ended = True
+
+    def feed(self, line: str, now: float):
+        """Parse one line; a progress= line completes a report."""
+        key, _, value = line.strip().partition("=")
+        if not key:
+            return
+        if key != "progress":
+            self._block[key] = value
+            return
+        if self._block:
+            self._report(self._block, now)
+        self._block = {}
+        if value == "end":
+            self.ended = True
+
+    def _report(self, block: Dict[str, str], now: float):
+        self.reports += 1
+        self.fps = parse_number(block.get("fps", ""))
+        self.speed = parse_number(block.get("speed", ""))
+        self.bitrate_kbps = parse_number(block.get("bitrate", ""))
+        self.frames = int(parse_number(block.get("frame", "")) or 0)
+        dup = int(parse_number(block.get("dup_frames", "")) or 0)
+        drop = int(parse_number(block.get("drop_frames", "")) or 0)
+        # out_time_ms is in microseconds too (a long-standing ffmpeg quirk)
+        out_time_us = parse_number(
+            block.get("out_time_us", block.get("out_time_ms", ""))
+        )
+        size = parse_number(block.get("total_size", "")) or 0.0
+        out_time = (out_time_us or 0.0) / 1e6
+
+        if self._previous is not None:
+            last_now, last_time, last_size, last_dup, last_drop = self._previous
+            elapsed = now - last_now
+            if elapsed > 0:
+                self.recent_speed = (out_time - last_time) / elapsed
+                self.recent_kbps = (size - last_size) * 8 / 1000 / elapsed
+            self.recent_dup = dup - last_dup
+            self.recent_drop = drop - last_drop
+        self.dup_frames, self.drop_frames = dup, drop
+        self._previous = (now, out_time, size, dup, drop)
+        self._update_health()
+
+    def _update_health(self):
+        if self.recent_speed is None:
+            return
+        if self.recent_speed < self.slow_speed:
+            self._slow_count += 1
+        else:
+            self._slow_count = 0
+            self.slow = False
+        if self._slow_count >= self.slow_reports and not self.slow:
+            self.slow = True
+            self.slow_episodes += 1
+            print(
+                f"Warning: {self.name} encoder at {self.recent_speed:.2f}x realtime, falling behind",
+                file=sys.stderr,
+            )
+
+    def pressure(self) -> Optional[str]:
+        """A reason string while the encoder is falling behind, else None."""
+        if self.slow and not self.ended:
+            return f"{self.name} encoder at {self.recent_speed:.2f}x"
+        return None
+
+    def close(self):
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+        if self._thread:
+            self._thread.join(timeout=2)
+        elif self._read_fd is not None:  # ffmpeg never started
+            os.close(self._read_fd)
+            self._read_fd = None
+
+    def stats(self) -> dict:
+        def rounded(value: Optional[float], digits: int = 2):
+            return None if value is None else round(value, digits)
+
+        return {
+            "reports": self.reports,
+            "frames": self.frames,
+            "fps": self.fps,
+            "speed": self.speed,
+            "recent_speed": rounded(self.recent_speed),
+            "bitrate_kbps": self.bitrate_kbps,
+            "recent_kbps": rounded(self.recent_kbps, 1),
+            "dup_frames": self.dup_frames,
+            "drop_frames": self.drop_frames,
+            "recent_dup": self.recent_dup,
+            "recent_drop": self.recent_drop,
+            "slow": self.slow,
+            "slow_episodes": self.slow_episodes,
+            "ended": self.ended,
+        }
+
+
+# A stand-in encoder: writes ffmpeg-style progress blocks to the fd in argv[1],
+# producing speed x realtime from each (seconds, speed) phase
+FAKE_ENCODER_SOURCE = """
+import os, sys, time
+fd, period, fps = int(sys.argv[1]), float(sys.argv[2]), 30
+phases = [(float(s), float(v)) for s, v in (p.split(":") for p in sys.argv[3:])]
+out = os.fdopen(fd, "w")
+media = size = frames = drops = 0.0
+start = time.monotonic()
+for seconds, speed in phases:
+    for _ in range(int(seconds / period)):
+        time.sleep(period)
+        media += period * speed
+        frames = int(media * fps)
+        size += period * speed * 2500 * 1000 / 8
+        drops += 0 if speed >= 1 else period * fps * (1 - speed) * 0.2
+        wall = time.monotonic() - start
+        out.write(
+            f"frame={frames}\\nfps={frames / wall:.2f}\\nbitrate=2500.0kbits/s\\n"
+            f"total_size={int(size)}\\nout_time_us={int(media * 1e6)}\\n"
+            f"dup_frames=0\\ndrop_frames={int(drops)}\\nspeed={media / wall:.3g}x\\n"
+            "progress=continue\\n"
+        )
+        out.flush()
+out.write("progress=end\\n")
+"""
+
+
+def simulate(args):
+    progress = FfmpegProgress("fake", args.slow_speed, stats_period=args.period)
+    progress.ffmpeg_args()
+    (write_fd,) = progress.pass_fds
+    phases = [f"{seconds}:{speed}" for seconds, speed in args.phases]
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            FAKE_ENCODER_SOURCE,
+            str(write_fd),
+            str(args.period),
+            *phases,
+        ],
+        pass_fds=(write_fd,),
+    )
+    progress.start()
+    print(f"Fake encoder phases (seconds:speed): {' '.join(phases)}")
+    while process.poll() is None:
+        time.sleep(args.period)
+        stats = progress.stats()
+        print(
+            f"speed {stats['speed']}, recent {stats['recent_speed']}, "
+            f"{stats['recent_kbps']} kbps, drops +{stats['recent_drop']}, "
+            f"pressure: {progress.pressure()}"
+        )
+    progress.close()
+    print(progress.stats())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ffmpeg -progress parsing tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sim = subparsers.add_parser(
+        "simulate", help="Parse a fake encoder that falls behind and recovers"
+    )
+    sim.add_argument("--period", type=float, default=0.5)
+    sim.add_argument("--slow-speed", type=float, default=DEFAULT_SLOW_SPEED)
+    sim.add_argument(
+        "--phases",
+        type=lambda text: tuple(float(v) for v in text.split(":")),
+        nargs="+",
+        default=[(4, 1.0), (4, 0.8), (4, 1.0)],
+        help="seconds:speed phases (default: 4:1.0 4:0.8 4:1.0)",
+    )
+    args = parser.parse_args()
+    if args.command == "simulate":
+        simulate(args)
+
+
+if __name__ == "__main__":
+    main()
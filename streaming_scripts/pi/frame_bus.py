@@ -0,0 +1,583 @@
+"""
+frame_bus.py - Share camera frames, detections and timestamps with other local processes
+
+Only one process can open the camera. With --frame-bus NAME, a streaming script also
+publishes every frame (before overlays are drawn), its detections and its timestamps
+into a ring buffer in /dev/shm/NAME. Any number of local readers (ROS nodes, a
+recorder, ...) can map that file and use frames in place: no second camera open and
+no socket copies.
+
+Layout (little-endian, all offsets in bytes):
+
+    Header, 4096 bytes at offset 0
+      0   4s   magic "FBUS"
+      4   u32  layout version (1)
+      8   u32  slot count
+      12  u32  width
+      16  u32  height
+      20  u32  channels
+      24  4s   pixel format ("BGR3": OpenCV BGR, 8 bits per channel)
+      28  u32  metadata capacity per slot
+      32  u64  slot stride
+      40  u32  writer pid
+      44  u32  reserved
+      48  u64  latest published frame sequence (0 until the first frame)
+      56  u64  creation time, CLOCK_MONOTONIC ns
+
+    Slot i at 4096 + i * stride; frame sequence s lives in slot s % slot count
+      0   u64  version: odd while the writer is filling the slot, even when complete
+      8   u64  frame sequence (starts at 1)
+      16  u64  publish time, CLOCK_MONOTONIC ns (time.monotonic_ns())
+      24  u64  sensor timestamp ns from the camera metadata (0 if unknown)
+      32  u32  metadata length
+      64       frame: height * width * channels bytes, row-major, no padding
+      64+F     metadata: UTF-8 JSON, e.g. {"detections": [{"label", "category",
+               "conf", "box": [x, y, w, h]}, ...]}, plus "audio" levels and
+               sound events with --audio-analysis (see audio_analyzer.py)
+
+Versioning is a seqlock. The writer bumps the slot version to odd, writes, and
+then bumps it to even. A reader reads the version, uses the data and reads the
+version again; if the two differ (or the first is odd) the slot was being
+overwritten and the read is discarded. Frames are handed out as numpy views into
+the mapping, so a reader that keeps a frame must call frame.valid() after using it
+(or frame.copy() first). With N slots a reader has N - 1 frame periods before its
+slot is reused.
+
+If the writer restarts or the resolution changes, the file is replaced. Readers
+notice that the inode changed and map the new one.
+
+Usage:
+    # Writer (the streaming scripts do this with --frame-bus NAME)
+    bus = FrameBusWriter("turtlebot_camera", width, height)
+    bus.publish(frame, {"detections": [...]}, sensor_timestamp_ns)
+
+    # Reader
+    reader = FrameBusReader("turtlebot_camera")
+    frame = reader.wait_next(timeout=1.0)
+    if frame:
+        process(frame.array, frame.metadata)
+        if not frame.valid():
+            ...  # overwritten while in use; discard the result
+
+    python3 frame_bus.py info turtlebot_camera
+    python3 frame_bus.py snapshot turtlebot_camera latest.png
+    python3 frame_bus.py benchmark --readers 4 --seconds 10
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from typing import List, Optional
+
+from startup_timing import lazy_import
+
+np = lazy_import("numpy")  # Only when used: the camera scripts' --help stays quick
+
+BUS_DIR = os.environ.get("FRAME_BUS_DIR", "/dev/shm")
+MAGIC = b"FBUS"
+LAYOUT_VERSION = 1
+HEADER_SIZE = 4096
+HEADER_FORMAT = "<4sIIIII4sIQIIQQ"
+LATEST_OFFSET = 48
+SLOT_HEADER_FORMAT = "<QQQQI"
+SLOT_HEADER_SIZE = 64
+PIXEL_FORMAT = b"BGR3"
+DEFAULT_SLOTS = 4
+DEFAULT_META_BYTES = 16384
+POLL_INTERVAL = 0.001
+
+
+def bus_path(name: str) -> str:
+    return os.path.join(BUS_DIR, name)
+
+
+def slot_stride(frame_bytes: int, meta_bytes: int) -> int:
+    size = SLOT_HEADER_SIZE + frame_bytes + meta_bytes
+    return (size + 4095) // 4096 * 4096  # Page-aligned frames for every slot
+
+
+def detection_records(detections, labels: List[str]) -> List[dict]:
+    """Detections (anything with .box, .category, .conf) as JSON-ready dicts."""
+    records = []
+    for detection in detections or []:
+        category = int(detection.category)
+        records.append(
+            {
+                "label": labels[category] if category < len(labels) else str(category),
+                "category": category,
+                "conf": round(float(detection.conf), 4),
+                "box": [int(v) for v in detection.box],
+            }
+        )
+    return records
+
+
+class FrameBusWriter:
+    def __init__(
+        self,
+        name: str,
+        width: int,
+        height: int,
+        channels: int = 3,
+        slots: int = DEFAULT_SLOTS,
+        meta_bytes: int = DEFAULT_META_BYTES,
+    ):
+        self.name = name
+        self.slots = slots
+        self.meta_bytes = meta_bytes
+        self.sequence = 0
+        self.metadata_truncated = 0
+        self._mmap: Optional[mmap.mmap] = None
+        self._create(width, height, channels)
+
+    def _create(self, width: int, height: int, channels: int):
+        """(Re)create the bus file; readers of an old file re-open by inode."""
+        self.close()
+        self.width, self.height, self.channels = width, height, channels
+        self.frame_bytes = width * height * channels
+        self.stride = slot_stride(self.frame_bytes, self.meta_bytes)
+        path = bus_path(self.name)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(temp_path, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, HEADER_SIZE + self.slots * self.stride)
+            self._mmap = mmap.mmap(fd, HEADER_SIZE + self.slots * self.stride)
+        finally:
+            os.close(fd)
+        struct.pack_into(
+            HEADER_FORMAT,
+            self._mmap,
+            0,
+            MAGIC,
+            LAYOUT_VERSION,
+            self.slots,
+            width,
+            height,
+            channels,
+            PIXEL_FORMAT,
+            self.meta_bytes,
+            self.stride,
+            os.getpid(),
+            0,
+            self.sequence,
+            time.monotonic_ns(),
+        )
+        os.replace(temp_path, path)  # Readers never see a half-initialised header
+        self._frames = [
+            np.ndarray(
+                (height, width, channels),
+                np.uint8,
+                self._mmap,
+                HEADER_SIZE + slot * self.stride + SLOT_HEADER_SIZE,
+            )
+            for slot in range(self.slots)
+        ]
+
+    def publish(
+        self,
+        frame: "np.ndarray",
+        metadata: Optional[dict] = None,
+        sensor_timestamp_ns: int = 0,
+    ) -> int:
+        """Copy one frame (and its metadata) into the next slot; returns its sequence."""
+        if frame.ndim == 2:
+            frame = frame[:, :, None]
+        if frame.shape != (self.height, self.width, self.channels):
+            height, width, channels = frame.shape
+            self._create(width, height, channels)
+        self.sequence += 1
+        slot = self.sequence % self.slots
+        offset = HEADER_SIZE + slot * self.stride
+        meta = json.dumps(metadata).encode() if metadata is not None else b""
+        if len(meta) > self.meta_bytes:
+            meta = b""
+            self.metadata_truncated += 1
+
+        (version,) = struct.unpack_from("<Q", self._mmap, offset)
+        struct.pack_into("<Q", self._mmap, offset, version + 1)  # Odd: writing
+        np.copyto(self._frames[slot], frame)
+        meta_offset = offset + SLOT_HEADER_SIZE + self.frame_bytes
+        self._mmap[meta_offset : meta_offset + len(meta)] = meta
+        struct.pack_into(
+            SLOT_HEADER_FORMAT,
+            self._mmap,
+            offset,
+            version + 1,
+            self.sequence,
+            time.monotonic_ns(),
+            sensor_timestamp_ns,
+            len(meta),
+        )
+        struct.pack_into("<Q", self._mmap, offset, version + 2)  # Even: complete
+        struct.pack_into("<Q", self._mmap, LATEST_OFFSET, self.sequence)
+        return self.sequence
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the shared memory file: header and every slot."""
+        return HEADER_SIZE + self.slots * self.stride
+
+    def stats(self) -> dict:
+        return {
+            "path": bus_path(self.name),
+            "frames_published": self.sequence,
+            "size": f"{self.width}x{self.height}x{self.channels}",
+            "slots": self.slots,
+            "metadata_truncated": self.metadata_truncated,
+        }
+
+    def close(self, unlink: bool = False):
+        if self._mmap is not None:
+            self._frames = []
+            self._mmap.close()
+            self._mmap = None
+        if unlink:
+            try:
+                os.unlink(bus_path(self.name))
+            except FileNotFoundError:
+                pass
+
+
+class BusFrame:
+    """One frame as a zero-copy view; valid() tells whether it is still intact."""
+
+    def __init__(
+        self,
+        mapping: mmap.mmap,
+        slot_offset: int,
+        version: int,
+        seq: int,
+        timestamp_ns: int,
+        sensor_timestamp_ns: int,
+        array: "np.ndarray",
+        meta: bytes,
+    ):
+        self._mapping = mapping  # Stays valid even if the reader re-maps
+        self._slot_offset = slot_offset
+        self._version = version
+        self.seq = seq
+        self.timestamp_ns = timestamp_ns
+        self.sensor_timestamp_ns = sensor_timestamp_ns
+        self.array = array
+        self._meta = meta
+        self._metadata: Optional[dict] = None
+
+    @property
+    def metadata(self) -> dict:
+        if self._metadata is None:
+            self._metadata = json.loads(self._meta) if self._meta else {}
+        return self._metadata
+
+    @property
+    def age(self) -> float:
+        """Seconds since the writer published this frame."""
+        return (time.monotonic_ns() - self.timestamp_ns) / 1e9
+
+    def valid(self) -> bool:
+        return struct.unpack_from("<Q", self._mapping, self._slot_offset)[0] == (
+            self._version
+        )
+
+    def copy(self) -> Optional["np.ndarray"]:
+        """A private copy of the frame, or None if it was overwritten while copying."""
+        array = self.array.copy()
+        return array if self.valid() else None
+
+
+class FrameBusReader:
+    def __init__(self, name: str):
+        self.name = name
+        self.torn_reads = 0
+        self.reopens = 0
+        self._mmap: Optional[mmap.mmap] = None
+        self._inode: Optional[int] = None
+        self._last_seq: Optional[int] = None
+        self._open()
+
+    def _open(self):
+        path = bus_path(self.name)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self._inode = os.fstat(fd).st_ino
+            size = os.fstat(fd).st_size
+            mapping = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        (
+            magic,
+            version,
+            self.slots,
+            self.width,
+            self.height,
+            self.channels,
+            self.pixel_format,
+            self.meta_bytes,
+            self.stride,
+            self.writer_pid,
+            _,
+            _,
+            self.created_ns,
+        ) = struct.unpack_from(HEADER_FORMAT, mapping, 0)
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            mapping.close()
+            raise ValueError(f"{path} is not a version {LAYOUT_VERSION} frame bus")
+        # An old mapping is left to the garbage collector: frames handed out may
+        # still be views into it
+        self._mmap = mapping
+        self.frame_bytes = self.width * self.height * self.channels
+
+    def _replaced(self) -> bool:
+        try:
+            return os.stat(bus_path(self.name)).st_ino != self._inode
+        except FileNotFoundError:
+            return False
+
+    def _slot_version(self, slot_offset: int) -> int:
+        return struct.unpack_from("<Q", self._mmap, slot_offset)[0]
+
+    @property
+    def latest_seq(self) -> int:
+        return struct.unpack_from("<Q", self._mmap, LATEST_OFFSET)[0]
+
+    def read(self, seq: int) -> Optional[BusFrame]:
+        """Frame `seq` if it is still in the ring and not being overwritten."""
+        slot_offset = HEADER_SIZE + (seq % self.slots) * self.stride
+        version, slot_seq, timestamp_ns, sensor_ns, meta_len = struct.unpack_from(
+            SLOT_HEADER_FORMAT, self._mmap, slot_offset
+        )
+        if version % 2 or slot_seq != seq:
+            return None
+        array = np.ndarray(
+            (self.height, self.width, self.channels),
+            np.uint8,
+            self._mmap,
+            slot_offset + SLOT_HEADER_SIZE,
+        )
+        meta_offset = slot_offset + SLOT_HEADER_SIZE + self.frame_bytes
+        meta = self._mmap[meta_offset : meta_offset + meta_len]
+        if self._slot_version(slot_offset) != version:
+            self.torn_reads += 1
+            return None
+        return BusFrame(
+            self._mmap, slot_offset, version, seq, timestamp_ns, sensor_ns, array, meta
+        )
+
+    def latest(self) -> Optional[BusFrame]:
+        seq = self.latest_seq
+        return self.read(seq) if seq else None
+
+    def wait_next(
+        self, after_seq: Optional[int] = None, timeout: Optional[float] = None
+    ) -> Optional[BusFrame]:
+        """Newest frame after `after_seq` (default: the latest seen); None on timeout.
+
+        Readers that fall behind skip to the newest frame rather than replaying
+        old ones; compare frame.seq with the previous one to count skips.
+        """
+        if after_seq is None:
+            after_seq = (
+                self._last_seq if self._last_seq is not None else self.latest_seq
+            )
+        deadline = None if timeout is None else time.monotonic() + timeout
+        next_reopen_check = time.monotonic() + 0.5
+        while True:
+            seq = self.latest_seq
+            if seq > after_seq:
+                frame = self.read(seq)
+                if frame is not None:
+                    self._last_seq = seq
+                    return frame
+            now = time.monotonic()
+            if now >= next_reopen_check:
+                next_reopen_check = now + 0.5
+                if self._replaced():
+                    self._open()  # Writer restarted or changed resolution
+                    self.reopens += 1
+                    after_seq = 0
+            if deadline is not None and now >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL)
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # Frames are still in use; the mapping goes with the last one
+            self._mmap = None
+
+
+def add_frame_bus_arguments(parser: argparse.ArgumentParser):
+    """Command-line option shared by every script that can publish its frames."""
+    parser.add_argument(
+        "--frame-bus",
+        type=str,
+        default=os.environ.get("FRAME_BUS"),
+        help=f"Publish frames and detections to {BUS_DIR}/NAME for local readers (env: FRAME_BUS)",
+    )
+
+
+def benchmark_reader(name: str, seconds: float, touch: bool, results):
+    reader = FrameBusReader(name)
+    received = skipped = invalid = mismatched = 0
+    latency_ns = []
+    last_seq = None
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        frame = reader.wait_next(timeout=0.5)
+        if frame is None:
+            continue
+        if last_seq is not None and frame.seq > last_seq + 1:
+            skipped += frame.seq - last_seq - 1
+        last_seq = frame.seq
+        if touch:
+            # The writer stamps the sequence into the frame; check it end to end
+            checksum = int(frame.array.reshape(-1)[:8].view("<u8")[0])
+            frame.array.mean()  # Read the whole frame like a real consumer
+            if not frame.valid():
+                invalid += 1
+                continue
+            if checksum != frame.seq:
+                mismatched += 1
+        latency_ns.append(time.monotonic_ns() - frame.timestamp_ns)
+        received += 1
+    results.put(
+        {
+            "received": received,
+            "skipped": skipped,
+            "invalid_after_use": invalid,
+            "torn_reads": reader.torn_reads,
+            "mismatched": mismatched,
+            "latency_p50_ms": float(np.percentile(latency_ns, 50) / 1e6),
+            "latency_p99_ms": float(np.percentile(latency_ns, 99) / 1e6),
+        }
+    )
+
+
+def benchmark(args):
+    """One writer at --fps (0: flat out) and --readers reader processes."""
+    import multiprocessing
+
+    name = f"frame_bus_bench_{os.getpid()}"
+    writer = FrameBusWriter(name, args.width, args.height, slots=args.slots)
+    frame = np.random.default_rng(0).integers(
+        0, 255, (args.height, args.width, 3), dtype=np.uint8
+    )
+    metadata = {
+        "detections": [
+            {"label": "person", "category": 0, "conf": 0.9, "box": [10, 20, 30, 40]}
+        ]
+    }
+    results = multiprocessing.Queue()
+    readers = [
+        multiprocessing.Process(
+            target=benchmark_reader,
+            args=(name, args.seconds, not args.no_touch, results),
+        )
+        for _ in range(args.readers)
+    ]
+    for process in readers:
+        process.start()
+    time.sleep(0.2)  # Let readers map the bus
+
+    start = time.monotonic()
+    published = 0
+    while time.monotonic() - start < args.seconds:
+        frame.reshape(-1)[:8] = np.frombuffer(
+            struct.pack("<Q", writer.sequence + 1), np.uint8
+        )
+        writer.publish(frame, metadata)
+        published += 1
+        if args.fps:
+            delay = start + published / args.fps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    elapsed = time.monotonic() - start
+
+    reader_results = [results.get() for _ in readers]
+    for process in readers:
+        process.join()
+    writer.close(unlink=True)
+
+    frame_mb = writer.frame_bytes / 1e6
+    print(
+        f"Writer: {published / elapsed:.1f} frames/s ({published / elapsed * frame_mb:.0f} MB/s) "
+        f"of {args.width}x{args.height}, {args.slots} slots"
+    )
+    for i, r in enumerate(reader_results):
+        print(
+            f"Reader {i}: {r['received'] / args.seconds:.1f} frames/s, skipped {r['skipped']}, "
+            f"torn {r['torn_reads']}, invalid after use {r['invalid_after_use']}, "
+            f"mismatched {r['mismatched']}, latency p50 {r['latency_p50_ms']:.2f} ms "
+            f"p99 {r['latency_p99_ms']:.2f} ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared-memory frame bus tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    info_parser = subparsers.add_parser("info", help="Print a bus header")
+    info_parser.add_argument("name")
+
+    snap_parser = subparsers.add_parser("snapshot", help="Save the latest frame")
+    snap_parser.add_argument("name")
+    snap_parser.add_argument("output", help="Image file (e.g. latest.png)")
+
+    bench_parser = subparsers.add_parser(
+        "benchmark", help="Writer throughput with several concurrent readers"
+    )
+    bench_parser.add_argument("--readers", type=int, default=4)
+    bench_parser.add_argument("--seconds", type=float, default=5.0)
+    bench_parser.add_argument("--width", type=int, default=1280)
+    bench_parser.add_argument("--height", type=int, default=720)
+    bench_parser.add_argument("--slots", type=int, default=DEFAULT_SLOTS)
+    bench_parser.add_argument(
+        "--fps",
+        type=float,
+        default=0,
+        help="Writer rate (default: as fast as possible)",
+    )
+    bench_parser.add_argument(
+        "--no-touch", action="store_true", help="Readers don't read the pixels"
+    )
+
+    args = parser.parse_args()
+    if args.command == "benchmark":
+        benchmark(args)
+        return
+
+    try:
+        reader = FrameBusReader(args.name)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.command == "info":
+        print(
+            f"{bus_path(args.name)}: {reader.width}x{reader.height}x{reader.channels} "
+            f"{reader.pixel_format.decode()}, {reader.slots} slots, writer pid {reader.writer_pid}, "
+            f"latest frame {reader.latest_seq}"
+        )
+        frame = reader.latest()
+        if frame:
+            print(
+                f"Latest frame age {frame.age * 1000:.1f} ms, metadata {frame.metadata}"
+            )
+    else:
+        import cv2
+
+        frame = reader.wait_next(after_seq=0, timeout=2.0)
+        image = frame.copy() if frame else None
+        if image is None:
+            print("Error: no frame available", file=sys.stderr)
+            sys.exit(1)
+        cv2.imwrite(args.output, image)
+        print(f"Saved frame {frame.seq} to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+frame_sources.py - BGR frames from a camera, a recording or a synthetic scene
+
+The IMX500 scripts get their frames from Picamera2. The CPU detection path has to
+run where picamera2 doesn't, like the Camera Module v2 on Ubuntu 22.04 or a laptop
+used for testing. So it reads frames from one of these sources:
+
+    libcamera         gst-launch-1.0 libcamerasrc, raw BGR frames over a pipe
+    picamera2[:N]     CSI camera N through Picamera2, in this process (a Pi 5 has two)
+    /dev/videoN       a V4L2 device through OpenCV
+    clip.mp4          a recorded video, looped and played at --fps
+    synthetic[:SEED]  moving shapes with known labels (no camera, no files)
+
+Every source has read() -> (frame, timestamp_ns) or None at the end, close(), and
+stats(). Frames are height x width x 3 uint8 BGR, the same layout as the
+RGB888 main stream the IMX500 scripts draw on. The synthetic, libcamera and
+picamera2 sources fill one preallocated frame, so a frame is only valid until the next
+read(); copy it to keep it (the frame bus, snapshots and preview already do).
+
+Usage:
+    source = open_frame_source("synthetic", 1280, 720, 30)
+    while (item := source.read()) is not None:
+        frame, timestamp_ns = item
+
+    python3 frame_sources.py synthetic --frames 90 --out /tmp/synthetic.png
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+from typing import List, Optional, Tuple
+
+from startup_timing import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+
+# Shapes drawn by SyntheticSource and the COCO category each one stands for
+SYNTHETIC_OBJECTS = [
+    # (COCO category index, BGR colour, shape)
+    (0, (60, 60, 220), "rectangle"),  # person
+    (2, (220, 120, 40), "rectangle"),  # car
+    (16, (40, 200, 80), "ellipse"),  # dog
+    (32, (0, 220, 255), "ellipse"),  # sports ball
+]
+
+Frame = Tuple["np.ndarray", int]
+
+
+class FrameSource:
+    def __init__(self, width: int, height: int, fps: float):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.frames = 0
+        self.started = time.monotonic()
+
+    def read(self) -> Optional[Frame]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _pace(self):
+        """Hold back sources that could run faster than real time."""
+        due = self.started + self.frames / self.fps
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -1.0:
+            self.started -= delay  # Far behind (paused, overloaded): don't burst
+        self.frames += 1
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "source": type(self).__name__,
+            "frames": self.frames,
+            "fps": round(self.frames / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+
+
+class SyntheticSource(FrameSource):
+    def __init__(
+        self, width: int, height: int, fps: float, paced: bool = True, seed: int = 1
+    ):
+        """Shapes bouncing over a noisy gradient, with their true boxes in .objects."""
+        super().__init__(width, height, fps)
+        self.paced = paced
+        rng = np.random.default_rng(seed)
+        gradient = np.linspace(40, 110, width, dtype=np.float32)[None, :, None]
+        noise = rng.normal(0, 6, (height, width, 1)).astype(np.float32)
+        self.background = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+        self.background = np.repeat(self.background, 3, axis=2)
+        self.frame = np.empty_like(self.background)
+        self.positions = rng.uniform(0.1, 0.6, (len(SYNTHETIC_OBJECTS), 2))
+        self.velocities = rng.uniform(-0.01, 0.01, (len(SYNTHETIC_OBJECTS), 2))
+        self.sizes = rng.uniform(0.12, 0.25, (len(SYNTHETIC_OBJECTS), 2))
+        self.objects: List[Tuple[int, Tuple[int, int, int, int]]] = []
+
+    def read(self) -> Optional[Frame]:
+        if self.paced:
+            self._pace()
+        else:
+            self.frames += 1
+        self.positions += self.velocities
+        bounce = (self.positions < 0) | (self.positions + self.sizes > 1)
+        self.velocities[bounce] *= -1
+        self.positions = np.clip(self.positions, 0, 1 - self.sizes)
+
+        frame = self.frame
+        np.copyto(frame, self.background)
+        self.objects = []
+        scale = np.array([self.width, self.height])
+        for (category, colour, shape), position, size in zip(
+            SYNTHETIC_OBJECTS, self.positions, self.sizes
+        ):
+            x, y = (position * scale).astype(int)
+            w, h = (size * scale).astype(int)
+            if shape == "rectangle":
+                cv2.rectangle(frame, (x, y), (x + w, y + h), colour, cv2.FILLED)
+            else:
+                centre, axes = (x + w // 2, y + h // 2), (w // 2, h // 2)
+                cv2.ellipse(frame, centre, axes, 0, 0, 360, colour, cv2.FILLED)
+            self.objects.append((category, (x, y, w, h)))
+        return frame, time.monotonic_ns()
+
+
+class VideoFileSource(FrameSource):
+    def __init__(
+        self, path: str, width: int, height: int, fps: float, loop: bool = True
+    ):
+        """A recording resized to width x height and played in real time."""
+        super().__init__(width, height, fps)
+        self.path = path
+        self.loop = loop
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise OSError(f"Cannot open video '{path}'")
+
+    def read(self) -> Optional[Frame]:
+        ok, frame = self.capture.read()
+        if not ok and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.capture.read()
+        if not ok:
+            return None
+        if frame.shape[1] != self.width or frame.shape[0] != self.height:
+            frame = cv2.resize(frame, (self.width, self.height))
+        self._pace()
+        return frame, time.monotonic_ns()
+
+    def close(self):
+        self.capture.release()
+
+
+class V4l2Source(FrameSource):
+    def __init__(self, device: str, width: int, height: int, fps: float):
+        super().__init__(width, height, fps)
+        self.capture = cv2.VideoCapture(device, cv2.CAP_V4L2)
+        if not self.capture.isOpened():
+            raise OSError(f"Cannot open camera '{device}'")
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.capture.set(cv2.CAP_PROP_FPS, fps)
+        self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    def read(self) -> Optional[Frame]:
+        ok, frame = self.capture.read()
+        if not ok:
+            return None
+        self.frames += 1
+        if frame.shape[1] != self.width or frame.shape[0] != self.height:
+            frame = cv2.resize(frame, (self.width, self.height))
+        return frame, time.monotonic_ns()
+
+    def close(self):
+        self.capture.release()
+
+
+class LibcameraSource(FrameSource):
+    def __init__(self, width: int, height: int, fps: float):
+        """libcamerasrc through gst-launch-1.0, the same path stream_video_to_pc.sh uses."""
+        super().__init__(width, height, fps)
+        self.frame_size = width * height * 3
+        caps = f"video/x-raw,width={width},height={height},framerate={int(fps)}/1"
+        self.process = subprocess.Popen(
+            [
+                "gst-launch-1.0",
+                "-q",
+                "libcamerasrc",
+                "!",
+                caps,
+                "!",
+                "videoconvert",
+                "!",
+                "video/x-raw,format=BGR",
+                "!",
+                "fdsink",
+                "fd=1",
+            ],
+            stdout=subprocess.PIPE,
+            bufsize=0,
+        )
+        self.buffer = bytearray(self.frame_size)
+        self.frame = np.frombuffer(self.buffer, np.uint8).reshape(height, width, 3)
+
+    def read(self) -> Optional[Frame]:
+        view = memoryview(self.buffer)
+        filled = 0
+        while filled < self.frame_size:
+            count = self.process.stdout.readinto(view[filled:])
+            if not count:
+                return None
+            filled += count
+        self.frames += 1
+        return self.frame, time.monotonic_ns()
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class Picamera2Source(FrameSource):
+    def __init__(
+        self, camera_num: int, width: int, height: int, fps: float, buffers: int = 6
+    ):
+        """A CSI camera through Picamera2, without the IMX500 network."""
+        from picamera2 import MappedArray, Picamera2
+
+        super().__init__(width, height, fps)
+        self.mapped_array = MappedArray
+        self.camera = Picamera2(camera_num)
+        self.camera.configure(
+            self.camera.create_video_configuration(
+                main={"size": (width, height), "format": "RGB888"},
+                controls={"FrameRate": float(fps)},
+                buffer_count=buffers,
+            )
+        )
+        self.frame = np.empty((height, width, 3), np.uint8)
+        self.metadata: dict = {}
+        self.camera.start()
+
+    def read(self) -> Optional[Frame]:
+        request = self.camera.capture_request()
+        try:
+            self.metadata = request.get_metadata() or {}
+            with self.mapped_array(request, "main") as m:
+                if m.array.shape != self.frame.shape:
+                    self.frame = np.empty(m.array.shape, np.uint8)
+                np.copyto(self.frame, m.array)  # The buffer goes back to the camera
+        finally:
+            request.release()
+        self.frames += 1
+        return self.frame, time.monotonic_ns()
+
+    def close(self):
+        self.camera.stop()
+
+
+def open_frame_source(spec: str, width: int, height: int, fps: float) -> FrameSource:
+    """'libcamera', 'picamera2[:N]', 'synthetic[:SEED]', '/dev/videoN' or a video file path."""
+    name, _, option = spec.partition(":")
+    if name == "synthetic":
+        return SyntheticSource(width, height, fps, seed=int(option or 1))
+    if name == "picamera2":
+        return Picamera2Source(int(option or 0), width, height, fps)
+    if spec == "libcamera":
+        return LibcameraSource(width, height, fps)
+    if spec.startswith("/dev/video"):
+        return V4l2Source(spec, width, height, fps)
+    if os.path.exists(spec):
+        return VideoFileSource(spec, width, height, fps)
+    raise ValueError(
+        f"Unknown frame source '{spec}' "
+        "(libcamera, picamera2[:N], synthetic[:SEED], /dev/videoN or a file)"
+    )
+
+
+def add_source_arguments(parser: argparse.ArgumentParser, default: str = "libcamera"):
+    """Command-line option shared by every script that reads a FrameSource."""
+    parser.add_argument(
+        "--source",
+        type=str,
+        default=os.environ.get("FRAME_SOURCE", default),
+        help="libcamera, picamera2[:N], synthetic[:SEED], /dev/videoN or a video file "
+        f"(env: FRAME_SOURCE, default: {default})",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read frames from a frame source")
+    parser.add_argument(
+        "source",
+        help="libcamera, picamera2[:N], synthetic[:SEED], /dev/videoN or a file",
+    )
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--frames", type=int, default=150)
+    parser.add_argument("--out", type=str, help="Save the last frame to this image")
+    args = parser.parse_args()
+
+    try:
+        source = open_frame_source(args.source, args.width, args.height, args.fps)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    frame = None
+    try:
+        for _ in range(args.frames):
+            item = source.read()
+            if item is None:
+                break
+            frame = item[0]
+    finally:
+        source.close()
+    print(source.stats())
+    if args.out and frame is not None:
+        cv2.imwrite(args.out, frame)
+        print(f"Saved {args.out}")
+
+
+if __name__ == "__main__":
+    main()
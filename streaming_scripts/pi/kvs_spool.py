@@ -0,0 +1,846 @@
+"""
+kvs_spool.py - Store-and-forward uploader that survives Wi-Fi dropouts
+
+kvssink keeps unsent video in a RAM buffer (storage-size=512 in
+stream_video_to_AWS.sh). When the robot drives out of Wi-Fi coverage, that buffer
+fills and the footage in it is lost. This spool puts a bounded on-disk queue in
+between instead:
+
+    gst-launch ... x264enc ! h264parse ! fdsink | kvs_spool.py run --url URL
+
+* The H.264 byte stream is cut into fragments at keyframes (--fragment-seconds).
+  Each fragment starts with SPS/PPS and an IDR, so it decodes on its own.
+* Each fragment is written to a .tmp file, fsynced and renamed to
+  <seq>-<start_ms>.h264. A state.json, replaced atomically, keeps the
+  sequence high-water mark. The directory listing is the queue index. After a
+  crash or power cut, leftover .tmp files are deleted and every complete fragment
+  is still queued, with no sequence number reused.
+* The queue is bounded by --max-mb. When full, the oldest fragment kept in
+  rejected/ goes first, then the oldest fragment that isn't being uploaded (or,
+  with --overflow drop-newest, the new one is dropped instead).
+* Uploaders send fragments oldest first, with at most --concurrency in flight
+  and all of them sharing one --max-kbps token bucket. The default of 1 keeps
+  arrivals in order. A fragment is deleted only after a 2xx (or 409, "already
+  have it"). A 400, 413 or 415 means the endpoint will never take it, so it
+  moves to rejected/. Any other error counts as an outage: the uploaders back
+  off exponentially, up to a minute, and retry the same fragment.
+
+Fragments are POSTed to an HTTP ingest endpoint with X-Stream-Name,
+X-Fragment-Sequence and X-Fragment-Start-Ms headers. The endpoint can be a relay
+in front of Kinesis (PutMedia needs MKV and SigV4 signing, which is left to the
+relay). It can also be the local stand-in here, which checks the order and
+keeps the received stream.
+
+Usage:
+    ./stream_video_to_AWS.sh    # with SPOOL_ENABLED=true and SPOOL_INGEST_URL set
+
+    python3 kvs_spool.py serve --port 8080 --out /tmp/received.h264   # ingest stand-in
+    python3 kvs_spool.py status --spool-dir ~/kvs_spool                # depth and backlog age
+
+    # 60 s of synthetic H.264 through a 15 s outage, with a 1500 kbps upload cap
+    python3 kvs_spool.py simulate --seconds 60 --outage 10:25 --max-kbps 1500
+"""
+
+import argparse
+import glob
+import http.client
+import http.server
+import json
+import os
+import random
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional, Set, Tuple
+
+from rtp_h264 import (
+    NAL_TYPE_IDR,
+    NAL_TYPE_PPS,
+    NAL_TYPE_SPS,
+    AccessUnitAssembler,
+)
+from stream_stats import StreamStats, add_stats_arguments
+
+DEFAULT_SPOOL_DIR = os.path.expanduser("~/kvs_spool")
+DEFAULT_MAX_MB = 2048
+DEFAULT_FRAGMENT_SECONDS = 2.0
+DEFAULT_CONCURRENCY = 1  # More gets through a backlog faster, out of order
+MAX_BACKOFF = 60.0
+REJECTED_STATUSES = (400, 413, 415)  # This fragment can never go; others may pass
+UPLOAD_CHUNK = 16384
+START_CODE = b"\x00\x00\x00\x01"
+
+
+class Fragment:
+    def __init__(self, seq: int, start_ms: int, path: str, size: int):
+        self.seq = seq
+        self.start_ms = start_ms
+        self.path = path
+        self.size = size
+
+    @classmethod
+    def from_path(cls, path: str) -> Optional["Fragment"]:
+        name = os.path.basename(path)[: -len(".h264")]
+        try:
+            seq, start_ms = (int(part) for part in name.split("-"))
+            return cls(seq, start_ms, path, os.path.getsize(path))
+        except (ValueError, OSError):
+            return None
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default}.", file=sys.stderr)
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default}.", file=sys.stderr)
+        return default
+
+
+def fsync_directory(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_durably(path: str, data: bytes):
+    """Write, fsync and rename into place: after a crash the file is whole or absent."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    fsync_directory(os.path.dirname(path))
+
+
+class FragmentSpool:
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024,
+        overflow: str = "drop-oldest",
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.fragments: Dict[int, Fragment] = {}
+        self.in_flight: Set[int] = set()
+        self.rejected: List[Tuple[str, int]] = (
+            []
+        )  # (path, size) in rejected/, oldest first
+        self.next_seq = 0
+        self.total_bytes = 0
+        self.rejected_bytes = 0
+        self.appended = 0
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.recovered = 0
+        self._condition = threading.Condition()
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(self.directory, "state.json")
+
+    @property
+    def rejected_dir(self) -> str:
+        return os.path.join(self.directory, "rejected")
+
+    def _recover(self):
+        for temp_path in glob.glob(os.path.join(self.directory, "*.tmp")):
+            os.remove(temp_path)  # Interrupted mid-write: never acknowledged
+        try:
+            with open(self.state_path) as f:
+                self.next_seq = json.load(f)["next_seq"]
+        except (OSError, ValueError, KeyError):
+            self.next_seq = 0
+        for path in glob.glob(os.path.join(self.directory, "*.h264")):
+            fragment = Fragment.from_path(path)
+            if fragment:
+                self.fragments[fragment.seq] = fragment
+                self.total_bytes += fragment.size
+                self.next_seq = max(self.next_seq, fragment.seq + 1)
+        self.recovered = len(self.fragments)
+        for path in sorted(glob.glob(os.path.join(self.rejected_dir, "*.h264"))):
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            self.rejected.append((path, size))
+            self.rejected_bytes += size
+
+    def append(self, data: bytes, start_ms: int) -> Optional[Fragment]:
+        """Queue a fragment durably; None if it was refused (drop-newest when full)."""
+        with self._condition:
+            if not self._make_room(len(data)):
+                self.dropped += 1
+                self.dropped_bytes += len(data)
+                return None
+            seq = self.next_seq
+            self.next_seq += 1
+        write_durably(
+            self.state_path, json.dumps({"next_seq": seq + 1}).encode()
+        )  # Before the fragment, so a crash can't reuse seq
+        path = os.path.join(self.directory, f"{seq:012d}-{start_ms}.h264")
+        write_durably(path, data)
+        fragment = Fragment(seq, start_ms, path, len(data))
+        with self._condition:
+            self.fragments[seq] = fragment
+            self.total_bytes += fragment.size
+            self.appended += 1
+            self._condition.notify_all()
+        return fragment
+
+    def _make_room(self, size: int) -> bool:
+        while self.total_bytes + self.rejected_bytes + size > self.max_bytes:
+            if self.rejected:
+                path, rejected_size = self.rejected.pop(0)
+                self.rejected_bytes -= rejected_size
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            if self.overflow == "drop-newest":
+                return False
+            idle = [seq for seq in self.fragments if seq not in self.in_flight]
+            if not idle:
+                return False
+            self._remove(min(idle), dropped=True)
+        return True
+
+    def _remove(self, seq: int, dropped: bool = False):
+        fragment = self.fragments.pop(seq)
+        self.total_bytes -= fragment.size
+        if dropped:
+            self.dropped += 1
+            self.dropped_bytes += fragment.size
+        try:
+            os.remove(fragment.path)
+        except FileNotFoundError:
+            pass
+
+    def take(self, timeout: float = 1.0) -> Optional[Fragment]:
+        """The oldest fragment nobody is uploading, marked in flight."""
+        with self._condition:
+            deadline = time.monotonic() + timeout
+            while True:
+                idle = [seq for seq in self.fragments if seq not in self.in_flight]
+                if idle:
+                    seq = min(idle)
+                    self.in_flight.add(seq)
+                    return self.fragments[seq]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def done(self, fragment: Fragment):
+        """Uploaded: forget and delete it."""
+        with self._condition:
+            self.in_flight.discard(fragment.seq)
+            if fragment.seq in self.fragments:
+                self._remove(fragment.seq)
+            self.uploaded += 1
+            self.uploaded_bytes += fragment.size
+
+    def reject(self, fragment: Fragment):
+        """Never uploadable: move it to rejected/, still counted against max_bytes."""
+        path = os.path.join(self.rejected_dir, os.path.basename(fragment.path))
+        kept = True
+        try:
+            os.makedirs(self.rejected_dir, exist_ok=True)
+            os.link(fragment.path, path)
+        except FileExistsError:
+            pass  # Kept before a crash, between the link and the removal
+        except OSError as e:
+            kept = False
+            print(
+                f"Warning: could not keep rejected fragment {fragment.seq}: {e}",
+                file=sys.stderr,
+            )
+        with self._condition:
+            self.in_flight.discard(fragment.seq)
+            if fragment.seq in self.fragments:
+                self._remove(fragment.seq)
+            if kept:
+                self.rejected.append((path, fragment.size))
+                self.rejected_bytes += fragment.size
+
+    def release(self, fragment: Fragment):
+        """Upload failed: back in the queue at its place."""
+        with self._condition:
+            self.in_flight.discard(fragment.seq)
+            self._condition.notify_all()
+
+    def backlog_age(self, now_ms: Optional[int] = None) -> float:
+        """Seconds since the start of the oldest fragment still queued."""
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        with self._condition:
+            if not self.fragments:
+                return 0.0
+            oldest = self.fragments[min(self.fragments)]
+        return max(0.0, (now_ms - oldest.start_ms) / 1000)
+
+    def stats(self) -> dict:
+        with self._condition:
+            depth, size = len(self.fragments), self.total_bytes
+            rejected, rejected_size = len(self.rejected), self.rejected_bytes
+        return {
+            "queued_fragments": depth,
+            "queued_mb": round(size / 1e6, 2),
+            "backlog_age_s": round(self.backlog_age(), 1),
+            "appended": self.appended,
+            "uploaded": self.uploaded,
+            "uploaded_mb": round(self.uploaded_bytes / 1e6, 2),
+            "dropped": self.dropped,
+            "dropped_mb": round(self.dropped_bytes / 1e6, 2),
+            "rejected_kept": rejected,
+            "rejected_mb": round(rejected_size / 1e6, 2),
+            "recovered_at_start": self.recovered,
+            "next_seq": self.next_seq,
+        }
+
+
+class Fragmenter:
+    def __init__(self, spool: FragmentSpool, fragment_seconds: float):
+        """Cut an Annex B stream into self-contained fragments at keyframes."""
+        self.spool = spool
+        self.fragment_seconds = fragment_seconds
+        self.assembler = AccessUnitAssembler()
+        self.parameter_sets: Dict[int, bytes] = {}
+        self.current: List[bytes] = []
+        self.current_start = 0.0
+        self.waiting_for_idr = True
+
+    def feed(self, data: bytes, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        access_units = self.assembler.feed(data) if data else self.assembler.flush()
+        for access_unit in access_units:
+            self._add(access_unit, now)
+        if not data:
+            self._cut()
+
+    def _add(self, access_unit: List[bytes], now: float):
+        types = [nal[0] & 0x1F for nal in access_unit]
+        for nal, nal_type in zip(access_unit, types):
+            if nal_type in (NAL_TYPE_SPS, NAL_TYPE_PPS):
+                self.parameter_sets[nal_type] = nal
+        if NAL_TYPE_IDR in types:
+            if self.current and now - self.current_start >= self.fragment_seconds:
+                self._cut()
+            if not self.current:
+                self.waiting_for_idr = False
+                self.current_start = now
+                # Repeat SPS/PPS so every fragment decodes on its own
+                for nal_type in (NAL_TYPE_SPS, NAL_TYPE_PPS):
+                    if nal_type in self.parameter_sets and nal_type not in types:
+                        self.current.append(self.parameter_sets[nal_type])
+        if self.waiting_for_idr:
+            return  # Frames before the first keyframe can't be decoded
+        self.current.extend(access_unit)
+
+    def _cut(self):
+        if self.current:
+            data = b"".join(START_CODE + nal for nal in self.current)
+            self.spool.append(data, int(self.current_start * 1000))
+        self.current = []
+
+
+class TokenBucket:
+    def __init__(self, rate_bytes: float, burst: Optional[float] = None):
+        """Shared upload budget in bytes per second; rate 0 means unlimited."""
+        self.rate = rate_bytes
+        self.burst = burst or max(rate_bytes, UPLOAD_CHUNK)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, count: int):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                wait = (count - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Uploader:
+    def __init__(
+        self,
+        spool: FragmentSpool,
+        url: str,
+        stream_name: str,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        max_kbps: float = 0.0,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: float = 30.0,
+    ):
+        self.spool = spool
+        self.url = urllib.parse.urlsplit(url)
+        self.stream_name = stream_name
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(max_kbps * 1000 / 8)
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.failures = 0
+        self.rejected = 0
+        self.online = False
+        self.last_error: Optional[str] = None
+        self.backoff = 0.0
+        self._next_attempt = 0.0  # time.monotonic() of the next probe while offline
+        self._probing = False  # A worker is probing the endpoint
+        self._lock = threading.Lock()
+        self._running = False
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        self._running = True
+        for index in range(self.concurrency):
+            thread = threading.Thread(
+                target=self._run, name=f"spool-upload-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _claim_attempt(self) -> Optional[bool]:
+        """May this worker upload now? None: wait; False: online; True: probe.
+
+        While offline, a single worker probes the endpoint once per backoff
+        period and the others wait, so recovery follows the outage rather
+        than the number of workers.
+        """
+        with self._lock:
+            if self.last_error is None:
+                return False
+            wait = self._next_attempt - time.monotonic()
+            if wait <= 0 and not self._probing:
+                self._probing = True
+                return True
+        time.sleep(min(max(wait, 0.05), 0.5))
+        return None
+
+    def _reachable(self):
+        with self._lock:
+            self.online, self.backoff, self.last_error = True, 0.0, None
+            self._next_attempt, self._probing = 0.0, False
+
+    def _run(self):
+        while self._running:
+            probe = self._claim_attempt()
+            if probe is None:
+                continue
+            fragment = self.spool.take(timeout=1.0)
+            if fragment is None:
+                if probe:
+                    with self._lock:
+                        self._probing = False
+                continue
+            try:
+                status = self._post(fragment)
+            except (OSError, http.client.HTTPException) as e:
+                self._failed(fragment, f"{type(e).__name__}: {e}", probe)
+                continue
+            if 200 <= status < 300 or status == 409:
+                self.spool.done(fragment)
+                self._reachable()
+            elif status in REJECTED_STATUSES:
+                # The endpoint will never take this one; keep it out of the way
+                print(
+                    f"Warning: ingest rejected fragment {fragment.seq} (HTTP {status})",
+                    file=sys.stderr,
+                )
+                self.spool.reject(fragment)
+                self._reachable()
+                with self._lock:
+                    self.rejected += 1
+            else:
+                # 5xx, 408/429, and 401/403 until credentials are fixed: retry later
+                self._failed(fragment, f"HTTP {status}", probe)
+
+    def _failed(self, fragment: Fragment, error: str, probe: bool):
+        self.spool.release(fragment)
+        with self._lock:
+            self.failures += 1
+            if self.online or self.last_error is None:
+                print(f"Upload failing ({error}); spooling to disk", file=sys.stderr)
+            self.online = False
+            self.last_error = error
+            now = time.monotonic()
+            # Once per backoff period: the uploads in flight when the link went
+            # down all fail together, and count as one failure
+            if probe or now >= self._next_attempt:
+                self.backoff = min(MAX_BACKOFF, max(1.0, self.backoff * 2))
+                self._next_attempt = now + self.backoff * random.uniform(0.8, 1.2)
+            if probe:
+                self._probing = False
+
+    def _post(self, fragment: Fragment) -> int:
+        connection_class = (
+            http.client.HTTPSConnection
+            if self.url.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        connection = connection_class(self.url.netloc, timeout=self.timeout)
+        try:
+            connection.putrequest("POST", self.url.path or "/")
+            headers = {
+                "Content-Type": "video/h264",
+                "Content-Length": str(fragment.size),
+                "X-Stream-Name": self.stream_name,
+                "X-Fragment-Sequence": str(fragment.seq),
+                "X-Fragment-Start-Ms": str(fragment.start_ms),
+                **self.headers,
+            }
+            for name, value in headers.items():
+                connection.putheader(name, value)
+            connection.endheaders()
+            with open(fragment.path, "rb") as f:
+                while chunk := f.read(UPLOAD_CHUNK):
+                    self.bucket.consume(len(chunk))
+                    connection.send(chunk)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+    def close(self):
+        self._running = False
+        for thread in self._threads:
+            thread.join(timeout=self.timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "online": self.online,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "backoff_s": round(self.backoff, 1),
+                "in_flight": len(self.spool.in_flight),
+                "last_error": self.last_error,
+            }
+
+
+class IngestStandIn(http.server.ThreadingHTTPServer):
+    def __init__(self, port: int, out_path: Optional[str], outage=None):
+        """Local ingest endpoint: checks sequence order, keeps the received stream.
+
+        outage=(start, end) answers 503 between those seconds after startup.
+        """
+        super().__init__(("127.0.0.1", port), IngestHandler)
+        self.out_path = out_path
+        self.outage = outage
+        self.started = time.monotonic()
+        self.received: Dict[int, bytes] = {}
+        self.arrival_order: List[int] = []
+        self.duplicates = 0
+        self.lock = threading.Lock()
+
+    def in_outage(self) -> bool:
+        if not self.outage:
+            return False
+        elapsed = time.monotonic() - self.started
+        return self.outage[0] <= elapsed < self.outage[1]
+
+    def write_stream(self):
+        """The received fragments, in sequence order, as one playable .h264 file."""
+        if not self.out_path:
+            return
+        with self.lock, open(self.out_path, "wb") as f:
+            for seq in sorted(self.received):
+                f.write(self.received[seq])
+
+    def stats(self) -> dict:
+        with self.lock:
+            order = self.arrival_order
+            out_of_order = sum(1 for a, b in zip(order, order[1:]) if b < a)
+            seqs = sorted(self.received)
+            gaps = (seqs[-1] - seqs[0] + 1 - len(seqs)) if seqs else 0
+            return {
+                "fragments": len(self.received),
+                "bytes": sum(len(data) for data in self.received.values()),
+                "duplicates": self.duplicates,
+                "out_of_order_arrivals": out_of_order,
+                "sequence_gaps": gaps,
+            }
+
+
+class IngestHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        server: IngestStandIn = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length)
+        if server.in_outage():
+            self.send_response(503)
+            self.end_headers()
+            return
+        seq = int(self.headers.get("X-Fragment-Sequence", -1))
+        with server.lock:
+            if seq in server.received:
+                server.duplicates += 1
+                status = 409
+            else:
+                server.received[seq] = data
+                server.arrival_order.append(seq)
+                status = 200
+        self.send_response(status)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def synthetic_annexb(fps: int, gop: int, kbps: int, seconds: float):
+    """(frame time, bytes) of a fake H.264 stream with the right NAL structure."""
+    rng = random.Random(0)
+    frame_bytes = kbps * 1000 // 8 // fps
+    for index in range(int(seconds * fps)):
+        if index % gop == 0:
+            nals = [
+                bytes([0x67]) + bytes(8),  # SPS
+                bytes([0x68]) + bytes(4),  # PPS
+                bytes([0x65, 0x88]) + rng.randbytes(frame_bytes * 4),  # IDR
+            ]
+        else:
+            nals = [bytes([0x41, 0x9A]) + rng.randbytes(frame_bytes // 2)]
+        # Keep the payload free of start codes, as emulation prevention would
+        data = b"".join(
+            START_CODE + nal.replace(b"\x00\x00", b"\x00\x03") for nal in nals
+        )
+        yield index / fps, data
+
+
+def add_spool_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--spool-dir",
+        type=str,
+        default=os.environ.get("SPOOL_DIR", DEFAULT_SPOOL_DIR),
+        help=f"Queue directory (env: SPOOL_DIR, default: {DEFAULT_SPOOL_DIR})",
+    )
+    parser.add_argument(
+        "--max-mb",
+        type=int,
+        default=env_int("SPOOL_MAX_MB", DEFAULT_MAX_MB),
+        help=f"Largest queue size on disk, rejected/ included (env: SPOOL_MAX_MB, default: {DEFAULT_MAX_MB})",
+    )
+    parser.add_argument(
+        "--overflow",
+        choices=["drop-oldest", "drop-newest"],
+        default="drop-oldest",
+        help="What to drop when the queue is full",
+    )
+    parser.add_argument(
+        "--fragment-seconds", type=float, default=DEFAULT_FRAGMENT_SECONDS
+    )
+    parser.add_argument(
+        "--url",
+        type=str,
+        default=os.environ.get("SPOOL_INGEST_URL", "http://127.0.0.1:8080/ingest"),
+        help="HTTP ingest endpoint (env: SPOOL_INGEST_URL)",
+    )
+    parser.add_argument(
+        "--stream-name",
+        type=str,
+        default=os.environ.get("KVS_STREAM_NAME", "turtlebot"),
+        help="Sent as X-Stream-Name (env: KVS_STREAM_NAME)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=env_int("SPOOL_CONCURRENCY", DEFAULT_CONCURRENCY),
+        help=f"Uploads in flight at once; more than 1 can deliver fragments out of order (env: SPOOL_CONCURRENCY, default: {DEFAULT_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--max-kbps",
+        type=float,
+        default=env_float("SPOOL_UPLOAD_KBPS", 0.0),
+        help="Upload bandwidth cap shared by all uploads, 0 for none (env: SPOOL_UPLOAD_KBPS)",
+    )
+    parser.add_argument(
+        "--header",
+        action="append",
+        default=[],
+        help="Extra 'Name: value' header for the ingest endpoint (repeatable)",
+    )
+
+
+def spool_from_args(args) -> Tuple[FragmentSpool, Uploader]:
+    spool = FragmentSpool(args.spool_dir, args.max_mb * 1024 * 1024, args.overflow)
+    headers = dict(
+        (name.strip(), value.strip())
+        for name, _, value in (header.partition(":") for header in args.header)
+    )
+    uploader = Uploader(
+        spool, args.url, args.stream_name, args.concurrency, args.max_kbps, headers
+    )
+    return spool, uploader
+
+
+def run(args):
+    """Spool H.264 from stdin and upload it until stdin ends and the queue drains."""
+    spool, uploader = spool_from_args(args)
+    if spool.recovered:
+        print(f"Recovered {spool.recovered} queued fragments from {args.spool_dir}")
+    stream_stats = StreamStats(args.stats_file, args.stats_interval)
+    stream_stats.add_source("spool", spool.stats)
+    stream_stats.add_source("uploader", uploader.stats)
+    fragmenter = Fragmenter(spool, args.fragment_seconds)
+    uploader.start()
+    stdin = sys.stdin.buffer
+    try:
+        while True:
+            data = stdin.read1(65536)
+            fragmenter.feed(data)
+            stream_stats.maybe_publish()
+            if not data:
+                break
+        print("Input ended; uploading what is queued (Ctrl+C leaves it on disk)")
+        while spool.fragments:
+            time.sleep(1)
+            stream_stats.maybe_publish()
+    except KeyboardInterrupt:
+        print(f"\nStopping; {len(spool.fragments)} fragments stay queued on disk")
+    finally:
+        uploader.close()
+        stream_stats.publish()
+        print(f"Spool stats: {spool.stats()}")
+
+
+def serve(args):
+    server = IngestStandIn(args.port, args.out)
+    print(f"Ingest stand-in on http://127.0.0.1:{args.port}/ingest")
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # kill also saves --out
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.write_stream()
+        print(server.stats())
+
+
+def status(args):
+    spool = FragmentSpool(args.spool_dir)
+    print(json.dumps(spool.stats(), indent=1))
+
+
+def simulate(args):
+    """Synthetic H.264 through an outage into the local stand-in; checks what arrived."""
+    import shutil
+    import tempfile
+
+    outage = tuple(float(v) for v in args.outage.split(":")) if args.outage else None
+    temp_dir = None if args.spool_dir else tempfile.mkdtemp(prefix="kvs_spool_")
+    try:
+        simulate_upload(args, outage, args.spool_dir or temp_dir)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def simulate_upload(args, outage, spool_dir: str):
+    server = IngestStandIn(0, None, outage)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    args.url = f"http://127.0.0.1:{server.server_address[1]}/ingest"
+    args.spool_dir = spool_dir
+    args.header = []
+    spool, uploader = spool_from_args(args)
+    fragmenter = Fragmenter(spool, args.fragment_seconds)
+    uploader.start()
+
+    sent = bytearray()
+    start = time.time()
+    next_report = 0.0
+    for frame_time, data in synthetic_annexb(
+        args.fps, args.fps, args.kbps, args.seconds
+    ):
+        delay = start + frame_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        sent += data
+        fragmenter.feed(data)
+        if frame_time >= next_report:
+            next_report += 5
+            stats = spool.stats()
+            print(
+                f"t={frame_time:4.0f}s online={uploader.online!s:5} "
+                f"queued={stats['queued_fragments']:3} ({stats['queued_mb']} MB) "
+                f"backlog={stats['backlog_age_s']:5.1f}s uploaded={stats['uploaded']}"
+            )
+    fragmenter.feed(b"")
+    drain_start = time.time()
+    while spool.fragments and time.time() - drain_start < 120:
+        time.sleep(0.5)
+    uploader.close()
+    print(f"Drained {time.time() - drain_start:.1f} s after the input ended")
+    print(f"Spool: {spool.stats()}")
+    print(f"Ingest: {server.stats()}")
+    received = b"".join(server.received[seq] for seq in sorted(server.received))
+    # The stand-in re-joins fragments; compare NAL payloads, which must all arrive
+    print(
+        "Received stream matches what was encoded:",
+        received.replace(START_CODE, b"") == bytes(sent).replace(START_CODE, b""),
+    )
+    server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Store-and-forward H.264 uploader")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Spool H.264 from stdin and upload")
+    add_spool_arguments(run_parser)
+    add_stats_arguments(run_parser)
+    serve_parser = subparsers.add_parser("serve", help="Local ingest stand-in")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--out", type=str, help="Write the received stream here")
+    status_parser = subparsers.add_parser("status", help="Queue depth and backlog age")
+    status_parser.add_argument(
+        "--spool-dir", type=str, default=os.environ.get("SPOOL_DIR", DEFAULT_SPOOL_DIR)
+    )
+    sim = subparsers.add_parser("simulate", help="Upload through an outage, locally")
+    add_spool_arguments(sim)
+    sim.set_defaults(spool_dir=None)  # A temporary one, removed afterwards
+    sim.add_argument("--seconds", type=float, default=40)
+    sim.add_argument("--fps", type=int, default=30)
+    sim.add_argument("--kbps", type=int, default=1000, help="Synthetic stream bitrate")
+    sim.add_argument(
+        "--outage", type=str, default="8:20", help="start:end seconds of 503s"
+    )
+    args = parser.parse_args()
+    {"run": run, "serve": serve, "status": status, "simulate": simulate}[args.command](
+        args
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+local_preview.py - A local preview window that never holds up the streams
+
+With --local-display, the streaming scripts used to call cv2.imshow() and
+cv2.waitKey(1) on every full-resolution frame inside the capture loop. Over a
+slow X forwarding or VNC session one imshow can take 50-200 ms, and that time was
+taken straight from capture, YouTube and the PC stream.
+
+LocalPreview moves the window to its own thread:
+
+* The capture loop calls offer(frame). A frame is taken only when the preview is
+  due (--preview-fps) and the window thread is idle. Otherwise offer() returns at
+  once and the frame counts as dropped. A taken frame is downscaled to
+  --preview-width before it is handed over, so the window never gets a
+  full-resolution frame.
+* The window thread runs at a low priority (nice PREVIEW_NICE). It makes all of
+  the HighGUI calls, and it keeps pumping window events between frames, so 'q'
+  still works when frames are rare.
+* Pressing 'q' in the window sets quit_requested. The capture loop checks it and
+  stops the stream as before.
+
+Usage (from a streaming script):
+    preview = preview_from_args(args)  # None without --local-display
+    while streaming:
+        ...
+        if preview:
+            preview.offer(frame_with_overlays)
+            if preview.quit_requested:
+                break
+    if preview:
+        preview.close()
+
+    # Capture fps with a slow display, drawing in the loop vs in a LocalPreview
+    python3 local_preview.py benchmark --render-ms 120
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from typing import Callable, List, Optional
+
+from startup_timing import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+
+DEFAULT_PREVIEW_WIDTH = 640
+DEFAULT_PREVIEW_FPS = 10.0
+PREVIEW_NICE = 10  # Below the capture loop, encoders and the detector
+IDLE_POLL = 0.05  # Seconds between window event pumps when no frame arrives
+WINDOW_TITLE = "Local Preview"
+
+
+def downscaled_size(width: int, height: int, max_width: int):
+    """Frame size no wider than max_width, same aspect ratio, even height."""
+    if width <= max_width:
+        return width, height
+    return max_width, max(2, round(height * max_width / width) // 2 * 2)
+
+
+class LocalPreview:
+    def __init__(
+        self,
+        width: int = DEFAULT_PREVIEW_WIDTH,
+        max_fps: float = DEFAULT_PREVIEW_FPS,
+        title: str = WINDOW_TITLE,
+        show: Optional[Callable] = None,
+    ):
+        """show(frame or None) -> key code replaces the HighGUI window, e.g. for tests."""
+        self.width = width
+        self.interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.title = title
+        self.show = show or self._show_window
+        self.quit_requested = False
+        self.error: Optional[str] = None
+        self._pending = None
+        self._busy = False
+        self._next_due = 0.0
+        self._size = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._window_open = False
+        self.offered = 0
+        self.shown = 0
+        self.dropped_rate = 0
+        self.dropped_busy = 0
+        self.offer_seconds = 0.0
+        self.max_offer_seconds = 0.0
+        self.render_seconds = 0.0
+        self.max_render_seconds = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="local-preview", daemon=True
+        )
+        self._thread.start()
+
+    def offer(self, frame):
+        """Hand a frame to the window if one is due and it is idle; never blocks."""
+        if self.error:
+            return  # The window thread has given up
+        started = time.monotonic()
+        self.offered += 1
+        if started < self._next_due:
+            self.dropped_rate += 1
+            return
+        if self._busy or self._pending is not None:
+            self.dropped_busy += 1
+            return
+        self._next_due = started + self.interval
+        height, width = frame.shape[:2]
+        if self._size is None:
+            self._size = downscaled_size(width, height, self.width)
+        if self._size == (width, height):
+            small = frame.copy()  # The caller reuses or overwrites its frame
+        else:
+            small = cv2.resize(frame, self._size, interpolation=cv2.INTER_AREA)
+        with self._lock:
+            self._pending = small
+        self._ready.set()
+        took = time.monotonic() - started
+        self.offer_seconds += took
+        self.max_offer_seconds = max(self.max_offer_seconds, took)
+
+    def _show_window(self, frame) -> int:
+        if frame is not None:
+            cv2.imshow(self.title, frame)
+            self._window_open = True
+        if not self._window_open:
+            return -1
+        return cv2.waitKey(1)
+
+    def _run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), PREVIEW_NICE)
+        except OSError:
+            pass  # Already lower, or not allowed; the preview works either way
+        while not self._stop.is_set():
+            self._ready.wait(IDLE_POLL)
+            with self._lock:
+                frame, self._pending = self._pending, None
+                self._ready.clear()
+                self._busy = frame is not None
+            started = time.monotonic()
+            try:
+                key = self.show(frame)
+            except Exception as e:  # A broken display must not stop the stream
+                self.error = str(e).strip().splitlines()[-1]
+                print(f"Warning: local preview stopped: {self.error}", file=sys.stderr)
+                break
+            finally:
+                self._busy = False
+            if frame is not None:
+                took = time.monotonic() - started
+                self.shown += 1
+                self.render_seconds += took
+                self.max_render_seconds = max(self.max_render_seconds, took)
+            if key is not None and key != -1 and key & 0xFF == ord("q"):
+                self.quit_requested = True
+        if self._window_open:
+            cv2.destroyWindow(self.title)
+            cv2.waitKey(1)  # Lets HighGUI actually take the window down
+
+    def close(self):
+        self._stop.set()
+        self._ready.set()
+        if self._thread:
+            self._thread.join(timeout=2.0)
+
+    def stats(self) -> dict:
+        taken = self.offered - self.dropped_rate - self.dropped_busy
+        return {
+            "offered": self.offered,
+            "shown": self.shown,
+            "dropped_rate": self.dropped_rate,
+            "dropped_busy": self.dropped_busy,
+            "size": f"{self._size[0]}x{self._size[1]}" if self._size else None,
+            "offer_ms": round(1000 * self.offer_seconds / taken, 3) if taken else 0.0,
+            "max_offer_ms": round(1000 * self.max_offer_seconds, 3),
+            "render_ms": (
+                round(1000 * self.render_seconds / self.shown, 2) if self.shown else 0.0
+            ),
+            "max_render_ms": round(1000 * self.max_render_seconds, 2),
+            "quit_requested": self.quit_requested,
+            **({"error": self.error} if self.error else {}),
+        }
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default}.", file=sys.stderr)
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default:g}.", file=sys.stderr)
+        return default
+
+
+def add_preview_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by the scripts with a local preview window."""
+    parser.add_argument(
+        "--local-display", action="store_true", help="Show video locally as well"
+    )
+    parser.add_argument(
+        "--preview-width",
+        type=int,
+        default=env_int("PREVIEW_WIDTH", DEFAULT_PREVIEW_WIDTH),
+        help=f"Downscale the local preview to this width (env: PREVIEW_WIDTH, default: {DEFAULT_PREVIEW_WIDTH})",
+    )
+    parser.add_argument(
+        "--preview-fps",
+        type=float,
+        default=env_float("PREVIEW_FPS", DEFAULT_PREVIEW_FPS),
+        help=f"Most frames per second the local preview shows (env: PREVIEW_FPS, default: {DEFAULT_PREVIEW_FPS})",
+    )
+
+
+def preview_from_args(args: argparse.Namespace) -> Optional[LocalPreview]:
+    """A started LocalPreview for --local-display, otherwise None."""
+    if not args.local_display:
+        return None
+    preview = LocalPreview(args.preview_width, args.preview_fps)
+    preview.start()
+    return preview
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_capture_loop(args, render_inline: bool, preview: Optional[LocalPreview]):
+    """Capture at args.fps for args.seconds; the display costs args.render_ms per frame."""
+    frame = np.random.default_rng(0).integers(
+        0, 255, (args.height, args.width, 3), dtype=np.uint8
+    )
+    period = 1.0 / args.fps
+    loop_times = []
+    frames = 0
+    started = time.monotonic()
+    next_frame = started
+    while time.monotonic() - started < args.seconds:
+        next_frame += period
+        delay = next_frame - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)  # The camera delivers a frame
+        loop_started = time.monotonic()
+        if render_inline:
+            cv2.resize(frame, (args.width // 2, args.height // 2))
+            time.sleep(args.render_ms / 1000)  # imshow + waitKey on a slow display
+        elif preview:
+            preview.offer(frame)
+        loop_times.append(time.monotonic() - loop_started)
+        frames += 1
+    elapsed = time.monotonic() - started
+    return {
+        "fps": round(frames / elapsed, 1),
+        "loop_p50_ms": round(1000 * percentile(loop_times, 0.5), 3),
+        "loop_p99_ms": round(1000 * percentile(loop_times, 0.99), 3),
+    }
+
+
+def benchmark(args):
+    """Capture fps with a slow display: drawn in the loop vs through a LocalPreview."""
+
+    def slow_display(frame) -> int:
+        if frame is not None:
+            time.sleep(args.render_ms / 1000)
+        return -1
+
+    print(
+        f"{args.width}x{args.height} at {args.fps} fps for {args.seconds:.0f} s, "
+        f"display takes {args.render_ms:.0f} ms per frame"
+    )
+    inline = run_capture_loop(args, render_inline=True, preview=None)
+    print(f"  imshow in the capture loop: {inline}")
+    preview = LocalPreview(args.preview_width, args.preview_fps, show=slow_display)
+    preview.start()
+    off_loop = run_capture_loop(args, render_inline=False, preview=preview)
+    preview.close()
+    print(f"  LocalPreview:               {off_loop}")
+    print(f"  preview stats: {preview.stats()}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local preview window helpers")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench = subparsers.add_parser(
+        "benchmark", help="Capture fps with a slow display, in-loop vs off-loop"
+    )
+    bench.add_argument("--width", type=int, default=1280)
+    bench.add_argument("--height", type=int, default=720)
+    bench.add_argument("--fps", type=float, default=30.0)
+    bench.add_argument("--seconds", type=float, default=5.0)
+    bench.add_argument(
+        "--render-ms",
+        type=float,
+        default=80.0,
+        help="Simulated imshow + waitKey time per frame (default: 80)",
+    )
+    bench.add_argument("--preview-width", type=int, default=DEFAULT_PREVIEW_WIDTH)
+    bench.add_argument("--preview-fps", type=float, default=DEFAULT_PREVIEW_FPS)
+    args = parser.parse_args()
+    commands = {"benchmark": benchmark}
+    return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,495 @@
+"""
+memory_budget.py - Fit a streaming script into the RAM of a small Pi
+
+A Pi 3 or Zero 2 W has 1 GB or 512 MB for ROS, the camera and the stream. The
+scripts were sized for a Pi 5. Camera buffers were hardcoded (10 in the
+capture_request scripts, 12 in the PC script), every frame was a new full-size
+array, and the YouTube and PC sinks of the both-script each ran their own
+ffmpeg with their own copy of x264.
+
+With --memory-budget MB (env: MEMORY_BUDGET_MB), a script plans its buffers
+from that budget:
+
+* plan_memory() estimates the resident memory of the pipeline at the stream's
+  resolution: the interpreter and its modules, each encoder process, the camera
+  buffers, the frame bus ring and the web viewer's GOP cache. While the
+  estimate exceeds the budget, it gives things up in this order: the
+  both-script's second encoder (one ffmpeg then encodes once for both sinks),
+  frame bus slots, the web viewer's GOP cache, then camera buffers down to
+  MIN_CAMERA_BUFFERS. Resolution and frame rate are left alone. A plan that
+  still doesn't fit is printed as a warning.
+* FrameBuffer is one preallocated frame that the capture loop copies each
+  camera request into. Before, every request got a new array from
+  make_array(). Frames now go to ffmpeg from that buffer without a tobytes()
+  copy.
+* MemoryMonitor reads the resident memory of the script and every process it
+  started from /proc, with a name for each (encoder, audio, camera source).
+  Named buffers come with their sizes. It is published as the "memory" stats
+  source and tracks the peak against the budget.
+
+Without a budget the plan keeps the old sizes, and the monitor still reports.
+
+Usage (from a streaming script):
+    plan = memory_plan_from_args(args, camera_buffers=10, encoders=2)
+    config = picam2.create_video_configuration(..., buffer_count=plan.camera_buffers)
+    monitor = MemoryMonitor(args.memory_budget)
+    monitor.add_process("encoder", lambda: ffmpeg_process.pid)
+    stream_stats.add_source("memory", monitor.stats)
+
+    # What fits in 140 MB at 1280x720 with two encoders, the frame bus and the web viewer
+    python3 memory_budget.py plan --budget 140 --encoders 2 --frame-bus --web-viewer
+
+    # Run a script on the synthetic camera and fail if its process tree outgrows the budget
+    python3 memory_budget.py check --budget 150 --duration 30
+    python3 memory_budget.py check --budget 150 -- stream_cpu_detection_video_to_pc.py \\
+        --source synthetic --detector-model synthetic --width 640 --height 480
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Union
+
+from frame_bus import DEFAULT_SLOTS as DEFAULT_FRAME_BUS_SLOTS
+from startup_timing import lazy_import
+from web_viewer import MAX_GOP_CACHE
+
+np = lazy_import("numpy")
+
+MB = 1024 * 1024
+# Rough planning estimates; MemoryMonitor reports what is actually resident
+PYTHON_BASE_MB = 75  # Interpreter, NumPy, OpenCV and picamera2 (measured 73-81 MB)
+ENCODER_BASE_MB = 14  # ffmpeg and libx264 at -tune zerolatency, without frames
+ENCODER_YUV_FRAMES = 6  # Frames x264 holds: lookahead, references and one per thread
+ENCODER_BGR_FRAMES = 2  # ffmpeg's raw input frame and its colour conversion
+MIN_CAMERA_BUFFERS = 4  # Fewer and the camera drops frames while a request is held
+MIN_FRAME_BUS_SLOTS = 2  # A reader still gets one frame period to copy a slot
+LOW_MEMORY_GOP_SECONDS = 4  # Web viewer fragments kept for joining browsers
+DEFAULT_CHECK_SCRIPT = [
+    "stream_cpu_detection_video_to_pc.py",
+    "--source",
+    "synthetic",
+    "--detector-model",
+    "synthetic",
+    "--remote-ip",
+    "127.0.0.1",
+]
+
+
+class MemoryPlan:
+    def __init__(
+        self,
+        budget_mb: float,
+        width: int,
+        height: int,
+        fps: float,
+        camera_buffers: int,
+        encoders: int,
+        frame_bus: bool,
+        web_viewer: bool,
+    ):
+        self.budget_mb = budget_mb
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.camera_buffers = camera_buffers
+        self.encoders = encoders
+        self.frame_bus = frame_bus
+        self.frame_bus_slots = DEFAULT_FRAME_BUS_SLOTS
+        self.web_viewer = web_viewer
+        self.gop_cache = MAX_GOP_CACHE
+        self.shared_encoder = False
+        self.steps: List[str] = []
+
+    @property
+    def frame_mb(self) -> float:
+        return self.width * self.height * 3 / MB
+
+    def estimates(self) -> Dict[str, float]:
+        """Resident memory (MB) of each part of the pipeline, as planned."""
+        pixels_mb = self.width * self.height / MB
+        encoder_mb = (
+            ENCODER_BASE_MB
+            + ENCODER_YUV_FRAMES * 1.5 * pixels_mb
+            + ENCODER_BGR_FRAMES * self.frame_mb
+        )
+        parts = {
+            "python": PYTHON_BASE_MB,
+            "encoders": encoder_mb * (1 if self.shared_encoder else self.encoders),
+            "camera_buffers": self.camera_buffers * self.frame_mb,
+            "capture_frame": self.frame_mb,
+        }
+        if self.frame_bus:
+            parts["frame_bus"] = self.frame_bus_slots * self.frame_mb
+        if self.web_viewer:
+            # Fragments at a typical 2.5 Mbps; the cache is capped by count
+            parts["web_viewer"] = self.gop_cache * 2500 / 8 / self.fps / 1024
+        return {name: round(mb, 1) for name, mb in parts.items()}
+
+    def estimate_mb(self) -> float:
+        return round(sum(self.estimates().values()), 1)
+
+    def fits(self) -> bool:
+        return not self.budget_mb or self.estimate_mb() <= self.budget_mb
+
+    def describe(self) -> str:
+        sinks = ""
+        if self.encoders > 1:
+            sinks = (
+                ", one shared encoder"
+                if self.shared_encoder
+                else ", one encoder per sink"
+            )
+        bus = f", {self.frame_bus_slots} frame bus slots" if self.frame_bus else ""
+        budget = f" of {self.budget_mb:g} MB" if self.budget_mb else ""
+        camera = (
+            f"{self.camera_buffers} camera buffers"
+            if self.camera_buffers
+            else "no camera buffers"
+        )
+        return (
+            f"{camera}{bus}{sinks}: "
+            f"about {self.estimate_mb():.0f} MB{budget} at {self.width}x{self.height}"
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "budget_mb": self.budget_mb,
+            "estimate_mb": self.estimate_mb(),
+            "estimates": self.estimates(),
+            "camera_buffers": self.camera_buffers,
+            "frame_bus_slots": self.frame_bus_slots if self.frame_bus else None,
+            "gop_cache": self.gop_cache if self.web_viewer else None,
+            "shared_encoder": self.shared_encoder,
+            "steps": self.steps,
+        }
+
+
+def plan_memory(
+    budget_mb: float,
+    width: int,
+    height: int,
+    fps: float,
+    camera_buffers: int,
+    encoders: int = 1,
+    frame_bus: bool = False,
+    web_viewer: bool = False,
+    can_share_encoder: bool = False,
+) -> MemoryPlan:
+    """The script's usual sizes, cut back step by step until the estimate fits the budget."""
+    plan = MemoryPlan(
+        budget_mb, width, height, fps, camera_buffers, encoders, frame_bus, web_viewer
+    )
+    if not budget_mb:
+        return plan
+    if not plan.fits() and encoders > 1 and can_share_encoder:
+        plan.shared_encoder = True
+        plan.steps.append("one encoder for all sinks")
+    if not plan.fits() and frame_bus and plan.frame_bus_slots > MIN_FRAME_BUS_SLOTS:
+        plan.frame_bus_slots = MIN_FRAME_BUS_SLOTS
+        plan.steps.append(f"{MIN_FRAME_BUS_SLOTS} frame bus slots")
+    if not plan.fits() and web_viewer:
+        plan.gop_cache = min(plan.gop_cache, round(fps * LOW_MEMORY_GOP_SECONDS))
+        plan.steps.append(f"web viewer caches {plan.gop_cache} fragments")
+    while not plan.fits() and plan.camera_buffers > MIN_CAMERA_BUFFERS:
+        plan.camera_buffers -= 1
+    if plan.camera_buffers < camera_buffers:
+        plan.steps.append(f"{plan.camera_buffers} camera buffers")
+    return plan
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default:g}.", file=sys.stderr)
+        return default
+
+
+def add_memory_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by the streaming scripts."""
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=env_float("MEMORY_BUDGET_MB", 0.0),
+        help="Size buffers and encoders to fit this many MB of resident memory; "
+        "0 keeps the usual sizes (env: MEMORY_BUDGET_MB)",
+    )
+
+
+def memory_plan_from_args(
+    args: argparse.Namespace,
+    camera_buffers: int,
+    encoders: int = 1,
+    can_share_encoder: bool = False,
+) -> MemoryPlan:
+    plan = plan_memory(
+        args.memory_budget,
+        args.width,
+        args.height,
+        args.fps,
+        camera_buffers,
+        encoders,
+        frame_bus=bool(args.frame_bus),
+        web_viewer=bool(getattr(args, "web_port", None)),
+        can_share_encoder=can_share_encoder,
+    )
+    if args.memory_budget:
+        print(f"Memory plan: {plan.describe()}")
+        if not plan.fits():
+            print(
+                f"Warning: {args.width}x{args.height} needs about {plan.estimate_mb():.0f} MB "
+                f"even with the smallest buffers; lower the resolution to fit "
+                f"{args.memory_budget:g} MB.",
+                file=sys.stderr,
+            )
+    return plan
+
+
+class FrameBuffer:
+    """One preallocated frame the capture loop reuses instead of a new array per request."""
+
+    def __init__(self):
+        self.array: Optional["np.ndarray"] = None
+        self.allocations = 0
+
+    def copy_from(self, source: "np.ndarray") -> "np.ndarray":
+        """Copy a (possibly strided) camera buffer in; reallocates only when the size changes."""
+        if self.array is None or self.array.shape != source.shape:
+            self.array = np.empty(source.shape, source.dtype)
+            self.allocations += 1
+        np.copyto(self.array, source)
+        return self.array
+
+    @property
+    def nbytes(self) -> int:
+        return self.array.nbytes if self.array is not None else 0
+
+
+def rss_kb(pid: Union[int, str] = "self") -> int:
+    """VmRSS of a process in kB; 0 if it has exited."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def descendants(pid: Union[int, str] = "self") -> List[int]:
+    """Every process below pid (children, their children, ...)."""
+    found: List[int] = []
+    pending = [str(pid)]
+    while pending:
+        parent = pending.pop()
+        try:
+            tasks = os.listdir(f"/proc/{parent}/task")
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                with open(f"/proc/{parent}/task/{task}/children") as f:
+                    children = [int(child) for child in f.read().split()]
+            except (OSError, ValueError):
+                continue
+            found += children
+            pending += [str(child) for child in children]
+    return found
+
+
+PidSource = Union[int, Callable[[], Optional[int]]]
+
+
+class MemoryMonitor:
+    def __init__(self, budget_mb: float = 0, plan: Optional[MemoryPlan] = None):
+        self.budget_mb = budget_mb
+        self.plan = plan
+        self._processes: Dict[str, PidSource] = {}
+        self._buffers: Dict[str, Callable[[], int]] = {}
+        self.samples = 0
+        self.peak_mb = 0.0
+        self.over_budget = 0
+        self._warned = False
+
+    def add_process(self, name: str, pid: PidSource):
+        """A child process by pid, or a callable for one that may be restarted (or absent)."""
+        self._processes[name] = pid
+
+    def add_buffer(self, name: str, size: Callable[[], int]):
+        """A buffer inside the script (bytes), reported next to the process totals."""
+        self._buffers[name] = size
+
+    def sample(self) -> Dict[str, float]:
+        """Resident MB per process: this script, each named child and all other descendants."""
+        processes = {"python": rss_kb() / 1024}
+        named = set()
+        for name, source in self._processes.items():
+            pid = source() if callable(source) else source
+            if pid:
+                named.add(pid)
+                kb = rss_kb(pid)
+                if kb:  # Not once it has exited
+                    processes[name] = kb / 1024
+        others = [pid for pid in descendants() if pid not in named]
+        if others:
+            processes["other_children"] = sum(rss_kb(pid) for pid in others) / 1024
+        total = sum(processes.values())
+        self.samples += 1
+        self.peak_mb = max(self.peak_mb, total)
+        if self.budget_mb and total > self.budget_mb:
+            self.over_budget += 1
+            if not self._warned:
+                self._warned = True
+                print(
+                    f"Warning: resident memory {total:.0f} MB is over the "
+                    f"{self.budget_mb:g} MB budget ({self.describe(processes)})",
+                    file=sys.stderr,
+                )
+        return processes
+
+    @staticmethod
+    def describe(processes: Dict[str, float]) -> str:
+        return ", ".join(f"{name} {mb:.0f} MB" for name, mb in processes.items())
+
+    def stats(self) -> dict:
+        processes = self.sample()
+        return {
+            "budget_mb": self.budget_mb or None,
+            "total_mb": round(sum(processes.values()), 1),
+            "peak_mb": round(self.peak_mb, 1),
+            "over_budget_samples": self.over_budget,
+            "processes_mb": {name: round(mb, 1) for name, mb in processes.items()},
+            "buffers_mb": {
+                name: round(size() / MB, 2) for name, size in self._buffers.items()
+            },
+            "plan": self.plan.to_dict() if self.plan else None,
+        }
+
+
+def plan(args):
+    """Print what a budget buys at a resolution."""
+    result = plan_memory(
+        args.budget,
+        args.width,
+        args.height,
+        args.fps,
+        args.camera_buffers,
+        args.encoders,
+        frame_bus=args.frame_bus,
+        web_viewer=args.web_viewer,
+        can_share_encoder=args.encoders > 1,
+    )
+    print(result.describe())
+    for name, mb in result.estimates().items():
+        print(f"  {name:<15} {mb:7.1f} MB")
+    if result.steps:
+        print(f"  cut back: {', '.join(result.steps)}")
+    if not result.fits():
+        print("  does not fit: lower the resolution")
+    return 0 if result.fits() else 1
+
+
+def tree_rss(pid: int) -> Dict[int, int]:
+    """kB per process for pid and everything below it."""
+    return {p: rss_kb(p) for p in [pid, *descendants(pid)]}
+
+
+def process_name(pid: int) -> str:
+    try:
+        with open(f"/proc/{pid}/comm") as f:
+            return f.read().strip()
+    except OSError:
+        return str(pid)
+
+
+def check(args):
+    """Run a script under a budget on the synthetic camera; fail if its tree ever exceeds it."""
+    script = args.script or DEFAULT_CHECK_SCRIPT
+    command = [sys.executable, *script, "--memory-budget", str(args.budget)]
+    print(
+        f"Running {' '.join(script)} for {args.duration:g} s under {args.budget:g} MB"
+    )
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    peak_kb = 0
+    peaks: Dict[str, int] = {}
+    samples = 0
+    deadline = time.monotonic() + args.duration
+    try:
+        while time.monotonic() < deadline and process.poll() is None:
+            tree = tree_rss(process.pid)
+            total = sum(tree.values())
+            peak_kb = max(peak_kb, total)
+            for pid, kb in tree.items():
+                name = process_name(pid)
+                peaks[name] = max(peaks.get(name, 0), kb)
+            samples += 1
+            time.sleep(args.interval)
+    finally:
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)  # The script's own cleanup path
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+    if samples == 0 or (process.returncode not in (0, -signal.SIGINT) and samples < 3):
+        print(
+            f"Error: the script exited early (status {process.returncode}).",
+            file=sys.stderr,
+        )
+        return 1
+    for name, kb in sorted(peaks.items(), key=lambda item: -item[1]):
+        print(f"  {name:<16} peak {kb / 1024:7.1f} MB")
+    verdict = "within" if peak_kb / 1024 <= args.budget else "OVER"
+    print(
+        f"Peak resident memory {peak_kb / 1024:.1f} MB over {samples} samples: "
+        f"{verdict} the {args.budget:g} MB budget"
+    )
+    return 0 if verdict == "within" else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fit a streaming script into a RAM budget"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    plan_parser = subparsers.add_parser(
+        "plan", help="What a budget buys at a resolution"
+    )
+    plan_parser.add_argument("--budget", type=float, required=True, help="MB")
+    plan_parser.add_argument("--width", type=int, default=1280)
+    plan_parser.add_argument("--height", type=int, default=720)
+    plan_parser.add_argument("--fps", type=float, default=30.0)
+    plan_parser.add_argument("--camera-buffers", type=int, default=10)
+    plan_parser.add_argument("--encoders", type=int, default=1)
+    plan_parser.add_argument("--frame-bus", action="store_true")
+    plan_parser.add_argument("--web-viewer", action="store_true")
+    check_parser = subparsers.add_parser(
+        "check", help="Run a script under a budget and fail if it goes over"
+    )
+    check_parser.add_argument("--budget", type=float, required=True, help="MB")
+    check_parser.add_argument("--duration", type=float, default=30.0, help="Seconds")
+    check_parser.add_argument("--interval", type=float, default=0.5, help="Seconds")
+    check_parser.add_argument(
+        "script",
+        nargs=argparse.REMAINDER,
+        help="After --: script and its arguments (default: the CPU detection "
+        "script on the synthetic camera)",
+    )
+    args = parser.parse_args()
+    if getattr(args, "script", None) and args.script[0] == "--":
+        args.script = args.script[1:]
+    commands = {"plan": plan, "check": check}
+    return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
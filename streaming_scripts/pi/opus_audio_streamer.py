@@ -0,0 +1,742 @@
+"""
+opus_audio_streamer.py - Opus audio to the PC with FEC, silence suppression and loss feedback
+
+stream_audio_to_pc.sh runs a fixed `opusenc bitrate=16000` with no in-band FEC, so
+audio breaks up on lossy Wi-Fi. It also keeps sending full packets while nobody
+speaks. This streamer encodes the same 48 kHz mono microphone with libopus itself
+(through ctypes), sends standard RTP Opus (payload type 96, so open_audio_stream.sh
+still plays it) and adds:
+
+* In-band FEC: every packet also carries a low-bitrate copy of the previous
+  frame. The receiver can rebuild a single lost frame from the packet after it.
+* Voice-activity DTX: an energy detector with an adaptive noise floor and a
+  hangover gates transmission. During silence, only a tiny keep-alive packet goes
+  out every 400 ms. The RTP timestamp keeps running, and the first packet of each
+  talk spurt carries the marker bit (RFC 7587).
+* Loss-aware bitrate: the receiver (pc/opus_audio_receiver.py) sends RTCP
+  receiver reports back on the same socket. The reported loss sets Opus's
+  expected-loss figure, which decides whether packets carry the FEC copy. It
+  also raises the bitrate to make room for that copy, and drops it back to
+  --bitrate once the link is clean (see BitrateController).
+* Stats: input level and peak (dBFS), speech fraction, packets sent and
+  suppressed, achieved kbps, target bitrate, reported loss and jitter.
+
+libopus comes with GStreamer's opus plugin; if it is missing, `sudo apt install libopus0`.
+
+Usage:
+    python3 opus_audio_streamer.py send [--device hw:3,0] [--ip 192.168.1.100] [--port 5002]
+    # --audio-analysis adds levels and sound events to the stats (see audio_analyzer.py)
+    # PC: python3 opus_audio_receiver.py --stdout | aplay -q -f S16_LE -r 48000 -c 1
+
+    # WAV file -> lossy relay -> PC receiver on this machine, loss changing every phase
+    python3 opus_audio_streamer.py loopback [--wav speech.wav] --loss-phases 6:0 10:0.15 8:0.02
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import math
+import os
+import random
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from typing import Optional, Tuple
+
+import numpy as np
+
+from audio_analyzer import add_audio_analysis_arguments, analyzer_from_args
+from audio_capture import AudioCapture
+from rtp_fec import LossyRelay
+from stream_stats import StreamStats, add_stats_arguments
+
+OPUS_APPLICATION_VOIP = 2048
+OPUS_SIGNAL_VOICE = 3001
+OPUS_SET_BITRATE_REQUEST = 4002
+OPUS_SET_COMPLEXITY_REQUEST = 4010
+OPUS_SET_INBAND_FEC_REQUEST = 4012
+OPUS_SET_PACKET_LOSS_PERC_REQUEST = 4014
+OPUS_SET_DTX_REQUEST = 4016
+OPUS_SET_SIGNAL_REQUEST = 4024
+OPUS_RATES = (8000, 12000, 16000, 24000, 48000)
+MAX_PACKET_BYTES = 1275
+
+RTP_CLOCK = 48000  # RFC 7587: Opus RTP timestamps always count 48 kHz samples
+OPUS_PAYLOAD_TYPE = 96
+RTCP_RECEIVER_REPORT = 201
+KEEPALIVE_SECONDS = 0.4  # Packet rate during silence (matches Opus's own DTX)
+FEEDBACK_TIMEOUT = 5.0  # Seconds without reports before stats flag feedback stale
+
+DEFAULT_BITRATE = 16  # kbps, what stream_audio_to_pc.sh used
+DEFAULT_MIN_BITRATE = 10
+DEFAULT_MAX_BITRATE = 32
+DEFAULT_EXPECTED_LOSS = 5  # percent, until the first receiver report
+FEC_MIN_BITRATE = 20000  # Below this Opus leaves the FEC copy out of speech packets
+DEFAULT_VAD_MARGIN_DB = 9.0
+DEFAULT_HANGOVER_MS = 300
+SILENCE_FLOOR_DBFS = -60.0
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default}.", file=sys.stderr)
+        return default
+
+
+def load_libopus():
+    """libopus through ctypes, with the signatures used here."""
+    name = ctypes.util.find_library("opus") or "libopus.so.0"
+    try:
+        lib = ctypes.CDLL(name)
+    except OSError as e:
+        raise OSError(
+            f"libopus not found ({e}); install it with: sudo apt install libopus0"
+        ) from e
+    lib.opus_encoder_create.restype = ctypes.c_void_p
+    lib.opus_encoder_create.argtypes = [
+        ctypes.c_int32,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.POINTER(ctypes.c_int),
+    ]
+    lib.opus_encode.restype = ctypes.c_int32
+    lib.opus_encode.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_int32,
+    ]
+    lib.opus_encoder_ctl.restype = ctypes.c_int
+    lib.opus_encoder_destroy.argtypes = [ctypes.c_void_p]
+    lib.opus_strerror.restype = ctypes.c_char_p
+    lib.opus_strerror.argtypes = [ctypes.c_int]
+    return lib
+
+
+class OpusEncoder:
+    def __init__(
+        self,
+        rate: int,
+        channels: int,
+        bitrate: int,
+        fec: bool = True,
+        dtx: bool = True,
+        complexity: int = 5,
+        expected_loss: int = DEFAULT_EXPECTED_LOSS,
+    ):
+        """A VoIP-tuned Opus encoder; bitrate in bits per second."""
+        if rate not in OPUS_RATES:
+            raise ValueError(f"Opus needs a sample rate in {OPUS_RATES}, not {rate}")
+        self.lib = load_libopus()
+        self.channels = channels
+        error = ctypes.c_int()
+        self.state = self.lib.opus_encoder_create(
+            rate, channels, OPUS_APPLICATION_VOIP, ctypes.byref(error)
+        )
+        if error.value != 0:
+            raise OSError(f"opus_encoder_create: {self._error(error.value)}")
+        self._out = ctypes.create_string_buffer(MAX_PACKET_BYTES)
+        self._ctl(OPUS_SET_SIGNAL_REQUEST, OPUS_SIGNAL_VOICE)
+        self._ctl(OPUS_SET_COMPLEXITY_REQUEST, complexity)
+        self._ctl(OPUS_SET_INBAND_FEC_REQUEST, int(fec))
+        self._ctl(OPUS_SET_DTX_REQUEST, int(dtx))
+        self.set_bitrate(bitrate)
+        self.set_expected_loss(expected_loss if fec else 0)
+
+    def _error(self, code: int) -> str:
+        return self.lib.opus_strerror(code).decode()
+
+    def _ctl(self, request: int, value: int):
+        result = self.lib.opus_encoder_ctl(
+            ctypes.c_void_p(self.state), ctypes.c_int(request), ctypes.c_int(value)
+        )
+        if result != 0:
+            raise OSError(f"opus_encoder_ctl({request}): {self._error(result)}")
+
+    def set_bitrate(self, bitrate: int):
+        self.bitrate = bitrate
+        self._ctl(OPUS_SET_BITRATE_REQUEST, bitrate)
+
+    def set_expected_loss(self, percent: int):
+        """How much of each packet Opus spends on the FEC copy of the last frame."""
+        self.expected_loss = percent
+        self._ctl(OPUS_SET_PACKET_LOSS_PERC_REQUEST, percent)
+
+    def encode(self, pcm: bytes) -> bytes:
+        """One frame of S16LE PCM (20 ms here) to one Opus packet."""
+        frame_samples = len(pcm) // (2 * self.channels)
+        length = self.lib.opus_encode(
+            self.state, pcm, frame_samples, self._out, MAX_PACKET_BYTES
+        )
+        if length < 0:
+            raise OSError(f"opus_encode: {self._error(length)}")
+        return self._out.raw[:length]
+
+    def close(self):
+        if self.state:
+            self.lib.opus_encoder_destroy(self.state)
+            self.state = None
+
+
+class VoiceActivityDetector:
+    def __init__(
+        self,
+        margin_db: float = DEFAULT_VAD_MARGIN_DB,
+        hangover_ms: float = DEFAULT_HANGOVER_MS,
+        block_ms: float = 20.0,
+    ):
+        """Speech is `margin_db` above a noise floor that falls fast and rises slowly."""
+        self.margin_db = margin_db
+        self.hangover_blocks = int(hangover_ms / block_ms)
+        self.noise_floor = SILENCE_FLOOR_DBFS
+        self.level_db = SILENCE_FLOOR_DBFS
+        self.peak_db = SILENCE_FLOOR_DBFS
+        self.active = False
+        self._hangover = 0
+
+    def update(self, pcm: bytes) -> bool:
+        samples = np.frombuffer(pcm, np.int16).astype(np.float32) / 32768
+        rms = float(np.sqrt(np.mean(samples * samples))) if samples.size else 0.0
+        self.level_db = 20 * math.log10(max(rms, 1e-5))
+        self.peak_db = 20 * math.log10(max(float(np.max(np.abs(samples))), 1e-5))
+        if self.level_db < self.noise_floor:
+            self.noise_floor = self.level_db
+        else:
+            self.noise_floor += 0.05  # ~2.5 dB/s: follows a rising background
+        speech = (
+            self.level_db > self.noise_floor + self.margin_db
+            and self.level_db > SILENCE_FLOOR_DBFS
+        )
+        if speech:
+            self._hangover = self.hangover_blocks
+        elif self._hangover:
+            self._hangover -= 1
+        self.active = speech or self._hangover > 0
+        return self.active
+
+
+class BitrateController:
+    def __init__(
+        self,
+        start: int = DEFAULT_BITRATE * 1000,
+        minimum: int = DEFAULT_MIN_BITRATE * 1000,
+        maximum: int = DEFAULT_MAX_BITRATE * 1000,
+        fec: bool = True,
+    ):
+        """Bitrate and expected loss from receiver reports (bits per second, percent).
+
+        Opus only adds its FEC copy when there is room for it: about 20 kbps and 6%
+        expected loss for speech. So loss raises the bitrate instead of lowering
+        it. From 2% loss, the bitrate jumps to FEC_MIN_BITRATE and then grows 10%
+        per report. On a clean link it settles back to `start`. Above 25% loss,
+        which is more likely congestion than Wi-Fi fading, it backs off 15% per
+        report. The expected loss handed to Opus is twice the smoothed loss,
+        because Wi-Fi losses come in bursts.
+        """
+        self.start = start
+        self.bitrate = start
+        self.minimum = minimum
+        self.maximum = maximum
+        self.fec = fec
+        self.loss = DEFAULT_EXPECTED_LOSS / 200
+        self.reports = 0
+
+    def on_report(self, fraction_lost: float) -> Tuple[int, int]:
+        self.reports += 1
+        # Rise quickly, decay slowly: one clean second must not switch FEC off
+        if fraction_lost > self.loss:
+            self.loss = 0.5 * self.loss + 0.5 * fraction_lost
+        else:
+            self.loss = 0.8 * self.loss + 0.2 * fraction_lost
+        if fraction_lost > 0.25:
+            self.bitrate = int(self.bitrate * 0.85)
+        elif self.fec and self.loss >= 0.02:
+            self.bitrate = max(int(self.bitrate * 1.1), FEC_MIN_BITRATE)
+        elif self.bitrate > self.start:
+            self.bitrate = max(self.start, int(self.bitrate * 0.95))
+        else:
+            self.bitrate = min(self.start, int(self.bitrate * 1.05))
+        self.bitrate = max(self.minimum, min(self.maximum, self.bitrate))
+        return self.bitrate, self.expected_loss_percent()
+
+    def expected_loss_percent(self) -> int:
+        return min(30, math.ceil(self.loss * 200))
+
+
+def parse_receiver_report(packet: bytes, ssrc: int) -> Optional[Tuple[float, int]]:
+    """(fraction lost, interarrival jitter in RTP units) for our SSRC, from an RTCP RR."""
+    offset = 0
+    while offset + 8 <= len(packet):
+        first, packet_type, length = struct.unpack("!BBH", packet[offset : offset + 4])
+        end = offset + 4 * (length + 1)
+        if packet_type == RTCP_RECEIVER_REPORT:
+            for index in range(first & 0x1F):
+                start = offset + 8 + 24 * index
+                block = packet[start : start + 24]
+                if len(block) < 24:
+                    break
+                source, lost_word, _, jitter = struct.unpack("!IIII", block[:16])
+                if source == ssrc:
+                    return (lost_word >> 24) / 256, jitter
+        offset = end
+    return None
+
+
+class OpusRtpSender:
+    def __init__(
+        self,
+        ip: str,
+        port: int,
+        rate: int,
+        channels: int,
+        bitrate: int = DEFAULT_BITRATE * 1000,
+        min_bitrate: int = DEFAULT_MIN_BITRATE * 1000,
+        max_bitrate: int = DEFAULT_MAX_BITRATE * 1000,
+        fec: bool = True,
+        dtx: bool = True,
+        adaptive: bool = True,
+        vad: Optional[VoiceActivityDetector] = None,
+        complexity: int = 5,
+        local_port: int = 0,
+    ):
+        """Encode 20 ms PCM blocks and send them as RTP; reports come back on the same socket."""
+        self.destination = (ip, port)
+        self.rate = rate
+        self.encoder = OpusEncoder(rate, channels, bitrate, fec, dtx, complexity)
+        self.fec = fec
+        self.dtx = dtx
+        self.adaptive = adaptive
+        self.controller = BitrateController(bitrate, min_bitrate, max_bitrate, fec)
+        self.vad = vad or VoiceActivityDetector()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("0.0.0.0", local_port))
+        self.ssrc = random.getrandbits(32)
+        self.sequence = random.getrandbits(16)
+        self.timestamp = random.getrandbits(32)
+
+        self.blocks = 0
+        self.speech_blocks = 0
+        self.packets_sent = 0
+        self.packets_suppressed = 0
+        self.bytes_sent = 0
+        self.reported_loss: Optional[float] = None
+        self.jitter_ms: Optional[float] = None
+        self.last_report: Optional[float] = None
+        self._talking = False
+        self._last_sent = 0.0
+        self._window = (time.monotonic(), 0)  # (start, bytes) for recent kbps
+        self.recent_kbps = 0.0
+        self._level_sum = 0.0
+        self._level_count = 0
+        self.level_db = SILENCE_FLOOR_DBFS
+        self.peak_db = SILENCE_FLOOR_DBFS
+        self._lock = threading.Lock()
+        self._targets: Optional[Tuple[int, int]] = None  # From reports, for encode()
+        self._running = True
+        self._feedback_thread = threading.Thread(
+            target=self._receive_feedback, name="opus-feedback", daemon=True
+        )
+        self._feedback_thread.start()
+
+    @property
+    def local_port(self) -> int:
+        return self.sock.getsockname()[1]
+
+    def send_block(self, pcm: bytes, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        frame_samples = len(pcm) // (2 * self.encoder.channels)
+        active = self.vad.update(pcm)
+        with self._lock:
+            targets, self._targets = self._targets, None
+        if targets:
+            self._apply_targets(*targets)
+        payload = self.encoder.encode(pcm)  # Every block, to keep the encoder state
+        with self._lock:
+            self.blocks += 1
+            self.speech_blocks += active
+            self._level_sum += 10 ** (self.vad.level_db / 10)
+            self._level_count += 1
+            self.peak_db = max(self.peak_db, self.vad.peak_db)
+        if not self.dtx or active or now - self._last_sent >= KEEPALIVE_SECONDS:
+            marker = active and not self._talking
+            self._send(payload, marker, now)
+        else:
+            self.packets_suppressed += 1
+        if self.dtx:
+            self._talking = active
+        self.timestamp = (self.timestamp + frame_samples * RTP_CLOCK // self.rate) & (
+            0xFFFFFFFF
+        )
+
+    def _send(self, payload: bytes, marker: bool, now: float):
+        header = struct.pack(
+            "!BBHII",
+            0x80,
+            (0x80 if marker else 0) | OPUS_PAYLOAD_TYPE,
+            self.sequence,
+            self.timestamp,
+            self.ssrc,
+        )
+        try:
+            self.sock.sendto(header + payload, self.destination)
+        except OSError as e:
+            print(f"Warning: audio packet not sent: {e}", file=sys.stderr)
+            return
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self._last_sent = now
+        with self._lock:
+            self.packets_sent += 1
+            self.bytes_sent += len(header) + len(payload)
+
+    def _receive_feedback(self):
+        self.sock.settimeout(0.5)
+        while self._running:
+            try:
+                packet = self.sock.recv(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            report = parse_receiver_report(packet, self.ssrc)
+            if report is None:
+                continue
+            fraction_lost, jitter = report
+            with self._lock:
+                self.reported_loss = fraction_lost
+                self.jitter_ms = jitter * 1000 / RTP_CLOCK
+                self.last_report = time.monotonic()
+            if self.adaptive:
+                targets = self.controller.on_report(fraction_lost)
+                with self._lock:
+                    self._targets = targets
+
+    def _apply_targets(self, bitrate: int, expected_loss: int):
+        """On the capture thread: opus_encoder_ctl must not race opus_encode."""
+        if bitrate != self.encoder.bitrate:
+            self.encoder.set_bitrate(bitrate)
+        if self.fec and expected_loss != self.encoder.expected_loss:
+            self.encoder.set_expected_loss(expected_loss)
+
+    def close(self):
+        self._running = False
+        self._feedback_thread.join(timeout=1)
+        self.sock.close()
+        self.encoder.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            start, start_bytes = self._window
+            if now - start >= 1.0:
+                self.recent_kbps = (
+                    (self.bytes_sent - start_bytes) * 8 / 1000 / (now - start)
+                )
+                self._window = (now, self.bytes_sent)
+            if self._level_count:
+                self.level_db = 10 * math.log10(self._level_sum / self._level_count)
+            level, peak = self.level_db, self.peak_db
+            self._level_sum, self._level_count = 0.0, 0
+            self.peak_db = SILENCE_FLOOR_DBFS
+            feedback_age = None if self.last_report is None else now - self.last_report
+            return {
+                "level_dbfs": round(level, 1),
+                "peak_dbfs": round(peak, 1),
+                "speech_fraction": round(self.speech_blocks / max(self.blocks, 1), 3),
+                "packets_sent": self.packets_sent,
+                "packets_suppressed": self.packets_suppressed,
+                "kbps": round(self.recent_kbps, 1),
+                "target_kbps": self.encoder.bitrate / 1000,
+                "expected_loss_percent": self.encoder.expected_loss,
+                "reported_loss": self.reported_loss,
+                "jitter_ms": (
+                    None if self.jitter_ms is None else round(self.jitter_ms, 1)
+                ),
+                "feedback_age_s": (
+                    None if feedback_age is None else round(feedback_age, 1)
+                ),
+                "feedback_stale": feedback_age is None
+                or feedback_age > FEEDBACK_TIMEOUT,
+            }
+
+
+def add_opus_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--bitrate",
+        type=int,
+        default=env_int("AUDIO_BITRATE", DEFAULT_BITRATE),
+        help=f"Starting Opus bitrate in kbps (env: AUDIO_BITRATE, default: {DEFAULT_BITRATE})",
+    )
+    parser.add_argument("--min-bitrate", type=int, default=DEFAULT_MIN_BITRATE)
+    parser.add_argument("--max-bitrate", type=int, default=DEFAULT_MAX_BITRATE)
+    parser.add_argument(
+        "--no-fec", action="store_true", help="Turn off Opus in-band FEC"
+    )
+    parser.add_argument(
+        "--no-dtx", action="store_true", help="Send every packet, even in silence"
+    )
+    parser.add_argument(
+        "--fixed-bitrate",
+        action="store_true",
+        help="Ignore receiver reports (the bitrate and FEC share stay as set)",
+    )
+    parser.add_argument(
+        "--vad-margin-db",
+        type=float,
+        default=DEFAULT_VAD_MARGIN_DB,
+        help="Level above the noise floor that counts as speech",
+    )
+    parser.add_argument("--hangover-ms", type=float, default=DEFAULT_HANGOVER_MS)
+    parser.add_argument(
+        "--complexity",
+        type=int,
+        default=5,
+        help="Opus complexity 0-10 (CPU vs quality)",
+    )
+
+
+def sender_from_args(
+    args, ip: str, port: int, rate: int, channels: int, local_port: int = 0
+) -> OpusRtpSender:
+    return OpusRtpSender(
+        ip,
+        port,
+        rate,
+        channels,
+        bitrate=args.bitrate * 1000,
+        min_bitrate=args.min_bitrate * 1000,
+        max_bitrate=args.max_bitrate * 1000,
+        fec=not args.no_fec,
+        dtx=not args.no_dtx,
+        adaptive=not args.fixed_bitrate,
+        vad=VoiceActivityDetector(args.vad_margin_db, args.hangover_ms),
+        complexity=args.complexity,
+        local_port=local_port,
+    )
+
+
+def stream_capture(audio: AudioCapture, sender: OpusRtpSender, on_block=None):
+    """Feed the capture's 20 ms blocks to the sender until the capture stops."""
+    read_fd = audio.add_sink("opus")
+    audio.start()
+    audio.start_clock()
+    with open(read_fd, "rb", buffering=0) as pcm:
+        while True:
+            block = b""
+            while len(block) < audio.block_bytes:
+                chunk = pcm.read(audio.block_bytes - len(block))
+                if not chunk:
+                    return
+                block += chunk
+            sender.send_block(block)
+            if on_block and on_block():
+                return
+
+
+def send(args):
+    try:
+        audio = AudioCapture(args.device)
+        sender = sender_from_args(
+            args, args.ip, args.port, audio.rate, audio.channels, args.local_port
+        )
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    analyzer = analyzer_from_args(args, audio)
+    stream_stats = StreamStats(args.stats_file, args.stats_interval)
+    stream_stats.add_source("audio", audio.stats)
+    stream_stats.add_source("opus", sender.stats)
+    if analyzer:
+        stream_stats.add_source("audio_analysis", analyzer.stats)
+    print(
+        f"Streaming Opus from {args.device} to {args.ip}:{args.port} "
+        f"({args.bitrate} kbps, FEC {'off' if args.no_fec else 'on'}, "
+        f"DTX {'off' if args.no_dtx else 'on'})"
+    )
+
+    def publish():
+        stream_stats.maybe_publish()
+        return False
+
+    try:
+        stream_capture(audio, sender, publish)
+    except KeyboardInterrupt:
+        print("\nStopping audio stream...")
+    finally:
+        audio.stop()
+        sender.close()
+        if analyzer:
+            analyzer.close()
+            print(f"Audio analysis stats: {analyzer.stats()}")
+        stream_stats.publish()
+        print(f"Opus stats: {sender.stats()}")
+
+
+def write_talk_spurts(path: str, seconds: float, rate: int = 48000):
+    """A speech-like test WAV: voiced bursts over a quiet noise floor."""
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * rate)) / rate
+    pitch = 140 + 30 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / rate
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 12))
+    syllables = np.clip(np.sin(2 * np.pi * 3.5 * t), 0, None)
+    talking = (t % 3.0) < 1.8  # 1.8 s of talk, 1.2 s of pause
+    signal_ = 0.25 * voiced * syllables * talking + rng.normal(0, 0.002, t.size)
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes((np.clip(signal_, -1, 1) * 32767).astype(np.int16).tobytes())
+
+
+def loopback(args):
+    """WAV -> sender -> lossy relay -> PC receiver, all on localhost."""
+    phases = [tuple(float(v) for v in phase.split(":")) for phase in args.loss_phases]
+    seconds = sum(duration for duration, _ in phases)
+    workdir = tempfile.mkdtemp(prefix="opus_loopback_")
+    wav_path = args.wav or os.path.join(workdir, "talk.wav")
+    if not args.wav:
+        write_talk_spurts(wav_path, seconds)
+    out_path = os.path.join(workdir, "received.wav")
+    relay_port, receiver_port, sender_port = (
+        args.base_port,
+        args.base_port + 10,
+        args.base_port + 20,
+    )
+
+    try:
+        audio = AudioCapture(wav_path)
+        sender = sender_from_args(
+            args, "127.0.0.1", relay_port, audio.rate, audio.channels, sender_port
+        )
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    receiver_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "pc",
+        "opus_audio_receiver.py",
+    )
+    receiver = subprocess.Popen(
+        [
+            sys.executable,
+            receiver_path,
+            "--port",
+            str(receiver_port),
+            "--out",
+            out_path,
+            "--feedback-to",
+            f"127.0.0.1:{sender_port}",
+            "--stats-interval",
+            str(seconds + 60),
+        ]
+    )
+    time.sleep(0.5)
+    relay = LossyRelay(relay_port, receiver_port, phases[0][1], args.burst)
+
+    phase_ends = np.cumsum([duration for duration, _ in phases])
+    start = time.monotonic()
+    state = {"phase": 0, "next_report": start + 2}
+
+    def on_block():
+        now = time.monotonic()
+        elapsed = now - start
+        while (
+            state["phase"] < len(phases) - 1 and elapsed >= phase_ends[state["phase"]]
+        ):
+            state["phase"] += 1
+            relay.set_loss(phases[state["phase"]][1], args.burst)
+        if now >= state["next_report"]:
+            state["next_report"] += 2
+            stats = sender.stats()
+            print(
+                f"t={elapsed:4.0f}s loss={phases[state['phase']][1]:.0%} "
+                f"reported={stats['reported_loss'] or 0:.1%} "
+                f"target={stats['target_kbps']:4.1f}k fec={stats['expected_loss_percent']:2}% "
+                f"sent={stats['kbps']:4.1f}k level={stats['level_dbfs']:6.1f} dBFS "
+                f"speech={stats['speech_fraction']:.0%}"
+            )
+        return elapsed >= seconds
+
+    try:
+        stream_capture(audio, sender, on_block)
+    finally:
+        audio.stop()
+        time.sleep(0.3)
+        relay.close()
+        receiver.send_signal(signal.SIGINT)  # Lets the receiver print its own stats
+        receiver.wait()
+        sender_stats = sender.stats()
+        sender.close()
+    print("\n--- Opus loopback ---")
+    print(f"Sender:           {sender_stats}")
+    print(
+        f"Relay forwarded:  {relay.forwarded}, dropped {len(relay.dropped_sequences)}"
+    )
+    print(f"Received audio:   {out_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Opus audio over RTP with FEC, DTX and loss-aware bitrate"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    send_parser = subparsers.add_parser("send", help="Stream a microphone or WAV file")
+    send_parser.add_argument(
+        "--device",
+        default=os.environ.get("AUDIO_DEVICE", "default"),
+        help="ALSA device or a .wav file (env: AUDIO_DEVICE)",
+    )
+    send_parser.add_argument(
+        "--ip", default=os.environ.get("REMOTE_PC_IP", "127.0.0.1")
+    )
+    send_parser.add_argument(
+        "--port", type=int, default=env_int("AUDIO_UDP_PORT", 5002)
+    )
+    send_parser.add_argument(
+        "--local-port",
+        type=int,
+        default=0,
+        help="Port to send from and receive reports on (default: any)",
+    )
+    add_opus_arguments(send_parser)
+    add_audio_analysis_arguments(send_parser)
+    add_stats_arguments(send_parser)
+
+    loop_parser = subparsers.add_parser(
+        "loopback", help="WAV through a lossy relay to the PC receiver, locally"
+    )
+    loop_parser.add_argument("--wav", help="16-bit WAV (default: synthetic speech)")
+    loop_parser.add_argument(
+        "--loss-phases",
+        nargs="+",
+        default=["6:0", "10:0.15", "8:0.02"],
+        help="seconds:loss phases (default: 6:0 10:0.15 8:0.02)",
+    )
+    loop_parser.add_argument("--burst", type=float, default=1.5)
+    loop_parser.add_argument("--base-port", type=int, default=47000)
+    add_opus_arguments(loop_parser)
+
+    args = parser.parse_args()
+    if args.command == "send":
+        send(args)
+    else:
+        loopback(args)
+
+
+if __name__ == "__main__":
+    main()
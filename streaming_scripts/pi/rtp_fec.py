@@ -0,0 +1,545 @@
+"""
+rtp_fec.py - Forward error correction and send pacing for the RTP video stream to the PC
+
+Over robot Wi-Fi a single lost packet corrupts the picture until the next keyframe.
+This module adds an optional protection layer on top of rtp_h264.py:
+
+* XorFecEncoder: RFC 5109 (ULPFEC, level 0) XOR parity packets. Every block of
+  group_size * interleave media packets gets `interleave` parity packets; parity j
+  covers packets j, j + interleave, j + 2 * interleave, ... so a burst of up to
+  `interleave` consecutive losses is still recoverable. Parity goes to its own UDP
+  port (video port + 1 by default) so a plain GStreamer receiver is unaffected.
+* SmoothedPacer: a sender thread with a token bucket that runs at a multiple of the
+  recent average bitrate, so an I-frame leaves as a steady stream instead of a
+  burst that overflows the access point queue.
+* ProtectedRtpTransport: ties the two together behind the same send(packets)
+  interface as rtp_h264.RtpSender.
+
+The PC side is streaming_scripts/pc/rtp_fec_receiver.py, which repairs the stream
+and forwards it to open_video_stream.sh. Pair this with periodic intra refresh in
+the encoder (--intra-refresh) so any remaining loss heals within one GOP period
+without sending full keyframes.
+
+Usage:
+    # Protect an Annex B H.264 pipe (e.g. from gst-launch ... ! fdsink)
+    ... | python3 rtp_fec.py send --ip 192.168.1.100 --port 5000 --fps 30 -
+
+    # Loopback loss simulation against the PC receiver
+    python3 rtp_fec.py simulate clip.h264 --loss 0.05 --burst 2
+"""
+
+import argparse
+import os
+import queue
+import random
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from rtp_h264 import (
+    DEFAULT_MTU,
+    H264RtpPacketizer,
+    RtpSender,
+    iter_access_units,
+    pump_annexb,
+)
+
+DEFAULT_FEC_PAYLOAD_TYPE = 127
+DEFAULT_GROUP_SIZE = 10
+DEFAULT_INTERLEAVE = 1
+DEFAULT_FLUSH_MS = 30.0
+FEC_HEADER_SIZE = 10
+ULP_LONG_HEADER_SIZE = 8  # L=1: 16-bit protection length + 48-bit mask
+MAX_MASK_OFFSET = 47
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default}.", file=sys.stderr)
+        return default
+
+
+def xor_bytes(a: bytes, b: bytes) -> bytes:
+    """XOR two byte strings, padding the shorter one with zeros."""
+    if len(a) < len(b):
+        a, b = b, a
+    result = int.from_bytes(a, "big") ^ int.from_bytes(b.ljust(len(a), b"\0"), "big")
+    return result.to_bytes(len(a), "big")
+
+
+def build_fec_packet(
+    media_packets: List[bytes],
+    sn_base: int,
+    offsets: List[int],
+    fec_sequence: int,
+    fec_payload_type: int,
+) -> bytes:
+    """Build one RFC 5109 FEC packet protecting media_packets (level 0, long mask)."""
+    bits_xor = 0  # P, X, CC, M and PT from the first two header bytes
+    ts_xor = 0
+    length_xor = 0
+    payload_xor = b""
+    timestamp = 0
+    ssrc = 0
+    for packet in media_packets:
+        first, second, _, timestamp, ssrc = struct.unpack("!BBHII", packet[:12])
+        bits_xor ^= (first << 8) | second
+        ts_xor ^= timestamp
+        length_xor ^= len(packet) - 12
+        payload_xor = xor_bytes(payload_xor, packet[12:])
+
+    mask = 0
+    for offset in offsets:
+        mask |= 1 << (MAX_MASK_OFFSET - offset)
+    first_byte = 0x40 | ((bits_xor >> 8) & 0x3F)  # E=0, L=1, then P X CC
+    fec_header = struct.pack(
+        "!BBHIH", first_byte, bits_xor & 0xFF, sn_base, ts_xor, length_xor
+    )
+    ulp_header = struct.pack("!H", len(payload_xor)) + mask.to_bytes(6, "big")
+    rtp_header = struct.pack(
+        "!BBHII", 0x80, fec_payload_type, fec_sequence, timestamp, ssrc
+    )
+    return rtp_header + fec_header + ulp_header + payload_xor
+
+
+class XorFecEncoder:
+    def __init__(
+        self,
+        group_size: int = DEFAULT_GROUP_SIZE,
+        interleave: int = DEFAULT_INTERLEAVE,
+        payload_type: int = DEFAULT_FEC_PAYLOAD_TYPE,
+        flush_ms: float = DEFAULT_FLUSH_MS,
+    ):
+        """Parity for every group_size media packets (overhead 1/group_size).
+
+        A block that hasn't filled within flush_ms is protected as it stands
+        at the next frame boundary, so parity for a quiet stream isn't late.
+        """
+        if group_size < 1 or interleave < 1:
+            raise ValueError("group_size and interleave must be at least 1")
+        if (group_size - 1) * interleave > MAX_MASK_OFFSET:
+            raise ValueError(
+                f"group_size {group_size} x interleave {interleave} doesn't fit the 48-bit FEC mask"
+            )
+        self.group_size = group_size
+        self.interleave = interleave
+        self.payload_type = payload_type
+        self.flush_seconds = flush_ms / 1000
+        self.sequence = random.getrandbits(16)
+        self.media_packets = 0
+        self.fec_packets = 0
+        self._block: List[bytes] = []
+        self._block_started = 0.0
+
+    def protect(self, packets: List[bytes]) -> List[bytes]:
+        """Add one frame's media packets; return the parity packets now due."""
+        fec = []
+        for packet in packets:
+            if not self._block:
+                self._block_started = time.monotonic()
+            self._block.append(packet)
+            self.media_packets += 1
+            if len(self._block) == self.group_size * self.interleave:
+                fec += self._flush()
+        if self._block and time.monotonic() - self._block_started >= (
+            self.flush_seconds
+        ):
+            fec += self._flush()
+        return fec
+
+    def _flush(self) -> List[bytes]:
+        block, self._block = self._block, []
+        sn_first = struct.unpack("!H", block[0][2:4])[0]
+        fec = []
+        for column in range(min(self.interleave, len(block))):
+            members = block[column :: self.interleave]
+            offsets = [i * self.interleave for i in range(len(members))]
+            fec.append(
+                build_fec_packet(
+                    members,
+                    (sn_first + column) & 0xFFFF,
+                    offsets,
+                    self.sequence,
+                    self.payload_type,
+                )
+            )
+            self.sequence = (self.sequence + 1) & 0xFFFF
+        self.fec_packets += len(fec)
+        return fec
+
+
+class SmoothedPacer:
+    def __init__(
+        self,
+        senders: Dict[str, RtpSender],
+        headroom: float = 2.0,
+        min_rate_bps: int = 500_000,
+        burst_packets: int = 8,
+        max_delay: float = 0.15,
+    ):
+        """Token-bucket send thread shared by the media and FEC senders.
+
+        The bucket refills at headroom x the recent average bitrate (never
+        below min_rate_bps). If the backlog gets older than max_delay the
+        pacer sends immediately rather than adding latency.
+        """
+        self.senders = senders
+        self.headroom = headroom
+        self.min_rate_bps = min_rate_bps
+        self.burst_bytes = burst_packets * DEFAULT_MTU
+        self.max_delay = max_delay
+        self.average_bps = float(min_rate_bps)
+        self.max_backlog_seconds = 0.0
+        self.late_sends = 0
+        self._queue: (
+            "queue.Queue[Optional[Tuple[float, List[Tuple[str, List[bytes]]]]]]"
+        ) = queue.Queue()
+        self._last_enqueue = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="rtp-pacer", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, groups: List[Tuple[str, List[bytes]]]):
+        """Queue one frame's packets, as (sender name, packets) groups sent in order.
+
+        The rate estimate is updated once per call, over every group: the media
+        and FEC packets of a frame together, spread over the frame interval.
+        """
+        groups = [(name, packets) for name, packets in groups if packets]
+        if not groups:
+            return
+        now = time.monotonic()
+        interval = max(now - self._last_enqueue, 1e-3)
+        self._last_enqueue = now
+        frame_bytes = sum(len(p) for _, packets in groups for p in packets)
+        instant_bps = frame_bytes * 8 / interval
+        # One update per frame: ~1 s time constant at 30 fps
+        self.average_bps += 0.03 * (instant_bps - self.average_bps)
+        self._queue.put((now, groups))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=2)
+
+    def _run(self):
+        tokens = float(self.burst_bytes)
+        last_refill = time.monotonic()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            enqueued, groups = item
+            packets = [
+                (self.senders[name], packet)
+                for name, group in groups
+                for packet in group
+            ]
+            for sender, packet in packets:
+                now = time.monotonic()
+                rate = max(self.min_rate_bps, self.headroom * self.average_bps) / 8
+                tokens = min(self.burst_bytes, tokens + (now - last_refill) * rate)
+                last_refill = now
+                backlog = now - enqueued
+                self.max_backlog_seconds = max(self.max_backlog_seconds, backlog)
+                if tokens < len(packet) and backlog < self.max_delay:
+                    time.sleep((len(packet) - tokens) / rate)
+                    tokens = float(len(packet))
+                    last_refill = time.monotonic()
+                elif tokens < len(packet):
+                    self.late_sends += 1
+                tokens -= len(packet)
+                sender.send([packet])
+
+
+class ProtectedRtpTransport:
+    """Media + FEC senders with optional pacing; a drop-in for RtpSender."""
+
+    def __init__(
+        self,
+        ip: str,
+        port: int,
+        fec_port: Optional[int] = None,
+        fec: Optional[XorFecEncoder] = None,
+        pacing: bool = True,
+        headroom: float = 2.0,
+    ):
+        self.media = RtpSender(ip, port)
+        self.fec = fec
+        self.fec_sender = RtpSender(ip, fec_port or port + 1) if fec else None
+        senders = {"media": self.media}
+        if self.fec_sender:
+            senders["fec"] = self.fec_sender
+        self.pacer = SmoothedPacer(senders, headroom=headroom) if pacing else None
+
+    def send(self, packets: List[bytes]):
+        fec_packets = self.fec.protect(packets) if self.fec else []
+        if self.pacer:
+            self.pacer.enqueue([("media", packets), ("fec", fec_packets)])
+            return
+        self.media.send(packets)
+        if fec_packets:
+            self.fec_sender.send(fec_packets)
+
+    def close(self):
+        if self.pacer:
+            self.pacer.close()
+        self.media.close()
+        if self.fec_sender:
+            self.fec_sender.close()
+
+    def stats(self) -> dict:
+        stats = {"media": self.media.stats()}
+        if self.fec:
+            stats["fec"] = dict(
+                self.fec_sender.stats(),
+                overhead=self.fec.fec_packets / max(self.fec.media_packets, 1),
+            )
+        if self.pacer:
+            stats["pacer"] = {
+                "average_kbps": round(self.pacer.average_bps / 1000, 1),
+                "max_backlog_ms": round(self.pacer.max_backlog_seconds * 1000, 1),
+                "late_sends": self.pacer.late_sends,
+            }
+        return stats
+
+
+def add_fec_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by every script that can protect its PC stream."""
+    parser.add_argument(
+        "--fec",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Send XOR parity packets for the PC stream (receive with pc/rtp_fec_receiver.py)",
+    )
+    parser.add_argument(
+        "--fec-group",
+        type=int,
+        default=DEFAULT_GROUP_SIZE,
+        help=f"Media packets per parity packet (default: {DEFAULT_GROUP_SIZE})",
+    )
+    parser.add_argument(
+        "--fec-interleave",
+        type=int,
+        default=DEFAULT_INTERLEAVE,
+        help="Interleave depth; recovers bursts of this many consecutive losses (default: 1)",
+    )
+    parser.add_argument(
+        "--fec-port",
+        type=int,
+        default=None,
+        help="UDP port for parity packets (default: video port + 1)",
+    )
+    parser.add_argument(
+        "--pacing",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Smooth sending at a multiple of the average bitrate when --fec is on",
+    )
+
+
+def transport_from_args(ip: str, port: int, args) -> ProtectedRtpTransport:
+    fec = XorFecEncoder(args.fec_group, args.fec_interleave)
+    return ProtectedRtpTransport(
+        ip, port, fec_port=args.fec_port, fec=fec, pacing=args.pacing
+    )
+
+
+class LossyRelay:
+    """Forward UDP from one port to another, dropping packets Gilbert-Elliott style."""
+
+    def __init__(self, listen_port: int, target_port: int, loss: float, burst: float):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", listen_port))
+        self.sock.settimeout(0.2)
+        self.target = ("127.0.0.1", target_port)
+        self.set_loss(loss, burst)
+        self.bad = False
+        self.dropped_sequences: Set[int] = set()
+        self.forwarded = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def set_loss(self, loss: float, burst: float):
+        """Mean burst length `burst`, overall loss rate `loss` (may change while running)."""
+        self.p_bad_to_good = 1 / max(burst, 1)
+        self.p_good_to_bad = loss * self.p_bad_to_good / max(1 - loss, 1e-6)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                packet = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            if self.bad:
+                self.bad = random.random() >= self.p_bad_to_good
+            else:
+                self.bad = random.random() < self.p_good_to_bad
+            if self.bad:
+                self.dropped_sequences.add(struct.unpack("!H", packet[2:4])[0])
+                continue
+            self.sock.sendto(packet, self.target)
+            self.forwarded += 1
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.sock.close()
+
+
+def simulate(args):
+    """Loss simulation: sender -> lossy relay -> PC receiver -> frame checker."""
+    base = args.base_port
+    media_in, fec_in = base, base + 1  # Relay inputs (what the Pi sends to)
+    media_rx, fec_rx = base + 10, base + 11  # PC receiver inputs
+    forward_port = base + 20  # Where the receiver hands the repaired stream
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", forward_port))
+    sink.settimeout(1.0)
+    receiver_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "pc", "rtp_fec_receiver.py"
+    )
+    receiver = subprocess.Popen(
+        [
+            sys.executable,
+            receiver_path,
+            "--port",
+            str(media_rx),
+            "--fec-port",
+            str(fec_rx),
+            "--forward-port",
+            str(forward_port),
+        ]
+    )
+    time.sleep(0.5)
+    relays = [
+        LossyRelay(media_in, media_rx, args.loss, args.burst),
+        LossyRelay(fec_in, fec_rx, args.loss, args.burst),
+    ]
+
+    # Frame membership from the sender's view: sequence -> frame index
+    frame_of_sequence: Dict[int, int] = {}
+    frame_count = 0
+    packetizer = H264RtpPacketizer(mtu=args.mtu)
+    fec = XorFecEncoder(args.fec_group, args.fec_interleave) if args.fec else None
+    transport = ProtectedRtpTransport(
+        "127.0.0.1", media_in, fec_port=fec_in, fec=fec, pacing=args.pacing
+    )
+
+    class RecordingTransport:
+        def send(self, packets):
+            for packet in packets:
+                frame_of_sequence[struct.unpack("!H", packet[2:4])[0]] = frame_count
+            transport.send(packets)
+
+    received: Set[int] = set()
+
+    def drain():
+        while True:
+            try:
+                packet = sink.recv(65536)
+            except socket.timeout:
+                return
+            received.add(struct.unpack("!H", packet[2:4])[0])
+
+    drainer = threading.Thread(target=drain, daemon=True)
+    drainer.start()
+    with open(args.clip, "rb") as f:
+        access_units = list(iter_access_units(f.read()))
+    recording = RecordingTransport()
+    start = time.monotonic()
+    for access_unit in access_units[: args.frames or None]:
+        delay = start + frame_count / args.fps - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        recording.send(packetizer.packetize(access_unit, frame_count * 3000))
+        frame_count += 1
+    time.sleep(0.5)
+    transport.close()
+    for relay in relays:
+        relay.close()
+    drainer.join()
+    receiver.send_signal(signal.SIGINT)  # Lets the receiver print its own stats
+    receiver.wait()
+
+    dropped = relays[0].dropped_sequences
+    frames_hit = {frame_of_sequence[s] for s in dropped if s in frame_of_sequence}
+    unrecovered = {frame_of_sequence[s] for s in frame_of_sequence if s not in received}
+    recovered_packets = len([s for s in dropped if s in received])
+    print("\n--- FEC loss simulation ---")
+    print(f"Frames sent:                 {frame_count}")
+    print(f"Media packets sent/dropped:  {len(frame_of_sequence)}/{len(dropped)}")
+    print(f"FEC packets dropped:         {len(relays[1].dropped_sequences)}")
+    print(f"Packets recovered:           {recovered_packets}")
+    print(f"Frames with loss:            {len(frames_hit)}")
+    print(f"Frames recovered:            {len(frames_hit - unrecovered)}")
+    print(f"Frames unrecovered:          {len(unrecovered)}")
+    print(f"Transport stats:             {transport.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RTP FEC and pacing for H.264")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    send_parser = subparsers.add_parser(
+        "send", help="Packetize and protect an Annex B H.264 stream"
+    )
+    send_parser.add_argument("input", help="Annex B H.264 file, or - for stdin")
+    send_parser.add_argument(
+        "--ip", default=os.environ.get("REMOTE_PC_IP", "127.0.0.1")
+    )
+    send_parser.add_argument(
+        "--port", type=int, default=env_int("VIDEO_UDP_PORT", 5000)
+    )
+    send_parser.add_argument("--fps", type=int, default=30)
+    send_parser.add_argument("--mtu", type=int, default=DEFAULT_MTU)
+    add_fec_arguments(send_parser)
+
+    sim_parser = subparsers.add_parser(
+        "simulate", help="Loopback loss simulation against pc/rtp_fec_receiver.py"
+    )
+    sim_parser.add_argument("clip", help="Annex B H.264 clip to send")
+    sim_parser.add_argument("--loss", type=float, default=0.05)
+    sim_parser.add_argument(
+        "--burst", type=float, default=1.5, help="Mean loss burst length in packets"
+    )
+    sim_parser.add_argument("--fps", type=int, default=30)
+    sim_parser.add_argument("--frames", type=int, default=0, help="0 sends the clip")
+    sim_parser.add_argument("--mtu", type=int, default=DEFAULT_MTU)
+    sim_parser.add_argument("--base-port", type=int, default=15000)
+    add_fec_arguments(sim_parser)
+    sim_parser.set_defaults(fec=True)
+
+    args = parser.parse_args()
+    if args.command == "simulate":
+        simulate(args)
+        return
+
+    transport = (
+        transport_from_args(args.ip, args.port, args)
+        if args.fec
+        else ProtectedRtpTransport(args.ip, args.port, pacing=args.pacing)
+    )
+    packetizer = H264RtpPacketizer(mtu=args.mtu)
+    stream = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    try:
+        pump_annexb(stream, packetizer, transport, args.fps, realtime=stream.seekable())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        transport.close()
+        print(f"Transport stats: {transport.stats()}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
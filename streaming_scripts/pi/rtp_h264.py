@@ -0,0 +1,449 @@
+"""
+rtp_h264.py - In-process RFC 6184 RTP packetizer for already-encoded H.264
+
+Replaces the `ffmpeg -c:v copy -f rtp` process that the PC stream used only to
+wrap encoder output in RTP. Each access unit is split into NAL units, sent as
+Single NAL Unit packets when they fit in the MTU and as FU-A fragments when they
+don't. SPS/PPS are cached and repeated in front of every IDR frame (like
+`rtph264pay config-interval=-1`) so a receiver can join at any keyframe. The
+packets of a frame go to the kernel in batches with sendmmsg(2), optionally
+spread over a pacing window so large I-frames don't leave as one burst.
+
+The output is what `open_video_stream.sh` expects: payload type 96, 90 kHz clock.
+
+Usage (stream a recorded Annex B clip to a PC running open_video_stream.sh):
+    python3 rtp_h264.py clip.h264 --ip 127.0.0.1 --port 5000 --fps 30
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import os
+import random
+import socket
+import struct
+import sys
+import time
+from typing import BinaryIO, Callable, Iterator, List, Optional
+
+RTP_VERSION = 2
+DEFAULT_PAYLOAD_TYPE = 96
+DEFAULT_MTU = 1400  # RTP packet size budget, leaves room for IP/UDP headers on Wi-Fi
+RTP_HEADER_SIZE = 12
+H264_CLOCK_RATE = 90000
+
+NAL_TYPE_IDR = 5
+NAL_TYPE_SPS = 7
+NAL_TYPE_PPS = 8
+NAL_TYPE_AUD = 9
+NAL_TYPE_FU_A = 28
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default}.", file=sys.stderr)
+        return default
+
+
+def split_annexb(data: bytes) -> List[bytes]:
+    """Split an Annex B byte stream into NAL units without start codes."""
+    nals = []
+    start = data.find(b"\x00\x00\x01")
+    while start != -1:
+        start += 3
+        end = data.find(b"\x00\x00\x01", start)
+        nal = data[start:] if end == -1 else data[start:end]
+        # A 4-byte start code leaves a trailing zero on the previous NAL
+        nal = nal.rstrip(b"\x00") if end != -1 else nal
+        if nal:
+            nals.append(nal)
+        start = end
+    return nals
+
+
+class AccessUnitAssembler:
+    """Incrementally group an Annex B byte stream into access units."""
+
+    def __init__(self):
+        self._buffer = b""
+        self._access_unit: List[bytes] = []
+        self._seen_vcl = False
+
+    def feed(self, data: bytes) -> List[List[bytes]]:
+        """Add stream bytes; return the access units completed so far."""
+        self._buffer += data
+        # Only NALs followed by another start code are known to be complete
+        last_start = self._buffer.rfind(b"\x00\x00\x01")
+        if last_start <= 0:
+            return []
+        if self._buffer[last_start - 1] == 0:
+            last_start -= 1
+        complete, self._buffer = self._buffer[:last_start], self._buffer[last_start:]
+        return self._add_nals(split_annexb(complete))
+
+    def flush(self) -> List[List[bytes]]:
+        """Return everything still buffered at the end of the stream."""
+        access_units = self._add_nals(split_annexb(self._buffer))
+        self._buffer = b""
+        if self._access_unit:
+            access_units.append(self._access_unit)
+            self._access_unit, self._seen_vcl = [], False
+        return access_units
+
+    def _add_nals(self, nals: List[bytes]) -> List[List[bytes]]:
+        access_units = []
+        for nal in nals:
+            nal_type = nal[0] & 0x1F
+            is_vcl = 1 <= nal_type <= 5
+            # first_mb_in_slice == 0 (ue(v) starting with a 1 bit) begins a new picture
+            starts_picture = is_vcl and len(nal) > 1 and nal[1] & 0x80
+            if self._seen_vcl and (not is_vcl or starts_picture):
+                access_units.append(self._access_unit)
+                self._access_unit, self._seen_vcl = [], False
+            self._access_unit.append(nal)
+            self._seen_vcl = self._seen_vcl or is_vcl
+        return access_units
+
+
+def iter_access_units(data: bytes) -> Iterator[List[bytes]]:
+    """Group a complete Annex B stream into access units (lists of NAL units)."""
+    assembler = AccessUnitAssembler()
+    yield from assembler.feed(data)
+    yield from assembler.flush()
+
+
+def pump_annexb(
+    stream: BinaryIO,
+    packetizer: Optional["H264RtpPacketizer"],
+    transport,
+    fps: int,
+    realtime: bool = False,
+    on_access_unit: Optional[Callable[[List[bytes], float], None]] = None,
+) -> int:
+    """Packetize an Annex B stream (a pipe from an encoder, or a file) until EOF.
+
+    RTP timestamps advance by one frame interval per access unit. With
+    realtime=True sending is paced to fps, for replaying recorded files.
+    transport is anything with send(packets), e.g. an RtpSender, or None to
+    only hand each access unit and its time in seconds to on_access_unit.
+    Returns the number of frames sent.
+    """
+    assembler = AccessUnitAssembler()
+    frame_index = 0
+    start = time.monotonic()
+    while True:
+        data = stream.read1(65536) if hasattr(stream, "read1") else stream.read(65536)
+        access_units = assembler.feed(data) if data else assembler.flush()
+        for access_unit in access_units:
+            if realtime:
+                delay = start + frame_index / fps - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            if on_access_unit:
+                on_access_unit(access_unit, frame_index / fps)
+            if transport:
+                rtp_timestamp = frame_index * H264_CLOCK_RATE // fps
+                transport.send(packetizer.packetize(access_unit, rtp_timestamp))
+            frame_index += 1
+        if not data:
+            return frame_index
+
+
+class H264RtpPacketizer:
+    def __init__(
+        self,
+        payload_type: int = DEFAULT_PAYLOAD_TYPE,
+        mtu: int = DEFAULT_MTU,
+        ssrc: Optional[int] = None,
+        repeat_parameter_sets: bool = True,
+    ):
+        self.payload_type = payload_type
+        self.max_payload = mtu - RTP_HEADER_SIZE
+        self.ssrc = random.getrandbits(32) if ssrc is None else ssrc
+        self.sequence = random.getrandbits(16)
+        self.repeat_parameter_sets = repeat_parameter_sets
+        self.sps: Optional[bytes] = None
+        self.pps: Optional[bytes] = None
+
+    def _header(self, timestamp: int, marker: bool) -> bytes:
+        header = struct.pack(
+            "!BBHII",
+            RTP_VERSION << 6,
+            (0x80 if marker else 0) | self.payload_type,
+            self.sequence,
+            timestamp & 0xFFFFFFFF,
+            self.ssrc,
+        )
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        return header
+
+    def packetize(self, nals: List[bytes], timestamp: int) -> List[bytes]:
+        """Turn one access unit into RTP packets; the marker bit ends the frame."""
+        nal_types = [nal[0] & 0x1F for nal in nals]
+        for nal, nal_type in zip(nals, nal_types):
+            if nal_type == NAL_TYPE_SPS:
+                self.sps = nal
+            elif nal_type == NAL_TYPE_PPS:
+                self.pps = nal
+        if (
+            self.repeat_parameter_sets
+            and NAL_TYPE_IDR in nal_types
+            and NAL_TYPE_SPS not in nal_types
+            and self.sps
+            and self.pps
+        ):
+            nals = [self.sps, self.pps] + nals
+        nals = [nal for nal in nals if nal[0] & 0x1F != NAL_TYPE_AUD]
+
+        packets = []
+        for index, nal in enumerate(nals):
+            last_nal = index == len(nals) - 1
+            if len(nal) <= self.max_payload:
+                packets.append(self._header(timestamp, last_nal) + nal)
+                continue
+            # FU-A: the NAL header is split into the FU indicator and FU header
+            fu_indicator = bytes([(nal[0] & 0xE0) | NAL_TYPE_FU_A])
+            nal_type = nal[0] & 0x1F
+            chunk = self.max_payload - 2
+            payload = memoryview(nal)[1:]
+            for offset in range(0, len(payload), chunk):
+                first = offset == 0
+                last = offset + chunk >= len(payload)
+                fu_header = bytes(
+                    [(0x80 if first else 0) | (0x40 if last else 0) | nal_type]
+                )
+                packets.append(
+                    self._header(timestamp, last_nal and last)
+                    + fu_indicator
+                    + fu_header
+                    + payload[offset : offset + chunk]
+                )
+        return packets
+
+
+class _Iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _Msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_Iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _Mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _Msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    libc_name = ctypes.util.find_library("c")
+    if not libc_name or not sys.platform.startswith("linux"):
+        return None
+    try:
+        sendmmsg = ctypes.CDLL(libc_name, use_errno=True).sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [
+        ctypes.c_int,
+        ctypes.POINTER(_Mmsghdr),
+        ctypes.c_uint,
+        ctypes.c_int,
+    ]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+class RtpSender:
+    def __init__(
+        self,
+        ip: str,
+        port: int,
+        batch_size: int = 32,
+        pacing_window: float = 0.0,
+    ):
+        """UDP sender for RTP packets.
+
+        batch_size packets are handed to the kernel per sendmmsg() call.
+        pacing_window (seconds) spreads the batches of one frame over that
+        much time instead of sending them back to back.
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((ip, port))
+        self.batch_size = batch_size
+        self.pacing_window = pacing_window
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.send_calls = 0
+        self.send_errors = 0
+
+    def send(self, packets: List[bytes]):
+        batches = [
+            packets[i : i + self.batch_size]
+            for i in range(0, len(packets), self.batch_size)
+        ]
+        gap = self.pacing_window / len(batches) if len(batches) > 1 else 0
+        start = time.monotonic()
+        for index, batch in enumerate(batches):
+            if gap and index:
+                delay = start + index * gap - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self._send_batch(batch)
+
+    def _send_batch(self, batch: List[bytes]):
+        self.send_calls += 1
+        if _sendmmsg is None:
+            for packet in batch:
+                self._sendto(packet)
+            return
+        count = len(batch)
+        # One contiguous copy of the batch; each iovec points into it
+        buffer = ctypes.create_string_buffer(b"".join(batch))
+        base = ctypes.addressof(buffer)
+        iovecs = (_Iovec * count)()
+        messages = (_Mmsghdr * count)()
+        offset = 0
+        for i, packet in enumerate(batch):
+            iovecs[i].iov_base = base + offset
+            iovecs[i].iov_len = len(packet)
+            messages[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+            messages[i].msg_hdr.msg_iovlen = 1
+            offset += len(packet)
+        sent = _sendmmsg(self.sock.fileno(), messages, count, 0)
+        if sent < 0:
+            errno = ctypes.get_errno()
+            self.send_errors += 1
+            if errno not in (11, 111):  # EAGAIN, ECONNREFUSED: drop and move on
+                print(
+                    f"Warning: sendmmsg failed: {os.strerror(errno)}", file=sys.stderr
+                )
+            return
+        self.packets_sent += sent
+        self.bytes_sent += sum(len(p) for p in batch[:sent])
+        for packet in batch[sent:]:
+            self._sendto(packet)
+
+    def _sendto(self, packet: bytes):
+        try:
+            self.sock.send(packet)
+            self.packets_sent += 1
+            self.bytes_sent += len(packet)
+        except OSError:
+            # Nobody listening yet (ICMP port unreachable) or a full socket buffer
+            self.send_errors += 1
+
+    def close(self):
+        self.sock.close()
+
+    def stats(self) -> dict:
+        return {
+            "packets_sent": self.packets_sent,
+            "bytes_sent": self.bytes_sent,
+            "send_calls": self.send_calls,
+            "send_errors": self.send_errors,
+        }
+
+
+class RtpFrameOutput:
+    """picamera2 encoder output that packetizes H.264 in-process.
+
+    Use it as RtpOutput, which adds picamera2's Output base class on first use.
+    """
+
+    def __init__(
+        self,
+        ip: str,
+        port: int,
+        mtu: int = DEFAULT_MTU,
+        pacing_window: float = 0.0,
+        payload_type: int = DEFAULT_PAYLOAD_TYPE,
+        transport=None,
+    ):
+        """transport replaces the plain RtpSender, e.g. with an FEC-protected one."""
+        super().__init__()
+        self.packetizer = H264RtpPacketizer(payload_type=payload_type, mtu=mtu)
+        self.sender = transport or RtpSender(ip, port, pacing_window=pacing_window)
+        self._first_timestamp: Optional[int] = None
+
+    def outputframe(
+        self, frame, keyframe=True, timestamp=None, packet=None, audio=False
+    ):
+        """Send one encoded access unit; picamera2 timestamps are in microseconds."""
+        if audio:
+            return
+        if timestamp is None:
+            timestamp = int(time.monotonic() * 1_000_000)
+        if self._first_timestamp is None:
+            self._first_timestamp = timestamp
+        rtp_timestamp = (timestamp - self._first_timestamp) * H264_CLOCK_RATE // 10**6
+        nals = split_annexb(bytes(frame))
+        self.sender.send(self.packetizer.packetize(nals, rtp_timestamp))
+
+    def stop(self):
+        super().stop()
+        self.sender.close()
+
+
+def __getattr__(name: str):
+    """Build RtpOutput when first asked for, so importing this module skips picamera2."""
+    if name != "RtpOutput":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    try:
+        from picamera2.outputs import Output
+    except ImportError:  # Allows loopback use on machines without picamera2
+        Output = object
+    rtp_output = type("RtpOutput", (RtpFrameOutput, Output), {})
+    globals()["RtpOutput"] = rtp_output
+    return rtp_output
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Send a recorded Annex B H.264 clip as RTP (for checking open_video_stream.sh)"
+    )
+    parser.add_argument("clip", help="Path to a raw .h264 (Annex B) file")
+    parser.add_argument("--ip", default=os.environ.get("REMOTE_PC_IP", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=env_int("VIDEO_UDP_PORT", 5000))
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--mtu", type=int, default=DEFAULT_MTU)
+    parser.add_argument(
+        "--pacing-ms",
+        type=float,
+        default=0.0,
+        help="Spread each frame's packets over this many milliseconds",
+    )
+    parser.add_argument("--loop", action="store_true", help="Repeat the clip")
+    args = parser.parse_args()
+
+    packetizer = H264RtpPacketizer(mtu=args.mtu)
+    sender = RtpSender(args.ip, args.port, pacing_window=args.pacing_ms / 1000)
+    print(f"Sending {args.clip} to {args.ip}:{args.port} at {args.fps}fps")
+    try:
+        while True:
+            with open(args.clip, "rb") as f:
+                pump_annexb(f, packetizer, sender, args.fps, realtime=True)
+            if not args.loop:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sender.close()
+        print(f"Sender stats: {sender.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,541 @@
+"""
+sampling_profiler.py - Profile a running stream on demand, without restarting it
+
+When a stream starts dropping frames, restarting it under a profiler loses
+the reproduction. The streaming scripts install SamplingProfiler instead. It
+is dormant until the process receives --profile-signal (default SIGUSR1,
+env: PROFILE_SIGNAL). Until then it is just a signal handler: no thread, no
+trace hook, no timer.
+
+On the signal it samples the Python stack of every thread from a background
+thread, every --profile-interval seconds, using sys._current_frames(), for
+--profile-seconds (env: PROFILE_SECONDS). A second signal stops it early.
+Then it writes two files to --profile-dir (env: PROFILE_DIR):
+
+* <script>-<pid>-<time>.folded: collapsed stacks, one "thread;frame;frame
+  count" line per distinct stack, with frames as "function (file.py:line)"
+  the way py-spy writes them. flamegraph.pl, speedscope and inferno read it
+  as is.
+* <script>-<pid>-<time>.txt: the share of samples in each hot-path stage
+  (capture, parse, draw, write) per thread, then the top functions by self
+  and total samples.
+
+Stages are found by walking each stack from the innermost frame outwards. A
+frame matches a stage by its function name, or by the source line it is
+executing, e.g. "stdin.write(" for a call into C that has no Python frame of
+its own. Stacks that match no stage count as "other".
+
+The sampler is a Python thread, so it can only look when it holds the GIL.
+With the default 5 ms switch interval it gets the GIL mostly where the main
+loop releases it (NumPy copies, camera waits), and pure-Python work such as
+parsing detections barely shows up. While a profile runs the switch interval
+is lowered to 50 us so samples land where the time goes; C calls that keep
+the GIL (e.g. a bytes copy) are still under-counted.
+
+Sampling costs about one stack walk per thread per interval, plus the extra
+GIL handoffs, and only while a profile runs. "python3 sampling_profiler.py
+benchmark" measures both the overhead and the sampled vs measured stage shares.
+
+Usage (from a streaming script):
+    profiler = profiler_from_args(args)  # Installs the signal handler
+    stream_stats.add_source("profiler", profiler.stats)
+
+    # Profile every running stream script for 20 s (or: kill -USR1 <pid>)
+    python3 sampling_profiler.py trigger --seconds 20
+    # Overhead on a synthetic capture loop, dormant vs sampling
+    python3 sampling_profiler.py benchmark
+"""
+
+import argparse
+import collections
+import linecache
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_SECONDS = 10.0
+DEFAULT_INTERVAL = 0.01  # 100 Hz, as py-spy samples
+DEFAULT_SIGNAL = "SIGUSR1"
+DEFAULT_DIR = "/tmp"
+# Where `trigger --seconds` leaves the length for a pid; the same for every script
+REQUEST_DIR = "/tmp"
+REQUEST_PREFIX = "profile-request-"
+TOP_FUNCTIONS = 25
+# GIL switch interval while sampling (default 5 ms); see the module docstring
+SWITCH_INTERVAL = 0.00005
+
+# (function names, source line fragments) per hot-path stage, checked in this order
+HOT_PATH_STAGES: List[Tuple[str, Tuple[str, ...], Tuple[str, ...]]] = [
+    (
+        "capture",
+        ("capture_request", "capture_metadata", "copy_from", "make_array"),
+        ("capture_request(", "capture_metadata(", "source.read(", "MappedArray("),
+    ),
+    (
+        "parse",
+        ("parse_detections", "get_outputs", "convert_inference_coords", "submit"),
+        ("parse_detections(", "detection_timeline.", "detector.", "framer.update("),
+    ),
+    (
+        "draw",
+        ("draw_detections", "draw_detections_on_array", "crop_frame"),
+        ("draw_detections", "crop_frame(", "cv2."),
+    ),
+    (
+        "write",
+        ("push_detections", "offer"),
+        ("stdin.write(", "frame_bus.publish(", ".offer(", "push_detections("),
+    ),
+]
+STAGES = [stage for stage, _, _ in HOT_PATH_STAGES] + ["other"]
+
+
+def classify(stack) -> str:
+    """The hot-path stage of a stack of (code, line), innermost frame first."""
+    for code, lineno in stack:
+        name = code.co_name
+        line = linecache.getline(code.co_filename, lineno)
+        for stage, functions, fragments in HOT_PATH_STAGES:
+            if name in functions or any(fragment in line for fragment in fragments):
+                return stage
+    return "other"
+
+
+class SamplingProfiler:
+    def __init__(
+        self,
+        output_dir: str = DEFAULT_DIR,
+        seconds: float = DEFAULT_SECONDS,
+        interval: float = DEFAULT_INTERVAL,
+        name: Optional[str] = None,
+    ):
+        self.output_dir = output_dir
+        self.seconds = seconds
+        self.interval = interval
+        self.name = name or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        self.signum: Optional[int] = None
+        self.sessions = 0
+        self.last_output: Optional[str] = None
+        self.last_summary: Dict[str, float] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._samples = 0
+        self._sample_seconds = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def install(self, signum: int = signal.SIGUSR1):
+        """Start (or stop) a profile on signum; nothing else runs until then."""
+        self.signum = signum
+        signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        if self.active:
+            self._stop.set()
+            return
+        self.start(self._requested_seconds() or self.seconds)
+
+    def _requested_seconds(self) -> Optional[float]:
+        """Seconds left by `sampling_profiler.py trigger --seconds N`, if any."""
+        path = os.path.join(REQUEST_DIR, f"{REQUEST_PREFIX}{os.getpid()}")
+        try:
+            with open(path) as f:
+                seconds = float(f.read().strip())
+            os.unlink(path)
+            return seconds
+        except (OSError, ValueError):
+            return None
+
+    def start(self, seconds: Optional[float] = None):
+        if self.active:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(seconds or self.seconds,),
+            name="profiler",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self, wait: bool = True):
+        """End a running profile early; its files are still written."""
+        self._stop.set()
+        if wait and self._thread:
+            self._thread.join()
+
+    def _run(self, seconds: float):
+        print(
+            f"Profiling for {seconds:g} s at {1 / self.interval:.0f} Hz...",
+            file=sys.stderr,
+        )
+        # Another thread only gets the GIL (and so gets sampled) when the running
+        # one yields it; yield often enough that samples land where time is spent
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch_interval, SWITCH_INTERVAL))
+        me = threading.get_ident()
+        # (thread, ((code, line), ...) outermost first) -> samples; labelled afterwards
+        stacks: collections.Counter = collections.Counter()
+        names: Dict[int, str] = {}
+        ticks = 0
+        started = time.monotonic()
+        deadline = started + seconds
+        next_tick = started
+        try:
+            while not self._stop.is_set() and time.monotonic() < deadline:
+                sample_started = time.perf_counter()
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append((frame.f_code, frame.f_lineno))
+                        frame = frame.f_back
+                    stack.reverse()
+                    stacks[ident, tuple(stack)] += 1
+                    if ident not in names:
+                        names.update(
+                            (thread.ident, thread.name)
+                            for thread in threading.enumerate()
+                        )
+                frame = None  # Don't keep the sampled frames alive
+                ticks += 1
+                self._samples += 1
+                self._sample_seconds += time.perf_counter() - sample_started
+                next_tick += self.interval
+                self._stop.wait(max(0.0, next_tick - time.monotonic()))
+        finally:
+            sys.setswitchinterval(switch_interval)
+        elapsed = time.monotonic() - started
+        self._write(stacks, names, ticks, elapsed)
+
+    def _write(self, stacks, names: Dict[int, str], ticks: int, elapsed: float):
+        stages: Dict[str, collections.Counter] = collections.defaultdict(
+            collections.Counter
+        )
+        self_counts: collections.Counter = collections.Counter()
+        total_counts: collections.Counter = collections.Counter()
+        folded: collections.Counter = collections.Counter()
+        for (ident, stack), count in stacks.items():
+            thread_name = names.get(ident, str(ident))
+            labels = [
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{line})"
+                for code, line in stack
+            ]
+            folded[";".join([thread_name, *labels])] += count
+            stages[thread_name][classify(reversed(stack))] += count
+            functions = [
+                f"{code.co_name} ({os.path.basename(code.co_filename)})"
+                for code, _ in stack
+            ]
+            if functions:
+                self_counts[functions[-1]] += count
+            for function in set(functions):
+                total_counts[function] += count
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        base = os.path.join(self.output_dir, f"{self.name}-{os.getpid()}-{stamp}")
+        with open(f"{base}.folded", "w") as f:
+            for stack, count in folded.most_common():
+                f.write(f"{stack} {count}\n")
+        lines = [
+            f"{self.name} (pid {os.getpid()}): {ticks} samples over {elapsed:.1f} s "
+            f"at {1 / self.interval:.0f} Hz, {len(stages)} threads",
+            "",
+            "Hot path (share of samples per thread):",
+            f"  {'thread':<20} " + " ".join(f"{stage:>8}" for stage in STAGES),
+        ]
+        summary: Dict[str, float] = {}
+        for thread_name, counts in sorted(
+            stages.items(), key=lambda kv: -sum(kv[1].values())
+        ):
+            total = sum(counts.values())
+            shares = {stage: counts[stage] / total for stage in STAGES}
+            lines.append(
+                f"  {thread_name[:20]:<20} "
+                + " ".join(f"{100 * shares[stage]:7.1f}%" for stage in STAGES)
+            )
+            if thread_name == "MainThread":
+                summary = {stage: round(share, 3) for stage, share in shares.items()}
+        samples = sum(self_counts.values()) or 1
+        lines += [
+            "",
+            f"Top functions ({samples} thread samples):",
+            "     self    total  function",
+        ]
+        for function, count in self_counts.most_common(TOP_FUNCTIONS):
+            lines.append(
+                f"  {100 * count / samples:6.1f}% {100 * total_counts[function] / samples:6.1f}%  {function}"
+            )
+        with open(f"{base}.txt", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        self.sessions += 1
+        self.last_output = base
+        self.last_summary = summary
+        print("\n".join(lines[: 4 + len(stages)]), file=sys.stderr)
+        print(f"Profile written to {base}.folded and {base}.txt", file=sys.stderr)
+
+    def stats(self) -> dict:
+        return {
+            "signal": signal.Signals(self.signum).name if self.signum else None,
+            "active": self.active,
+            "sessions": self.sessions,
+            "samples": self._samples,
+            "sample_ms": (
+                round(1000 * self._sample_seconds / self._samples, 3)
+                if self._samples
+                else None
+            ),
+            "last_output": self.last_output,
+            "main_thread_stages": self.last_summary or None,
+        }
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default:g}.", file=sys.stderr)
+        return default
+
+
+def add_profiler_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by the streaming scripts."""
+    parser.add_argument(
+        "--profile-signal",
+        default=os.environ.get("PROFILE_SIGNAL", DEFAULT_SIGNAL),
+        help=f"Signal that starts (and stops) a sampling profile; 'none' to ignore "
+        f"(env: PROFILE_SIGNAL, default: {DEFAULT_SIGNAL})",
+    )
+    parser.add_argument(
+        "--profile-seconds",
+        type=float,
+        default=env_float("PROFILE_SECONDS", DEFAULT_SECONDS),
+        help=f"Length of a profile (env: PROFILE_SECONDS, default: {DEFAULT_SECONDS:g})",
+    )
+    parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=DEFAULT_INTERVAL,
+        help=f"Seconds between stack samples (default: {DEFAULT_INTERVAL})",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=os.environ.get("PROFILE_DIR", DEFAULT_DIR),
+        help=f"Where profiles are written (env: PROFILE_DIR, default: {DEFAULT_DIR})",
+    )
+
+
+def profiler_from_args(args: argparse.Namespace) -> SamplingProfiler:
+    """A dormant SamplingProfiler, listening for --profile-signal unless it is 'none'."""
+    profiler = SamplingProfiler(
+        args.profile_dir, args.profile_seconds, args.profile_interval
+    )
+    if args.profile_signal.lower() != "none":
+        name = args.profile_signal.upper()
+        try:
+            profiler.install(
+                signal.Signals[name if name.startswith("SIG") else f"SIG{name}"]
+            )
+        except (KeyError, ValueError) as e:
+            print(f"Warning: profiler not installed: {e}", file=sys.stderr)
+    return profiler
+
+
+def stream_pids() -> List[Tuple[int, str]]:
+    """Running stream scripts: (pid, script name) from /proc."""
+    found = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit() or int(entry) == os.getpid():
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                argv = f.read().split(b"\0")
+        except OSError:
+            continue
+        for arg in argv[1:3]:
+            script = os.path.basename(arg.decode(errors="replace"))
+            if script.startswith("stream_") and script.endswith(".py"):
+                found.append((int(entry), script))
+                break
+    return found
+
+
+def catches_signal(pid: int, signum: int) -> Optional[bool]:
+    """Whether pid has a handler for signum (SigCgt in /proc); None if unknown."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("SigCgt:"):
+                    return bool(int(line.split()[1], 16) >> (signum - 1) & 1)
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def trigger(args):
+    """Ask running stream scripts for a profile."""
+    targets = [(pid, str(pid)) for pid in args.pid] if args.pid else stream_pids()
+    if not targets:
+        print("Error: no running stream script found; give a pid.", file=sys.stderr)
+        return 1
+    signum = signal.Signals[
+        args.signal if args.signal.startswith("SIG") else f"SIG{args.signal}"
+    ]
+    sent = 0
+    for pid, script in targets:
+        if catches_signal(pid, signum) is False:
+            # Its default action would kill the stream (profiler off, or another signal)
+            print(
+                f"Warning: {script} (pid {pid}) does not handle {signum.name}; skipped",
+                file=sys.stderr,
+            )
+            continue
+        if args.seconds:
+            with open(os.path.join(REQUEST_DIR, f"{REQUEST_PREFIX}{pid}"), "w") as f:
+                f.write(f"{args.seconds}\n")
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            print(f"Error: {pid}: {e}", file=sys.stderr)
+            return 1
+        print(
+            f"Sent {signum.name} to {script} (pid {pid}); "
+            "it prints where the profile goes"
+        )
+        sent += 1
+    return 0 if sent else 1
+
+
+def synthetic_capture_loop(stop: threading.Event, counter: list, timings: dict):
+    """A capture/parse/draw/write loop in Python and NumPy, timing each stage itself."""
+    import numpy as np
+
+    frame = np.zeros((720, 1280, 3), np.uint8)
+    buffer = np.empty_like(frame)
+
+    class Sink:
+        def write(self, data):
+            bytes(memoryview(data).cast("B")[: 1 << 20])
+
+    stdin = Sink()
+
+    def capture_request():
+        np.copyto(buffer, frame)
+        return buffer
+
+    def parse_detections():
+        return sorted((i * 7919) % 101 for i in range(3000))
+
+    def draw_detections_on_array(array):
+        for y in range(100, 400, 20):
+            array[y : y + 2, 100:1100] = 255
+        return array
+
+    clock = time.perf_counter
+    while not stop.is_set():
+        t0 = clock()
+        array = capture_request()
+        t1 = clock()
+        parse_detections()
+        t2 = clock()
+        draw_detections_on_array(array)
+        t3 = clock()
+        stdin.write(array)
+        t4 = clock()
+        for stage, seconds in zip(STAGES, (t1 - t0, t2 - t1, t3 - t2, t4 - t3)):
+            timings[stage] += seconds
+        counter[0] += 1
+
+
+def benchmark(args):
+    """Loop rate dormant vs sampling, and sampled vs measured stage shares."""
+    profiler = SamplingProfiler(
+        args.profile_dir, args.seconds, args.interval, "benchmark"
+    )
+    profiler.install()
+    background_stop = threading.Event()
+
+    def idle_worker():
+        while not background_stop.wait(0.001):
+            pass
+
+    for index in range(args.threads):
+        threading.Thread(
+            target=idle_worker, name=f"worker-{index}", daemon=True
+        ).start()
+    results = {}
+    timings = collections.Counter()
+    for mode in ["dormant", "sampling"]:
+        stop, counter = threading.Event(), [0]
+        timings.clear()
+        if mode == "sampling":
+            os.kill(os.getpid(), signal.SIGUSR1)  # The way a stream is asked for one
+        timer = threading.Timer(args.seconds, stop.set)
+        timer.start()
+        started = time.monotonic()
+        synthetic_capture_loop(stop, counter, timings)
+        results[mode] = counter[0] / (time.monotonic() - started)
+        if mode == "sampling":
+            profiler.stop()
+    background_stop.set()
+    overhead = 100 * (1 - results["sampling"] / results["dormant"])
+    stats = profiler.stats()
+    print(
+        f"Loop rate: {results['dormant']:.1f}/s dormant, {results['sampling']:.1f}/s sampling "
+        f"at {1 / args.interval:.0f} Hz with {args.threads} idle threads "
+        f"({overhead:.1f}% slower); {stats['sample_ms']} ms per sample"
+    )
+    measured = sum(timings.values())
+    sampled = stats["main_thread_stages"] or {}
+    print("Main thread stage shares, measured vs sampled:")
+    for stage in STAGES[:-1]:
+        print(
+            f"  {stage:<8} {100 * timings[stage] / measured:5.1f}% "
+            f"{100 * sampled.get(stage, 0):5.1f}%"
+        )
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sampling profiles of a running stream"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    trigger_parser = subparsers.add_parser(
+        "trigger", help="Ask running stream scripts for a profile"
+    )
+    trigger_parser.add_argument(
+        "pid", type=int, nargs="*", help="Default: every stream_*.py running"
+    )
+    trigger_parser.add_argument(
+        "--seconds", type=float, help="Profile length (default: the script's own)"
+    )
+    trigger_parser.add_argument(
+        "--signal", default=os.environ.get("PROFILE_SIGNAL", DEFAULT_SIGNAL)
+    )
+    bench = subparsers.add_parser(
+        "benchmark", help="Overhead on a synthetic capture loop"
+    )
+    bench.add_argument("--seconds", type=float, default=5.0)
+    bench.add_argument("--interval", type=float, default=DEFAULT_INTERVAL)
+    bench.add_argument(
+        "--threads", type=int, default=4, help="Idle worker threads to sample too"
+    )
+    bench.add_argument("--profile-dir", default=DEFAULT_DIR)
+    args = parser.parse_args()
+    commands = {"trigger": trigger, "benchmark": benchmark}
+    return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,448 @@
+"""
+snapshot_server.py - "What does the robot see right now?" as a JPEG over HTTP
+
+Opening a full RTP stream to glance at one robot is heavy for an operator and
+heavier for a fleet dashboard polling every robot. With --snapshot-port, a
+streaming script also answers
+
+    GET /snapshot.jpg[?overlays=0|1][&scale=0.5][&quality=80]
+    GET /stats
+
+with the latest frame as a JPEG, with or without detection overlays.
+
+The capture path does no work for snapshots unless someone asks:
+
+* offer(frame, detections) is called for every frame. It copies the clean frame
+  only when a request is waiting for one, and returns at once otherwise.
+* A request takes the last copied frame if it is at most --snapshot-max-age old.
+  Otherwise it asks for the next frame and waits, up to one second, for capture
+  to copy it.
+* Overlays, scaling and JPEG encoding run in the HTTP request thread, at a lower
+  priority, and never in the capture loop.
+* Encoded JPEGs are cached per (frame sequence, overlays, scale, quality). When
+  concurrent requests ask for the same image, one thread encodes it and the rest
+  wait for that result, so a dashboard refresh across many clients costs one
+  encode per frame.
+
+Usage (from a streaming script):
+    snapshots = snapshots_from_args(args, draw=draw_detections_on_array)  # None if off
+    while streaming:
+        ...
+        if snapshots:
+            snapshots.offer(frame, detections)  # before overlays are drawn
+    if snapshots:
+        snapshots.close()
+
+    curl -o now.jpg "http://robot1.local:8081/snapshot.jpg?scale=0.5"
+
+    # Many clients against a synthetic 30 fps capture: encodes vs requests
+    python3 snapshot_server.py benchmark --clients 8 --seconds 5
+"""
+
+import argparse
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from typing import Callable, Dict, List, Optional
+
+from startup_timing import lazy_import
+
+cv2 = lazy_import("cv2")
+
+DEFAULT_SNAPSHOT_HOST = "0.0.0.0"
+DEFAULT_MAX_AGE = 0.2  # Seconds a copied frame still counts as "right now"
+DEFAULT_QUALITY = 80
+FRAME_WAIT = 1.0  # Longest a request waits for capture to hand over a frame
+ENCODE_WAIT = 5.0  # Longest a request waits for another thread's encode
+SNAPSHOT_NICE = 10  # Encoding yields to capture, encoders and sinks
+
+
+class FrameSnapshots:
+    def __init__(
+        self, draw: Optional[Callable] = None, max_age: float = DEFAULT_MAX_AGE
+    ):
+        """draw(array, detections) puts the overlays on a copy of the frame."""
+        self.draw = draw
+        self.max_age = max_age
+        self.server: Optional["SnapshotHTTPServer"] = None
+        self._cond = threading.Condition()
+        self._wanted = False
+        self._frame = None
+        self._detections = None
+        self._sequence = 0
+        self._captured_at = 0.0
+        self._cache: Dict[tuple, bytes] = {}
+        self._cache_sequence = 0
+        self._encoding: Dict[tuple, threading.Event] = {}
+        self.frames_copied = 0
+        self.requests = 0
+        self.encodes = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.no_frame = 0
+        self.encode_seconds = 0.0
+        self.bytes_served = 0
+
+    def offer(self, frame, detections=None):
+        """Capture path: copies the frame only when a snapshot request is waiting."""
+        if not self._wanted:
+            return
+        copy = frame.copy()  # Sources reuse their buffers; overlays are drawn later
+        with self._cond:
+            self._wanted = False
+            self._frame, self._detections = copy, detections
+            self._sequence += 1
+            self._captured_at = time.monotonic()
+            self._cond.notify_all()
+        self.frames_copied += 1
+
+    def latest(self, timeout: float = FRAME_WAIT):
+        """(sequence, captured_at, frame, detections) no older than max_age, or None."""
+        with self._cond:
+            if (
+                self._frame is None
+                or time.monotonic() - self._captured_at > self.max_age
+            ):
+                self._wanted = True
+                sequence = self._sequence
+                if not self._cond.wait_for(lambda: self._sequence != sequence, timeout):
+                    return None
+            return self._sequence, self._captured_at, self._frame, self._detections
+
+    def _encode(self, frame, detections, overlays: bool, scale: float, quality: int):
+        started = time.monotonic()
+        image = frame
+        if overlays and self.draw and detections:
+            image = frame.copy()  # Other requests share the clean frame
+            self.draw(image, detections)
+        if scale != 1.0:
+            image = cv2.resize(
+                image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+            )
+        ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise RuntimeError("JPEG encoding failed")
+        self.encodes += 1
+        self.encode_seconds += time.monotonic() - started
+        return buffer.tobytes()
+
+    def snapshot(self, overlays: bool = True, scale: float = 1.0, quality: int = 80):
+        """(sequence, age in seconds, JPEG bytes) of the latest frame, or None."""
+        self.requests += 1
+        latest = self.latest()
+        if latest is None:
+            self.no_frame += 1
+            return None
+        sequence, captured_at, frame, detections = latest
+        key = (sequence, overlays, scale, quality)
+        with self._cond:
+            if sequence > self._cache_sequence:
+                self._cache.clear()  # Only the newest frame is worth keeping
+                self._cache_sequence = sequence
+            data = self._cache.get(key)
+            pending = self._encoding.get(key) if data is None else None
+            if data is None and pending is None:
+                self._encoding[key] = threading.Event()
+        if data is not None:
+            self.cache_hits += 1
+        elif pending is not None:
+            # Another request is encoding exactly this image; share its result
+            pending.wait(ENCODE_WAIT)
+            self.coalesced += 1
+            with self._cond:
+                data = self._cache.get(key)
+            if data is None:  # That encode failed or its frame was superseded
+                data = self._encode(frame, detections, overlays, scale, quality)
+        else:
+            try:
+                data = self._encode(frame, detections, overlays, scale, quality)
+            finally:
+                with self._cond:
+                    if data is not None and sequence >= self._cache_sequence:
+                        self._cache[key] = data
+                    self._encoding.pop(key).set()
+        self.bytes_served += len(data)
+        return sequence, time.monotonic() - captured_at, data
+
+    def serve(self, host: str, port: int):
+        """Answer snapshot requests on host:port from a daemon thread."""
+        self.server = SnapshotHTTPServer((host, port), self)
+        threading.Thread(
+            target=self.server.serve_forever, name="snapshot-http", daemon=True
+        ).start()
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "encodes": self.encodes,
+            "cache_hits": self.cache_hits,
+            "coalesced": self.coalesced,
+            "no_frame": self.no_frame,
+            "frames_copied": self.frames_copied,
+            "encode_ms": (
+                round(1000 * self.encode_seconds / self.encodes, 2)
+                if self.encodes
+                else 0.0
+            ),
+            "bytes_served": self.bytes_served,
+        }
+
+
+class SnapshotHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, snapshots: FrameSnapshots):
+        super().__init__(address, SnapshotHandler)
+        self.snapshots = snapshots
+
+
+class SnapshotHandler(http.server.BaseHTTPRequestHandler):
+    def setup(self):
+        super().setup()
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), SNAPSHOT_NICE)
+        except OSError:
+            pass  # Already lower, or not allowed; snapshots work either way
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        snapshots: FrameSnapshots = self.server.snapshots
+        if url.path == "/stats":
+            self._reply(200, "application/json", json.dumps(snapshots.stats()).encode())
+            return
+        if url.path not in ("/", "/snapshot.jpg"):
+            self._reply(404, "text/plain", b"Try /snapshot.jpg or /stats\n")
+            return
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            overlays = query.get("overlays", ["1"])[0] not in ("0", "false", "no")
+            scale = float(query.get("scale", ["1"])[0])
+            quality = int(query.get("quality", [str(DEFAULT_QUALITY)])[0])
+            if not (0.05 <= scale <= 1.0 and 1 <= quality <= 100):
+                raise ValueError
+        except ValueError:
+            self._reply(
+                400, "text/plain", b"scale must be 0.05-1.0 and quality 1-100\n"
+            )
+            return
+        try:
+            result = snapshots.snapshot(overlays, round(scale, 3), quality)
+        except Exception as e:  # Report it; the stream itself is unaffected
+            self._reply(500, "text/plain", f"Snapshot failed: {e}\n".encode())
+            return
+        if result is None:
+            self._reply(503, "text/plain", b"No frame from the camera\n")
+            return
+        sequence, age, data = result
+        self._reply(
+            200,
+            "image/jpeg",
+            data,
+            {"X-Frame-Sequence": str(sequence), "X-Frame-Age-Ms": f"{1000 * age:.0f}"},
+        )
+
+    def _reply(self, status: int, content_type: str, body: bytes, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def env_port(name: str) -> Optional[int]:
+    """A port from the environment; None (off) when unset or invalid."""
+    value = os.environ.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Leaving it off.", file=sys.stderr)
+        return None
+
+
+def add_snapshot_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by the scripts that serve snapshots."""
+    parser.add_argument(
+        "--snapshot-port",
+        type=int,
+        default=env_port("SNAPSHOT_PORT"),
+        help="Serve the latest frame as JPEG on this HTTP port (env: SNAPSHOT_PORT; unset: off)",
+    )
+    parser.add_argument(
+        "--snapshot-host",
+        default=os.environ.get("SNAPSHOT_HOST", DEFAULT_SNAPSHOT_HOST),
+        help=f"Address for the snapshot server (env: SNAPSHOT_HOST, default: {DEFAULT_SNAPSHOT_HOST})",
+    )
+    parser.add_argument(
+        "--snapshot-max-age",
+        type=float,
+        default=DEFAULT_MAX_AGE,
+        help=f"Seconds a captured snapshot frame is reused before a fresh one is taken (default: {DEFAULT_MAX_AGE})",
+    )
+
+
+def snapshots_from_args(
+    args: argparse.Namespace, draw: Optional[Callable] = None
+) -> Optional[FrameSnapshots]:
+    """A serving FrameSnapshots for --snapshot-port, otherwise None."""
+    if not args.snapshot_port:
+        return None
+    snapshots = FrameSnapshots(draw, args.snapshot_max_age)
+    try:
+        snapshots.serve(args.snapshot_host, args.snapshot_port)
+    except OSError as e:
+        print(
+            f"Warning: snapshot server not started on port {args.snapshot_port}: {e}",
+            file=sys.stderr,
+        )
+        return None
+    print(f"Snapshots at http://{args.snapshot_host}:{args.snapshot_port}/snapshot.jpg")
+    return snapshots
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def draw_boxes(array, detections):
+    for x, y, w, h in detections:
+        cv2.rectangle(array, (x, y), (x + w, y + h), (0, 255, 0), 2)
+
+
+def benchmark(args):
+    """A synthetic capture loop and many polling clients: what do snapshots cost?"""
+    from frame_sources import SyntheticSource
+
+    source = SyntheticSource(args.width, args.height, args.fps)
+    snapshots = FrameSnapshots(draw_boxes)
+    snapshots.serve("127.0.0.1", 0)
+    port = snapshots.server.server_address[1]
+    stop = threading.Event()
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+
+    def client(index: int):
+        query = ["", "?overlays=0", "?scale=0.5"][index % 3]
+        url = f"http://127.0.0.1:{port}/snapshot.jpg{query}"
+        while not stop.is_set():
+            started = time.monotonic()
+            try:
+                with urllib.request.urlopen(url, timeout=5) as response:
+                    response.read()
+                    status = response.status
+            except OSError as e:
+                status = getattr(e, "code", 0)
+            latencies.append(time.monotonic() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+            time.sleep(args.poll_interval)
+
+    clients = [
+        threading.Thread(target=client, args=(i,), daemon=True)
+        for i in range(args.clients)
+    ]
+    for thread in clients:
+        thread.start()
+    offer_times: List[float] = []
+    frames = 0
+    started = time.monotonic()
+    while time.monotonic() - started < args.seconds:
+        frame, _ = source.read()
+        offer_started = time.monotonic()
+        snapshots.offer(frame, [(40, 40, 120, 90)])
+        offer_times.append(time.monotonic() - offer_started)
+        frames += 1
+    elapsed = time.monotonic() - started
+    stop.set()
+    for thread in clients:
+        thread.join()
+    snapshots.close()
+    stats = snapshots.stats()
+    print(
+        f"{args.clients} clients polling every {args.poll_interval:.2f} s, "
+        f"{args.width}x{args.height} capture at {frames / elapsed:.1f} fps"
+    )
+    print(
+        f"  offer(): p50 {1000 * percentile(offer_times, 0.5):.3f} ms, "
+        f"p99 {1000 * percentile(offer_times, 0.99):.3f} ms, "
+        f"max {1000 * max(offer_times):.3f} ms"
+    )
+    if latencies:
+        print(
+            f"  requests: {sum(statuses.values())} {statuses}, latency p50 "
+            f"{1000 * percentile(latencies, 0.5):.1f} ms, p99 {1000 * percentile(latencies, 0.99):.1f} ms"
+        )
+    print(f"  {stats}")
+    return 0
+
+
+def serve(args):
+    """Serve snapshots of a frame source, e.g. to try the endpoint without a stream."""
+    from frame_sources import open_frame_source
+
+    source = open_frame_source(args.source, args.width, args.height, args.fps)
+    snapshots = snapshots_from_args(args)
+    if not snapshots:
+        return 1
+    try:
+        while True:
+            item = source.read()
+            if item is None:
+                break
+            snapshots.offer(item[0])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        snapshots.close()
+        source.close()
+        print(f"Snapshot stats: {snapshots.stats()}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JPEG snapshots of a live stream")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench = subparsers.add_parser(
+        "benchmark", help="Snapshot cost with many clients on a synthetic capture"
+    )
+    bench.add_argument("--clients", type=int, default=8)
+    bench.add_argument("--poll-interval", type=float, default=0.1)
+    bench.add_argument("--seconds", type=float, default=5.0)
+    bench.add_argument("--width", type=int, default=1280)
+    bench.add_argument("--height", type=int, default=720)
+    bench.add_argument("--fps", type=float, default=30.0)
+    serve_parser = subparsers.add_parser(
+        "serve", help="Serve snapshots of a frame source (no stream)"
+    )
+    serve_parser.add_argument("--source", default="synthetic")
+    serve_parser.add_argument("--width", type=int, default=1280)
+    serve_parser.add_argument("--height", type=int, default=720)
+    serve_parser.add_argument("--fps", type=float, default=30.0)
+    add_snapshot_arguments(serve_parser)
+    args = parser.parse_args()
+    if args.command == "serve" and not args.snapshot_port:
+        parser.error("serve needs --snapshot-port (or SNAPSHOT_PORT)")
+    commands = {"benchmark": benchmark, "serve": serve}
+    return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,782 @@
+"""
+soak_test.py - Hours-long runs that catch slow leaks and latency creep
+
+The streams run for hours on Pis that also run ROS, so slow growth matters:
+detections cached in globals, per-frame numpy allocations, pipe buffers,
+threads or file descriptors that are never closed. A short benchmark can't see
+any of it. This harness runs a pipeline for a set time and samples it at regular
+intervals:
+
+* process RSS and the RSS of its children (ffmpeg, gst-launch, arecord)
+* open file descriptors and threads
+* Python heap size (tracemalloc), with the allocation sites that grew the most
+  since the end of the warmup
+* garbage collector pauses: count, total and longest per interval
+* per-stage latency (p50/p95 per interval) for the built-in pipeline, from the
+  moment a frame arrives to the encoder write, and any
+  numeric fields you name in a wrapped script's stats file
+
+Every sample is appended to samples.jsonl as it is taken, so even a run that
+crashes leaves its data behind. At the end the samples after the warmup go
+through a drift analysis. For each series it compares the medians of the first
+and last quarters and fits a Theil-Sen slope (robust to GC spikes and one-off
+stalls); latency only counts as creeping when both show the growth. Leaks (RSS, heap, fds, threads, child RSS) and latency creep (stages,
+GC pauses, tracked fields) are flagged. Tail series (p95, longest GC pause) are
+noisier than medians and need a larger change (--tail-creep) to count. The exit
+status is 1 if anything was flagged, so a nightly job can fail on it.
+
+Usage:
+    # The CPU detection pipeline on the synthetic camera (the default source) for two hours
+    python3 soak_test.py run --duration 2h
+
+    # Any streaming script, with its own stats file fields tracked for creep
+    python3 soak_test.py wrap --duration 4h --track-stats /tmp/soak_stats.json \\
+        --track detector.latency_ms -- \\
+        stream_cpu_detection_video_to_pc.py --source synthetic --stats-file /tmp/soak_stats.json
+
+    # Re-analyze a finished (or crashed) run with other thresholds
+    python3 soak_test.py report ~/soak/soak-20240101-120000/samples.jsonl --leak-mb-per-hour 2
+
+    # Check the harness itself: a deliberate 20 KB/s leak must be flagged (and
+    # nothing else), and the same run without the leak must pass
+    python3 soak_test.py self-check --duration 3m --sample-interval 2
+"""
+
+import argparse
+import gc
+import json
+import os
+import runpy
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_SAMPLE_INTERVAL = 10.0
+DEFAULT_SNAPSHOT_INTERVAL = 300.0
+DEFAULT_LEAK_MB_PER_HOUR = 4.0
+DEFAULT_LEAK_MIN_MB = 2.0
+DEFAULT_CREEP = 0.2  # Relative latency growth that counts as creep
+DEFAULT_CREEP_MIN_MS = 0.5
+# p95 and longest-pause series swing with a handful of slow frames per interval
+DEFAULT_TAIL_CREEP = 0.5
+DEFAULT_TAIL_CREEP_MIN_MS = 3.0
+# Outside the git tree, survives reboots
+DEFAULT_OUT_ROOT = os.path.expanduser("~/soak")
+SELF_CHECK_LEAK_KB_PER_S = 20.0
+MIN_SAMPLES = 8
+TOP_ALLOCATORS = 10
+
+
+def parse_duration(text: str) -> float:
+    """'90', '90s', '30m' or '2h' to seconds."""
+    units = {"s": 1, "m": 60, "h": 3600}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def read_status_kb(pid="self") -> Dict[str, int]:
+    """VmRSS, Threads, ... from /proc/<pid>/status (kB values without the unit)."""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                parts = value.split()
+                if parts and parts[0].isdigit():
+                    fields[key] = int(parts[0])
+    except OSError:
+        pass
+    return fields
+
+
+def child_pids() -> List[int]:
+    pids = []
+    for task in os.listdir("/proc/self/task"):
+        try:
+            with open(f"/proc/self/task/{task}/children") as f:
+                pids += [int(pid) for pid in f.read().split()]
+        except OSError:
+            pass
+    return pids
+
+
+class StageTimer:
+    def __init__(self):
+        """Per-stage durations, collected between samples."""
+        self._durations: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self._durations.setdefault(stage, []).append(seconds)
+
+    def timed(self, stage: str, function: Callable, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.record(stage, time.perf_counter() - start)
+        return result
+
+    def collect(self) -> Dict[str, dict]:
+        with self._lock:
+            durations, self._durations = self._durations, {}
+        return {
+            stage: {
+                "count": len(values),
+                "p50_ms": round(float(np.percentile(values, 50)) * 1000, 3),
+                "p95_ms": round(float(np.percentile(values, 95)) * 1000, 3),
+                "max_ms": round(max(values) * 1000, 3),
+            }
+            for stage, values in durations.items()
+            if values
+        }
+
+
+class GcPauses:
+    def __init__(self):
+        """Time every collection through gc.callbacks."""
+        self._started = 0.0
+        self._pauses: List[Tuple[int, float]] = []
+        self._lock = threading.Lock()
+        gc.callbacks.append(self._callback)
+
+    def _callback(self, phase: str, info: dict):
+        if phase == "start":
+            self._started = time.perf_counter()
+        else:
+            with self._lock:
+                self._pauses.append(
+                    (info["generation"], time.perf_counter() - self._started)
+                )
+
+    def collect(self) -> dict:
+        with self._lock:
+            pauses, self._pauses = self._pauses, []
+        durations = [seconds for _, seconds in pauses]
+        return {
+            "count": len(pauses),
+            "gen2": sum(1 for generation, _ in pauses if generation == 2),
+            "total_ms": round(sum(durations) * 1000, 3),
+            "max_ms": round(max(durations, default=0.0) * 1000, 3),
+        }
+
+    def close(self):
+        if self._callback in gc.callbacks:
+            gc.callbacks.remove(self._callback)
+
+
+class SoakSampler:
+    def __init__(
+        self,
+        out_dir: str,
+        interval: float = DEFAULT_SAMPLE_INTERVAL,
+        snapshot_interval: float = DEFAULT_SNAPSHOT_INTERVAL,
+        warmup: float = 0.0,
+        trace: bool = True,
+        timer: Optional[StageTimer] = None,
+        extra: Optional[Callable[[], dict]] = None,
+    ):
+        """Sample this process every `interval` seconds into out_dir/samples.jsonl."""
+        self.out_dir = out_dir
+        self.interval = interval
+        self.snapshot_interval = snapshot_interval
+        self.warmup = warmup
+        self.trace = trace
+        self.timer = timer
+        self.extra = extra
+        self.gc_pauses = GcPauses()
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self.top_allocators: List[dict] = []
+        self.samples = 0
+        self.started = time.monotonic()
+        self._next_snapshot = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        os.makedirs(out_dir, exist_ok=True)
+        self.samples_path = os.path.join(out_dir, "samples.jsonl")
+        self._file = open(self.samples_path, "w")
+
+    def start(self):
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.started = time.monotonic()
+        self._thread = threading.Thread(
+            target=self._run, name="soak-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        elapsed = time.monotonic() - self.started
+        status = read_status_kb()
+        children = [read_status_kb(pid).get("VmRSS", 0) for pid in child_pids()]
+        record = {
+            "t": round(elapsed, 2),
+            "rss_mb": round(status.get("VmRSS", 0) / 1024, 2),
+            "children_rss_mb": round(sum(children) / 1024, 2),
+            "children": len(children),
+            "fds": len(os.listdir("/proc/self/fd")),
+            "threads": status.get("Threads", threading.active_count()),
+            "gc": self.gc_pauses.collect(),
+        }
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            record["heap_mb"] = round(current / 1e6, 3)
+            record["heap_peak_mb"] = round(peak / 1e6, 3)
+            self._maybe_snapshot(elapsed)
+        if self.timer:
+            record["stages"] = self.timer.collect()
+        if self.extra:
+            try:
+                record["tracked"] = self.extra()
+            except Exception as e:  # A failing probe must not end the soak
+                record["tracked"] = {"error": str(e)}
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        self.samples += 1
+
+    def _maybe_snapshot(self, elapsed: float):
+        if elapsed < self.warmup or elapsed < self._next_snapshot:
+            return
+        self._next_snapshot = elapsed + self.snapshot_interval
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ]
+        )
+        if self.baseline is None:
+            self.baseline = snapshot
+            return
+        self.top_allocators = [
+            {
+                "where": str(stat.traceback),
+                "growth_kb": round(stat.size_diff / 1024, 1),
+                "blocks_growth": stat.count_diff,
+                "size_kb": round(stat.size / 1024, 1),
+            }
+            for stat in snapshot.compare_to(self.baseline, "lineno")[:TOP_ALLOCATORS]
+            if stat.size_diff > 0
+        ]
+
+    def close(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 1)
+        if tracemalloc.is_tracing():
+            self._maybe_snapshot(float("inf"))
+        self.gc_pauses.close()
+        self._file.close()
+
+
+def theil_sen_slope(t: np.ndarray, v: np.ndarray) -> float:
+    """Median of pairwise slopes: one GC spike or stall can't tilt it."""
+    if len(t) < 2:
+        return 0.0
+    i, j = np.triu_indices(len(t), k=1)
+    dt = t[j] - t[i]
+    keep = dt > 0
+    if not keep.any():
+        return 0.0
+    return float(np.median((v[j] - v[i])[keep] / dt[keep]))
+
+
+def series_of(samples: List[dict]) -> Dict[str, Tuple[str, List[Tuple[float, float]]]]:
+    """name -> (kind, [(t, value)]) for everything the drift analysis checks."""
+    series: Dict[str, Tuple[str, List[Tuple[float, float]]]] = {}
+
+    def add(name: str, kind: str, t: float, value):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            series.setdefault(name, (kind, []))[1].append((t, float(value)))
+
+    for sample in samples:
+        t = sample["t"]
+        add("rss_mb", "memory", t, sample.get("rss_mb"))
+        add("children_rss_mb", "memory", t, sample.get("children_rss_mb"))
+        add("heap_mb", "memory", t, sample.get("heap_mb"))
+        add("fds", "count", t, sample.get("fds"))
+        add("threads", "count", t, sample.get("threads"))
+        add("gc_max_pause_ms", "tail", t, sample.get("gc", {}).get("max_ms"))
+        for stage, stats in sample.get("stages", {}).items():
+            add(f"stage.{stage}.p50_ms", "latency", t, stats.get("p50_ms"))
+            add(f"stage.{stage}.p95_ms", "tail", t, stats.get("p95_ms"))
+        for name, value in sample.get("tracked", {}).items():
+            add(f"tracked.{name}", "latency", t, value)
+    return series
+
+
+def analyze(
+    samples: List[dict],
+    warmup: float,
+    leak_mb_per_hour: float = DEFAULT_LEAK_MB_PER_HOUR,
+    leak_min_mb: float = DEFAULT_LEAK_MIN_MB,
+    creep: float = DEFAULT_CREEP,
+    creep_min_ms: float = DEFAULT_CREEP_MIN_MS,
+    tail_creep: float = DEFAULT_TAIL_CREEP,
+    tail_creep_min_ms: float = DEFAULT_TAIL_CREEP_MIN_MS,
+) -> dict:
+    """Drift per series after the warmup, with leak and creep flags."""
+    steady = [sample for sample in samples if sample["t"] >= warmup]
+    report = {
+        "samples": len(samples),
+        "steady_samples": len(steady),
+        "steady_seconds": round(steady[-1]["t"] - steady[0]["t"], 1) if steady else 0,
+        "series": {},
+        "flags": [],
+    }
+    if len(steady) < MIN_SAMPLES:
+        report["flags"].append(
+            f"insufficient data: {len(steady)} samples after warmup (need {MIN_SAMPLES})"
+        )
+        return report
+
+    for name, (kind, points) in series_of(steady).items():
+        if len(points) < MIN_SAMPLES:
+            continue
+        t = np.array([p[0] for p in points])
+        v = np.array([p[1] for p in points])
+        quarter = max(len(v) // 4, 2)
+        first, last = float(np.median(v[:quarter])), float(np.median(v[-quarter:]))
+        slope = theil_sen_slope(t, v) * 3600
+        flag = None
+        if kind == "memory":
+            if slope > leak_mb_per_hour and last - first > leak_min_mb:
+                flag = f"leak: +{last - first:.1f} MB, {slope:.1f} MB/h"
+        elif kind == "count":
+            if last > first and slope > 0 and v[-1] > v[:quarter].max():
+                flag = f"leak: {first:.0f} -> {last:.0f}"
+        else:
+            relative, minimum = (
+                (tail_creep, tail_creep_min_ms)
+                if kind == "tail"
+                else (creep, creep_min_ms)
+            )
+            # Both estimates must agree: a step between two noisy quarters moves
+            # the medians, but only a real trend carries the slope that far
+            trend = slope / 3600 * (t[-1] - t[0])
+            growth = min(last - first, trend)
+            if growth > first * relative and growth > minimum:
+                flag = f"creep: {first:.2f} -> {last:.2f} ms"
+        report["series"][name] = {
+            "start": round(first, 3),
+            "end": round(last, 3),
+            "slope_per_hour": round(slope, 3),
+            "flag": flag,
+        }
+        if flag:
+            report["flags"].append(f"{name} {flag}")
+    return report
+
+
+def print_report(report: dict, top_allocators: List[dict]):
+    print(
+        f"\n--- Soak drift report ({report['steady_samples']} samples over "
+        f"{report['steady_seconds']:.0f} s after warmup) ---"
+    )
+    print(f"{'series':34} {'start':>10} {'end':>10} {'per hour':>10}  flag")
+    for name, row in report["series"].items():
+        print(
+            f"{name:34} {row['start']:10.3f} {row['end']:10.3f} "
+            f"{row['slope_per_hour']:10.3f}  {row['flag'] or ''}"
+        )
+    if top_allocators:
+        print("\nTop Python allocation growth since warmup:")
+        for allocator in top_allocators:
+            print(
+                f"  +{allocator['growth_kb']:9.1f} KB  {allocator['blocks_growth']:+7d} blocks  {allocator['where']}"
+            )
+    if report["flags"]:
+        print("\nFLAGGED:")
+        for flag in report["flags"]:
+            print(f"  {flag}")
+    else:
+        print("\nNo leaks or latency creep found.")
+
+
+def finish(sampler: SoakSampler, args) -> int:
+    sampler.close()
+    with open(sampler.samples_path) as f:
+        samples = [json.loads(line) for line in f if line.strip()]
+    report = analyze(
+        samples,
+        sampler.warmup,
+        args.leak_mb_per_hour,
+        args.leak_min_mb,
+        args.creep,
+        args.creep_min_ms,
+        args.tail_creep,
+        args.tail_creep_min_ms,
+    )
+    report["top_allocators"] = sampler.top_allocators
+    report_path = os.path.join(sampler.out_dir, "report.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=1)
+    print_report(report, sampler.top_allocators)
+    print(f"\nSamples: {sampler.samples_path}\nReport:  {report_path}")
+    return 1 if report["flags"] else 0
+
+
+def sampler_from_args(args, timer=None, extra=None) -> SoakSampler:
+    duration = parse_duration(args.duration)
+    warmup = parse_duration(args.warmup) if args.warmup else duration * 0.1
+    out_dir = args.out_dir or os.path.join(
+        DEFAULT_OUT_ROOT, time.strftime("soak-%Y%m%d-%H%M%S")
+    )
+    return SoakSampler(
+        out_dir,
+        args.sample_interval,
+        args.snapshot_interval,
+        warmup,
+        not args.no_tracemalloc,
+        timer,
+        extra,
+    )
+
+
+def run(args) -> int:
+    """The CPU detection pipeline, stage by stage, as stream_cpu_detection_video_to_pc.py runs it."""
+    import stream_cpu_detection_video_to_pc as pipeline
+    from cpu_affinity import layout_from_args
+    from cpu_detector import detector_from_args
+    from frame_bus import FrameBusWriter, detection_records
+    from frame_sources import SyntheticSource, open_frame_source
+
+    duration = parse_duration(args.duration)
+    if args.encoder == "ffmpeg" and not shutil.which("ffmpeg"):
+        print("ffmpeg not found; running without the encoder stage", file=sys.stderr)
+        args.encoder = "none"
+    if args.source == "synthetic" and args.unpaced:
+        source = SyntheticSource(args.width, args.height, args.fps, paced=False)
+    else:
+        source = open_frame_source(args.source, args.width, args.height, args.fps)
+    pipeline.cpu_layout = layout_from_args(args)
+    detector = detector_from_args(args, pipeline.cpu_layout.threads("detector"))
+    frame_bus = (
+        FrameBusWriter(args.frame_bus, args.width, args.height)
+        if args.frame_bus
+        else None
+    )
+    encoder = pipeline.start_ffmpeg_pc(args) if args.encoder == "ffmpeg" else None
+
+    timer = StageTimer()
+
+    def inference_latency() -> dict:
+        return {"inference_ms": round(detector.rate.latency * 1000, 3)}
+
+    sampler = sampler_from_args(args, timer, inference_latency)
+    leak: List[bytes] = []
+    leak_bytes = int(args.inject_leak_kb_per_s * 1024 / args.fps)
+    print(
+        f"Soaking {args.source} -> detector -> overlay"
+        f"{' -> frame bus' if frame_bus else ''}{' -> ffmpeg' if encoder else ''} "
+        f"for {duration:.0f} s, samples in {sampler.out_dir}"
+    )
+    detector.start()
+    sampler.start()
+    deadline = time.monotonic() + duration
+    try:
+        while time.monotonic() < deadline:
+            item = source.read()  # Not timed: a paced camera mostly waits here
+            if item is None:
+                print("Frame source ended.")
+                break
+            frame, timestamp_ns = item
+            work_start = time.perf_counter()
+            detector.submit(frame)
+            detections = detector.latest()
+            timer.record("detect", time.perf_counter() - work_start)
+            if frame_bus:
+                timer.timed(
+                    "frame_bus",
+                    frame_bus.publish,
+                    frame,
+                    {"detections": detection_records(detections, [])},
+                    timestamp_ns,
+                )
+            frame = timer.timed(
+                "overlay", pipeline.draw_detections_on_array, frame, detections
+            )
+            if encoder:
+                timer.timed("encode_write", encoder.stdin.write, frame.tobytes())
+            else:
+                timer.timed("encode_write", frame.tobytes)
+            if leak_bytes:
+                leak.append(bytes(leak_bytes))
+            timer.record("frame", time.perf_counter() - work_start)
+    except KeyboardInterrupt:
+        print("\nStopping soak early...")
+    finally:
+        detector.close()
+        if encoder:
+            encoder.stdin.close()
+            encoder.terminate()
+            encoder.wait()
+        if frame_bus:
+            frame_bus.close(unlink=True)
+        source.close()
+    return finish(sampler, args)
+
+
+def wrap(args) -> int:
+    """Run a streaming script in this process with the sampler around it."""
+    if not args.script:
+        print("Error: name the script to run after --", file=sys.stderr)
+        return 2
+    script, *script_args = [arg for arg in args.script if arg != "--"]
+
+    def tracked() -> dict:
+        if not args.track_stats:
+            return {}
+        try:
+            with open(args.track_stats) as f:
+                document = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        values = {}
+        for path in args.track:
+            value = document
+            for key in path.split("."):
+                value = value.get(key) if isinstance(value, dict) else None
+            values[path] = value
+        return values
+
+    sampler = sampler_from_args(args, extra=tracked)
+    duration = parse_duration(args.duration)
+    # Stop the script the way Ctrl+C does, so its own cleanup runs
+    timer = threading.Timer(duration, os.kill, (os.getpid(), signal.SIGINT))
+    timer.daemon = True
+    print(f"Soaking {script} for {duration:.0f} s, samples in {sampler.out_dir}")
+    sys.argv = [script, *script_args]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    sampler.start()
+    timer.start()
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except KeyboardInterrupt:
+        pass
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            print(f"{script} exited with {e.code}", file=sys.stderr)
+    finally:
+        timer.cancel()
+    return finish(sampler, args)
+
+
+def self_check(args) -> int:
+    """Two runs of the built-in pipeline: one leaking on purpose, one clean."""
+    out_root = args.out_dir or os.path.join(
+        DEFAULT_OUT_ROOT, time.strftime("self-check-%Y%m%d-%H%M%S")
+    )
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "run",
+        "--duration",
+        args.duration,
+        "--sample-interval",
+        str(args.sample_interval),
+        "--encoder",
+        "none",  # The harness is under test here, not ffmpeg
+    ]
+    results = []
+    for name, extra in (
+        ("leak", ["--inject-leak-kb-per-s", str(SELF_CHECK_LEAK_KB_PER_S)]),
+        ("clean", []),
+    ):
+        out_dir = os.path.join(out_root, name)
+        print(f"\n=== Self-check: {name} run ===", flush=True)
+        subprocess.run(command + extra + ["--out-dir", out_dir])
+        try:
+            with open(os.path.join(out_dir, "report.json")) as f:
+                flags = json.load(f)["flags"]
+        except (OSError, ValueError, KeyError) as e:
+            flags = [f"no report: {e}"]
+        if name == "leak":
+            leaks = [flag for flag in flags if "_mb leak:" in flag]
+            passed = bool(leaks) and len(leaks) == len(flags)
+        else:
+            passed = not flags
+        results.append((name, passed, flags))
+
+    print("\n--- Self-check ---")
+    for name, passed, flags in results:
+        print(
+            f"{name:6} {'PASS' if passed else 'FAIL'}  {'; '.join(flags) or 'no flags'}"
+        )
+    return 0 if all(passed for _, passed, _ in results) else 1
+
+
+def report(args) -> int:
+    with open(args.samples) as f:
+        samples = [json.loads(line) for line in f if line.strip()]
+    duration = samples[-1]["t"] if samples else 0.0
+    warmup = parse_duration(args.warmup) if args.warmup else duration * 0.1
+    result = analyze(
+        samples,
+        warmup,
+        args.leak_mb_per_hour,
+        args.leak_min_mb,
+        args.creep,
+        args.creep_min_ms,
+        args.tail_creep,
+        args.tail_creep_min_ms,
+    )
+    print_report(result, [])
+    return 1 if result["flags"] else 0
+
+
+def add_analysis_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--warmup",
+        type=str,
+        help="Time excluded from the drift analysis (default: 10%% of the run)",
+    )
+    parser.add_argument(
+        "--leak-mb-per-hour",
+        type=float,
+        default=DEFAULT_LEAK_MB_PER_HOUR,
+        help=f"Memory growth rate that counts as a leak (default: {DEFAULT_LEAK_MB_PER_HOUR})",
+    )
+    parser.add_argument(
+        "--leak-min-mb",
+        type=float,
+        default=DEFAULT_LEAK_MIN_MB,
+        help="...and the least total growth that does",
+    )
+    parser.add_argument(
+        "--creep",
+        type=float,
+        default=DEFAULT_CREEP,
+        help=f"Relative latency growth that counts as creep (default: {DEFAULT_CREEP})",
+    )
+    parser.add_argument("--creep-min-ms", type=float, default=DEFAULT_CREEP_MIN_MS)
+    parser.add_argument(
+        "--tail-creep",
+        type=float,
+        default=DEFAULT_TAIL_CREEP,
+        help=f"The same for p95 and longest-pause series (default: {DEFAULT_TAIL_CREEP})",
+    )
+    parser.add_argument(
+        "--tail-creep-min-ms", type=float, default=DEFAULT_TAIL_CREEP_MIN_MS
+    )
+
+
+def add_sampler_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--duration",
+        type=str,
+        default="1h",
+        help="Run time: 90s, 30m, 2h (default: 1h)",
+    )
+    parser.add_argument(
+        "--sample-interval", type=float, default=DEFAULT_SAMPLE_INTERVAL
+    )
+    parser.add_argument(
+        "--snapshot-interval",
+        type=float,
+        default=DEFAULT_SNAPSHOT_INTERVAL,
+        help="Seconds between tracemalloc snapshots",
+    )
+    parser.add_argument(
+        "--no-tracemalloc",
+        action="store_true",
+        help="Skip heap tracing (it slows allocation-heavy code down)",
+    )
+    parser.add_argument(
+        "--out-dir", type=str, help="Default: ~/soak/soak-<date>-<time>"
+    )
+    add_analysis_arguments(parser)
+
+
+def main():
+    from cpu_affinity import add_affinity_arguments
+    from cpu_detector import add_detector_arguments
+    from frame_sources import add_source_arguments
+    from rtp_fec import add_fec_arguments
+
+    parser = argparse.ArgumentParser(description="Soak tests with drift reports")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser(
+        "run", help="Soak the CPU detection pipeline stage by stage"
+    )
+    add_sampler_arguments(run_parser)
+    add_source_arguments(run_parser, default="synthetic")
+    add_detector_arguments(run_parser)
+    add_affinity_arguments(run_parser)
+    add_fec_arguments(run_parser)
+    run_parser.add_argument("--width", type=int, default=1280)
+    run_parser.add_argument("--height", type=int, default=720)
+    run_parser.add_argument("--fps", type=int, default=30)
+    run_parser.add_argument("--bitrate", type=int, default=2500)
+    run_parser.add_argument("--threshold", type=float, default=0.55)
+    run_parser.add_argument("--iou", type=float, default=0.65)
+    run_parser.add_argument("--max-detections", type=int, default=10)
+    run_parser.add_argument("--remote-ip", type=str, default="127.0.0.1")
+    run_parser.add_argument("--remote-port", type=int, default=5000)
+    run_parser.add_argument(
+        "--encoder",
+        choices=["ffmpeg", "none"],
+        default="ffmpeg",
+        help="Write frames to a real libx264 ffmpeg (RTP to --remote-ip) or skip it",
+    )
+    run_parser.add_argument("--frame-bus", type=str, help="Also publish to this bus")
+    run_parser.add_argument(
+        "--unpaced",
+        action="store_true",
+        help="Run the synthetic camera as fast as possible (more frames per hour)",
+    )
+    run_parser.add_argument(
+        "--inject-leak-kb-per-s",
+        type=float,
+        default=0.0,
+        help="Leak on purpose, to check that the report flags it",
+    )
+
+    wrap_parser = subparsers.add_parser(
+        "wrap",
+        help="Soak a streaming script: soak_test.py wrap [options] -- script.py args",
+    )
+    add_sampler_arguments(wrap_parser)
+    wrap_parser.add_argument(
+        "--track-stats", type=str, help="The script's --stats-file, read every sample"
+    )
+    wrap_parser.add_argument(
+        "--track",
+        action="append",
+        default=[],
+        help="Dotted field in the stats file to check for creep (repeatable)",
+    )
+    wrap_parser.add_argument("script", nargs=argparse.REMAINDER)
+
+    check_parser = subparsers.add_parser(
+        "self-check",
+        help="A deliberate leak must be flagged and a clean run must pass",
+    )
+    check_parser.add_argument("--duration", type=str, default="3m")
+    check_parser.add_argument("--sample-interval", type=float, default=2.0)
+    check_parser.add_argument(
+        "--out-dir", type=str, help="Default: ~/soak/self-check-<date>-<time>"
+    )
+
+    report_parser = subparsers.add_parser("report", help="Analyze a samples.jsonl")
+    report_parser.add_argument("samples")
+    add_analysis_arguments(report_parser)
+
+    args = parser.parse_args()
+    commands = {"run": run, "wrap": wrap, "self-check": self_check, "report": report}
+    sys.exit(commands[args.command](args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""
+startup_timing.py - Fast, measured startup for the streaming scripts
+
+A detection script used to import OpenCV, NumPy and all of picamera2 before it
+even parsed its arguments, then bring everything up one step after another:
+IMX500 network load, labels, camera configuration, network firmware upload,
+encoder spawn. On a Pi 5 that is several seconds to the first frame, and
+`--help` alone took over a second.
+
+This module gives the scripts three things:
+
+- lazy_import("cv2") / lazy_import("picamera2", "Picamera2"): a stand-in that
+  imports on first use, so `--help` and `--print-intrinsics` never pay for
+  modules they do not touch. The import time is recorded as a startup phase.
+- StartupTimer.phase() and StartupTimer.background(): named, timed steps. A
+  background step runs in a daemon thread, so independent work (spawning the
+  encoders and audio sinks, opening the frame bus, importing OpenCV) overlaps
+  the IMX500 firmware upload, which only waits on the sensor.
+- A breakdown from process start (read from /proc, so interpreter start-up and
+  top-level imports are counted) to the first frame written, printed with
+  --startup-report and published as the "startup" stats source.
+
+Usage (from a streaming script):
+    from startup_timing import lazy_import, startup_timer
+    cv2 = lazy_import("cv2")
+    IMX500 = lazy_import("picamera2.devices", "IMX500")
+
+    with startup_timer.phase("imx500 network load"):
+        imx500 = IMX500(args.model)
+    encoders = startup_timer.background("spawn encoders", start_encoders, args)
+    with startup_timer.phase("camera start (firmware upload)"):
+        picam2.start()
+    ffmpeg_process = encoders.result()
+    ...
+    startup_timer.first_frame()  # after the first frame is handed to a sink
+
+    python3 startup_timing.py imports stream_object_detection_video_to_YT.py --help
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+
+def process_start_monotonic() -> float:
+    """time.monotonic() at which this process started, or now if /proc can't tell."""
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may contain spaces; the fields after it don't
+            fields = f.read().rsplit(")", 1)[1].split()
+        start_ticks = int(fields[19])  # Field 22: start time in clock ticks after boot
+        age = time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf(
+            "SC_CLK_TCK"
+        )
+    except (OSError, IndexError, ValueError, AttributeError):
+        return time.monotonic()
+    return time.monotonic() - max(0.0, age)
+
+
+class StartupPhase:
+    def __init__(self, name: str, start: float, thread: str):
+        self.name = name
+        self.start = start
+        self.end: Optional[float] = None
+        self.thread = thread
+        self.error: Optional[str] = None
+
+
+class BackgroundStep:
+    """A startup step running in its own thread; result() joins it and re-raises."""
+
+    def __init__(self, timer: "StartupTimer", name: str, target: Callable, args):
+        self._result = None
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(timer, name, target, args),
+            name=f"startup-{name.replace(' ', '-')}",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(self, timer: "StartupTimer", name: str, target: Callable, args):
+        try:
+            with timer.phase(name):
+                self._result = target(*args)
+        except BaseException as e:  # Handed to the thread that asks for the result
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class StartupTimer:
+    def __init__(self):
+        self.process_start = process_start_monotonic()
+        self.phases: List[StartupPhase] = []
+        self.first_frame_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def offset(self, at: float) -> float:
+        return at - self.process_start
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time the body of a with block as one startup phase."""
+        phase = StartupPhase(name, time.monotonic(), threading.current_thread().name)
+        with self._lock:
+            self.phases.append(phase)
+        try:
+            yield phase
+        except BaseException as e:
+            phase.error = type(e).__name__
+            raise
+        finally:
+            phase.end = time.monotonic()
+
+    def background(self, name: str, target: Callable, *args) -> BackgroundStep:
+        """Run target(*args) as a timed phase in a daemon thread."""
+        return BackgroundStep(self, name, target, args)
+
+    def first_frame(self) -> bool:
+        """Record the first frame; True only on the call that recorded it."""
+        if self.first_frame_at is not None:
+            return False
+        self.first_frame_at = time.monotonic()
+        return True
+
+    def time_to_first_frame(self) -> Optional[float]:
+        if self.first_frame_at is None:
+            return None
+        return self.offset(self.first_frame_at)
+
+    def stats(self) -> dict:
+        with self._lock:
+            phases = list(self.phases)
+        return {
+            "time_to_first_frame": self.time_to_first_frame(),
+            "phases": {
+                phase.name: {
+                    "start": round(self.offset(phase.start), 4),
+                    "duration": (
+                        round(phase.end - phase.start, 4)
+                        if phase.end is not None
+                        else None
+                    ),
+                    "thread": phase.thread,
+                    **({"error": phase.error} if phase.error else {}),
+                }
+                for phase in phases
+            },
+        }
+
+    def nesting(self, phases: List[StartupPhase]) -> Dict[int, int]:
+        """How many phases of the same thread each phase runs inside of."""
+        depth = {}
+        for phase in phases:
+            depth[id(phase)] = sum(
+                1
+                for outer in phases
+                if outer is not phase
+                and outer.thread == phase.thread
+                and outer.start <= phase.start
+                and (outer.end is None or (phase.end or outer.end) <= outer.end)
+            )
+        return depth
+
+    def report(self, file=None):
+        """Print the phases on a timeline from process start to the first frame."""
+        file = file or sys.stdout
+        with self._lock:
+            phases = sorted(self.phases, key=lambda phase: phase.start)
+        depth = self.nesting(phases)
+        print("Startup breakdown (seconds since process start):", file=file)
+        print(f"  {'phase':<36} {'start':>7} {'end':>7} {'took':>7}  thread", file=file)
+        if phases:
+            first = self.offset(phases[0].start)
+            name = "(interpreter and module imports)"
+            print(f"  {name:<36} {0.0:7.3f} {first:7.3f} {first:7.3f}", file=file)
+        for phase in phases:
+            start = self.offset(phase.start)
+            if phase.end is None:
+                end_text, took_text = "running", ""
+            else:
+                end_text = f"{self.offset(phase.end):7.3f}"
+                took_text = f"{phase.end - phase.start:7.3f}"
+            name = "  " * depth[id(phase)] + phase.name
+            suffix = f" ({phase.error})" if phase.error else ""
+            print(
+                f"  {name:<36} {start:7.3f} {end_text:>7} {took_text:>7}  "
+                f"{phase.thread}{suffix}",
+                file=file,
+            )
+        ttff = self.time_to_first_frame()
+        if ttff is not None:
+            main_thread = threading.main_thread().name
+            background = sum(
+                phase.end - phase.start
+                for phase in phases
+                if phase.end is not None
+                and depth[id(phase)] == 0
+                and phase.thread != main_thread
+            )
+            print(
+                f"  time to first frame: {ttff:.3f} s"
+                f" ({background:.3f} s of it ran in background steps)",
+                file=file,
+            )
+
+
+startup_timer = StartupTimer()
+
+
+class LazyImport:
+    """Stands in for a module (or one name in it) until it is first used.
+
+    Attribute lookups and calls import the module, record the import as a startup
+    phase and then pass through; looked-up attributes are cached on the stand-in,
+    so a per-frame `np.array_split` costs the same as with a plain import.
+    """
+
+    def __init__(self, module: str, attribute: Optional[str], timer: StartupTimer):
+        self.__dict__["_lazy_target"] = (module, attribute)
+        self.__dict__["_lazy_timer"] = timer
+        self.__dict__["_lazy_lock"] = threading.Lock()
+
+    def _lazy_load(self):
+        loaded = self.__dict__.get("_lazy_loaded")
+        if loaded is not None:
+            return loaded
+        module_name, attribute = self._lazy_target
+        with self._lazy_lock:
+            if "_lazy_loaded" not in self.__dict__:
+                if module_name in sys.modules:
+                    module = sys.modules[module_name]
+                else:
+                    with self._lazy_timer.phase(f"import {module_name}"):
+                        # __import__ rather than importlib, so -X importtime sees it
+                        __import__(module_name)
+                    module = sys.modules[module_name]
+                self.__dict__["_lazy_loaded"] = (
+                    getattr(module, attribute) if attribute else module
+                )
+        return self.__dict__["_lazy_loaded"]
+
+    def __getattr__(self, name: str):
+        value = getattr(self._lazy_load(), name)
+        self.__dict__[name] = value
+        return value
+
+    def __call__(self, *args, **kwargs):
+        return self._lazy_load()(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        module_name, attribute = self._lazy_target
+        state = "loaded" if "_lazy_loaded" in self.__dict__ else "not loaded"
+        target = f"{module_name}.{attribute}" if attribute else module_name
+        return f"<lazy {target} ({state})>"
+
+
+def lazy_import(
+    module: str, attribute: Optional[str] = None, timer: StartupTimer = startup_timer
+) -> LazyImport:
+    """A module, or `from module import attribute`, that is imported on first use."""
+    return LazyImport(module, attribute, timer)
+
+
+def warm_imports(*modules: LazyImport):
+    """Load lazy imports now, e.g. in a background step during the firmware upload."""
+    for module in modules:
+        module._lazy_load()
+
+
+def add_startup_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by the scripts that time their startup."""
+    parser.add_argument(
+        "--startup-report",
+        action=argparse.BooleanOptionalAction,
+        default=bool(os.environ.get("STARTUP_REPORT")),
+        help="Print a startup phase breakdown once the first frame is out (env: STARTUP_REPORT)",
+    )
+
+
+def report_first_frame(args: argparse.Namespace, timer: StartupTimer = startup_timer):
+    """Call after each frame goes out; reports the first one, is a no-op afterwards."""
+    if not timer.first_frame():
+        return
+    print(f"First frame {timer.time_to_first_frame():.2f} s after process start")
+    if args.startup_report:
+        timer.report()
+
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def imports(args):
+    """Run a script under -X importtime and show where its start-up time goes."""
+    command = [sys.executable, "-X", "importtime", *args.command]
+    started = time.monotonic()
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wall = time.monotonic() - started
+    packages: Dict[str, int] = {}
+    for line in result.stderr.decode(errors="replace").splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative_us, depth, name = int(match[2]), len(match[3]) // 2, match[4]
+        if depth == 0:  # Top-level imports; their cumulative time includes children
+            package = name.split(".")[0]
+            packages[package] = packages.get(package, 0) + cumulative_us
+    print(f"{' '.join(args.command)}: {wall:.3f} s wall, exit {result.returncode}")
+    ranked = sorted(packages.items(), key=lambda item: -item[1])
+    for package, cumulative_us in ranked[: args.top]:
+        print(f"  {cumulative_us / 1e6:7.3f} s  {package}")
+    heavy = [name for name in args.heavy.split(",") if name in packages]
+    print(f"Heavy modules imported: {', '.join(heavy) if heavy else 'none'}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Startup timing helpers for the streaming scripts"
+    )
+    subparsers = parser.add_subparsers(dest="command_name", required=True)
+    imports_parser = subparsers.add_parser(
+        "imports", help="Show which imports a script's start-up pays for"
+    )
+    imports_parser.add_argument("command", nargs=argparse.REMAINDER)
+    imports_parser.add_argument(
+        "--top", type=int, default=10, help="Packages to list (default: 10)"
+    )
+    imports_parser.add_argument(
+        "--heavy",
+        default="cv2,numpy,picamera2,libcamera",
+        help="Comma-separated packages that --help should not need",
+    )
+    args = parser.parse_args()
+    commands = {"imports": imports}
+    return commands[args.command_name](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,6 +6,24 @@
 #   1. Copy ~/.bashrc_exports.pi.example to ~/.bashrc and modify the variables as needed
 #   2. Run the script:
 #      ./stream_audio_to_pc.sh
+#
+# Set AUDIO_ADAPTIVE=true on lossy Wi-Fi: opus_audio_streamer.py adds in-band FEC,
+# stops sending during silence and adapts the bitrate to the loss the PC reports.
+# Receive it with pc/opus_audio_receiver.py (open_audio_stream.sh plays it too,
+# but sends no loss reports).
+#
+# Set AUDIO_ANALYSIS=true to also measure levels, clipping and silence and detect sound
+# events (see audio_analyzer.py). The GStreamer pipeline cannot do this, so it runs
+# opus_audio_streamer.py too. Set STREAM_STATS_FILE to follow the results.
+
+AUDIO_ADAPTIVE="${AUDIO_ADAPTIVE:-false}"
+AUDIO_ANALYSIS="${AUDIO_ANALYSIS:-false}"
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
+if [ "$AUDIO_ADAPTIVE" = "true" ] || [ "$AUDIO_ANALYSIS" = "true" ]; then
+	exec python3 "${SCRIPT_DIR}/opus_audio_streamer.py" send \
+		--device "${AUDIO_DEVICE}" --ip "${REMOTE_PC_IP}" --port "${AUDIO_UDP_PORT}"
+fi
 
 # GStreamer pipeline to capture audio from the microphone and send it to the remote PC
 gst-launch-1.0 -v \
@@ -0,0 +1,442 @@
+"""
+stream_cpu_detection_video_to_pc.py - CPU object detection with overlays to a remote PC
+
+For cameras without an IMX500, such as the Camera Module v2 on Ubuntu 22.04 (where
+picamera2 and the AI Camera don't work), a webcam or a recording. Frames come from
+libcamerasrc (the same path stream_video_to_pc.sh uses) or any frame_sources.py
+source. A small network runs on the CPU in a worker thread (see cpu_detector.py).
+The overlays are drawn like the IMX500 scripts draw them, and the video goes to the
+PC as H.264 RTP, ready for open_video_stream.sh.
+
+Usage:
+    python3 stream_cpu_detection_video_to_pc.py --detector-model ssd_mobilenet_v2.pb \\
+        --detector-config ssd_mobilenet_v2.pbtxt --labels coco_labels.txt
+    Uses environment variables for remote IP/port, width, height, FPS and bitrate if not specified.
+    Try it on any Linux box with --source synthetic --detector-model synthetic.
+    Add --fec on lossy Wi-Fi; receive with pc/rtp_fec_receiver.py.
+    Use --cpu-layout isolated (or ros) to keep the detector off the capture core.
+    Add --frame-bus NAME to share frames and detections with local processes (see frame_bus.py).
+    Add --web-port 8082 to watch the stream in a browser, detections included (see web_viewer.py).
+    Add --encoder-profile FILE to encode with settings measured on a clip (see encoder_tuner.py).
+    Add --memory-budget MB on a Pi 3 or Zero 2 W to size buffers to fit (see memory_budget.py).
+    Add --harvest-dir DIR to save crops of detected objects as a training dataset
+    (see crop_harvester.py).
+    Send SIGUSR1 (or run sampling_profiler.py trigger) to profile the running stream
+    (see sampling_profiler.py).
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+from typing import List, Optional
+
+import cv2
+import numpy as np
+
+from cpu_affinity import CpuLayout, add_affinity_arguments, layout_from_args
+from cpu_detector import (
+    CpuDetector,
+    Detection,
+    add_detector_arguments,
+    detector_from_args,
+)
+from crop_harvester import add_harvest_arguments, harvester_from_args
+from encoder_tuner import EncoderProfile, add_profile_arguments, profile_from_args
+from ffmpeg_progress import FfmpegProgress
+from frame_bus import FrameBusWriter, add_frame_bus_arguments, detection_records
+from frame_sources import (
+    FrameSource,
+    LibcameraSource,
+    add_source_arguments,
+    open_frame_source,
+)
+from local_preview import add_preview_arguments, preview_from_args
+from memory_budget import MemoryMonitor, add_memory_arguments, memory_plan_from_args
+from snapshot_server import add_snapshot_arguments, snapshots_from_args
+from rtp_fec import ProtectedRtpTransport, add_fec_arguments, transport_from_args
+from rtp_h264 import H264RtpPacketizer, pump_annexb
+from sampling_profiler import add_profiler_arguments, profiler_from_args
+from stream_stats import StreamStats, add_stats_arguments
+from web_viewer import WebViewer, add_web_viewer_arguments, web_viewer_from_args
+
+DEFAULT_COCO_LABELS_PATH = "assets/coco_labels.txt"
+
+# --- Global variables ---
+labels: List[str] = []
+args_global: Optional[argparse.Namespace] = None
+ffmpeg_process = None
+ffmpeg_progress: Optional[FfmpegProgress] = None
+pc_transport: Optional[ProtectedRtpTransport] = None
+cpu_layout: Optional[CpuLayout] = None
+frame_bus: Optional[FrameBusWriter] = None
+encoder_profile = EncoderProfile()
+detector: Optional[CpuDetector] = None
+source: Optional[FrameSource] = None
+web_viewer: Optional[WebViewer] = None
+
+
+def draw_detections_on_array(
+    array: np.ndarray, detections_to_draw: Optional[List[Detection]]
+):
+    if detections_to_draw is None:
+        return array
+
+    for detection_obj in detections_to_draw:
+        x, y, w, h = detection_obj.box
+        category = int(detection_obj.category)
+        name = labels[category] if category < len(labels) else str(category)
+        label_text = f"{name} ({detection_obj.conf:.2f})"
+        (text_width, text_height), baseline = cv2.getTextSize(
+            label_text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1
+        )
+        text_x = x + 5
+        text_y = y + 15
+        cv2.rectangle(
+            array,
+            (text_x, text_y - text_height - baseline // 2),
+            (text_x + text_width, text_y + baseline // 2),
+            (255, 255, 255),
+            cv2.FILLED,
+        )
+        cv2.putText(
+            array,
+            label_text,
+            (text_x, text_y),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.5,
+            (0, 0, 255),
+            1,
+        )  # Red text on BGR
+        cv2.rectangle(array, (x, y), (x + w, y + h), (0, 255, 0, 0), thickness=2)
+    return array
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        # VIDEO_FRAMERATE may be a GStreamer fraction such as 30/1
+        return int(value.split("/")[0])
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default}.", file=sys.stderr)
+        return default
+
+
+def get_args_cpu():
+    global args_global
+    parser = argparse.ArgumentParser(
+        description="CPU Object Detection to Remote PC (no AI Camera needed)"
+    )
+    add_source_arguments(parser)
+    add_detector_arguments(parser)
+    parser.add_argument(
+        "--threshold", type=float, default=0.55, help="Detection threshold"
+    )
+    parser.add_argument("--iou", type=float, default=0.65, help="Set iou threshold")
+    parser.add_argument(
+        "--max-detections", type=int, default=10, help="Set max detections"
+    )
+    parser.add_argument(
+        "--labels",
+        type=str,
+        help=f"Path to labels file, one per class id (default: {DEFAULT_COCO_LABELS_PATH})",
+    )
+    parser.add_argument(
+        "--fps",
+        type=int,
+        default=env_int("VIDEO_FRAMERATE", 30),
+        help="Frames per second (env: VIDEO_FRAMERATE, default: 30)",
+    )
+    parser.add_argument(
+        "--bitrate",
+        type=int,
+        default=env_int("VIDEO_BITRATE", 2500),
+        help="Target bitrate for H.264 encoding in Kbps (env: VIDEO_BITRATE, default: 2500 Kbps)",
+    )
+    parser.add_argument(
+        "--width",
+        type=int,
+        default=env_int("VIDEO_WIDTH", 1280),
+        help="Stream width (env: VIDEO_WIDTH, default: 1280)",
+    )
+    parser.add_argument(
+        "--height",
+        type=int,
+        default=env_int("VIDEO_HEIGHT", 720),
+        help="Stream height (env: VIDEO_HEIGHT, default: 720)",
+    )
+    parser.add_argument(
+        "--remote-ip",
+        type=str,
+        default=os.environ.get("REMOTE_PC_IP", "127.0.0.1"),
+        help="Remote PC IP address (env: REMOTE_PC_IP)",
+    )
+    parser.add_argument(
+        "--remote-port",
+        type=int,
+        default=env_int("VIDEO_UDP_PORT", 5000),
+        help="Remote PC UDP port (env: VIDEO_UDP_PORT)",
+    )
+    add_fec_arguments(parser)
+    add_affinity_arguments(parser)
+    add_frame_bus_arguments(parser)
+    add_stats_arguments(parser)
+    add_preview_arguments(parser)
+    add_profile_arguments(parser)
+    add_snapshot_arguments(parser)
+    add_harvest_arguments(parser)
+    add_web_viewer_arguments(parser)
+    add_memory_arguments(parser)
+    add_profiler_arguments(parser)
+    args_global = parser.parse_args()
+    return args_global
+
+
+def load_labels(path: Optional[str]) -> List[str]:
+    try:
+        with open(path or DEFAULT_COCO_LABELS_PATH, "r") as f:
+            return f.read().splitlines()
+    except FileNotFoundError:
+        if path:
+            print(f"Error: Labels file '{path}' not found.", file=sys.stderr)
+            sys.exit(1)
+        print(
+            f"Warning: Default labels file '{DEFAULT_COCO_LABELS_PATH}' not found; drawing class ids.",
+            file=sys.stderr,
+        )
+        return []
+
+
+def start_ffmpeg_pc(args_val):
+    global ffmpeg_progress
+    ffmpeg_progress = FfmpegProgress("pc")
+    ffmpeg_cmd = [
+        "ffmpeg",
+        *ffmpeg_progress.ffmpeg_args(),
+        "-loglevel",
+        "warning",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "bgr24",
+        "-s",
+        f"{args_val.width}x{args_val.height}",
+        "-r",
+        str(args_val.fps),
+        "-i",
+        "-",
+        "-c:v",
+        "libx264",
+        *encoder_profile.ffmpeg_args(
+            args_val.fps, args_val.bitrate, threads=cpu_layout.x264_args("encoder-pc")
+        ),
+        "-pix_fmt",
+        "yuv420p",
+    ]
+    if args_val.fec:
+        # Raw H.264 on stdout; rtp_fec packetizes, protects and paces it
+        ffmpeg_cmd += ["-f", "h264", "pipe:1"]
+    elif web_viewer:
+        # One encode, two muxers: RTP to the PC as before, raw H.264 for browsers
+        ffmpeg_cmd += [
+            "-f",
+            "tee",
+            f"[f=rtp]rtp://{args_val.remote_ip}:{args_val.remote_port}|[f=h264]pipe:1",
+        ]
+    else:
+        ffmpeg_cmd += [
+            "-f",
+            "rtp",
+            f"rtp://{args_val.remote_ip}:{args_val.remote_port}",
+        ]
+    process = subprocess.Popen(
+        ffmpeg_cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE if args_val.fec or web_viewer else None,
+        pass_fds=ffmpeg_progress.pass_fds,
+    )
+    ffmpeg_progress.start()
+    cpu_layout.apply_to_process("encoder-pc", process.pid)
+    return process
+
+
+def start_pc_pump(args_val, process) -> Optional[ProtectedRtpTransport]:
+    """Read the encoder's H.264 in a background thread: FEC-protected RTP, browsers or both."""
+    transport = None
+    if args_val.fec:
+        transport = transport_from_args(
+            args_val.remote_ip, args_val.remote_port, args_val
+        )
+    threading.Thread(
+        target=pump_annexb,
+        args=(
+            process.stdout,
+            H264RtpPacketizer() if transport else None,
+            transport,
+            args_val.fps,
+        ),
+        kwargs={"on_access_unit": web_viewer.push_access_unit if web_viewer else None},
+        name="pc-rtp-fec" if transport else "pc-web-viewer",
+        daemon=True,
+    ).start()
+    return transport
+
+
+def main():
+    global labels, ffmpeg_process, pc_transport, cpu_layout, frame_bus, detector, source, web_viewer
+    global encoder_profile
+
+    args_val = get_args_cpu()
+    profiler = profiler_from_args(args_val)
+    encoder_profile = profile_from_args(args_val)
+    cpu_layout = layout_from_args(args_val)
+    labels = load_labels(args_val.labels)
+    detector = detector_from_args(args_val, cpu_layout.threads("detector"))
+
+    try:
+        source = open_frame_source(
+            args_val.source, args_val.width, args_val.height, args_val.fps
+        )
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    # Frames come from the source's own reused buffer; no camera request buffers here
+    memory_plan = memory_plan_from_args(args_val, camera_buffers=0)
+    if args_val.frame_bus:
+        frame_bus = FrameBusWriter(
+            args_val.frame_bus,
+            args_val.width,
+            args_val.height,
+            slots=memory_plan.frame_bus_slots,
+        )
+        print(f"Publishing frames to frame bus '{args_val.frame_bus}'")
+
+    web_viewer = web_viewer_from_args(args_val, gop_cache=memory_plan.gop_cache)
+    ffmpeg_process = start_ffmpeg_pc(args_val)
+    if args_val.fec or web_viewer:
+        pc_transport = start_pc_pump(args_val, ffmpeg_process)
+    detector.start()
+    # An encoder falling behind slows inference down like a late capture loop
+    detector.rate.add_pressure_source(ffmpeg_progress.pressure)
+
+    # The encoder was placed when it started; now the Python threads (the
+    # detector's OpenCV workers are created by its thread and inherit its CPUs)
+    cpu_layout.apply_to_current_thread("capture")
+    cpu_layout.apply_to_named_threads()
+    print(f"CPU layout: {cpu_layout.describe()}")
+
+    stream_stats = StreamStats(args_val.stats_file, args_val.stats_interval)
+    stream_stats.add_source("source", source.stats)
+    stream_stats.add_source("detector", detector.stats)
+    stream_stats.add_source("encoder", ffmpeg_progress.stats)
+    if pc_transport:
+        stream_stats.add_source("rtp", pc_transport.stats)
+    preview = preview_from_args(args_val)
+    if preview:
+        stream_stats.add_source("preview", preview.stats)
+    snapshots = snapshots_from_args(args_val, draw=draw_detections_on_array)
+    if snapshots:
+        stream_stats.add_source("snapshots", snapshots.stats)
+    harvester = harvester_from_args(args_val, labels)
+    if harvester:
+        stream_stats.add_source("harvester", harvester.stats)
+    if web_viewer:
+        stream_stats.add_source("web_viewer", web_viewer.stats)
+    memory = MemoryMonitor(args_val.memory_budget, memory_plan)
+    memory.add_process("encoder", ffmpeg_process.pid)
+    if isinstance(source, LibcameraSource):
+        memory.add_process("camera", source.process.pid)
+    if frame_bus:
+        memory.add_buffer("frame_bus", lambda: frame_bus.nbytes)
+    if web_viewer:
+        memory.add_buffer("web_viewer", web_viewer.cached_bytes)
+    stream_stats.add_source("memory", memory.stats)
+    stream_stats.add_source("profiler", profiler.stats)
+    print(
+        f"Streaming {args_val.source} with CPU detection to {args_val.remote_ip}:{args_val.remote_port}"
+    )
+
+    frames_written = 0
+    try:
+        while True:
+            item = source.read()
+            if item is None:
+                print("Frame source ended.")
+                break
+            frame, timestamp_ns = item
+            detector.submit(frame)
+            detections = detector.latest()
+
+            if frame_bus:
+                # Clean frame (no overlays) plus detections for local readers
+                frame_bus.publish(
+                    frame,
+                    {"detections": detection_records(detections, labels)},
+                    timestamp_ns,
+                )
+            if snapshots:
+                snapshots.offer(frame, detections)  # Copies only on demand
+            if harvester:
+                harvester.offer(frame, detections)  # Copies the crops it keeps
+            frame_with_overlays = draw_detections_on_array(frame, detections)
+
+            if preview:
+                preview.offer(frame_with_overlays)  # Downscaled, never blocks
+                if preview.quit_requested:
+                    break
+
+            try:
+                ffmpeg_process.stdin.write(frame_with_overlays)  # No tobytes() copy
+            except IOError as e:
+                print(f"Error writing to ffmpeg: {e}", file=sys.stderr)
+                break
+            if web_viewer:
+                # The encoder turns the n-th frame written into the n-th access unit
+                web_viewer.push_detections(
+                    frames_written / args_val.fps, detection_records(detections, labels)
+                )
+            frames_written += 1
+            stream_stats.maybe_publish()
+
+    except KeyboardInterrupt:
+        print("\nStopping stream due to KeyboardInterrupt...")
+    finally:
+        print("Cleaning up resources...")
+        profiler.stop()
+        if preview:
+            preview.close()
+            print(f"Local preview stats: {preview.stats()}")
+        if snapshots:
+            snapshots.close()
+            print(f"Snapshot stats: {snapshots.stats()}")
+        if harvester:
+            harvester.close()
+            print(f"Crop harvester stats: {harvester.stats()}")
+        detector.close()
+        print(f"Detector stats: {detector.stats()}")
+        if ffmpeg_process:
+            print("Stopping ffmpeg process...")
+            ffmpeg_process.stdin.close()
+            ffmpeg_process.terminate()
+            ffmpeg_process.wait()
+            print(f"Encoder stats: {ffmpeg_progress.stats()}")
+        if pc_transport:
+            pc_transport.close()
+            print(f"PC RTP stats: {pc_transport.stats()}")
+        if web_viewer:
+            web_viewer.close()
+            print(f"Web viewer stats: {web_viewer.stats()}")
+        if frame_bus:
+            print(f"Frame bus stats: {frame_bus.stats()}")
+            frame_bus.close(unlink=True)
+        print(f"Memory stats: {memory.stats()}")
+        stream_stats.publish()
+        source.close()
+        print("Cleanup finished.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+stream_multi_camera_to_pc.py - Several cameras with overlays to a remote PC, from one process
+
+For robots with more than one camera: the two CSI ports of a Pi 5, an AI Camera next
+to a Camera Module v2, or a webcam. One process and one ffmpeg drive every camera.
+Each camera has its own capture thread and, optionally, a detector: the AI Camera's
+own network, or the CPU detector (one copy of the network shared by every camera
+that uses it). See camera_rig.py.
+
+Usage:
+    python3 stream_multi_camera_to_pc.py --camera imx500,name=front \\
+        --camera picamera2:1,name=rear,detect=cpu
+    Uses environment variables for remote IP/port, width, height, FPS and bitrate if not specified;
+    a camera's own size=, fps=, bitrate= and port= override them.
+    With --layout streams (the default) camera N goes to --remote-port + 10 * N; receive them
+    with pc/multi_robot_receiver.py, which the script prints the command for.
+    --layout mosaic tiles the cameras into one stream for open_video_stream.sh, with one encode.
+    Try it without cameras: --camera synthetic:1,detect=cpu --camera synthetic:2,detect=cpu
+    Add --stats-file /tmp/stream_stats.json to follow each camera (fps, encoder stalls, detector).
+    Add --harvest-dir DIR to save crops of detected objects as a training dataset
+    (see crop_harvester.py); the metadata records which camera each crop came from.
+    Send SIGUSR1 (or run sampling_profiler.py trigger) to profile the running stream
+    (see sampling_profiler.py).
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import List, Optional
+
+from camera_rig import (
+    LAYOUTS,
+    PORT_STEP,
+    CameraPipeline,
+    SharedEncoder,
+    open_camera,
+    parse_camera_spec,
+    shared_detectors,
+)
+from cpu_detector import add_detector_arguments
+from crop_harvester import add_harvest_arguments, harvester_from_args
+from detection_sync import add_sync_arguments
+from encoder_tuner import add_profile_arguments, profile_from_args
+from nanodet_postprocess import add_nanodet_arguments
+from sampling_profiler import add_profiler_arguments, profiler_from_args
+from stream_stats import StreamStats, add_stats_arguments
+
+DEFAULT_MODEL_PATH = (
+    "/usr/share/imx500-models/imx500_network_ssd_mobilenetv2_fpnlite_320x320_pp.rpk"
+)
+DEFAULT_COCO_LABELS_PATH = "assets/coco_labels.txt"
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        # VIDEO_FRAMERATE may be a GStreamer fraction such as 30/1
+        return int(value.split("/")[0])
+    except ValueError:
+        print(f"Warning: Invalid {name}. Using default {default}.", file=sys.stderr)
+        return default
+
+
+def get_args_multi():
+    parser = argparse.ArgumentParser(
+        description="Several cameras with object detection to a remote PC, from one process"
+    )
+    parser.add_argument(
+        "--camera",
+        action="append",
+        required=True,
+        help="SOURCE[,name=..][,size=WxH][,fps=..][,detect=cpu|none][,bitrate=..][,port=..]; "
+        "SOURCE is imx500, picamera2:N, libcamera, synthetic:SEED, /dev/videoN or a file. "
+        "Repeat for each camera",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=LAYOUTS,
+        default=os.environ.get("CAMERA_LAYOUT", "streams"),
+        help="A stream per camera, or one mosaic of all of them (env: CAMERA_LAYOUT, "
+        "default: streams)",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=DEFAULT_MODEL_PATH,
+        help="Network of the imx500 camera",
+    )
+    add_detector_arguments(parser)
+    add_nanodet_arguments(parser)
+    parser.add_argument(
+        "--threshold", type=float, default=0.55, help="Detection threshold"
+    )
+    parser.add_argument("--iou", type=float, default=0.65, help="Set iou threshold")
+    parser.add_argument(
+        "--max-detections", type=int, default=10, help="Set max detections"
+    )
+    parser.add_argument(
+        "--labels",
+        type=str,
+        help=f"Path to labels file, one per class id (default: {DEFAULT_COCO_LABELS_PATH})",
+    )
+    parser.add_argument(
+        "--fps",
+        type=int,
+        default=env_int("VIDEO_FRAMERATE", 30),
+        help="Frames per second (env: VIDEO_FRAMERATE, default: 30)",
+    )
+    parser.add_argument(
+        "--bitrate",
+        type=int,
+        default=env_int("VIDEO_BITRATE", 2500),
+        help="Bitrate per stream, or of the mosaic, in Kbps (env: VIDEO_BITRATE, default: 2500 Kbps)",
+    )
+    parser.add_argument(
+        "--width",
+        type=int,
+        default=env_int("VIDEO_WIDTH", 1280),
+        help="Width of each stream, or of the mosaic (env: VIDEO_WIDTH, default: 1280)",
+    )
+    parser.add_argument(
+        "--height",
+        type=int,
+        default=env_int("VIDEO_HEIGHT", 720),
+        help="Height of each stream, or of the mosaic (env: VIDEO_HEIGHT, default: 720)",
+    )
+    parser.add_argument(
+        "--remote-ip",
+        type=str,
+        default=os.environ.get("REMOTE_PC_IP", "127.0.0.1"),
+        help="Remote PC IP address (env: REMOTE_PC_IP)",
+    )
+    parser.add_argument(
+        "--remote-port",
+        type=int,
+        default=env_int("VIDEO_UDP_PORT", 5000),
+        help=f"UDP port of the first camera; the next ones add {PORT_STEP} each "
+        "(env: VIDEO_UDP_PORT)",
+    )
+    add_sync_arguments(parser)
+    add_profile_arguments(parser)
+    add_harvest_arguments(parser)
+    add_stats_arguments(parser)
+    add_profiler_arguments(parser)
+    return parser.parse_args()
+
+
+def load_labels(path: Optional[str]) -> List[str]:
+    try:
+        with open(path or DEFAULT_COCO_LABELS_PATH, "r") as f:
+            return f.read().splitlines()
+    except FileNotFoundError:
+        if path:
+            print(f"Error: Labels file '{path}' not found.", file=sys.stderr)
+            sys.exit(1)
+        print(
+            f"Warning: Default labels file '{DEFAULT_COCO_LABELS_PATH}' not found; drawing class ids.",
+            file=sys.stderr,
+        )
+        return []
+
+
+def main():
+    args = get_args_multi()
+    profiler = profiler_from_args(args)
+    try:
+        specs = [
+            parse_camera_spec(text, index, args)
+            for index, text in enumerate(args.camera)
+        ]
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    names = [spec.name for spec in specs]
+    if len(set(names)) != len(names):
+        print(f"Error: camera names must differ: {names}", file=sys.stderr)
+        sys.exit(1)
+    if sum(spec.source == "imx500" for spec in specs) > 1:
+        print("Error: only one camera can be the imx500.", file=sys.stderr)
+        sys.exit(1)
+    labels = load_labels(args.labels)
+    encoder_profile = profile_from_args(args)
+    detectors = shared_detectors(args, specs)
+    harvester = harvester_from_args(args, labels)
+
+    sources = []
+    try:
+        for spec in specs:
+            sources.append(open_camera(spec, args, labels))
+            print(f"Camera {spec}")
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        for source in sources:
+            source.close()
+        sys.exit(1)
+
+    try:
+        encoder = SharedEncoder(specs, args.layout, args, encoder_profile)
+    except OSError as e:
+        print(f"Error: could not start ffmpeg: {e}", file=sys.stderr)
+        for source in sources:
+            source.close()
+        if harvester:
+            harvester.close()
+        sys.exit(1)
+    pipelines = [
+        CameraPipeline(
+            spec,
+            source,
+            detectors.get(spec.name),
+            getattr(source, "labels", labels),
+            encoder.sink(index),
+            harvester,
+        )
+        for index, (spec, source) in enumerate(zip(specs, sources))
+    ]
+    stream_stats = StreamStats(args.stats_file, args.stats_interval)
+    stream_stats.add_source(
+        "cameras", lambda: {p.spec.name: p.stats() for p in pipelines}
+    )
+    stream_stats.add_source("encoder", encoder.stats)
+    stream_stats.add_source("profiler", profiler.stats)
+    if harvester:
+        stream_stats.add_source("harvester", harvester.stats)
+    for pipeline in pipelines:
+        pipeline.start()
+    print(f"Streaming {len(pipelines)} cameras: {encoder.describe()}")
+    if args.layout == "streams":
+        robots = " ".join(f"--robot {spec.name}:{spec.port}" for spec in specs)
+        print(f"On the PC: python3 multi_robot_receiver.py {robots}")
+
+    try:
+        while any(pipeline.running for pipeline in pipelines):
+            if not encoder.running:
+                print("Error: ffmpeg exited.", file=sys.stderr)
+                break
+            stream_stats.maybe_publish()
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        print("\nStopping stream due to KeyboardInterrupt...")
+    finally:
+        print("Cleaning up resources...")
+        profiler.stop()
+        for pipeline in pipelines:
+            pipeline.stop()
+        print("Stopping ffmpeg process...")
+        encoder.close()
+        for pipeline in pipelines:
+            pipeline.close()
+            print(f"Camera {pipeline.spec.name} stats: {pipeline.stats()}")
+        print(f"Encoder stats: {encoder.stats()}")
+        if harvester:
+            harvester.close()
+            print(f"Crop harvester stats: {harvester.stats()}")
+        stream_stats.publish()
+        print("Cleanup finished.")
+
+
+if __name__ == "__main__":
+    main()
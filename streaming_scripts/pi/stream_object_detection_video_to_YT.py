@@ -6,7 +6,21 @@ and streams the output to YouTube Live using ffmpeg for minimal latency.
 
 Usage:
     python stream_object_detection_video_to_YT.py --model /path/to/model.rpk --stream-key your-youtube-stream-key
-    Uses environment variables for YouTube stream key, width, height, FPS, bitrate if not specified.
+    Uses environment variables for YouTube stream key, width, height, FPS, bitrate, audio device if not specified.
+    Set --audio-device (env: AUDIO_DEVICE) to mux the microphone into the stream; silent audio otherwise.
+    Add --governor to trade x264 preset, fps and resolution for temperature before the Pi throttles,
+    and --stats-file /tmp/stream_stats.json to follow the stream (encoder speed, drops and bitrate,
+    governor decisions) live.
+    Add --frame-bus NAME to share frames and detections with local processes (see frame_bus.py).
+    Add --startup-report to see where the time to the first frame goes (see startup_timing.py).
+    Add --encoder-profile FILE to encode with settings measured on a clip (see encoder_tuner.py).
+    Add --memory-budget MB on a Pi 3 or Zero 2 W to size buffers to fit (see memory_budget.py).
+    Add --harvest-dir DIR to save crops of detected objects as a training dataset
+    (see crop_harvester.py).
+    Add --audio-analysis to publish microphone levels and sound events with the detections
+    (see audio_analyzer.py).
+    Send SIGUSR1 (or run sampling_profiler.py trigger) to profile the running stream
+    (see sampling_profiler.py).
 """
 
 import argparse
@@ -16,12 +30,45 @@ import subprocess
 from functools import lru_cache
 from typing import List, Optional
 
-import cv2
-import numpy as np
-
-from picamera2 import Picamera2
-from picamera2.devices import IMX500
-from picamera2.devices.imx500 import NetworkIntrinsics, postprocess_nanodet_detection
+from audio_analyzer import add_audio_analysis_arguments, analyzer_from_args
+from audio_capture import AudioCapture
+from crop_harvester import add_harvest_arguments, harvester_from_args
+from detection_sync import DetectionTimeline, add_sync_arguments, timeline_from_args
+from encoder_tuner import EncoderProfile, add_profile_arguments, profile_from_args
+from ffmpeg_progress import FfmpegProgress
+from frame_bus import FrameBusWriter, add_frame_bus_arguments, detection_records
+from local_preview import add_preview_arguments, preview_from_args
+from memory_budget import (
+    FrameBuffer,
+    MemoryMonitor,
+    MemoryPlan,
+    add_memory_arguments,
+    memory_plan_from_args,
+)
+from snapshot_server import add_snapshot_arguments, snapshots_from_args
+from nanodet_postprocess import add_nanodet_arguments, nanodet_postprocessor
+from sampling_profiler import add_profiler_arguments, profiler_from_args
+from startup_timing import (
+    add_startup_arguments,
+    lazy_import,
+    report_first_frame,
+    startup_timer,
+    warm_imports,
+)
+from stream_stats import StreamStats, add_stats_arguments
+from thermal_governor import QualityLevel, add_governor_arguments, governor_from_args
+
+# Imported on first use, so --help and --print-intrinsics skip OpenCV (and --help picamera2)
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+Picamera2 = lazy_import("picamera2", "Picamera2")
+MappedArray = lazy_import("picamera2", "MappedArray")
+IMX500 = lazy_import("picamera2.devices", "IMX500")
+NetworkIntrinsics = lazy_import("picamera2.devices.imx500", "NetworkIntrinsics")
+postprocess_nanodet_detection = lazy_import(
+    "picamera2.devices.imx500", "postprocess_nanodet_detection"
+)
+scale_boxes = lazy_import("picamera2.devices.imx500.postprocess", "scale_boxes")
 
 # --- Constants for default paths ---
 DEFAULT_MODEL_PATH = (
@@ -30,13 +77,20 @@ DEFAULT_MODEL_PATH = (
 DEFAULT_COCO_LABELS_PATH = "assets/coco_labels.txt"
 
 # --- Global variables ---
-last_detections: List["Detection"] = []
 last_results: Optional[List["Detection"]] = None
-picam2: Optional[Picamera2] = None
-imx500: Optional[IMX500] = None
-intrinsics: Optional[NetworkIntrinsics] = None
+picam2: Optional["Picamera2"] = None
+imx500: Optional["IMX500"] = None
+intrinsics: Optional["NetworkIntrinsics"] = None
 args_global: Optional[argparse.Namespace] = None
 ffmpeg_process = None
+ffmpeg_progress: Optional[FfmpegProgress] = None
+audio_capture: Optional[AudioCapture] = None
+frames_sent = 0
+frame_bus: Optional[FrameBusWriter] = None
+encoder_profile = EncoderProfile()
+detection_timeline: Optional[DetectionTimeline] = None
+memory_plan: Optional[MemoryPlan] = None
+frame_buffer = FrameBuffer()
 
 
 class Detection:
@@ -54,14 +108,15 @@ class Detection:
             )
 
 
-def parse_detections(metadata: dict) -> List["Detection"]:
-    global last_detections, intrinsics, args_global
+def parse_detections(metadata: dict) -> Optional[List["Detection"]]:
+    """Detections from this frame's output tensor; None if it carries none."""
+    global intrinsics, args_global
     if not intrinsics or not args_global:
         print(
             "Error: Intrinsics or args_global not initialized for parse_detections.",
             file=sys.stderr,
         )
-        return last_detections
+        return None
 
     bbox_normalization = intrinsics.bbox_normalization
     bbox_order = intrinsics.bbox_order
@@ -72,19 +127,24 @@ def parse_detections(metadata: dict) -> List["Detection"]:
     np_outputs = imx500.get_outputs(metadata, add_batch=True)
     input_w, input_h = imx500.get_input_size()
     if np_outputs is None:
-        return last_detections
+        return None
 
     current_detections: List[Detection] = []
-    if intrinsics.postprocess == "nanodet":
+    if (
+        intrinsics.postprocess == "nanodet"
+        and args_global.nanodet_engine == "picamera2"
+    ):
         boxes, scores, classes = postprocess_nanodet_detection(
             outputs=np_outputs[0],
             conf=threshold,
             iou_thres=iou,
             max_out_dets=max_detections,
         )[0]
-        from picamera2.devices.imx500.postprocess import scale_boxes
-
         boxes = scale_boxes(boxes, 1, 1, input_h, input_w, False, False)
+    elif intrinsics.postprocess == "nanodet":
+        boxes, scores, classes = nanodet_postprocessor(input_w)(
+            np_outputs[0], conf=threshold, iou_thres=iou, max_out_dets=max_detections
+        )
     else:
         boxes, scores, classes = np_outputs[0][0], np_outputs[1][0], np_outputs[2][0]
         if bbox_normalization:
@@ -103,7 +163,6 @@ def parse_detections(metadata: dict) -> List["Detection"]:
         )
         if score > threshold
     ]
-    last_detections = current_detections
     return current_detections
 
 
@@ -119,7 +178,7 @@ def get_labels() -> List[str]:
 
 
 def draw_detections_on_array(
-    array: np.ndarray,
+    array: "np.ndarray",
     detections_to_draw: Optional[List[Detection]],
     current_request_for_roi=None,
 ):
@@ -273,16 +332,53 @@ def get_args_yt_local():
         help=f"Stream height (env: VIDEO_HEIGHT, default: {script_default_height})",
     )
     parser.add_argument(
-        "--local-display", action="store_true", help="Show video locally as well"
+        "--audio-device",
+        type=str,
+        default=os.environ.get("AUDIO_DEVICE"),
+        help="ALSA capture device (e.g. hw:3,0) or a WAV file to stream as audio; silent audio if unset (env: AUDIO_DEVICE)",
     )
+    add_audio_analysis_arguments(parser)
+    add_preview_arguments(parser)
+    add_profile_arguments(parser)
+    add_sync_arguments(parser)
+    add_snapshot_arguments(parser)
+    add_harvest_arguments(parser)
+    add_governor_arguments(parser)
+    add_stats_arguments(parser)
+    add_frame_bus_arguments(parser)
+    add_nanodet_arguments(parser)
+    add_startup_arguments(parser)
+    add_memory_arguments(parser)
+    add_profiler_arguments(parser)
     args_global = parser.parse_args()
     return args_global
 
 
-def start_ffmpeg_stream(args_val):
-    """Start ffmpeg process for streaming to YouTube with silent audio and proper timestamps, using BGR format throughout."""
+def start_ffmpeg_stream(
+    args_val,
+    audio: Optional[AudioCapture] = None,
+    level: Optional[QualityLevel] = None,
+):
+    """Start ffmpeg process for streaming to YouTube with microphone (or silent) audio and proper timestamps, using BGR format throughout."""
+    global ffmpeg_progress
+    if level is None:
+        level = QualityLevel(
+            encoder_profile.preset, args_val.fps, args_val.width, args_val.height
+        )
+    audio_fd = audio.add_sink("youtube") if audio else None
+    if audio_fd is not None:
+        audio_input = audio.ffmpeg_input_args(audio_fd)  # Shared microphone capture
+    else:
+        audio_input = [
+            "-f",
+            "lavfi",
+            "-i",
+            "anullsrc=channel_layout=stereo:sample_rate=44100",  # Silent audio
+        ]
+    ffmpeg_progress = FfmpegProgress("youtube")
     ffmpeg_cmd = [
         "ffmpeg",
+        *ffmpeg_progress.ffmpeg_args(),  # Encoder health on a pipe, not stderr
         "-fflags",
         "+genpts",  # Generate presentation timestamps
         "-f",
@@ -290,29 +386,15 @@ def start_ffmpeg_stream(args_val):
         "-pix_fmt",
         "bgr24",  # Use BGR format throughout
         "-s",
-        f"{args_val.width}x{args_val.height}",
+        f"{level.width}x{level.height}",
         "-r",
-        str(args_val.fps),
+        str(level.fps),
         "-i",
         "-",  # Read video from stdin
-        "-f",
-        "lavfi",
-        "-i",
-        "anullsrc=channel_layout=stereo:sample_rate=44100",  # Silent audio
+        *audio_input,
         "-c:v",
         "libx264",
-        "-preset",
-        "veryfast",
-        "-tune",
-        "zerolatency",
-        "-b:v",
-        f"{args_val.bitrate}k",
-        "-maxrate",
-        f"{args_val.bitrate}k",
-        "-bufsize",
-        f"{2*args_val.bitrate}k",
-        "-g",
-        str(args_val.fps * 2),  # Keyframe interval (2 seconds)
+        *encoder_profile.ffmpeg_args(level.fps, args_val.bitrate, preset=level.preset),
         "-pix_fmt",
         "yuv420p",
         "-c:a",
@@ -326,15 +408,83 @@ def start_ffmpeg_stream(args_val):
         "flv",
         f"rtmp://a.rtmp.youtube.com/live2/{args_val.stream_key}",
     ]
-    return subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE)
+    pass_fds = ffmpeg_progress.pass_fds
+    if audio_fd is not None:
+        pass_fds += (audio_fd,)
+    process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE, pass_fds=pass_fds)
+    ffmpeg_progress.start()
+    if audio_fd is not None:
+        os.close(audio_fd)  # ffmpeg holds its own copy of the read end
+    return process
+
+
+def stop_ffmpeg_stream(process):
+    try:
+        process.stdin.close()
+    except IOError:
+        pass  # ffmpeg already exited
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def create_camera_config(width: int, height: int, fps: int):
+    return picam2.create_video_configuration(
+        main={
+            "size": (width, height),
+            "format": "RGB888",
+        },  # Output RGB
+        controls={"FrameRate": float(fps)},
+        buffer_count=memory_plan.camera_buffers,
+    )
+
+
+def apply_quality_level(args_val, level: QualityLevel, previous: QualityLevel):
+    """Restart the encoder (and the camera when the size changes) at a new level.
+
+    YouTube sees a short reconnect; that is far less visible than the frame rate
+    collapse of a throttled Pi.
+    """
+    global ffmpeg_process
+    stop_ffmpeg_stream(ffmpeg_process)
+    if (level.width, level.height) != (previous.width, previous.height):
+        picam2.stop()
+        picam2.configure(create_camera_config(level.width, level.height, level.fps))
+        picam2.start()
+    elif level.fps != previous.fps:
+        picam2.set_controls({"FrameRate": float(level.fps)})
+    ffmpeg_process = start_ffmpeg_stream(args_val, audio_capture, level)
+
+
+def start_sinks(args_val):
+    """Audio capture, the encoder and the frame bus; none of them waits on the camera."""
+    global ffmpeg_process, audio_capture, frame_bus
+    if args_val.audio_device:
+        audio_capture = AudioCapture(args_val.audio_device)
+    ffmpeg_process = start_ffmpeg_stream(args_val, audio_capture)
+    if args_val.frame_bus:
+        frame_bus = FrameBusWriter(
+            args_val.frame_bus,
+            args_val.width,
+            args_val.height,
+            slots=memory_plan.frame_bus_slots,
+        )
 
 
 def main():
-    global picam2, imx500, intrinsics, args_global, ffmpeg_process
+    global picam2, imx500, intrinsics, args_global, ffmpeg_process, audio_capture
+    global frames_sent, frame_bus, detection_timeline, encoder_profile, memory_plan
 
     args_val = get_args_yt_local()
+    profiler = profiler_from_args(args_val)
+    encoder_profile = profile_from_args(args_val)
+    memory_plan = memory_plan_from_args(args_val, camera_buffers=10)
 
-    imx500 = IMX500(args_val.model)
+    with startup_timer.phase("imx500 network load"):
+        imx500 = IMX500(args_val.model)
     intrinsics = imx500.network_intrinsics
     if not intrinsics:
         intrinsics = NetworkIntrinsics()
@@ -375,50 +525,132 @@ def main():
         print(intrinsics)
         sys.exit(0)
 
-    picam2 = Picamera2(imx500.camera_num)
-    video_config = picam2.create_video_configuration(
-        main={
-            "size": (args_val.width, args_val.height),
-            "format": "RGB888",
-        },  # Output RGB
-        controls={"FrameRate": float(args_val.fps)},
-        buffer_count=10,
-    )
-    picam2.configure(video_config)
+    # The encoder, audio and OpenCV come up while the network firmware uploads
+    sinks = startup_timer.background("encoder and sinks", start_sinks, args_val)
+    overlays = startup_timer.background("overlay modules", warm_imports, cv2)
+
+    with startup_timer.phase("camera configure"):
+        picam2 = Picamera2(imx500.camera_num)
+        picam2.configure(
+            create_camera_config(args_val.width, args_val.height, args_val.fps)
+        )
 
-    # Start ffmpeg process
-    ffmpeg_process = start_ffmpeg_stream(args_val)
+    imx500.show_network_fw_progress_bar()
+    with startup_timer.phase("camera start (firmware upload)"):
+        picam2.start()
+    sinks.result()
+    overlays.result()
     if not ffmpeg_process:
         print("Error: Failed to start ffmpeg process", file=sys.stderr)
         sys.exit(1)
-
-    imx500.show_network_fw_progress_bar()
-    picam2.start()
     print("Picamera2 started. Streaming to YouTube Live")
     if intrinsics.preserve_aspect_ratio:
         imx500.set_auto_aspect_ratio()
 
+    audio_analyzer = analyzer_from_args(args_val, audio_capture)
+    if audio_capture:
+        audio_capture.start()
+        audio_capture.start_clock()  # Audio time zero is the first video frame
+        print(f"Streaming audio from {args_val.audio_device}")
+
+    governor = (
+        governor_from_args(args_val, encoder_profile.preset)
+        if args_val.governor
+        else None
+    )
+    preview = preview_from_args(args_val)
+    stream_stats = StreamStats(args_val.stats_file, args_val.stats_interval)
+    stream_stats.add_source("video", lambda: {"frames_sent": frames_sent})
+    # Looked up on every call: a governor step restarts ffmpeg with a new reader
+    stream_stats.add_source("encoder", lambda: ffmpeg_progress.stats())
+    stream_stats.add_source("startup", startup_timer.stats)
+    stream_stats.add_source("profiler", profiler.stats)
+    detection_timeline = timeline_from_args(args_val)
+    stream_stats.add_source("detection_sync", detection_timeline.stats)
+    if audio_capture:
+        stream_stats.add_source("audio", audio_capture.stats)
+    if audio_analyzer:
+        stream_stats.add_source("audio_analysis", audio_analyzer.stats)
+    if frame_bus:
+        stream_stats.add_source("frame_bus", frame_bus.stats)
+        print(f"Publishing frames to frame bus '{args_val.frame_bus}'")
+    if preview:
+        stream_stats.add_source("preview", preview.stats)
+    snapshots = snapshots_from_args(args_val, draw=draw_detections_on_array)
+    if snapshots:
+        stream_stats.add_source("snapshots", snapshots.stats)
+    harvester = harvester_from_args(args_val, get_labels())
+    if harvester:
+        stream_stats.add_source("harvester", harvester.stats)
+    if governor:
+        stream_stats.add_source("governor", governor.stats)
+        governor.add_pressure_source(lambda: ffmpeg_progress.pressure())
+        print(f"Quality governor on, starting at {governor.level}")
+    memory = MemoryMonitor(args_val.memory_budget, memory_plan)
+    # Looked up on every sample: a governor step restarts ffmpeg
+    memory.add_process(
+        "encoder", lambda: ffmpeg_process.pid if ffmpeg_process else None
+    )
+    if audio_capture:
+        memory.add_process("audio", lambda: audio_capture.source_pid)
+    memory.add_buffer("capture_frame", lambda: frame_buffer.nbytes)
+    if frame_bus:
+        memory.add_buffer("frame_bus", lambda: frame_bus.nbytes)
+    stream_stats.add_source("memory", memory.stats)
+
     try:
         while True:
+            if governor:
+                previous = governor.level
+                level = governor.update()
+                if level:
+                    print(
+                        f"Quality governor: {previous} -> {level} ({governor.decisions[-1]['reason']})"
+                    )
+                    apply_quality_level(args_val, level, previous)
+            stream_stats.maybe_publish()
+
             request = picam2.capture_request()
             try:
-                metadata = request.get_metadata()
+                metadata = request.get_metadata() or {}
+                timestamp = metadata.get("SensorTimestamp", 0)
                 if metadata:
-                    last_results = parse_detections(metadata)
-
-                frame_array_bgr = request.make_array("main")
+                    parsed = parse_detections(metadata)
+                    if parsed is not None:
+                        detection_timeline.publish(timestamp, parsed)
+                # This frame's detections, or recent ones if it carried no output tensor
+                last_results = detection_timeline.for_frame(timestamp)
+
+                # One reused array instead of a new one per request
+                with MappedArray(request, "main") as m:
+                    frame_array_bgr = frame_buffer.copy_from(m.array)
+                if frame_bus:
+                    # Clean frame (no overlays) plus detections for local readers
+                    metadata = {
+                        "detections": detection_records(last_results, get_labels())
+                    }
+                    if audio_analyzer:
+                        metadata["audio"] = audio_analyzer.snapshot()
+                    frame_bus.publish(frame_array_bgr, metadata, timestamp)
+                if snapshots:
+                    snapshots.offer(frame_array_bgr, last_results)  # Copies on demand
+                if harvester:
+                    # Copies the crops it keeps
+                    harvester.offer(frame_array_bgr, last_results)
                 frame_with_overlays_bgr = draw_detections_on_array(
                     frame_array_bgr, last_results, request
                 )
 
-                if args_val.local_display:
-                    cv2.imshow("Local Preview", frame_with_overlays_bgr)
-                    if cv2.waitKey(1) & 0xFF == ord("q"):
+                if preview:
+                    preview.offer(frame_with_overlays_bgr)  # Downscaled, never blocks
+                    if preview.quit_requested:
                         break
 
                 # Write BGR frame directly to ffmpeg process
                 try:
-                    ffmpeg_process.stdin.write(frame_with_overlays_bgr.tobytes())
+                    ffmpeg_process.stdin.write(frame_with_overlays_bgr)
+                    frames_sent += 1
+                    report_first_frame(args_val)
                 except IOError as e:
                     print(f"Error writing to ffmpeg: {e}", file=sys.stderr)
                     break
@@ -434,13 +666,33 @@ def main():
         traceback.print_exc()
     finally:
         print("Cleaning up resources...")
-        if args_val.local_display:
-            cv2.destroyAllWindows()
+        profiler.stop()
+        if preview:
+            preview.close()
+            print(f"Local preview stats: {preview.stats()}")
+        if snapshots:
+            snapshots.close()
+            print(f"Snapshot stats: {snapshots.stats()}")
+        if harvester:
+            harvester.close()
+            print(f"Crop harvester stats: {harvester.stats()}")
+        if audio_capture:
+            print("Stopping audio capture...")
+            audio_capture.stop()
+            print(f"Audio stats: {audio_capture.stats()}")
+        if audio_analyzer:
+            audio_analyzer.close()
+            print(f"Audio analysis stats: {audio_analyzer.stats()}")
         if ffmpeg_process:
             print("Stopping ffmpeg process...")
-            ffmpeg_process.stdin.close()
-            ffmpeg_process.terminate()
-            ffmpeg_process.wait()
+            stop_ffmpeg_stream(ffmpeg_process)
+            print(f"Encoder stats: {ffmpeg_progress.stats()}")
+        if detection_timeline:
+            print(f"Detection sync: {detection_timeline.describe()}")
+        print(f"Memory stats: {memory.stats()}")
+        stream_stats.publish()
+        if frame_bus:
+            frame_bus.close(unlink=True)
         if picam2 and picam2.started:
             print("Stopping Picamera2...")
             picam2.stop()
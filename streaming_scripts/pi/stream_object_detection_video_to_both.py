@@ -6,36 +6,103 @@ and streams the output to both YouTube Live (RTMP) and a remote PC (UDP) using f
 
 Usage:
     python stream_obj_det_to_both.py --model /path/to/model.rpk --stream-key your-youtube-stream-key --remote-ip 192.168.1.100 --remote-port 5000
-    Uses environment variables for YouTube stream key, remote IP/port, width, height, FPS, bitrate if not specified.
+    Uses environment variables for YouTube stream key, remote IP/port, width, height, FPS, bitrate, audio device if not specified.
+    Set --audio-device (env: AUDIO_DEVICE) to capture the microphone once and send it as AAC to YouTube
+    and as Opus RTP to the remote PC (--audio-port, env: AUDIO_UDP_PORT); silent audio to YouTube otherwise.
+    Add --fec (and usually --intra-refresh) on lossy Wi-Fi; receive with pc/rtp_fec_receiver.py.
+    Use --cpu-layout isolated (or ros, to leave core 0 to ROS) to pin capture and encoders to their own cores.
+    Add --frame-bus NAME to share frames and detections with local processes (see frame_bus.py).
+    Add --stats-file /tmp/stream_stats.json to follow both encoders (speed, drops, bitrate) live.
+    Add --startup-report to see where the time to the first frame goes (see startup_timing.py).
+    Add --web-port 8082 to watch the PC stream in a browser, detections included (see web_viewer.py).
+    Add --encoder-profile FILE to encode with settings measured on a clip (see encoder_tuner.py).
+    Add --memory-budget MB on a Pi 3 or Zero 2 W to size buffers to fit; a tight budget encodes
+    once for both sinks (see memory_budget.py).
+    Add --auto-framing isp (or array) to stream a smaller frame that follows the detections
+    (see auto_framing.py).
+    Add --harvest-dir DIR to save crops of detected objects as a training dataset
+    (see crop_harvester.py).
+    Add --audio-analysis to publish microphone levels and sound events with the detections
+    (see audio_analyzer.py).
+    Send SIGUSR1 (or run sampling_profiler.py trigger) to profile the running stream
+    (see sampling_profiler.py).
 """
 
 import argparse
 import sys
 import os
 import subprocess
+import threading
 from functools import lru_cache
 from typing import List, Optional
 
-import cv2
-import numpy as np
-
-from picamera2 import Picamera2
-from picamera2.devices import IMX500
-from picamera2.devices.imx500 import NetworkIntrinsics, postprocess_nanodet_detection
+from audio_analyzer import add_audio_analysis_arguments, analyzer_from_args
+from audio_capture import AudioCapture
+from auto_framing import AutoFramer, add_framing_arguments, framer_from_args
+from cpu_affinity import CpuLayout, add_affinity_arguments, layout_from_args
+from crop_harvester import add_harvest_arguments, harvester_from_args
+from detection_sync import DetectionTimeline, add_sync_arguments, timeline_from_args
+from encoder_tuner import EncoderProfile, add_profile_arguments, profile_from_args
+from ffmpeg_progress import FfmpegProgress
+from frame_bus import FrameBusWriter, add_frame_bus_arguments, detection_records
+from local_preview import add_preview_arguments, preview_from_args
+from memory_budget import (
+    FrameBuffer,
+    MemoryMonitor,
+    MemoryPlan,
+    add_memory_arguments,
+    memory_plan_from_args,
+)
+from snapshot_server import add_snapshot_arguments, snapshots_from_args
+from nanodet_postprocess import add_nanodet_arguments, nanodet_postprocessor
+from rtp_fec import ProtectedRtpTransport, add_fec_arguments, transport_from_args
+from rtp_h264 import H264RtpPacketizer, pump_annexb
+from sampling_profiler import add_profiler_arguments, profiler_from_args
+from startup_timing import (
+    add_startup_arguments,
+    lazy_import,
+    report_first_frame,
+    startup_timer,
+    warm_imports,
+)
+from stream_stats import StreamStats, add_stats_arguments
+from web_viewer import WebViewer, add_web_viewer_arguments, web_viewer_from_args
+
+# Imported on first use, so --help and --print-intrinsics skip OpenCV (and --help picamera2)
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+Picamera2 = lazy_import("picamera2", "Picamera2")
+MappedArray = lazy_import("picamera2", "MappedArray")
+IMX500 = lazy_import("picamera2.devices", "IMX500")
+NetworkIntrinsics = lazy_import("picamera2.devices.imx500", "NetworkIntrinsics")
+postprocess_nanodet_detection = lazy_import(
+    "picamera2.devices.imx500", "postprocess_nanodet_detection"
+)
+scale_boxes = lazy_import("picamera2.devices.imx500.postprocess", "scale_boxes")
 
 DEFAULT_MODEL_PATH = (
     "/usr/share/imx500-models/imx500_network_ssd_mobilenetv2_fpnlite_320x320_pp.rpk"
 )
 DEFAULT_COCO_LABELS_PATH = "assets/coco_labels.txt"
 
-last_detections: List["Detection"] = []
-last_results: Optional[List["Detection"]] = None
-picam2: Optional[Picamera2] = None
-imx500: Optional[IMX500] = None
-intrinsics: Optional[NetworkIntrinsics] = None
+picam2: Optional["Picamera2"] = None
+imx500: Optional["IMX500"] = None
+intrinsics: Optional["NetworkIntrinsics"] = None
 args_global: Optional[argparse.Namespace] = None
 ffmpeg_yt_process = None
 ffmpeg_pc_process = None
+yt_progress: Optional[FfmpegProgress] = None
+pc_progress: Optional[FfmpegProgress] = None
+audio_capture: Optional[AudioCapture] = None
+pc_transport: Optional[ProtectedRtpTransport] = None
+cpu_layout: Optional[CpuLayout] = None
+frame_bus: Optional[FrameBusWriter] = None
+encoder_profile = EncoderProfile()
+detection_timeline: Optional[DetectionTimeline] = None
+web_viewer: Optional[WebViewer] = None
+memory_plan: Optional[MemoryPlan] = None
+frame_buffer = FrameBuffer()
+framer: Optional[AutoFramer] = None
 
 
 class Detection:
@@ -43,6 +110,7 @@ class Detection:
         global picam2, imx500
         self.category = category
         self.conf = conf
+        self.coords = coords  # Normalized to the whole sensor, for auto framing
         if picam2 and imx500:
             self.box = imx500.convert_inference_coords(coords, metadata, picam2)
         else:
@@ -53,14 +121,15 @@ class Detection:
             )
 
 
-def parse_detections(metadata: dict) -> List["Detection"]:
-    global last_detections, intrinsics, args_global
+def parse_detections(metadata: dict) -> Optional[List["Detection"]]:
+    """Detections from this frame's output tensor; None if it carries none."""
+    global intrinsics, args_global
     if not intrinsics or not args_global:
         print(
             "Error: Intrinsics or args_global not initialized for parse_detections.",
             file=sys.stderr,
         )
-        return last_detections
+        return None
 
     bbox_normalization = intrinsics.bbox_normalization
     bbox_order = intrinsics.bbox_order
@@ -71,19 +140,24 @@ def parse_detections(metadata: dict) -> List["Detection"]:
     np_outputs = imx500.get_outputs(metadata, add_batch=True)
     input_w, input_h = imx500.get_input_size()
     if np_outputs is None:
-        return last_detections
+        return None
 
     current_detections: List[Detection] = []
-    if intrinsics.postprocess == "nanodet":
+    if (
+        intrinsics.postprocess == "nanodet"
+        and args_global.nanodet_engine == "picamera2"
+    ):
         boxes, scores, classes = postprocess_nanodet_detection(
             outputs=np_outputs[0],
             conf=threshold,
             iou_thres=iou,
             max_out_dets=max_detections,
         )[0]
-        from picamera2.devices.imx500.postprocess import scale_boxes
-
         boxes = scale_boxes(boxes, 1, 1, input_h, input_w, False, False)
+    elif intrinsics.postprocess == "nanodet":
+        boxes, scores, classes = nanodet_postprocessor(input_w)(
+            np_outputs[0], conf=threshold, iou_thres=iou, max_out_dets=max_detections
+        )
     else:
         boxes, scores, classes = np_outputs[0][0], np_outputs[1][0], np_outputs[2][0]
         if bbox_normalization:
@@ -102,7 +176,6 @@ def parse_detections(metadata: dict) -> List["Detection"]:
         )
         if score > threshold
     ]
-    last_detections = current_detections
     return current_detections
 
 
@@ -118,7 +191,7 @@ def get_labels() -> List[str]:
 
 
 def draw_detections_on_array(
-    array: np.ndarray,
+    array: "np.ndarray",
     detections_to_draw: Optional[List[Detection]],
     current_request_for_roi=None,
 ):
@@ -278,7 +351,17 @@ def get_args_both():
         default=default_remote_ip,
         help="Remote PC IP address (env: REMOTE_PC_IP)",
     )
-    default_remote_port = int(os.environ.get("VIDEO_UDP_PORT", 5000))
+    script_default_remote_port = 5000
+    env_remote_port_str = os.environ.get("VIDEO_UDP_PORT")
+    default_remote_port = script_default_remote_port
+    if env_remote_port_str:
+        try:
+            default_remote_port = int(env_remote_port_str)
+        except ValueError:
+            print(
+                f"Warning: Invalid VIDEO_UDP_PORT. Using default {script_default_remote_port}.",
+                file=sys.stderr,
+            )
     parser.add_argument(
         "--remote-port",
         type=int,
@@ -286,15 +369,70 @@ def get_args_both():
         help="Remote PC UDP port (env: VIDEO_UDP_PORT)",
     )
     parser.add_argument(
-        "--local-display", action="store_true", help="Show video locally as well"
+        "--audio-device",
+        type=str,
+        default=os.environ.get("AUDIO_DEVICE"),
+        help="ALSA capture device (e.g. hw:3,0) or a WAV file to stream as audio; silent audio if unset (env: AUDIO_DEVICE)",
+    )
+    script_default_audio_port = 5002
+    env_audio_port_str = os.environ.get("AUDIO_UDP_PORT")
+    default_audio_port = script_default_audio_port
+    if env_audio_port_str:
+        try:
+            default_audio_port = int(env_audio_port_str)
+        except ValueError:
+            print(
+                f"Warning: Invalid AUDIO_UDP_PORT. Using default {script_default_audio_port}.",
+                file=sys.stderr,
+            )
+    parser.add_argument(
+        "--audio-port",
+        type=int,
+        default=default_audio_port,
+        help="Remote PC UDP port for Opus RTP audio (env: AUDIO_UDP_PORT)",
+    )
+    add_fec_arguments(parser)
+    parser.add_argument(
+        "--intra-refresh",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Refresh the PC stream with a moving intra column instead of full keyframes",
     )
+    add_affinity_arguments(parser)
+    add_frame_bus_arguments(parser)
+    add_nanodet_arguments(parser)
+    add_stats_arguments(parser)
+    add_startup_arguments(parser)
+    add_memory_arguments(parser)
+    add_framing_arguments(parser)
+    add_profiler_arguments(parser)
+    add_audio_analysis_arguments(parser)
+    add_preview_arguments(parser)
+    add_profile_arguments(parser)
+    add_sync_arguments(parser)
+    add_snapshot_arguments(parser)
+    add_harvest_arguments(parser)
+    add_web_viewer_arguments(parser)
     args_global = parser.parse_args()
     return args_global
 
 
-def start_ffmpeg_yt(args_val):
+def start_ffmpeg_yt(args_val, audio: Optional[AudioCapture] = None):
+    global yt_progress
+    yt_progress = FfmpegProgress("youtube")
+    audio_fd = audio.add_sink("youtube") if audio else None
+    if audio_fd is not None:
+        audio_input = audio.ffmpeg_input_args(audio_fd)
+    else:
+        audio_input = [
+            "-f",
+            "lavfi",
+            "-i",
+            "anullsrc=channel_layout=stereo:sample_rate=44100",
+        ]
     ffmpeg_cmd = [
         "ffmpeg",
+        *yt_progress.ffmpeg_args(),
         "-fflags",
         "+genpts",
         "-f",
@@ -307,24 +445,12 @@ def start_ffmpeg_yt(args_val):
         str(args_val.fps),
         "-i",
         "-",
-        "-f",
-        "lavfi",
-        "-i",
-        "anullsrc=channel_layout=stereo:sample_rate=44100",
+        *audio_input,
         "-c:v",
         "libx264",
-        "-preset",
-        "veryfast",
-        "-tune",
-        "zerolatency",
-        "-b:v",
-        f"{args_val.bitrate}k",
-        "-maxrate",
-        f"{args_val.bitrate}k",
-        "-bufsize",
-        f"{2*args_val.bitrate}k",
-        "-g",
-        str(args_val.fps * 2),
+        *encoder_profile.ffmpeg_args(
+            args_val.fps, args_val.bitrate, threads=cpu_layout.x264_args("encoder-yt")
+        ),
         "-pix_fmt",
         "yuv420p",
         "-c:a",
@@ -338,12 +464,118 @@ def start_ffmpeg_yt(args_val):
         "flv",
         f"rtmp://a.rtmp.youtube.com/live2/{args_val.stream_key}",
     ]
-    return subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE)
+    process = popen_with_audio(ffmpeg_cmd, audio_fd, yt_progress)
+    cpu_layout.apply_to_process("encoder-yt", process.pid)
+    return process
+
+
+def start_ffmpeg_pc(args_val, audio: Optional[AudioCapture] = None):
+    global pc_progress
+    pc_progress = FfmpegProgress("pc")
+    audio_fd = audio.add_sink("pc") if audio else None
+    audio_input = audio.ffmpeg_input_args(audio_fd) if audio_fd is not None else []
+    ffmpeg_cmd = [
+        "ffmpeg",
+        *pc_progress.ffmpeg_args(),
+        "-fflags",
+        "+genpts",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "bgr24",
+        "-s",
+        f"{args_val.width}x{args_val.height}",
+        "-r",
+        str(args_val.fps),
+        "-i",
+        "-",
+        *audio_input,
+        "-map",
+        "0:v",
+        "-c:v",
+        "libx264",
+        *encoder_profile.ffmpeg_args(
+            args_val.fps, args_val.bitrate, threads=cpu_layout.x264_args("encoder-pc")
+        ),
+        "-pix_fmt",
+        "yuv420p",
+    ]
+    if args_val.intra_refresh:
+        # Spread intra coding over the GOP so a loss heals without keyframe bursts
+        ffmpeg_cmd += ["-intra-refresh", "1"]
+    if args_val.fec:
+        # Raw H.264 on stdout; rtp_fec packetizes, protects and paces it
+        ffmpeg_cmd += ["-f", "h264", "pipe:1"]
+    elif web_viewer:
+        # One encode, two muxers: RTP to the PC as before, raw H.264 for browsers
+        ffmpeg_cmd += [
+            "-f",
+            "tee",
+            f"[f=rtp]rtp://{args_val.remote_ip}:{args_val.remote_port}|[f=h264]pipe:1",
+        ]
+    else:
+        ffmpeg_cmd += [
+            "-f",
+            "rtp",
+            f"rtp://{args_val.remote_ip}:{args_val.remote_port}",
+        ]
+    if audio_fd is not None:
+        # The RTP muxer carries one stream, so Opus goes out as a second output
+        # with the caps open_audio_stream.sh expects (48 kHz, payload 96)
+        ffmpeg_cmd += [
+            "-map",
+            "1:a",
+            "-c:a",
+            "libopus",
+            "-b:a",
+            "32k",
+            "-application",
+            "voip",
+            "-ar",
+            "48000",
+            "-payload_type",
+            "96",
+            "-f",
+            "rtp",
+            f"rtp://{args_val.remote_ip}:{args_val.audio_port}",
+        ]
+    process = popen_with_audio(
+        ffmpeg_cmd,
+        audio_fd,
+        pc_progress,
+        stdout=subprocess.PIPE if args_val.fec or web_viewer else None,
+    )
+    cpu_layout.apply_to_process("encoder-pc", process.pid)
+    return process
 
 
-def start_ffmpeg_pc(args_val):
+def start_ffmpeg_shared(args_val, audio: Optional[AudioCapture] = None):
+    """One encoder for both sinks: the tee muxer sends the same H.264 to YouTube and the PC."""
+    global yt_progress
+    yt_progress = FfmpegProgress("shared")
+    audio_fd = audio.add_sink("shared") if audio else None
+    if audio_fd is not None:
+        audio_input = audio.ffmpeg_input_args(audio_fd)
+    else:
+        audio_input = [
+            "-f",
+            "lavfi",
+            "-i",
+            "anullsrc=channel_layout=stereo:sample_rate=44100",
+        ]
+    # FLV needs SPS/PPS out of band; dump_extra puts them back in front of the
+    # keyframes for the PC, which joins mid-stream like it did with its own encoder
+    pc_rtp = f"[f=rtp:select=v:bsfs/v=dump_extra:onfail=ignore]rtp://{args_val.remote_ip}:{args_val.remote_port}"
+    pc_h264 = "[f=h264:select=v:bsfs/v=dump_extra]pipe:1"
+    if args_val.fec:
+        pc_slaves = pc_h264  # rtp_fec packetizes, protects and paces it
+    elif web_viewer:
+        pc_slaves = f"{pc_rtp}|{pc_h264}"
+    else:
+        pc_slaves = pc_rtp
     ffmpeg_cmd = [
         "ffmpeg",
+        *yt_progress.ffmpeg_args(),
         "-fflags",
         "+genpts",
         "-f",
@@ -356,35 +588,146 @@ def start_ffmpeg_pc(args_val):
         str(args_val.fps),
         "-i",
         "-",
+        *audio_input,
+        "-map",
+        "0:v",
+        "-map",
+        "1:a",
         "-c:v",
         "libx264",
-        "-preset",
-        "veryfast",
-        "-tune",
-        "zerolatency",
-        "-b:v",
-        f"{args_val.bitrate}k",
-        "-maxrate",
-        f"{args_val.bitrate}k",
-        "-bufsize",
-        f"{2*args_val.bitrate}k",
-        "-g",
-        str(args_val.fps * 2),
+        *encoder_profile.ffmpeg_args(
+            args_val.fps, args_val.bitrate, threads=cpu_layout.x264_args("encoder-yt")
+        ),
         "-pix_fmt",
         "yuv420p",
+        "-flags",
+        "+global_header",
+        "-c:a",
+        "aac",
+        "-b:a",
+        "128k",
+        "-ar",
+        "44100",
+        "-shortest",
         "-f",
-        "rtp",
-        f"rtp://{args_val.remote_ip}:{args_val.remote_port}",
+        "tee",
+        f"[f=flv:onfail=ignore]rtmp://a.rtmp.youtube.com/live2/{args_val.stream_key}|{pc_slaves}",
     ]
-    return subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE)
+    if audio_fd is not None:
+        # Opus for the PC from the same capture, as start_ffmpeg_pc sends it
+        ffmpeg_cmd += [
+            "-map",
+            "1:a",
+            "-c:a",
+            "libopus",
+            "-b:a",
+            "32k",
+            "-application",
+            "voip",
+            "-ar",
+            "48000",
+            "-payload_type",
+            "96",
+            "-f",
+            "rtp",
+            f"rtp://{args_val.remote_ip}:{args_val.audio_port}",
+        ]
+    process = popen_with_audio(
+        ffmpeg_cmd,
+        audio_fd,
+        yt_progress,
+        stdout=subprocess.PIPE if args_val.fec or web_viewer else None,
+    )
+    cpu_layout.apply_to_process("encoder-yt", process.pid)
+    return process
+
+
+def popen_with_audio(
+    ffmpeg_cmd, audio_fd: Optional[int], progress: FfmpegProgress, stdout=None
+):
+    """Start ffmpeg with video on stdin and the progress pipe (and shared audio pipe) inherited."""
+    pass_fds = progress.pass_fds
+    if audio_fd is not None:
+        pass_fds += (audio_fd,)
+    process = subprocess.Popen(
+        ffmpeg_cmd, stdin=subprocess.PIPE, stdout=stdout, pass_fds=pass_fds
+    )
+    progress.start()
+    if audio_fd is not None:
+        os.close(audio_fd)  # ffmpeg holds its own copy of the read end
+    return process
+
+
+def start_pc_pump(args_val, ffmpeg_process) -> Optional[ProtectedRtpTransport]:
+    """Read the PC encoder's H.264 in a background thread: FEC-protected RTP, browsers or both."""
+    transport = None
+    if args_val.fec:
+        transport = transport_from_args(
+            args_val.remote_ip, args_val.remote_port, args_val
+        )
+    threading.Thread(
+        target=pump_annexb,
+        args=(
+            ffmpeg_process.stdout,
+            H264RtpPacketizer() if transport else None,
+            transport,
+            args_val.fps,
+        ),
+        kwargs={"on_access_unit": web_viewer.push_access_unit if web_viewer else None},
+        name="pc-rtp-fec" if transport else "pc-web-viewer",
+        daemon=True,
+    ).start()
+    return transport
+
+
+def start_sinks(args_val):
+    """Audio capture, both encoders and the frame bus; none of them waits on the camera."""
+    global ffmpeg_yt_process, ffmpeg_pc_process, audio_capture, pc_transport, frame_bus
+    global pc_progress
+    if args_val.audio_device:
+        audio_capture = AudioCapture(args_val.audio_device)
+    if args_val.frame_bus:
+        # The whole camera frame, also when the encoders get a framed crop of it
+        width, height = (
+            framer.camera_size if framer else (args_val.width, args_val.height)
+        )
+        frame_bus = FrameBusWriter(
+            args_val.frame_bus, width, height, slots=memory_plan.frame_bus_slots
+        )
+        print(f"Publishing frames to frame bus '{args_val.frame_bus}'")
+
+    if memory_plan.shared_encoder:
+        ffmpeg_yt_process = ffmpeg_pc_process = start_ffmpeg_shared(
+            args_val, audio_capture
+        )
+        pc_progress = yt_progress
+        print("One encoder for YouTube and the PC (memory budget)")
+    else:
+        ffmpeg_yt_process = start_ffmpeg_yt(args_val, audio_capture)
+        ffmpeg_pc_process = start_ffmpeg_pc(args_val, audio_capture)
+    if ffmpeg_pc_process and (args_val.fec or web_viewer):
+        pc_transport = start_pc_pump(args_val, ffmpeg_pc_process)
 
 
 def main():
-    global picam2, imx500, intrinsics, args_global, ffmpeg_yt_process, ffmpeg_pc_process
+    global picam2, imx500, intrinsics, args_global, ffmpeg_yt_process, ffmpeg_pc_process, audio_capture, pc_transport, cpu_layout, frame_bus, web_viewer, detection_timeline
+    global framer
+    global encoder_profile, memory_plan
 
     args_val = get_args_both()
+    profiler = profiler_from_args(args_val)
+    encoder_profile = profile_from_args(args_val)
+    cpu_layout = layout_from_args(args_val)
+    # Intra refresh suits the PC but leaves YouTube without keyframes, so it keeps two encoders
+    memory_plan = memory_plan_from_args(
+        args_val,
+        camera_buffers=10,
+        encoders=2,
+        can_share_encoder=not args_val.intra_refresh,
+    )
 
-    imx500 = IMX500(args_val.model)
+    with startup_timer.phase("imx500 network load"):
+        imx500 = IMX500(args_val.model)
     intrinsics = imx500.network_intrinsics
     if not intrinsics:
         intrinsics = NetworkIntrinsics()
@@ -425,53 +768,175 @@ def main():
         print(intrinsics)
         sys.exit(0)
 
-    picam2 = Picamera2(imx500.camera_num)
-    video_config = picam2.create_video_configuration(
-        main={"size": (args_val.width, args_val.height), "format": "RGB888"},
-        controls={"FrameRate": float(args_val.fps)},
-        buffer_count=10,
-    )
-    picam2.configure(video_config)
+    framer = framer_from_args(args_val, get_labels())
+    camera_size = framer.camera_size if framer else (args_val.width, args_val.height)
+    if framer:
+        # From here on the stream size and bitrate are the framed ones
+        args_val.width, args_val.height = framer.output_size
+        args_val.bitrate = framer.bitrate
+        print(f"Auto framing: {framer.describe()}, {args_val.bitrate} kbps")
 
-    ffmpeg_yt_process = start_ffmpeg_yt(args_val)
-    ffmpeg_pc_process = start_ffmpeg_pc(args_val)
+    web_viewer = web_viewer_from_args(args_val, gop_cache=memory_plan.gop_cache)
+    if web_viewer and args_val.intra_refresh:
+        print(
+            "Warning: with --intra-refresh only the first frame is a keyframe; "
+            "browsers that connect later cannot start playing.",
+            file=sys.stderr,
+        )
+
+    # The encoders, audio and OpenCV come up while the network firmware uploads
+    sinks = startup_timer.background("encoders and sinks", start_sinks, args_val)
+    overlays = startup_timer.background("overlay modules", warm_imports, cv2)
+
+    with startup_timer.phase("camera configure"):
+        picam2 = Picamera2(imx500.camera_num)
+        video_config = picam2.create_video_configuration(
+            main={"size": camera_size, "format": "RGB888"},
+            controls={"FrameRate": float(args_val.fps)},
+            buffer_count=memory_plan.camera_buffers,
+        )
+        picam2.configure(video_config)
+        if framer and framer.mode == "isp":
+            framer.set_field(picam2.camera_properties["ScalerCropMaximum"])
+
+    imx500.show_network_fw_progress_bar()
+    with startup_timer.phase("camera start (firmware upload)"):
+        picam2.start()
+    sinks.result()
+    overlays.result()
     if not ffmpeg_yt_process or not ffmpeg_pc_process:
         print("Error: Failed to start ffmpeg process(es)", file=sys.stderr)
         sys.exit(1)
-
-    imx500.show_network_fw_progress_bar()
-    picam2.start()
     print(
         f"Picamera2 started. Streaming to YouTube Live and {args_val.remote_ip}:{args_val.remote_port}"
     )
     if intrinsics.preserve_aspect_ratio:
         imx500.set_auto_aspect_ratio()
 
+    audio_analyzer = analyzer_from_args(args_val, audio_capture)
+    if audio_capture:
+        audio_capture.start()
+        audio_capture.start_clock()  # Audio time zero is the first video frame
+        print(
+            f"Streaming audio from {args_val.audio_device} to YouTube Live and {args_val.remote_ip}:{args_val.audio_port}"
+        )
+        if audio_capture.source_pid:
+            cpu_layout.apply_to_process("audio", audio_capture.source_pid)
+
+    # The encoders were placed when they started; now the Python threads
+    cpu_layout.apply_to_current_thread("capture")
+    cpu_layout.apply_to_named_threads()
+    print(f"CPU layout: {cpu_layout.describe()}")
+
+    stream_stats = StreamStats(args_val.stats_file, args_val.stats_interval)
+    stream_stats.add_source("encoder_youtube", yt_progress.stats)
+    shared_encoder = ffmpeg_pc_process is ffmpeg_yt_process
+    if not shared_encoder:
+        stream_stats.add_source("encoder_pc", pc_progress.stats)
+    stream_stats.add_source("startup", startup_timer.stats)
+    stream_stats.add_source("profiler", profiler.stats)
+    detection_timeline = timeline_from_args(args_val)
+    stream_stats.add_source("detection_sync", detection_timeline.stats)
+    if audio_capture:
+        stream_stats.add_source("audio", audio_capture.stats)
+    if audio_analyzer:
+        stream_stats.add_source("audio_analysis", audio_analyzer.stats)
+    if pc_transport:
+        stream_stats.add_source("pc_rtp", pc_transport.stats)
+    if frame_bus:
+        stream_stats.add_source("frame_bus", frame_bus.stats)
+    preview = preview_from_args(args_val)
+    if preview:
+        stream_stats.add_source("preview", preview.stats)
+    snapshots = snapshots_from_args(args_val, draw=draw_detections_on_array)
+    if snapshots:
+        stream_stats.add_source("snapshots", snapshots.stats)
+    harvester = harvester_from_args(args_val, get_labels())
+    if harvester:
+        stream_stats.add_source("harvester", harvester.stats)
+    if web_viewer:
+        stream_stats.add_source("web_viewer", web_viewer.stats)
+    if framer:
+        stream_stats.add_source("framing", framer.stats)
+    memory = MemoryMonitor(args_val.memory_budget, memory_plan)
+    memory.add_process("encoder_youtube", ffmpeg_yt_process.pid)
+    if not shared_encoder:
+        memory.add_process("encoder_pc", ffmpeg_pc_process.pid)
+    if audio_capture and audio_capture.source_pid:
+        memory.add_process("audio", audio_capture.source_pid)
+    memory.add_buffer("capture_frame", lambda: frame_buffer.nbytes)
+    if frame_bus:
+        memory.add_buffer("frame_bus", lambda: frame_bus.nbytes)
+    if web_viewer:
+        memory.add_buffer("web_viewer", web_viewer.cached_bytes)
+    stream_stats.add_source("memory", memory.stats)
+
+    frames_written = 0
     try:
         while True:
+            stream_stats.maybe_publish()
             request = picam2.capture_request()
             try:
-                metadata = request.get_metadata()
+                metadata = request.get_metadata() or {}
+                timestamp = metadata.get("SensorTimestamp", 0)
                 if metadata:
-                    last_results = parse_detections(metadata)
-
-                frame_array_bgr = request.make_array("main")
+                    parsed = parse_detections(metadata)
+                    if parsed is not None:
+                        detection_timeline.publish(timestamp, parsed)
+                # This frame's detections, or recent ones if it carried no output tensor
+                last_results = detection_timeline.for_frame(timestamp)
+                if framer:
+                    crop = framer.update(last_results)
+                    if crop and framer.mode == "isp":
+                        # Takes effect a few frames later; boxes follow each frame's own crop
+                        picam2.set_controls({"ScalerCrop": crop})
+
+                # One reused array instead of a new one per request
+                with MappedArray(request, "main") as m:
+                    frame_array_bgr = frame_buffer.copy_from(m.array)
+                if frame_bus:
+                    # Clean frame (no overlays) plus detections for local readers
+                    metadata = {
+                        "detections": detection_records(last_results, get_labels())
+                    }
+                    if audio_analyzer:
+                        metadata["audio"] = audio_analyzer.snapshot()
+                    frame_bus.publish(frame_array_bgr, metadata, timestamp)
+                if snapshots:
+                    snapshots.offer(frame_array_bgr, last_results)  # Copies on demand
+                if harvester:
+                    # Copies the crops it keeps
+                    harvester.offer(frame_array_bgr, last_results)
+                if framer:
+                    # The encoders get the framed region, with the boxes moved into it
+                    frame_array_bgr = framer.crop_frame(frame_array_bgr)
+                    last_results = framer.remap(last_results)
                 frame_with_overlays_bgr = draw_detections_on_array(
                     frame_array_bgr, last_results, request
                 )
 
-                if args_val.local_display:
-                    cv2.imshow("Local Preview", frame_with_overlays_bgr)
-                    if cv2.waitKey(1) & 0xFF == ord("q"):
+                if preview:
+                    preview.offer(frame_with_overlays_bgr)  # Downscaled, never blocks
+                    if preview.quit_requested:
                         break
 
-                # Write BGR frame to both ffmpeg processes
+                # Write BGR frame to both ffmpeg processes (once to a shared one)
                 try:
-                    ffmpeg_yt_process.stdin.write(frame_with_overlays_bgr.tobytes())
-                    ffmpeg_pc_process.stdin.write(frame_with_overlays_bgr.tobytes())
+                    ffmpeg_yt_process.stdin.write(frame_with_overlays_bgr)
+                    if not shared_encoder:
+                        ffmpeg_pc_process.stdin.write(frame_with_overlays_bgr)
+                    report_first_frame(args_val)
                 except IOError as e:
                     print(f"Error writing to ffmpeg: {e}", file=sys.stderr)
                     break
+                if web_viewer:
+                    # The PC encoder turns the n-th frame written into the n-th access unit
+                    web_viewer.push_detections(
+                        frames_written / args_val.fps,
+                        detection_records(last_results, get_labels()),
+                        audio_analyzer.snapshot() if audio_analyzer else None,
+                    )
+                frames_written += 1
             finally:
                 request.release()
 
@@ -484,18 +949,50 @@ def main():
         traceback.print_exc()
     finally:
         print("Cleaning up resources...")
-        if args_val.local_display:
-            cv2.destroyAllWindows()
+        profiler.stop()
+        if preview:
+            preview.close()
+            print(f"Local preview stats: {preview.stats()}")
+        if snapshots:
+            snapshots.close()
+            print(f"Snapshot stats: {snapshots.stats()}")
+        if harvester:
+            harvester.close()
+            print(f"Crop harvester stats: {harvester.stats()}")
+        if audio_capture:
+            print("Stopping audio capture...")
+            audio_capture.stop()
+            print(f"Audio stats: {audio_capture.stats()}")
+        if audio_analyzer:
+            audio_analyzer.close()
+            print(f"Audio analysis stats: {audio_analyzer.stats()}")
         if ffmpeg_yt_process:
             print("Stopping ffmpeg (YouTube) process...")
             ffmpeg_yt_process.stdin.close()
             ffmpeg_yt_process.terminate()
             ffmpeg_yt_process.wait()
-        if ffmpeg_pc_process:
+            print(f"YouTube encoder stats: {yt_progress.stats()}")
+        if ffmpeg_pc_process and ffmpeg_pc_process is not ffmpeg_yt_process:
             print("Stopping ffmpeg (PC) process...")
             ffmpeg_pc_process.stdin.close()
             ffmpeg_pc_process.terminate()
             ffmpeg_pc_process.wait()
+            print(f"PC encoder stats: {pc_progress.stats()}")
+        if pc_transport:
+            pc_transport.close()
+            print(f"PC RTP stats: {pc_transport.stats()}")
+        if web_viewer:
+            web_viewer.close()
+            print(f"Web viewer stats: {web_viewer.stats()}")
+        if frame_bus:
+            print(f"Frame bus stats: {frame_bus.stats()}")
+            frame_bus.close(unlink=True)
+        if detection_timeline:
+            print(f"Detection sync: {detection_timeline.describe()}")
+        if framer:
+            print(f"Auto framing stats: {framer.stats()}")
+        print(f"Memory stats: {memory.stats()}")
+        stream_stats.publish()
         if picam2 and picam2.started:
             print("Stopping Picamera2...")
             picam2.stop()
@@ -2,27 +2,73 @@
 stream_object_detection_video_to_pc.py - Object detection demo for IMX500 AI Camera with FFmpeg RTP streaming
 
 This script uses the IMX500 AI Camera for object detection
-and streams the output to a remote PC using FFmpeg for RTP.
+and streams the output to a remote PC over RTP. The H.264 from the hardware encoder
+is packetized in-process (rtp_h264.py); --rtp-output ffmpeg uses FFmpeg instead.
 
 Usage:
     python stream_object_detection_video_to_pc.py --model /path/to/model.rpk [--ip 192.168.1.100] [--port 5000]
     Uses environment variables for IP, port, width, height, FPS, bitrate if not specified.
+    Add --frame-bus NAME to share frames and detections with local processes (see frame_bus.py).
+    Add --startup-report to see where the time to the first frame goes (see startup_timing.py).
+    Add --web-port 8082 to watch the stream in a browser, detections included (see web_viewer.py).
+    Add --memory-budget MB on a Pi 3 or Zero 2 W to size buffers to fit (see memory_budget.py).
+    Add --auto-framing isp to stream a smaller frame that follows the detections (see auto_framing.py).
+    Add --harvest-dir DIR to save crops of detected objects as a training dataset
+    (see crop_harvester.py).
+    Send SIGUSR1 (or run sampling_profiler.py trigger) to profile the running stream
+    (see sampling_profiler.py).
 """
 
 import argparse
 import sys
 import os
+import time
 from functools import lru_cache
 from typing import List, Optional
 
-import cv2
-import numpy as np
-
-from picamera2 import MappedArray, Picamera2
-from picamera2.encoders import H264Encoder
-from picamera2.outputs import FfmpegOutput
-from picamera2.devices import IMX500
-from picamera2.devices.imx500 import NetworkIntrinsics, postprocess_nanodet_detection
+from auto_framing import AutoFramer, add_framing_arguments, framer_from_args
+from crop_harvester import CropHarvester, add_harvest_arguments, harvester_from_args
+from detection_sync import DetectionTimeline, add_sync_arguments, timeline_from_args
+from frame_bus import FrameBusWriter, add_frame_bus_arguments, detection_records
+from memory_budget import (
+    MemoryMonitor,
+    MemoryPlan,
+    add_memory_arguments,
+    memory_plan_from_args,
+)
+from nanodet_postprocess import add_nanodet_arguments, nanodet_postprocessor
+from rtp_fec import add_fec_arguments, transport_from_args
+from rtp_h264 import DEFAULT_MTU
+from sampling_profiler import add_profiler_arguments, profiler_from_args
+from snapshot_server import (
+    FrameSnapshots,
+    add_snapshot_arguments,
+    snapshots_from_args,
+)
+from startup_timing import (
+    add_startup_arguments,
+    lazy_import,
+    report_first_frame,
+    startup_timer,
+    warm_imports,
+)
+from web_viewer import WebViewer, add_web_viewer_arguments, web_viewer_from_args
+
+# Imported on first use, so --help and --print-intrinsics skip OpenCV (and --help picamera2)
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+MappedArray = lazy_import("picamera2", "MappedArray")
+Picamera2 = lazy_import("picamera2", "Picamera2")
+H264Encoder = lazy_import("picamera2.encoders", "H264Encoder")
+FfmpegOutput = lazy_import("picamera2.outputs", "FfmpegOutput")
+IMX500 = lazy_import("picamera2.devices", "IMX500")
+NetworkIntrinsics = lazy_import("picamera2.devices.imx500", "NetworkIntrinsics")
+postprocess_nanodet_detection = lazy_import(
+    "picamera2.devices.imx500", "postprocess_nanodet_detection"
+)
+scale_boxes = lazy_import("picamera2.devices.imx500.postprocess", "scale_boxes")
+RtpOutput = lazy_import("rtp_h264", "RtpOutput")
+WebViewerOutput = lazy_import("web_viewer", "WebViewerOutput")
 
 # --- Constants for default paths ---
 DEFAULT_MODEL_PATH = (
@@ -33,10 +79,14 @@ DEFAULT_COCO_LABELS_PATH = (
 )
 
 # --- Global variable for detections, initialized ---
-# This will store the last successfully parsed detections.
-last_detections: List["Detection"] = []
-# This will store the results to be drawn by the callback.
-last_results: Optional[List["Detection"]] = None
+# Parsed detections keyed by the sensor timestamp of their frame, for the callback.
+detection_timeline: Optional[DetectionTimeline] = None
+frame_bus: Optional[FrameBusWriter] = None
+snapshots: Optional[FrameSnapshots] = None
+harvester: Optional[CropHarvester] = None
+web_viewer: Optional[WebViewer] = None
+memory_plan: Optional[MemoryPlan] = None
+framer: Optional[AutoFramer] = None
 
 
 class Detection:
@@ -44,13 +94,16 @@ class Detection:
         """Create a Detection object, recording the bounding box, category and confidence."""
         self.category = category
         self.conf = conf
+        self.coords = coords  # Normalized to the whole sensor, for auto framing
         # Ensure picam2 is defined in the scope where Detection instances are created (it is, in __main__)
         self.box = imx500.convert_inference_coords(coords, metadata, picam2)
 
 
-def parse_detections(metadata: dict) -> List["Detection"]:
-    """Parse the output tensor into a number of detected objects, scaled to the ISP output."""
-    global last_detections  # To update and return cached detections on failure
+def parse_detections(metadata: dict) -> Optional[List["Detection"]]:
+    """Parse the output tensor into a number of detected objects, scaled to the ISP output.
+
+    Returns None when this frame carries no output tensor.
+    """
     # Accessing global 'intrinsics' and 'args' is common in scripts after __main__ setup
     bbox_normalization = intrinsics.bbox_normalization
     bbox_order = intrinsics.bbox_order
@@ -61,21 +114,21 @@ def parse_detections(metadata: dict) -> List["Detection"]:
     np_outputs = imx500.get_outputs(metadata, add_batch=True)
     input_w, input_h = imx500.get_input_size()
     if np_outputs is None:
-        return (
-            last_detections  # Return previous detections if current frame yields none
-        )
+        return None
 
     current_detections: List[Detection] = []
-    if intrinsics.postprocess == "nanodet":
+    if intrinsics.postprocess == "nanodet" and args.nanodet_engine == "picamera2":
         boxes, scores, classes = postprocess_nanodet_detection(
             outputs=np_outputs[0],
             conf=threshold,
             iou_thres=iou,
             max_out_dets=max_detections,
         )[0]
-        from picamera2.devices.imx500.postprocess import scale_boxes
-
         boxes = scale_boxes(boxes, 1, 1, input_h, input_w, False, False)
+    elif intrinsics.postprocess == "nanodet":
+        boxes, scores, classes = nanodet_postprocessor(input_w)(
+            np_outputs[0], conf=threshold, iou_thres=iou, max_out_dets=max_detections
+        )
     else:
         boxes, scores, classes = np_outputs[0][0], np_outputs[1][0], np_outputs[2][0]
         if bbox_normalization:
@@ -97,7 +150,6 @@ def parse_detections(metadata: dict) -> List["Detection"]:
         )  # Use correct boxes variable
         if score > threshold
     ]
-    last_detections = current_detections  # Cache the new detections
     return current_detections
 
 
@@ -114,72 +166,105 @@ def get_labels() -> List[str]:
 
 def draw_detections(request, stream="main"):
     """Draw the detections for this request onto the ISP output."""
-    # Accessing global 'last_results', 'intrinsics', 'imx500'
-    detections = last_results
+    # Accessing global 'detection_timeline', 'intrinsics', 'imx500'
+    metadata = request.get_metadata()
+    timestamp = metadata.get("SensorTimestamp", 0)
+    if args.overlay_sync == "exact":
+        # The main thread only sees this request's metadata after this callback returns
+        parsed = parse_detections(metadata)
+        if parsed is not None:
+            detection_timeline.publish(timestamp, parsed)
+    detections = detection_timeline.for_frame(timestamp)
+    if framer:
+        detections = framer.remap(detections)  # Drops objects outside this frame's crop
+    report_first_frame(args)
+    if frame_bus:
+        # Clean frame (no overlays yet) plus detections for local readers
+        with MappedArray(request, stream) as m:
+            frame_bus.publish(
+                m.array,
+                {"detections": detection_records(detections, get_labels())},
+                timestamp,
+            )
+    if snapshots:
+        with MappedArray(request, stream) as m:
+            snapshots.offer(m.array, detections)  # Copies only on demand
+    if harvester and detections:
+        with MappedArray(request, stream) as m:
+            harvester.offer(m.array, detections)  # Copies the crops it keeps
+    if web_viewer and encoder_started and encoder.firsttimestamp is not None:
+        # picamera2 stamps encoded frames with sensor time since its first frame
+        web_viewer.push_detections(
+            (timestamp // 1000 - encoder.firsttimestamp) / 1e6,
+            detection_records(detections, get_labels()),
+        )
     if detections is None:
         return
 
-    labels = get_labels()
     with MappedArray(request, stream) as m:
-        for (
-            detection_obj
-        ) in detections:  # Renamed 'detection' to 'detection_obj' to avoid conflict
-            x, y, w, h = detection_obj.box
-            label_text = (
-                f"{labels[int(detection_obj.category)]} ({detection_obj.conf:.2f})"
-            )
+        draw_detections_on_array(m.array, detections, request)
 
-            (text_width, text_height), baseline = cv2.getTextSize(
-                label_text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1
-            )
-            text_x = x + 5
-            text_y = y + 15
-
-            # Create a copy of the array to draw the background with opacity
-            overlay = m.array.copy()
-
-            # Draw the background rectangle on the overlay
-            cv2.rectangle(
-                overlay,
-                (
-                    text_x,
-                    text_y - text_height - baseline // 2,
-                ),  # Adjusted for better background fit
-                (text_x + text_width, text_y + baseline // 2),
-                (255, 255, 255),
-                cv2.FILLED,
-            )
 
-            alpha = 0.30
-            cv2.addWeighted(overlay, alpha, m.array, 1 - alpha, 0, m.array)
-
-            # Draw the text on top of the background
-            cv2.putText(
-                m.array,
-                label_text,
-                (text_x, text_y),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.5,
-                (0, 0, 255),
-                1,
-            )
+def draw_detections_on_array(array, detections, request=None):
+    """Draw detections (and, given the request, the ROI) onto a BGR array."""
+    labels = get_labels()
+    for (
+        detection_obj
+    ) in detections:  # Renamed 'detection' to 'detection_obj' to avoid conflict
+        x, y, w, h = detection_obj.box
+        label_text = f"{labels[int(detection_obj.category)]} ({detection_obj.conf:.2f})"
+
+        (text_width, text_height), baseline = cv2.getTextSize(
+            label_text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1
+        )
+        text_x = x + 5
+        text_y = y + 15
+
+        # Create a copy of the array to draw the background with opacity
+        overlay = array.copy()
+
+        # Draw the background rectangle on the overlay
+        cv2.rectangle(
+            overlay,
+            (
+                text_x,
+                text_y - text_height - baseline // 2,
+            ),  # Adjusted for better background fit
+            (text_x + text_width, text_y + baseline // 2),
+            (255, 255, 255),
+            cv2.FILLED,
+        )
 
-            # Draw detection box
-            cv2.rectangle(m.array, (x, y), (x + w, y + h), (0, 255, 0, 0), thickness=2)
+        alpha = 0.30
+        cv2.addWeighted(overlay, alpha, array, 1 - alpha, 0, array)
+
+        # Draw the text on top of the background
+        cv2.putText(
+            array,
+            label_text,
+            (text_x, text_y),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.5,
+            (0, 0, 255),
+            1,
+        )
 
-        if intrinsics.preserve_aspect_ratio:
-            b_x, b_y, b_w, b_h = imx500.get_roi_scaled(request)
-            color = (255, 0, 0)  # red
-            cv2.putText(
-                m.array,
-                "ROI",
-                (b_x + 5, b_y + 15),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.5,
-                color,
-                1,
-            )
-            cv2.rectangle(m.array, (b_x, b_y), (b_x + b_w, b_y + b_h), (255, 0, 0, 0))
+        # Draw detection box
+        cv2.rectangle(array, (x, y), (x + w, y + h), (0, 255, 0, 0), thickness=2)
+
+    if request is not None and intrinsics.preserve_aspect_ratio:
+        b_x, b_y, b_w, b_h = imx500.get_roi_scaled(request)
+        color = (255, 0, 0)  # red
+        cv2.putText(
+            array,
+            "ROI",
+            (b_x + 5, b_y + 15),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.5,
+            color,
+            1,
+        )
+        cv2.rectangle(array, (b_x, b_y), (b_x + b_w, b_y + b_h), (255, 0, 0, 0))
 
 
 def get_args():
@@ -347,16 +432,83 @@ def get_args():
         help=f"Stream height (env: VIDEO_HEIGHT, script default: {script_default_height})",
     )
 
+    # --- RTP output ---
+    parser.add_argument(
+        "--rtp-output",
+        choices=["python", "ffmpeg"],
+        default="python",
+        help="Packetize RTP in-process (python) or in an FFmpeg child process (ffmpeg)",
+    )
+    parser.add_argument(
+        "--mtu",
+        type=int,
+        default=DEFAULT_MTU,
+        help=f"Maximum RTP packet size in bytes for --rtp-output python (default: {DEFAULT_MTU})",
+    )
+    parser.add_argument(
+        "--pacing-ms",
+        type=float,
+        default=0.0,
+        help="Spread each frame's RTP packets over this many milliseconds (0 sends them at once)",
+    )
+
+    add_fec_arguments(parser)
+    add_frame_bus_arguments(parser)
+    add_nanodet_arguments(parser)
+    add_startup_arguments(parser)
+    add_memory_arguments(parser)
+    # The hardware encoder reads the camera's buffers, so there is no array crop here
+    add_framing_arguments(parser, modes=["off", "isp"])
+    add_snapshot_arguments(parser)
+    add_harvest_arguments(parser)
+    add_web_viewer_arguments(parser)
+    add_sync_arguments(parser, modes=True)
+    add_profiler_arguments(parser)
+
     parser.add_argument(
         "--local-display", action="store_true", help="Show video locally as well"
     )
     return parser.parse_args()
 
 
+def create_encoder(args):
+    """The H.264 encoder and its output; neither needs the camera running."""
+    global frame_bus
+    if args.frame_bus:
+        frame_bus = FrameBusWriter(
+            args.frame_bus, args.width, args.height, slots=memory_plan.frame_bus_slots
+        )
+        print(f"Publishing frames to frame bus '{args.frame_bus}'")
+    encoder = H264Encoder(bitrate=args.bitrate)
+    if args.rtp_output == "python":
+        # Packetize in this process; no FFmpeg child just to wrap RTP
+        output = RtpOutput(
+            args.ip,
+            args.port,
+            mtu=args.mtu,
+            pacing_window=args.pacing_ms / 1000,
+            transport=(
+                transport_from_args(args.ip, args.port, args) if args.fec else None
+            ),
+        )
+    else:
+        # Using FFmpeg for RTP output
+        output_command = (
+            f"-f h264 -y -an -r {args.fps} -c:v copy -f rtp rtp://{args.ip}:{args.port}"
+        )
+        output = FfmpegOutput(output_command)
+    # Browsers get the same encoded frames; nothing is encoded twice
+    encoder.output = [output, WebViewerOutput(web_viewer)] if web_viewer else output
+    return encoder, output
+
+
 if __name__ == "__main__":
     args = get_args()
 
-    imx500 = IMX500(args.model)  # This must be called before instantiation of Picamera2
+    with startup_timer.phase("imx500 network load"):
+        imx500 = IMX500(
+            args.model
+        )  # This must be called before instantiation of Picamera2
     intrinsics = imx500.network_intrinsics
     if not intrinsics:
         intrinsics = NetworkIntrinsics()
@@ -398,13 +550,40 @@ if __name__ == "__main__":
             )  # Set to empty list to avoid errors later, but detections will lack names
     intrinsics.update_with_defaults()
 
+    if args.fec and args.rtp_output != "python":
+        print("Error: --fec needs --rtp-output python.", file=sys.stderr)
+        sys.exit(1)
+
     if args.print_intrinsics:
         print(intrinsics)
         sys.exit(0)  # Exit after printing
 
-    picam2 = Picamera2(
-        imx500.camera_num
-    )  # Define picam2 here so it's in scope for Detection class
+    profiler = profiler_from_args(args)
+    framer = framer_from_args(args, get_labels())
+    if framer:
+        # The camera delivers, and the encoder gets, the framed size and bitrate
+        args.width, args.height = framer.output_size
+        args.bitrate = framer.bitrate
+        print(f"Auto framing: {framer.describe()}, {args.bitrate / 1000000:.2f} Mbps")
+
+    # The hardware encoder keeps its frames in the camera's memory, not in an ffmpeg
+    memory_plan = memory_plan_from_args(args, camera_buffers=12, encoders=0)
+    memory = MemoryMonitor(args.memory_budget, memory_plan)
+
+    # The encoder, its output and OpenCV come up while the network firmware uploads
+    snapshots = snapshots_from_args(args, draw=draw_detections_on_array)
+    harvester = harvester_from_args(args, get_labels())
+    web_viewer = web_viewer_from_args(args, gop_cache=memory_plan.gop_cache)
+    detection_timeline = timeline_from_args(args)
+    encoder_step = startup_timer.background("encoder and output", create_encoder, args)
+    overlays = startup_timer.background("overlay modules", warm_imports, cv2)
+
+    with startup_timer.phase("camera configure"):
+        picam2 = Picamera2(
+            imx500.camera_num
+        )  # Define picam2 here so it's in scope for Detection class
+    if framer:
+        framer.set_field(picam2.camera_properties["ScalerCropMaximum"])
 
     picam2_started = False
     encoder_started = False
@@ -413,24 +592,19 @@ if __name__ == "__main__":
         video_config = picam2.create_video_configuration(
             main={"size": (args.width, args.height), "format": "RGB888"},
             controls={"FrameRate": args.fps},
-            buffer_count=12,
+            buffer_count=memory_plan.camera_buffers,
         )
 
         imx500.show_network_fw_progress_bar()
-        picam2.start(video_config, show_preview=args.local_display)
+        with startup_timer.phase("camera start (firmware upload)"):
+            picam2.start(video_config, show_preview=args.local_display)
         picam2_started = True
 
         if intrinsics.preserve_aspect_ratio:
             imx500.set_auto_aspect_ratio()
 
-        encoder = H264Encoder(bitrate=args.bitrate)
-        # Using FFmpeg for RTP output
-        output_command = (
-            f"-f h264 -y -an -r {args.fps} -c:v copy -f rtp rtp://{args.ip}:{args.port}"
-        )
-        output = FfmpegOutput(output_command)
-
-        encoder.output = output
+        encoder, output = encoder_step.result()
+        overlays.result()
         picam2.start_encoder(encoder)
         encoder_started = True
 
@@ -446,12 +620,29 @@ if __name__ == "__main__":
         )  # Corrected ffplay command
 
         picam2.pre_callback = draw_detections
+        if frame_bus:
+            memory.add_buffer("frame_bus", lambda: frame_bus.nbytes)
+        if web_viewer:
+            memory.add_buffer("web_viewer", web_viewer.cached_bytes)
 
+        next_memory_sample = time.monotonic()
         while True:
             metadata = picam2.capture_metadata()
-            if metadata:
-                last_results = parse_detections(metadata)
-            # If no metadata, last_results remains from previous frame, draw_detections handles None
+            if framer:
+                crop = framer.update(detection_timeline.newest())
+                if crop:
+                    # Takes effect a few frames later; boxes follow each frame's own crop
+                    picam2.set_controls({"ScalerCrop": crop})
+            if time.monotonic() >= next_memory_sample:
+                memory.sample()  # Tracks the peak; reported at cleanup
+                next_memory_sample += 1.0
+            if metadata and args.overlay_sync == "latest":
+                # Drawn on later frames: the callback for this one has already run
+                parsed = parse_detections(metadata)
+                if parsed is not None:
+                    detection_timeline.publish(
+                        metadata.get("SensorTimestamp", 0), parsed
+                    )
 
     except KeyboardInterrupt:
         print("\nStopping stream due to KeyboardInterrupt...")
@@ -462,12 +653,33 @@ if __name__ == "__main__":
         traceback.print_exc()  # Print full traceback for unexpected errors
     finally:
         print("Cleaning up resources...")
+        profiler.stop()
         if encoder_started:
             try:
                 print("Stopping encoder...")
                 picam2.stop_encoder()
+                if args.rtp_output == "python":
+                    print(f"RTP sender stats: {output.sender.stats()}")
             except Exception as e_enc:
                 print(f"Error stopping encoder: {e_enc}", file=sys.stderr)
+        if frame_bus:
+            print(f"Frame bus stats: {frame_bus.stats()}")
+            frame_bus.close(unlink=True)
+        if snapshots:
+            snapshots.close()
+            print(f"Snapshot stats: {snapshots.stats()}")
+        if harvester:
+            harvester.close()
+            print(f"Crop harvester stats: {harvester.stats()}")
+        if web_viewer:
+            web_viewer.close()
+            print(f"Web viewer stats: {web_viewer.stats()}")
+        print(f"Detection sync: {detection_timeline.describe()}")
+        print(f"Detection sync stats: {detection_timeline.stats()}")
+        if framer:
+            print(f"Auto framing stats: {framer.stats()}")
+        print(f"Memory stats: {memory.stats()}")
+        print(f"Profiler stats: {profiler.stats()}")
         if picam2_started:
             try:
                 print("Stopping Picamera2...")
@@ -0,0 +1,88 @@
+"""
+stream_stats.py - One place where a streaming script publishes its running statistics
+
+Every component that keeps counters (audio capture, RTP sender, quality governor, ...)
+already has a stats() method returning a dict. A StreamStats collects those under a
+name and, at a fixed interval, writes one JSON document with all of them. The file
+is replaced atomically, so `watch cat`, a dashboard or a ROS node can read it at any
+time without seeing half a write.
+
+Usage (from a streaming script):
+    stats = StreamStats(args.stats_file, args.stats_interval)
+    stats.add_source("audio", audio_capture.stats)
+    stats.add_source("governor", governor.stats)
+    while streaming:
+        ...
+        stats.maybe_publish()  # cheap; writes only when the interval has passed
+    stats.publish()
+
+    watch -n1 cat /tmp/stream_stats.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Callable, Dict, Optional
+
+DEFAULT_STATS_INTERVAL = 5.0
+
+
+class StreamStats:
+    def __init__(self, path: Optional[str], interval: float = DEFAULT_STATS_INTERVAL):
+        """Publish to `path` every `interval` seconds; with no path, nothing is written."""
+        self.path = path
+        self.interval = interval
+        self.started = time.time()
+        self.sources: Dict[str, Callable[[], dict]] = {}
+        self._next_publish = time.monotonic() + interval
+
+    def add_source(self, name: str, stats: Callable[[], dict]):
+        """Register a stats() callable; re-adding a name replaces it."""
+        self.sources[name] = stats
+
+    def snapshot(self) -> dict:
+        document = {"time": time.time(), "uptime": time.time() - self.started}
+        for name, stats in self.sources.items():
+            try:
+                document[name] = stats()
+            except Exception as e:  # A broken source must not stop the stream
+                document[name] = {"error": str(e)}
+        return document
+
+    def maybe_publish(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        if now < self._next_publish:
+            return
+        self._next_publish = now + self.interval
+        self.publish()
+
+    def publish(self):
+        if not self.path:
+            return
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(self.snapshot(), f, indent=1, default=str)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(
+                f"Warning: could not write stats to {self.path}: {e}", file=sys.stderr
+            )
+
+
+def add_stats_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by every script that publishes stream stats."""
+    parser.add_argument(
+        "--stats-file",
+        type=str,
+        default=os.environ.get("STREAM_STATS_FILE"),
+        help="Write running stream statistics to this JSON file (env: STREAM_STATS_FILE)",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=DEFAULT_STATS_INTERVAL,
+        help=f"Seconds between stats file updates (default: {DEFAULT_STATS_INTERVAL})",
+    )
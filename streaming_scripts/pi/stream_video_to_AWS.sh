@@ -6,6 +6,13 @@
 #   1. Copy ~/.bashrc_exports.pi.example to ~/.bashrc and modify the variables as needed
 #   2. Run the script:
 #      ./stream_video_to_AWS.sh
+#
+# Set SPOOL_ENABLED=true to keep driving through Wi-Fi dropouts: the stream is cut
+# into keyframe-aligned fragments, queued on disk (SPOOL_DIR, at most SPOOL_MAX_MB)
+# and uploaded in order to SPOOL_INGEST_URL once the network is back (see kvs_spool.py).
+
+SPOOL_ENABLED="${SPOOL_ENABLED:-false}"
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 
 # Check if AWS credentials are available
 if [ -z "$AWS_ACCESS_KEY_ID" ] || [ -z "$AWS_SECRET_ACCESS_KEY" ]; then
@@ -16,14 +23,30 @@ fi
 echo "GST_PLUGIN_PATH=${GST_PLUGIN_PATH}"
 echo "Starting GStreamer pipeline for KVS stream: ${KVS_STREAM_NAME}..."
 
-gst-launch-1.0 -v \
-	libcamerasrc \
-	! video/x-raw,width=640,height=480,framerate=30/1 \
-	! videoconvert \
-	! x264enc bitrate=1000 bframes=0 key-int-max=30 tune=zerolatency speed-preset=ultrafast byte-stream=true \
-	! video/x-h264,profile=baseline,stream-format=avc,alignment=au \
-	! h264parse \
-	! kvssink stream-name="${KVS_STREAM_NAME}" storage-size=512
+if [ "$SPOOL_ENABLED" = "true" ]; then
+	echo "Spooling to ${SPOOL_DIR:-$HOME/kvs_spool}, uploading to ${SPOOL_INGEST_URL}"
+
+	# Encoded H.264 goes to stdout (-q keeps gst-launch messages off it)
+	gst-launch-1.0 -q \
+		libcamerasrc \
+		! video/x-raw,width=640,height=480,framerate=30/1 \
+		! videoconvert \
+		! x264enc bitrate=1000 bframes=0 key-int-max=30 tune=zerolatency speed-preset=ultrafast byte-stream=true \
+		! video/x-h264,profile=baseline \
+		! h264parse config-interval=-1 \
+		! video/x-h264,stream-format=byte-stream,alignment=au \
+		! fdsink fd=1 |
+		python3 "${SCRIPT_DIR}/kvs_spool.py" run --stream-name "${KVS_STREAM_NAME}"
+else
+	gst-launch-1.0 -v \
+		libcamerasrc \
+		! video/x-raw,width=640,height=480,framerate=30/1 \
+		! videoconvert \
+		! x264enc bitrate=1000 bframes=0 key-int-max=30 tune=zerolatency speed-preset=ultrafast byte-stream=true \
+		! video/x-h264,profile=baseline,stream-format=avc,alignment=au \
+		! h264parse \
+		! kvssink stream-name="${KVS_STREAM_NAME}" storage-size=512
+fi
 
 # Notes on gst-launch options:
 # -v : Verbose output, helpful for debugging.
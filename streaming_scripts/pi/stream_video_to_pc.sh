@@ -6,6 +6,13 @@
 #   1. Copy ~/.bashrc_exports.pi.example to ~/.bashrc and modify the variables as needed
 #   2. Run the script:
 #      ./stream_video_to_pc.sh
+#
+# Set FEC_ENABLED=true on lossy Wi-Fi: the encoder switches to periodic intra refresh
+# and rtp_fec.py adds XOR parity packets and send pacing. Receive it on the PC with
+# rtp_fec_receiver.py (see the README).
+#
+# Set CPU_LAYOUT (e.g. ros, to leave core 0 to ROS) to run the pipeline on the
+# encoder-pc cores of that layout (see cpu_affinity.py).
 
 # Video stream settings with defaults
 VIDEO_WIDTH="${VIDEO_WIDTH:-1920}"
@@ -13,19 +20,51 @@ VIDEO_HEIGHT="${VIDEO_HEIGHT:-1080}"
 VIDEO_FRAMERATE="${VIDEO_FRAMERATE:-30/1}"
 VIDEO_BITRATE="${VIDEO_BITRATE:-4096}"
 VIDEO_UDP_PORT="${VIDEO_UDP_PORT:-5000}"
+FEC_ENABLED="${FEC_ENABLED:-false}"
+FEC_GROUP="${FEC_GROUP:-10}"
+FEC_INTERLEAVE="${FEC_INTERLEAVE:-1}"
+CPU_LAYOUT="${CPU_LAYOUT:-none}"
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
+# Run gst-launch under the encoder's CPU set and priority when a layout is set
+GST_LAUNCH=(gst-launch-1.0)
+if [ "$CPU_LAYOUT" != "none" ]; then
+	echo "CPU layout: ${CPU_LAYOUT}"
+	GST_LAUNCH=(python3 "${SCRIPT_DIR}/cpu_affinity.py" run --cpu-layout "${CPU_LAYOUT}" encoder-pc -- gst-launch-1.0)
+fi
 
 echo "GST_PLUGIN_PATH=${GST_PLUGIN_PATH}"
 echo "Streaming video to ${REMOTE_PC_IP}:${VIDEO_UDP_PORT}"
 echo "Starting GStreamer pipeline..."
 
-# GStreamer pipeline to capture from webcam, encode, and send over UDP
-gst-launch-1.0 -v \
-	libcamerasrc \
-	! "video/x-raw,width=${VIDEO_WIDTH},height=${VIDEO_HEIGHT},framerate=${VIDEO_FRAMERATE}" \
-	! videoconvert \
-	! videorate \
-	! "video/x-raw,framerate=${VIDEO_FRAMERATE}" \
-	! x264enc tune=zerolatency bitrate="${VIDEO_BITRATE}" speed-preset=superfast \
-	! h264parse \
-	! rtph264pay config-interval=1 pt=96 \
-	! udpsink host="${REMOTE_PC_IP}" port="${VIDEO_UDP_PORT}"
+if [ "$FEC_ENABLED" = "true" ]; then
+	echo "FEC enabled: parity packets to ${REMOTE_PC_IP}:$((VIDEO_UDP_PORT + 1))"
+	FPS="${VIDEO_FRAMERATE%%/*}"
+
+	# Encoded H.264 goes to stdout (-q keeps gst-launch messages off it)
+	"${GST_LAUNCH[@]}" -q \
+		libcamerasrc \
+		! "video/x-raw,width=${VIDEO_WIDTH},height=${VIDEO_HEIGHT},framerate=${VIDEO_FRAMERATE}" \
+		! videoconvert \
+		! videorate \
+		! "video/x-raw,framerate=${VIDEO_FRAMERATE}" \
+		! x264enc tune=zerolatency bitrate="${VIDEO_BITRATE}" speed-preset=superfast intra-refresh=true key-int-max="$((FPS * 2))" \
+		! h264parse \
+		! "video/x-h264,stream-format=byte-stream,alignment=au" \
+		! fdsink fd=1 |
+		python3 "${SCRIPT_DIR}/rtp_fec.py" send - \
+			--ip "${REMOTE_PC_IP}" --port "${VIDEO_UDP_PORT}" --fps "${FPS}" \
+			--fec --fec-group "${FEC_GROUP}" --fec-interleave "${FEC_INTERLEAVE}"
+else
+	# GStreamer pipeline to capture from webcam, encode, and send over UDP
+	"${GST_LAUNCH[@]}" -v \
+		libcamerasrc \
+		! "video/x-raw,width=${VIDEO_WIDTH},height=${VIDEO_HEIGHT},framerate=${VIDEO_FRAMERATE}" \
+		! videoconvert \
+		! videorate \
+		! "video/x-raw,framerate=${VIDEO_FRAMERATE}" \
+		! x264enc tune=zerolatency bitrate="${VIDEO_BITRATE}" speed-preset=superfast \
+		! h264parse \
+		! rtph264pay config-interval=1 pt=96 \
+		! udpsink host="${REMOTE_PC_IP}" port="${VIDEO_UDP_PORT}"
+fi
@@ -0,0 +1,487 @@
+"""
+thermal_governor.py - Step stream quality down before the Pi throttles, and back up when it cools
+
+A Pi 4 running libx264 plus overlay drawing heats up until the firmware lowers the
+ARM clock at 80 °C. The frame rate then collapses partway through a stream. This
+governor watches the SoC temperature (and how fast it is rising), the CPU clock and
+the CPU load, and moves along a quality ladder before that happens:
+
+    level 0   veryfast  30 fps  1280x720   (what was asked for)
+    level 1   superfast 30 fps  1280x720
+    level 2   ultrafast 30 fps  1280x720
+    level 3   ultrafast 20 fps  1280x720
+    level 4   ultrafast 15 fps  1280x720
+    level 5   ultrafast 15 fps   960x540
+    level 6   ultrafast 15 fps   640x360
+
+The cheapest visual loss comes first: a faster x264 preset, then frame rate, and
+resolution last. The governor steps down quickly (a few seconds of pressure) and
+steps up slowly (a minute of headroom). This stops it flapping between two levels.
+Other components can add pressure too: an encoder that can't keep up with real
+time (ffmpeg_progress.py) counts like a hot SoC.
+
+Everything is read relative to a sysfs root, so a fake tree can stand in for the Pi:
+
+    <root>/sys/class/thermal/thermal_zone*/temp                   millidegrees C
+    <root>/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq   kHz
+    <root>/sys/devices/system/cpu/cpu0/cpufreq/scaling_max_freq   kHz
+    <root>/proc/stat                                              CPU load
+
+Usage (from a streaming script):
+    governor = governor_from_args(args, preset="veryfast")
+    while streaming:
+        level = governor.update()  # rate-limited; None unless the level changes
+        if level:
+            restart_encoder(level)
+
+    # Watch what the governor would do on this machine
+    python3 thermal_governor.py watch
+
+    # Replay a heat-up / cool-down profile against a fake sysfs tree
+    python3 thermal_governor.py simulate
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+from typing import Callable, List, Optional
+
+# x264 presets from slowest to fastest; the governor only moves right of the start
+X264_PRESETS = [
+    "medium",
+    "fast",
+    "faster",
+    "veryfast",
+    "superfast",
+    "ultrafast",
+]
+FPS_STEPS = [2 / 3, 1 / 2]  # Of the requested frame rate
+RESOLUTION_STEPS = [3 / 4, 1 / 2]  # Of the requested width and height
+MIN_FPS = 10
+
+# Pi 4 firmware starts lowering the ARM clock at 80 °C
+DEFAULT_TEMP_HIGH = 75.0
+DEFAULT_TEMP_LOW = 65.0
+DEFAULT_LOAD_HIGH = 0.95
+DEFAULT_LOAD_LOW = 0.85
+DEFAULT_INTERVAL = 2.0
+DEFAULT_DOWN_HOLD = 6.0
+DEFAULT_UP_HOLD = 60.0
+DEFAULT_SETTLE = 20.0  # Let a new level show in the temperature before the next step
+TEMP_LOOKAHEAD = 30.0  # Seconds the temperature trend is projected forward
+DECISION_HISTORY = 20
+
+
+class QualityLevel:
+    def __init__(self, preset: str, fps: int, width: int, height: int):
+        self.preset = preset
+        self.fps = fps
+        self.width = width
+        self.height = height
+
+    def __eq__(self, other):
+        return isinstance(other, QualityLevel) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return f"{self.preset} {self.fps}fps {self.width}x{self.height}"
+
+
+def build_quality_ladder(
+    preset: str, fps: int, width: int, height: int
+) -> List[QualityLevel]:
+    """Levels from the requested quality (index 0) down to the cheapest encode."""
+    ladder = [QualityLevel(preset, fps, width, height)]
+    if preset in X264_PRESETS:
+        for faster in X264_PRESETS[X264_PRESETS.index(preset) + 1 :]:
+            ladder.append(QualityLevel(faster, fps, width, height))
+    cheapest = ladder[-1]
+    for factor in FPS_STEPS:
+        step_fps = max(MIN_FPS, int(fps * factor))
+        if step_fps < ladder[-1].fps:
+            ladder.append(QualityLevel(cheapest.preset, step_fps, width, height))
+    step_fps = ladder[-1].fps
+    for factor in RESOLUTION_STEPS:
+        # Keep dimensions even for yuv420p
+        step_w, step_h = int(width * factor) // 2 * 2, int(height * factor) // 2 * 2
+        ladder.append(QualityLevel(cheapest.preset, step_fps, step_w, step_h))
+    return ladder
+
+
+class SystemSample:
+    def __init__(
+        self,
+        temp_c: Optional[float],
+        freq_khz: Optional[int],
+        max_freq_khz: Optional[int],
+        load: Optional[float],
+    ):
+        self.temp_c = temp_c
+        self.freq_khz = freq_khz
+        self.max_freq_khz = max_freq_khz
+        self.load = load
+
+    @property
+    def clock_limited(self) -> bool:
+        """Below the maximum clock while busy: throttling (or an undervolt) is on."""
+        if not self.freq_khz or not self.max_freq_khz or self.load is None:
+            return False
+        return self.freq_khz < self.max_freq_khz and self.load > 0.5
+
+    def as_dict(self) -> dict:
+        return {
+            "temp_c": self.temp_c,
+            "freq_mhz": self.freq_khz / 1000 if self.freq_khz else None,
+            "max_freq_mhz": self.max_freq_khz / 1000 if self.max_freq_khz else None,
+            "load": round(self.load, 3) if self.load is not None else None,
+        }
+
+
+class SysfsReader:
+    def __init__(self, root: str = "/"):
+        self.root = root
+        self._last_cpu_times: Optional[List[int]] = None
+
+    def _path(self, relative: str) -> str:
+        return os.path.join(self.root, relative)
+
+    def _read_number(self, relative: str) -> Optional[int]:
+        try:
+            with open(self._path(relative)) as f:
+                return int(f.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def temperature(self) -> Optional[float]:
+        """Hottest thermal zone in °C."""
+        temps = []
+        for path in glob.glob(self._path("sys/class/thermal/thermal_zone*/temp")):
+            try:
+                with open(path) as f:
+                    temps.append(int(f.read().strip()) / 1000)
+            except (OSError, ValueError):
+                continue
+        return max(temps) if temps else None
+
+    def cpu_load(self) -> Optional[float]:
+        """Busy fraction of all CPUs since the previous call (None on the first)."""
+        try:
+            with open(self._path("proc/stat")) as f:
+                fields = [int(v) for v in f.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        previous, self._last_cpu_times = self._last_cpu_times, fields
+        if previous is None:
+            return None
+        deltas = [now - before for now, before in zip(fields, previous)]
+        total = sum(deltas)
+        if total <= 0:
+            return None
+        idle = deltas[3] + (deltas[4] if len(deltas) > 4 else 0)  # idle + iowait
+        return 1.0 - idle / total
+
+    def sample(self) -> SystemSample:
+        cpufreq = "sys/devices/system/cpu/cpu0/cpufreq"
+        return SystemSample(
+            temp_c=self.temperature(),
+            freq_khz=self._read_number(f"{cpufreq}/scaling_cur_freq"),
+            max_freq_khz=self._read_number(f"{cpufreq}/scaling_max_freq"),
+            load=self.cpu_load(),
+        )
+
+
+class ThermalGovernor:
+    def __init__(
+        self,
+        ladder: List[QualityLevel],
+        sysfs_root: str = "/",
+        temp_high: float = DEFAULT_TEMP_HIGH,
+        temp_low: float = DEFAULT_TEMP_LOW,
+        load_high: float = DEFAULT_LOAD_HIGH,
+        load_low: float = DEFAULT_LOAD_LOW,
+        interval: float = DEFAULT_INTERVAL,
+        down_hold: float = DEFAULT_DOWN_HOLD,
+        up_hold: float = DEFAULT_UP_HOLD,
+        settle: float = DEFAULT_SETTLE,
+    ):
+        self.ladder = ladder
+        self.reader = SysfsReader(sysfs_root)
+        self.temp_high = temp_high
+        self.temp_low = temp_low
+        self.load_high = load_high
+        self.load_low = load_low
+        self.interval = interval
+        self.down_hold = down_hold
+        self.up_hold = up_hold
+        self.settle = settle
+
+        self.index = 0
+        self.last_sample: Optional[SystemSample] = None
+        self.temp_slope = 0.0  # °C per second, smoothed
+        self.decisions: List[dict] = []
+        self._next_sample = 0.0
+        self._last_temp: Optional[float] = None
+        self._last_time: Optional[float] = None
+        self._pressure_since: Optional[float] = None
+        self._headroom_since: Optional[float] = None
+        self._last_change = float("-inf")
+        self._pressure_sources: List[Callable[[], Optional[str]]] = []
+
+    def add_pressure_source(self, pressure: Callable[[], Optional[str]]):
+        """Another step-down signal, e.g. FfmpegProgress.pressure (a reason or None)."""
+        self._pressure_sources.append(pressure)
+
+    @property
+    def level(self) -> QualityLevel:
+        return self.ladder[self.index]
+
+    def update(self, now: Optional[float] = None) -> Optional[QualityLevel]:
+        """Sample if the interval has passed; return the new level when it changes."""
+        now = time.monotonic() if now is None else now
+        if now < self._next_sample:
+            return None
+        self._next_sample = now + self.interval
+        sample = self.reader.sample()
+        self.last_sample = sample
+        self._track_slope(sample.temp_c, now)
+
+        reason = self._pressure_reason(sample)
+        if reason:
+            self._headroom_since = None
+            if self._pressure_since is None:
+                self._pressure_since = now
+            if (
+                now - self._pressure_since >= self.down_hold
+                and now - self._last_change >= self.settle
+                and self.index < len(self.ladder) - 1
+            ):
+                return self._change(self.index + 1, reason, now)
+            return None
+
+        self._pressure_since = None
+        if self._has_headroom(sample):
+            if self._headroom_since is None:
+                self._headroom_since = now
+            if (
+                now - self._headroom_since >= self.up_hold
+                and now - self._last_change >= self.up_hold
+                and self.index > 0
+            ):
+                return self._change(self.index - 1, "cool", now)
+        else:
+            self._headroom_since = None
+        return None
+
+    def _track_slope(self, temp_c: Optional[float], now: float):
+        if temp_c is None:
+            return
+        if self._last_temp is not None and now > self._last_time:
+            slope = (temp_c - self._last_temp) / (now - self._last_time)
+            self.temp_slope += 0.3 * (slope - self.temp_slope)
+        self._last_temp, self._last_time = temp_c, now
+
+    def _pressure_reason(self, sample: SystemSample) -> Optional[str]:
+        if sample.temp_c is not None:
+            if sample.temp_c >= self.temp_high:
+                return f"temperature {sample.temp_c:.1f}C"
+            projected = sample.temp_c + max(0.0, self.temp_slope) * TEMP_LOOKAHEAD
+            if projected >= self.temp_high:
+                return f"temperature rising to {projected:.1f}C"
+        if sample.clock_limited:
+            return f"clock limited to {sample.freq_khz // 1000} MHz"
+        if sample.load is not None and sample.load >= self.load_high:
+            return f"cpu load {sample.load:.0%}"
+        for pressure in self._pressure_sources:
+            reason = pressure()
+            if reason:
+                return reason
+        return None
+
+    def _has_headroom(self, sample: SystemSample) -> bool:
+        if sample.temp_c is not None and sample.temp_c >= self.temp_low:
+            return False
+        return sample.load is None or sample.load < self.load_low
+
+    def _change(self, index: int, reason: str, now: float) -> QualityLevel:
+        decision = {
+            "time": time.time(),
+            "from": repr(self.level),
+            "to": repr(self.ladder[index]),
+            "reason": reason,
+            **self.last_sample.as_dict(),
+        }
+        self.decisions = (self.decisions + [decision])[-DECISION_HISTORY:]
+        self.index = index
+        self._last_change = now
+        self._pressure_since = None
+        self._headroom_since = None
+        return self.level
+
+    def stats(self) -> dict:
+        return {
+            "level": self.index,
+            "quality": repr(self.level),
+            "temp_slope_c_per_min": round(self.temp_slope * 60, 2),
+            **(self.last_sample.as_dict() if self.last_sample else {}),
+            "changes": len(self.decisions),
+            "last_decision": self.decisions[-1] if self.decisions else None,
+        }
+
+
+def add_governor_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by every script that encodes with libx264."""
+    parser.add_argument(
+        "--governor",
+        action=argparse.BooleanOptionalAction,
+        default=os.environ.get("QUALITY_GOVERNOR", "false").lower() == "true",
+        help="Lower x264 preset, fps and resolution before the Pi throttles (env: QUALITY_GOVERNOR)",
+    )
+    parser.add_argument(
+        "--sysfs-root",
+        type=str,
+        default="/",
+        help="Read temperature, clock and load under this root (for a fake sysfs tree)",
+    )
+    parser.add_argument(
+        "--temp-high",
+        type=float,
+        default=DEFAULT_TEMP_HIGH,
+        help=f"Step quality down at this SoC temperature in C (default: {DEFAULT_TEMP_HIGH})",
+    )
+    parser.add_argument(
+        "--temp-low",
+        type=float,
+        default=DEFAULT_TEMP_LOW,
+        help=f"Step quality back up below this temperature in C (default: {DEFAULT_TEMP_LOW})",
+    )
+
+
+def governor_from_args(args, preset: str) -> ThermalGovernor:
+    ladder = build_quality_ladder(preset, args.fps, args.width, args.height)
+    return ThermalGovernor(
+        ladder, args.sysfs_root, temp_high=args.temp_high, temp_low=args.temp_low
+    )
+
+
+class FakeSysfs:
+    """A writable stand-in for the Pi's sysfs and /proc/stat."""
+
+    def __init__(self, root: str, max_freq_khz: int = 1800000):
+        self.root = root
+        self.max_freq_khz = max_freq_khz
+        self._busy = 0
+        self._idle = 0
+        os.makedirs(os.path.join(root, "sys/class/thermal/thermal_zone0"))
+        os.makedirs(os.path.join(root, "sys/devices/system/cpu/cpu0/cpufreq"))
+        os.makedirs(os.path.join(root, "proc"))
+        self._write(
+            "sys/devices/system/cpu/cpu0/cpufreq/scaling_max_freq", max_freq_khz
+        )
+
+    def _write(self, relative: str, value):
+        with open(os.path.join(self.root, relative), "w") as f:
+            f.write(f"{value}\n")
+
+    def set(self, temp_c: float, load: float, freq_khz: Optional[int] = None):
+        """Advance the fake machine by one sample period."""
+        self._write("sys/class/thermal/thermal_zone0/temp", int(temp_c * 1000))
+        self._write(
+            "sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq",
+            freq_khz or self.max_freq_khz,
+        )
+        self._busy += int(load * 400)
+        self._idle += int((1 - load) * 400)
+        self._write("proc/stat", f"cpu  {self._busy} 0 0 {self._idle} 0 0 0 0 0 0")
+
+
+def simulate(args):
+    """Heat a fake Pi under a full-quality encode and check the governor's reaction."""
+    root = tempfile.mkdtemp(prefix="fake_sysfs_")
+    try:
+        fake = FakeSysfs(root)
+        ladder = build_quality_ladder("veryfast", 30, 1280, 720)
+        governor = ThermalGovernor(ladder, root, interval=args.interval)
+        temp = 50.0
+        throttled_seconds = 0.0
+        now = 0.0
+        while now < args.duration:
+            # Heat is roughly proportional to encode cost; cheaper levels cool down
+            cost = 1.0 - governor.index / len(ladder)
+            ambient = 45.0 if now < args.duration / 2 else 35.0
+            equilibrium = ambient + 45.0 * cost
+            temp += (equilibrium - temp) * args.interval / 90.0
+            freq = None
+            if temp >= 80.0:
+                freq = 1500000  # What the firmware would do
+                throttled_seconds += args.interval
+            fake.set(temp, 0.45 + 0.45 * cost, freq)
+            level = None if args.fixed else governor.update(now)
+            if level:
+                print(
+                    f"t={now:5.0f}s {temp:5.1f}C -> level {governor.index} ({level}): "
+                    f"{governor.decisions[-1]['reason']}"
+                )
+            now += args.interval
+        print(
+            f"Final level {governor.index} ({governor.level}) at {temp:.1f}C; "
+            f"{throttled_seconds:.0f}s spent at or above 80C"
+        )
+    finally:
+        shutil.rmtree(root)
+
+
+def watch(args):
+    governor = ThermalGovernor(
+        build_quality_ladder(args.preset, args.fps, args.width, args.height),
+        args.sysfs_root,
+        interval=args.interval,
+    )
+    print(
+        "Ladder: " + ", ".join(f"{i}: {lvl}" for i, lvl in enumerate(governor.ladder))
+    )
+    try:
+        while True:
+            level = governor.update()
+            if level:
+                print(f"-> {governor.decisions[-1]}")
+            if governor.last_sample:
+                print(governor.stats(), flush=True)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Thermal and CPU quality governor")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    watch_parser = subparsers.add_parser(
+        "watch", help="Print samples and decisions for this machine"
+    )
+    watch_parser.add_argument("--sysfs-root", default="/")
+    watch_parser.add_argument("--preset", default="veryfast", choices=X264_PRESETS)
+    watch_parser.add_argument("--fps", type=int, default=30)
+    watch_parser.add_argument("--width", type=int, default=1280)
+    watch_parser.add_argument("--height", type=int, default=720)
+    watch_parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL)
+
+    sim_parser = subparsers.add_parser(
+        "simulate", help="Replay a heat-up and cool-down against a fake sysfs tree"
+    )
+    sim_parser.add_argument("--duration", type=float, default=1800.0)
+    sim_parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL)
+    sim_parser.add_argument(
+        "--fixed", action="store_true", help="Never change level, for comparison"
+    )
+
+    args = parser.parse_args()
+    if args.command == "simulate":
+        simulate(args)
+    else:
+        watch(args)
+
+
+if __name__ == "__main__":
+    main()
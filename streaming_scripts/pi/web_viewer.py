@@ -0,0 +1,1096 @@
+"""
+web_viewer.py - Low-latency browser viewer: the PC stream as fragmented MP4 over WebSocket
+
+Watching a robot used to mean GStreamer or ffplay on a PC that can receive its
+RTP. With --web-port, a streaming script also serves a small page
+(web_viewer.html) that plays the live stream in any browser with Media Source
+Extensions:
+
+    http://robot1.local:8082/          the viewer page
+    ws://robot1.local:8082/ws          the stream (used by the page)
+    http://robot1.local:8082/stats     viewer and fan-out counters as JSON
+
+The H.264 the PC encoder already produces is reused as is; nothing is decoded
+or re-encoded for the browser:
+
+* Each access unit is wrapped once into a fragment (moof + mdat, one sample)
+  behind an init segment (ftyp + moov) built from the stream's SPS and PPS.
+  The WebSocket frame around it is built once too, so every viewer is sent the
+  same bytes and a viewer costs a queue append per frame, not an encode.
+* Every viewer has its own sender thread and queue. A viewer whose oldest queued
+  item has waited longer than --web-max-lag is dropped back to the next
+  keyframe, so one slow browser never delays the capture loop or other viewers.
+* A new viewer gets the init segment and the fragments since the last keyframe,
+  so the picture appears at once; the page then skips to the live edge.
+* Detections go out on the same socket as small JSON text messages, stamped
+  with the media time of the frame they belong to. The page draws them on a
+  canvas above the video, in step with the frame on screen.
+
+Usage (from a streaming script):
+    web_viewer = web_viewer_from_args(args)  # None without --web-port
+    pump_annexb(..., on_access_unit=web_viewer.push_access_unit)
+    web_viewer.push_detections(frame_index / fps, detection_records(...))
+    web_viewer.close()
+
+    # Play a recorded Annex B clip to browsers, without a camera
+    python3 web_viewer.py serve clip.h264 --web-port 8082
+
+    # Loopback load test: latency and CPU as the number of viewers grows
+    python3 web_viewer.py loadtest --viewers 1,4,16,32
+"""
+
+import argparse
+import base64
+import collections
+import hashlib
+import http.server
+import json
+import os
+import random
+import resource
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from typing import Callable, Deque, List, Optional, Tuple
+
+from rtp_h264 import (
+    H264_CLOCK_RATE,
+    NAL_TYPE_AUD,
+    NAL_TYPE_IDR,
+    NAL_TYPE_PPS,
+    NAL_TYPE_SPS,
+    iter_access_units,
+    split_annexb,
+)
+
+DEFAULT_WEB_HOST = "0.0.0.0"
+DEFAULT_MAX_LAG = 1.0  # Seconds a viewer's oldest queued item may wait
+MAX_GOP_CACHE = 600  # Fragments kept for joining viewers (20 s at 30 fps)
+VIEWER_NICE = 10  # Viewer sends yield to capture, encoders and the RTP stream
+IDLE_POLL = 0.5  # Seconds between checks for client messages when idle
+SEND_TIMEOUT = 10.0  # A client that accepts nothing for this long is dropped
+IOV_MAX = 1024
+PAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "web_viewer.html")
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+# ISO BMFF sample flags: a sync sample, and one that depends on earlier samples
+SYNC_SAMPLE_FLAGS = 0x02000000
+NON_SYNC_SAMPLE_FLAGS = 0x01010000
+# Profiles whose SPS carries chroma format and bit depth fields
+HIGH_PROFILES = {100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135}
+
+
+class BitReader:
+    """Reads bits and Exp-Golomb codes from an RBSP."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.position = 0
+
+    def bit(self) -> int:
+        byte = self.data[self.position >> 3]
+        value = (byte >> (7 - (self.position & 7))) & 1
+        self.position += 1
+        return value
+
+    def bits(self, count: int) -> int:
+        value = 0
+        for _ in range(count):
+            value = (value << 1) | self.bit()
+        return value
+
+    def ue(self) -> int:
+        zeros = 0
+        while self.bit() == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self) -> int:
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+class BitWriter:
+    """The reverse of BitReader, for the load test's synthetic parameter sets."""
+
+    def __init__(self):
+        self.values: List[int] = []
+
+    def bits(self, value: int, count: int):
+        self.values.extend((value >> (count - 1 - i)) & 1 for i in range(count))
+
+    def ue(self, value: int):
+        value += 1
+        length = value.bit_length()
+        self.bits(0, length - 1)
+        self.bits(value, length)
+
+    def rbsp(self) -> bytes:
+        self.values.append(1)  # rbsp_stop_one_bit, then zeros to the byte
+        self.values.extend([0] * (-len(self.values) % 8))
+        return bytes(
+            int("".join(map(str, self.values[i : i + 8])), 2)
+            for i in range(0, len(self.values), 8)
+        )
+
+
+def unescape_rbsp(nal: bytes) -> bytes:
+    """Remove emulation prevention bytes (00 00 03 -> 00 00)."""
+    return nal.replace(b"\x00\x00\x03", b"\x00\x00")
+
+
+def sps_dimensions(sps: bytes) -> Tuple[int, int]:
+    """Picture width and height, after cropping, from an SPS NAL unit."""
+    reader = BitReader(unescape_rbsp(sps[1:]))
+    profile_idc = reader.bits(8)
+    reader.bits(16)  # constraint flags, level_idc
+    reader.ue()  # seq_parameter_set_id
+    chroma_format_idc = 1
+    if profile_idc in HIGH_PROFILES:
+        chroma_format_idc = reader.ue()
+        if chroma_format_idc == 3:
+            reader.bit()  # separate_colour_plane_flag
+        reader.ue()  # bit_depth_luma_minus8
+        reader.ue()  # bit_depth_chroma_minus8
+        reader.bit()  # qpprime_y_zero_transform_bypass_flag
+        if reader.bit():  # seq_scaling_matrix_present_flag
+            for index in range(8 if chroma_format_idc != 3 else 12):
+                if reader.bit():
+                    last, next_scale = 8, 8
+                    for _ in range(16 if index < 6 else 64):
+                        if next_scale:
+                            next_scale = (last + reader.se()) % 256
+                        last = next_scale or last
+    reader.ue()  # log2_max_frame_num_minus4
+    pic_order_cnt_type = reader.ue()
+    if pic_order_cnt_type == 0:
+        reader.ue()  # log2_max_pic_order_cnt_lsb_minus4
+    elif pic_order_cnt_type == 1:
+        reader.bit()
+        reader.se()
+        reader.se()
+        for _ in range(reader.ue()):
+            reader.se()
+    reader.ue()  # max_num_ref_frames
+    reader.bit()  # gaps_in_frame_num_value_allowed_flag
+    width_in_mbs = reader.ue() + 1
+    height_in_map_units = reader.ue() + 1
+    frame_mbs_only = reader.bit()
+    if not frame_mbs_only:
+        reader.bit()  # mb_adaptive_frame_field_flag
+    reader.bit()  # direct_8x8_inference_flag
+    width = width_in_mbs * 16
+    height = (2 - frame_mbs_only) * height_in_map_units * 16
+    if reader.bit():  # frame_cropping_flag
+        left, right, top, bottom = (reader.ue() for _ in range(4))
+        crop_x = 1 if chroma_format_idc in (0, 3) else 2
+        crop_y = (2 - frame_mbs_only) * (2 if chroma_format_idc == 1 else 1)
+        width -= crop_x * (left + right)
+        height -= crop_y * (top + bottom)
+    return width, height
+
+
+def codec_string(sps: bytes) -> str:
+    """RFC 6381 codec string for MediaSource, e.g. avc1.64001f."""
+    return "avc1.%02x%02x%02x" % (sps[1], sps[2], sps[3])
+
+
+def box(kind: bytes, *payload: bytes) -> bytes:
+    body = b"".join(payload)
+    return struct.pack(">I", 8 + len(body)) + kind + body
+
+
+def full_box(kind: bytes, version: int, flags: int, *payload: bytes) -> bytes:
+    return box(kind, struct.pack(">I", (version << 24) | flags), *payload)
+
+
+UNITY_MATRIX = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+class Fmp4Muxer:
+    """Wraps H.264 access units into an fMP4 init segment and one-sample fragments."""
+
+    def __init__(self, timescale: int = H264_CLOCK_RATE, track_id: int = 1):
+        self.timescale = timescale
+        self.track_id = track_id
+        self.sequence = 0
+        self.default_duration = timescale // 30
+        self._last_decode_time: Optional[int] = None
+
+    def init_segment(self, sps: bytes, pps: bytes) -> bytes:
+        width, height = sps_dimensions(sps)
+        ftyp = box(b"ftyp", b"isom", struct.pack(">I", 0x200), b"isomiso6avc1mp41")
+        mvhd = full_box(
+            b"mvhd",
+            0,
+            0,
+            struct.pack(">IIII", 0, 0, 1000, 0),
+            struct.pack(">IH10x", 0x10000, 0x100),  # rate, volume, reserved
+            UNITY_MATRIX,
+            bytes(24),  # pre_defined
+            struct.pack(">I", self.track_id + 1),  # next_track_ID
+        )
+        tkhd = full_box(
+            b"tkhd",
+            0,
+            0x3,  # enabled, in movie
+            struct.pack(">IIIII", 0, 0, self.track_id, 0, 0),
+            bytes(8),  # reserved
+            struct.pack(">hhhH", 0, 0, 0, 0),  # layer, group, volume, reserved
+            UNITY_MATRIX,
+            struct.pack(">II", width << 16, height << 16),
+        )
+        mdhd = full_box(
+            b"mdhd", 0, 0, struct.pack(">IIIIHH", 0, 0, self.timescale, 0, 0x55C4, 0)
+        )
+        hdlr = full_box(
+            b"hdlr", 0, 0, bytes(4), b"vide", bytes(12), b"VideoHandler\x00"
+        )
+        avcc = box(
+            b"avcC",
+            bytes([1, sps[1], sps[2], sps[3], 0xFF, 0xE1]),
+            struct.pack(">H", len(sps)),
+            sps,
+            b"\x01",
+            struct.pack(">H", len(pps)),
+            pps,
+        )
+        avc1 = box(
+            b"avc1",
+            bytes(6),
+            struct.pack(">H", 1),  # data_reference_index
+            bytes(16),
+            struct.pack(">HH", width, height),
+            struct.pack(">II", 0x480000, 0x480000),  # 72 dpi
+            bytes(4),
+            struct.pack(">H", 1),  # frame_count
+            bytes(32),  # compressorname
+            struct.pack(">Hh", 0x18, -1),  # depth, pre_defined
+            avcc,
+        )
+        stbl = box(
+            b"stbl",
+            full_box(b"stsd", 0, 0, struct.pack(">I", 1), avc1),
+            full_box(b"stts", 0, 0, bytes(4)),
+            full_box(b"stsc", 0, 0, bytes(4)),
+            full_box(b"stsz", 0, 0, bytes(8)),
+            full_box(b"stco", 0, 0, bytes(4)),
+        )
+        minf = box(
+            b"minf",
+            full_box(b"vmhd", 0, 1, bytes(8)),
+            box(
+                b"dinf",
+                full_box(b"dref", 0, 0, struct.pack(">I", 1), full_box(b"url ", 0, 1)),
+            ),
+            stbl,
+        )
+        trak = box(b"trak", tkhd, box(b"mdia", mdhd, hdlr, minf))
+        trex = full_box(b"trex", 0, 0, struct.pack(">IIIII", self.track_id, 1, 0, 0, 0))
+        return ftyp + box(b"moov", mvhd, trak, box(b"mvex", trex))
+
+    def fragment(self, nals: List[bytes], pts: float, keyframe: bool) -> bytes:
+        """One access unit (NAL units without start codes) at pts seconds."""
+        decode_time = round(pts * self.timescale)
+        if self._last_decode_time is not None:
+            step = decode_time - self._last_decode_time
+            if 0 < step < self.timescale:
+                self.default_duration = step  # Next frame's time isn't known yet
+        self._last_decode_time = decode_time
+        self.sequence += 1
+        sample = b"".join(
+            struct.pack(">I", len(nal)) + nal
+            for nal in nals
+            if nal[0] & 0x1F not in (NAL_TYPE_SPS, NAL_TYPE_PPS, NAL_TYPE_AUD)
+        )
+        flags = SYNC_SAMPLE_FLAGS if keyframe else NON_SYNC_SAMPLE_FLAGS
+
+        def moof(data_offset: int) -> bytes:
+            return box(
+                b"moof",
+                full_box(b"mfhd", 0, 0, struct.pack(">I", self.sequence)),
+                box(
+                    b"traf",
+                    full_box(
+                        b"tfhd", 0, 0x020000, struct.pack(">I", self.track_id)
+                    ),  # default-base-is-moof
+                    full_box(b"tfdt", 1, 0, struct.pack(">Q", max(0, decode_time))),
+                    full_box(
+                        b"trun",
+                        0,
+                        0x000701,  # data offset, sample duration, size and flags
+                        struct.pack(
+                            ">IiIII",
+                            1,
+                            data_offset,
+                            self.default_duration,
+                            len(sample),
+                            flags,
+                        ),
+                    ),
+                ),
+            )
+
+        header = moof(0)
+        return moof(len(header) + 8) + box(b"mdat", sample)
+
+
+def websocket_header(opcode: int, length: int, mask: bool = False) -> bytes:
+    """Frame header for one unfragmented message."""
+    first = 0x80 | opcode
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        return struct.pack(">BB", first, mask_bit | length)
+    if length < 1 << 16:
+        return struct.pack(">BBH", first, mask_bit | 126, length)
+    return struct.pack(">BBQ", first, mask_bit | 127, length)
+
+
+def websocket_accept(key: str) -> str:
+    digest = hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+
+def read_exactly(sock: socket.socket, count: int) -> bytes:
+    data = b""
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+
+def read_websocket_message(sock: socket.socket) -> Tuple[int, bytes]:
+    """(opcode, payload) of the next frame, unmasking client frames."""
+    first, second = read_exactly(sock, 2)
+    length = second & 0x7F
+    if length == 126:
+        (length,) = struct.unpack(">H", read_exactly(sock, 2))
+    elif length == 127:
+        (length,) = struct.unpack(">Q", read_exactly(sock, 8))
+    mask = read_exactly(sock, 4) if second & 0x80 else None
+    payload = read_exactly(sock, length)
+    if mask:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return first & 0x0F, payload
+
+
+def send_buffers(sock: socket.socket, buffers: List[bytes]) -> int:
+    """Write all buffers with as few sendmsg calls as partial writes allow."""
+    views = [memoryview(buffer) for buffer in buffers if buffer]
+    total = sum(len(view) for view in views)
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index : index + IOV_MAX])
+        while sent and index < len(views):
+            if sent >= len(views[index]):
+                sent -= len(views[index])
+                index += 1
+            else:
+                views[index] = views[index][sent:]
+                sent = 0
+    return total
+
+
+class QueuedMessage:
+    __slots__ = ("parts", "keyframe", "essential")
+
+    def __init__(self, parts, keyframe: bool = False, essential: bool = False):
+        self.parts = parts  # (header, payload), shared by every viewer
+        self.keyframe = keyframe
+        self.essential = essential  # Setup messages survive a resync
+
+
+class ViewerConnection:
+    """One browser: a queue filled by the hub and drained by the handler thread."""
+
+    def __init__(self, sock: socket.socket, address, max_lag: float):
+        self.sock = sock
+        self.address = address
+        self.max_lag = max_lag
+        self.waiting_for_keyframe = False
+        self.closed = False
+        self._items: Deque[Tuple[QueuedMessage, float]] = collections.deque()
+        self._cond = threading.Condition()
+        self.bytes_sent = 0
+        self.messages_sent = 0
+        self.dropped = 0
+        self.resyncs = 0
+
+    def enqueue(self, message: QueuedMessage, media: bool = True):
+        """Queue a message; media are skipped until a keyframe after a resync."""
+        now = time.monotonic()
+        with self._cond:
+            if self.closed:
+                return
+            if (
+                not message.essential
+                and self._items
+                and now - self._items[0][1] > self.max_lag
+            ):
+                # Too far behind: keep the setup messages, restart at a keyframe
+                kept = [item for item in self._items if item[0].essential]
+                self.dropped += len(self._items) - len(kept)
+                self._items.clear()
+                self._items.extend(kept)
+                self.waiting_for_keyframe = True
+                self.resyncs += 1
+            if self.waiting_for_keyframe and not message.essential:
+                if not (media and message.keyframe):
+                    self.dropped += 1
+                    return
+                self.waiting_for_keyframe = False
+            self._items.append((message, now))
+            self._cond.notify()
+
+    def run(self):
+        """Send queued messages until the client goes away."""
+        self.sock.settimeout(SEND_TIMEOUT)
+        try:
+            while not self.closed:
+                with self._cond:
+                    self._cond.wait_for(
+                        lambda: self._items or self.closed, timeout=IDLE_POLL
+                    )
+                    batch = list(self._items)
+                    self._items.clear()
+                if batch:
+                    buffers = [part for message, _ in batch for part in message.parts]
+                    self.bytes_sent += send_buffers(self.sock, buffers)
+                    self.messages_sent += len(batch)
+                if select.select([self.sock], [], [], 0)[0]:
+                    self._handle_client_message()
+        except (OSError, ConnectionError):
+            pass  # The browser went away
+        finally:
+            self.close()
+
+    def _handle_client_message(self):
+        opcode, payload = read_websocket_message(self.sock)
+        if opcode == OPCODE_CLOSE:
+            self.sock.sendall(websocket_header(OPCODE_CLOSE, len(payload)) + payload)
+            self.closed = True
+        elif opcode == OPCODE_PING:
+            self.sock.sendall(websocket_header(OPCODE_PONG, len(payload)) + payload)
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._items.clear()
+            self._cond.notify()
+
+
+def websocket_message(opcode: int, payload: bytes) -> tuple:
+    return websocket_header(opcode, len(payload)), payload
+
+
+class WebViewer:
+    def __init__(
+        self,
+        max_lag: float = DEFAULT_MAX_LAG,
+        burned_in: bool = False,
+        gop_cache: int = MAX_GOP_CACHE,
+    ):
+        """burned_in: the video already has overlays, so the page starts with its own off.
+
+        gop_cache: most fragments kept since the last keyframe for joining browsers.
+        """
+        self.max_lag = max_lag
+        self.burned_in = burned_in
+        self.gop_cache = gop_cache
+        self.muxer = Fmp4Muxer()
+        self.server: Optional["WebViewerHTTPServer"] = None
+        self._lock = threading.Lock()
+        self._viewers: List[ViewerConnection] = []
+        self._sps: Optional[bytes] = None
+        self._pps: Optional[bytes] = None
+        self._setup: List[tuple] = []  # hello text + init segment
+        self._gop: List[QueuedMessage] = []
+        self.viewers_total = 0
+        self.access_units = 0
+        self.keyframes = 0
+        self.before_init = 0
+        self.bytes_muxed = 0
+        self.mux_seconds = 0.0
+        self.detection_messages = 0
+        self.finished_bytes_sent = 0
+        self.finished_dropped = 0
+        self.finished_resyncs = 0
+
+    def push_access_unit(self, nals: List[bytes], pts: float):
+        """Encoder path: one access unit (NAL units without start codes) at pts seconds."""
+        started = time.monotonic()
+        types = [nal[0] & 0x1F for nal in nals]
+        if NAL_TYPE_SPS in types and NAL_TYPE_PPS in types:
+            sps = nals[types.index(NAL_TYPE_SPS)]
+            pps = nals[types.index(NAL_TYPE_PPS)]
+            if (sps, pps) != (self._sps, self._pps):
+                self._new_parameter_sets(sps, pps)
+        if not self._setup:
+            self.before_init += 1  # Nothing decodable until the first SPS/PPS
+            return
+        keyframe = NAL_TYPE_IDR in types
+        fragment = self.muxer.fragment(nals, pts, keyframe)
+        message = QueuedMessage(websocket_message(OPCODE_BINARY, fragment), keyframe)
+        with self._lock:
+            if keyframe:
+                self._gop = [message]
+            elif self._gop and len(self._gop) < self.gop_cache:
+                self._gop.append(message)
+            else:
+                self._gop = []  # No keyframe in reach; joiners wait for the next
+            viewers = list(self._viewers)
+        for viewer in viewers:
+            viewer.enqueue(message)
+        self.access_units += 1
+        self.keyframes += keyframe
+        self.bytes_muxed += len(fragment)
+        self.mux_seconds += time.monotonic() - started
+
+    def _new_parameter_sets(self, sps: bytes, pps: bytes):
+        """First SPS/PPS, or a change of resolution: a new init segment for everyone."""
+        width, height = sps_dimensions(sps)
+        hello = {
+            "type": "hello",
+            "codec": codec_string(sps),
+            "width": width,
+            "height": height,
+            "burned_in": self.burned_in,
+        }
+        setup = [
+            websocket_message(OPCODE_TEXT, json.dumps(hello).encode()),
+            websocket_message(OPCODE_BINARY, self.muxer.init_segment(sps, pps)),
+        ]
+        with self._lock:
+            self._sps, self._pps = sps, pps
+            self._setup = setup
+            self._gop = []
+            viewers = list(self._viewers)
+        for viewer in viewers:
+            for parts in setup:
+                viewer.enqueue(QueuedMessage(parts, essential=True))
+
+    def push_detections(
+        self, pts: float, records: List[dict], audio: Optional[dict] = None
+    ):
+        """Capture path: detections (and audio levels) for the frame at pts seconds; free without viewers."""
+        if not self._viewers:
+            return
+        message = {
+            "type": "detections",
+            "pts": round(pts, 4),
+            "wall": round(time.time(), 4),
+            "detections": records,
+        }
+        if audio:
+            message["audio"] = audio
+        queued = QueuedMessage(
+            websocket_message(OPCODE_TEXT, json.dumps(message).encode())
+        )
+        with self._lock:
+            viewers = list(self._viewers)
+        for viewer in viewers:
+            viewer.enqueue(queued, media=False)
+        self.detection_messages += 1
+
+    def add_viewer(self, viewer: ViewerConnection):
+        """Queue the setup and the current GOP for a new viewer, then register it."""
+        with self._lock:
+            for parts in self._setup:
+                viewer.enqueue(QueuedMessage(parts, essential=True))
+            if self._gop:
+                for message in self._gop:
+                    viewer.enqueue(message)
+            else:
+                viewer.waiting_for_keyframe = True
+            self._viewers.append(viewer)
+            self.viewers_total += 1
+
+    def remove_viewer(self, viewer: ViewerConnection):
+        with self._lock:
+            if viewer in self._viewers:
+                self._viewers.remove(viewer)
+                self.finished_bytes_sent += viewer.bytes_sent
+                self.finished_dropped += viewer.dropped
+                self.finished_resyncs += viewer.resyncs
+
+    def serve(self, host: str, port: int):
+        """Serve the page and the stream on host:port from a daemon thread."""
+        self.server = WebViewerHTTPServer((host, port), self)
+        threading.Thread(
+            target=self.server.serve_forever, name="web-viewer-http", daemon=True
+        ).start()
+
+    def close(self):
+        with self._lock:
+            viewers = list(self._viewers)
+        for viewer in viewers:
+            viewer.close()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def cached_bytes(self) -> int:
+        """Bytes held since the last keyframe for browsers that join."""
+        with self._lock:
+            return sum(len(part) for message in self._gop for part in message.parts)
+
+    def stats(self) -> dict:
+        with self._lock:
+            viewers = list(self._viewers)
+        return {
+            "viewers": len(viewers),
+            "viewers_total": self.viewers_total,
+            "access_units": self.access_units,
+            "keyframes": self.keyframes,
+            "before_init": self.before_init,
+            "bytes_muxed": self.bytes_muxed,
+            "mux_ms": (
+                round(1000 * self.mux_seconds / self.access_units, 3)
+                if self.access_units
+                else 0.0
+            ),
+            "detection_messages": self.detection_messages,
+            "bytes_sent": self.finished_bytes_sent
+            + sum(viewer.bytes_sent for viewer in viewers),
+            "dropped": self.finished_dropped
+            + sum(viewer.dropped for viewer in viewers),
+            "resyncs": self.finished_resyncs
+            + sum(viewer.resyncs for viewer in viewers),
+        }
+
+
+class WebViewerHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # A dashboard may open many viewers at once
+
+    def __init__(self, address, viewer: WebViewer):
+        super().__init__(address, WebViewerHandler)
+        self.viewer = viewer
+
+
+class WebViewerHandler(http.server.BaseHTTPRequestHandler):
+    def setup(self):
+        super().setup()
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), VIEWER_NICE)
+        except OSError:
+            pass  # Already lower, or not allowed; the viewer works either way
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        hub: WebViewer = self.server.viewer
+        if path == "/ws":
+            self._websocket(hub)
+        elif path in ("/", "/index.html"):
+            try:
+                with open(PAGE_PATH, "rb") as f:
+                    page = f.read()
+            except OSError as e:
+                self._reply(500, "text/plain", f"Viewer page missing: {e}\n".encode())
+                return
+            self._reply(200, "text/html; charset=utf-8", page)
+        elif path == "/stats":
+            self._reply(200, "application/json", json.dumps(hub.stats()).encode())
+        else:
+            self._reply(404, "text/plain", b"Try / or /stats\n")
+
+    def _websocket(self, hub: WebViewer):
+        key = self.headers.get("Sec-WebSocket-Key")
+        if self.headers.get("Upgrade", "").lower() != "websocket" or not key:
+            self._reply(400, "text/plain", b"Expected a WebSocket upgrade\n")
+            return
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", websocket_accept(key))
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        viewer = ViewerConnection(self.connection, self.client_address, hub.max_lag)
+        hub.add_viewer(viewer)
+        try:
+            viewer.run()
+        finally:
+            hub.remove_viewer(viewer)
+
+    def _reply(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def env_port(name: str) -> Optional[int]:
+    """A port from the environment; None (off) when unset or invalid."""
+    value = os.environ.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Invalid {name}. Leaving it off.", file=sys.stderr)
+        return None
+
+
+def add_web_viewer_arguments(parser: argparse.ArgumentParser):
+    """Command-line options shared by the scripts that serve the browser viewer."""
+    parser.add_argument(
+        "--web-port",
+        type=int,
+        default=env_port("WEB_VIEWER_PORT"),
+        help="Serve a browser viewer of the PC stream on this HTTP port (env: WEB_VIEWER_PORT; unset: off)",
+    )
+    parser.add_argument(
+        "--web-host",
+        default=os.environ.get("WEB_VIEWER_HOST", DEFAULT_WEB_HOST),
+        help=f"Address for the browser viewer (env: WEB_VIEWER_HOST, default: {DEFAULT_WEB_HOST})",
+    )
+    parser.add_argument(
+        "--web-max-lag",
+        type=float,
+        default=DEFAULT_MAX_LAG,
+        help=f"Seconds a browser may fall behind before it skips to the next keyframe (default: {DEFAULT_MAX_LAG})",
+    )
+
+
+def web_viewer_from_args(
+    args: argparse.Namespace, burned_in: bool = True, gop_cache: int = MAX_GOP_CACHE
+) -> Optional[WebViewer]:
+    """A serving WebViewer for --web-port, otherwise None."""
+    if not args.web_port:
+        return None
+    viewer = WebViewer(args.web_max_lag, burned_in, gop_cache)
+    try:
+        viewer.serve(args.web_host, args.web_port)
+    except OSError as e:
+        print(
+            f"Warning: web viewer not started on port {args.web_port}: {e}",
+            file=sys.stderr,
+        )
+        return None
+    print(f"Browser viewer at http://{args.web_host}:{args.web_port}/")
+    return viewer
+
+
+class WebFrameOutput:
+    """picamera2 encoder output that feeds a WebViewer.
+
+    Use it as WebViewerOutput, which adds picamera2's Output base class on first use.
+    """
+
+    def __init__(self, viewer: WebViewer):
+        super().__init__()
+        self.viewer = viewer
+
+    def outputframe(
+        self, frame, keyframe=True, timestamp=None, packet=None, audio=False
+    ):
+        """picamera2 timestamps are microseconds since the encoder's first frame."""
+        if audio:
+            return
+        if timestamp is None:
+            timestamp = int(time.monotonic() * 1_000_000)
+        self.viewer.push_access_unit(split_annexb(bytes(frame)), timestamp / 1e6)
+
+
+def __getattr__(name: str):
+    """Build WebViewerOutput when first asked for, so importing this module skips picamera2."""
+    if name != "WebViewerOutput":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    try:
+        from picamera2.outputs import Output
+    except ImportError:  # Allows loopback use on machines without picamera2
+        Output = object
+    web_output = type("WebViewerOutput", (WebFrameOutput, Output), {})
+    globals()["WebViewerOutput"] = web_output
+    return web_output
+
+
+def synthetic_access_units(
+    width: int, height: int, fps: int, gop: int, kbps: int
+) -> Callable[[int], List[bytes]]:
+    """index -> access unit of a stream with a real SPS/PPS and random slice data."""
+    writer = BitWriter()
+    writer.bits(66, 8)  # profile_idc: Baseline
+    writer.bits(0xC0, 8)  # constraint_set0/1
+    writer.bits(31, 8)  # level_idc 3.1
+    for value in (0, 0, 2, 1):  # sps id, log2_max_frame_num-4, poc type 2, refs
+        writer.ue(value)
+    writer.bits(0, 1)
+    writer.ue((width + 15) // 16 - 1)
+    writer.ue((height + 15) // 16 - 1)
+    writer.bits(0b11, 2)  # frame_mbs_only, direct_8x8_inference
+    crop = (-height % 16) // 2
+    writer.bits(1 if crop else 0, 1)
+    if crop:
+        for value in (0, 0, 0, crop):
+            writer.ue(value)
+    writer.bits(0, 1)  # no VUI
+    sps = bytes([0x67]) + writer.rbsp()
+    pps = bytes([0x68, 0xCE, 0x38, 0x80])
+    rng = random.Random(0)
+    frame_bytes = kbps * 1000 // 8 // fps
+    keyframe = rng.randbytes(frame_bytes * 4).replace(b"\x00", b"\x01")
+    delta = rng.randbytes(frame_bytes // 2).replace(b"\x00", b"\x01")
+
+    def access_unit(index: int) -> List[bytes]:
+        if index % gop == 0:
+            return [sps, pps, bytes([0x65, 0x88]) + keyframe]
+        return [bytes([0x41, 0x9A]) + delta]
+
+    return access_unit
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def websocket_connect(host: str, port: int, path: str = "/ws") -> socket.socket:
+    sock = socket.create_connection((host, port), timeout=5)
+    key = base64.b64encode(os.urandom(16)).decode()
+    sock.sendall(
+        (
+            f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\n"
+            f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+        ).encode()
+    )
+    response = b""
+    while b"\r\n\r\n" not in response:
+        chunk = sock.recv(1)
+        if not chunk:
+            raise ConnectionError("closed during handshake")
+        response += chunk
+    if websocket_accept(key).encode() not in response:
+        raise ConnectionError(f"bad handshake: {response.splitlines()[0]!r}")
+    return sock
+
+
+def clients(args):
+    """Loopback viewers: read the stream and report latency from detection stamps."""
+    stop_at = time.monotonic() + args.seconds
+    latencies: List[float] = []
+    received = [0, 0]  # bytes, fragments
+    errors: List[str] = []
+    lock = threading.Lock()
+
+    def viewer():
+        try:
+            sock = websocket_connect(args.host, args.port)
+        except (OSError, ConnectionError) as e:
+            with lock:
+                errors.append(str(e))
+            return
+        mine: List[float] = []
+        nbytes = fragments = 0
+        sock.settimeout(1.0)  # The load test may stop pushing before we stop reading
+        try:
+            while time.monotonic() < stop_at:
+                try:
+                    opcode, payload = read_websocket_message(sock)
+                except socket.timeout:
+                    continue
+                if opcode == OPCODE_TEXT:
+                    message = json.loads(payload)
+                    if message["type"] == "detections":
+                        mine.append(time.time() - message["wall"])
+                elif opcode == OPCODE_BINARY:
+                    nbytes += len(payload)
+                    fragments += payload[4:8] == b"moof"
+        except (OSError, ConnectionError) as e:
+            with lock:
+                errors.append(str(e))
+        finally:
+            sock.close()
+        with lock:
+            latencies.extend(mine)
+            received[0] += nbytes
+            received[1] += fragments
+
+    threads = [threading.Thread(target=viewer) for _ in range(args.count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(
+        json.dumps(
+            {
+                "latency_p50_ms": (
+                    round(1000 * percentile(latencies, 0.5), 2) if latencies else None
+                ),
+                "latency_p99_ms": (
+                    round(1000 * percentile(latencies, 0.99), 2) if latencies else None
+                ),
+                "bytes": received[0],
+                "fragments": received[1],
+                "errors": errors[:3],
+            }
+        )
+    )
+    return 0
+
+
+def cpu_seconds(who: int = resource.RUSAGE_SELF) -> float:
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def loadtest(args):
+    """One synthetic encode fanned out to a growing number of loopback viewers."""
+    hub = WebViewer()
+    hub.serve("127.0.0.1", 0)
+    port = hub.server.server_address[1]
+    access_unit = synthetic_access_units(
+        args.width, args.height, args.fps, args.gop, args.kbps
+    )
+    index = 0
+    print(
+        f"{args.width}x{args.height} at {args.fps} fps, {args.kbps} kbps, "
+        f"{args.seconds:.0f} s per step; clients run in a separate process"
+    )
+    print(
+        f"  {'viewers':>7} {'server cpu':>10} {'per viewer':>10} {'push p50':>9} "
+        f"{'push p99':>9} {'latency p50':>11} {'p99':>8} {'Mbit/s out':>10} {'drops':>6}"
+    )
+    for count in [int(value) for value in args.viewers.split(",")]:
+        child = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "clients",
+                "--port",
+                str(port),
+                "--count",
+                str(count),
+                "--seconds",
+                str(args.seconds + 1.0),
+            ],
+            stdout=subprocess.PIPE,
+        )
+        deadline = time.monotonic() + 5
+        while hub.stats()["viewers"] < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        before = hub.stats()
+        push_times: List[float] = []
+        cpu_before = cpu_seconds()
+        started = time.monotonic()
+        frames = 0
+        while time.monotonic() - started < args.seconds:
+            delay = started + frames / args.fps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            push_started = time.monotonic()
+            pts = index / args.fps
+            hub.push_access_unit(access_unit(index), pts)
+            hub.push_detections(pts, [{"label": "person", "box": [40, 40, 120, 90]}])
+            push_times.append(time.monotonic() - push_started)
+            index += 1
+            frames += 1
+        elapsed = time.monotonic() - started
+        cpu = cpu_seconds() - cpu_before
+        after = hub.stats()
+        result = json.loads(child.communicate()[0] or b"{}")
+        sent = after["bytes_sent"] - before["bytes_sent"]
+        print(
+            f"  {count:>7} {100 * cpu / elapsed:>9.1f}% {100 * cpu / elapsed / count:>9.2f}% "
+            f"{1000 * percentile(push_times, 0.5):>7.3f}ms {1000 * percentile(push_times, 0.99):>7.3f}ms "
+            f"{result.get('latency_p50_ms')!s:>9}ms {result.get('latency_p99_ms')!s:>6}ms "
+            f"{8 * sent / elapsed / 1e6:>10.1f} {after['dropped'] - before['dropped']:>6}"
+        )
+        if result.get("errors"):
+            print(f"    client errors: {result['errors']}")
+        deadline = time.monotonic() + 5
+        while hub.stats()["viewers"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+    hub.close()
+    print(f"  {hub.stats()}")
+    return 0
+
+
+def serve(args):
+    """Play a recorded Annex B clip to browsers in a loop, e.g. to try the page."""
+    with open(args.clip, "rb") as f:
+        access_units = list(iter_access_units(f.read()))
+    if not access_units:
+        print(f"Error: no H.264 access units in {args.clip}", file=sys.stderr)
+        return 1
+    viewer = web_viewer_from_args(args, burned_in=False)
+    if not viewer:
+        return 1
+    index = 0
+    started = time.monotonic()
+    try:
+        while True:
+            delay = started + index / args.fps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            viewer.push_access_unit(
+                access_units[index % len(access_units)], index / args.fps
+            )
+            index += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        viewer.close()
+        print(f"Web viewer stats: {viewer.stats()}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Browser viewer: H.264 as fragmented MP4 over WebSocket"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    load = subparsers.add_parser(
+        "loadtest", help="Latency and CPU with a growing number of loopback viewers"
+    )
+    load.add_argument("--viewers", default="1,2,4,8,16,32")
+    load.add_argument("--seconds", type=float, default=5.0)
+    load.add_argument("--width", type=int, default=1280)
+    load.add_argument("--height", type=int, default=720)
+    load.add_argument("--fps", type=int, default=30)
+    load.add_argument("--gop", type=int, default=60)
+    load.add_argument("--kbps", type=int, default=2500)
+    client_parser = subparsers.add_parser(
+        "clients", help="Loopback viewers for loadtest (prints JSON)"
+    )
+    client_parser.add_argument("--host", default="127.0.0.1")
+    client_parser.add_argument("--port", type=int, required=True)
+    client_parser.add_argument("--count", type=int, default=1)
+    client_parser.add_argument("--seconds", type=float, default=5.0)
+    serve_parser = subparsers.add_parser(
+        "serve", help="Play a recorded Annex B clip to browsers (no camera)"
+    )
+    serve_parser.add_argument("clip")
+    serve_parser.add_argument("--fps", type=int, default=30)
+    add_web_viewer_arguments(serve_parser)
+    args = parser.parse_args()
+    if args.command == "serve" and not args.web_port:
+        parser.error("serve needs --web-port (or WEB_VIEWER_PORT)")
+    commands = {"loadtest": loadtest, "clients": clients, "serve": serve}
+    return commands[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())